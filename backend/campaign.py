@@ -0,0 +1,389 @@
+"""
+Coding Campaigns
+One coding plan applied to many vehicles concurrently, each on its own connection
+"""
+
+import asyncio
+import random
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, List, Optional
+import logging
+
+from enet import ENETConnection
+from g01_x3_b48_module import G01ECUManager, G01_X3_B48_CONFIG
+from coding_plan import CodingPlan, execute_plan
+
+logger = logging.getLogger(__name__)
+
+ENET_PORT = 6801
+
+# Vehicles coded at once unless the request says otherwise, and the ceiling
+DEFAULT_PARALLELISM = 4
+MAX_PARALLELISM = 32
+
+# Further attempts after a failed one; the vehicle's slot is free while it
+# waits RETRY_DELAY * 2^n (jittered) so the rest of the fleet keeps going
+DEFAULT_RETRIES = 2
+RETRY_DELAY = 2.0
+
+# One attempt (connect, VIN check, plan) is abandoned after this long
+ATTEMPT_TIMEOUT = 120.0
+
+# Finished campaigns kept for GET /campaigns
+MAX_FINISHED = 50
+
+DID_VIN = 0xF190
+
+# Vehicle states
+PENDING = "pending"
+RUNNING = "running"
+RETRY_WAIT = "retry_wait"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+FINAL_STATES = (SUCCEEDED, FAILED, CANCELLED)
+
+class VehicleMismatch(Exception):
+    """The car at a gateway is not the one the campaign lists; never retried"""
+
+# ============================================================================
+# VEHICLES
+# ============================================================================
+
+@dataclass
+class CampaignVehicle:
+    """One car of a campaign and how its coding went"""
+    gateway: str  # ENET address, "ip" or "ip:port"
+    vin: Optional[str] = None  # Expected VIN; checked before anything is written
+    state: str = PENDING
+    attempts: int = 0
+    error: Optional[str] = None
+    result: Optional[Dict] = None
+    vin_read: Optional[str] = None
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+
+    @property
+    def address(self) -> tuple:
+        host, _, port = self.gateway.partition(":")
+        return host, int(port or ENET_PORT)
+
+    def to_dict(self) -> Dict:
+        elapsed = None
+        if self.started_at is not None:
+            elapsed = round((self.finished_at or time.monotonic()) - self.started_at, 2)
+        return {
+            "gateway": self.gateway,
+            "vin": self.vin,
+            "vin_read": self.vin_read,
+            "state": self.state,
+            "attempts": self.attempts,
+            "error": self.error,
+            "elapsed_s": elapsed,
+            "result": self.result,
+        }
+
+# ============================================================================
+# CAMPAIGN
+# ============================================================================
+
+class Campaign:
+    """
+    Runs a coding plan on every vehicle, at most `parallelism` at a time
+
+    Each vehicle gets its own connection and ECU manager, so a car that
+    hangs, drops its link or rejects a write affects nobody else. A failed
+    attempt gives up its slot before retrying; a VIN mismatch is final.
+
+    Args:
+        connect: Builds an unconnected transport for a vehicle; by default an
+                 ENETConnection on the campaign's own socket thread pool,
+                 without traffic capture or session recording
+        on_vehicle_done: Awaited once per vehicle when it reaches a final state
+    """
+
+    def __init__(self, plan: CodingPlan, vehicles: List[CampaignVehicle],
+                 modifications: Optional[List[str]] = None,
+                 parallelism: int = DEFAULT_PARALLELISM, retries: int = DEFAULT_RETRIES,
+                 verify: bool = True, retry_delay: float = RETRY_DELAY, catalog=None,
+                 connect: Optional[Callable[[CampaignVehicle], object]] = None,
+                 on_vehicle_done: Optional[Callable[["Campaign", CampaignVehicle], Awaitable[None]]] = None):
+        if not vehicles:
+            raise ValueError("Campaign has no vehicles")
+        gateways = [v.gateway for v in vehicles]
+        if len(set(gateways)) != len(gateways):
+            raise ValueError("A gateway is listed more than once")
+        self.id = str(uuid.uuid4())
+        self.plan = plan
+        self.modifications = modifications or [m for ecu in plan.ecus for m in ecu.modifications]
+        self.vehicles = vehicles
+        self.parallelism = min(MAX_PARALLELISM, max(1, parallelism))
+        self.retries = max(0, retries)
+        self.verify = verify
+        self.retry_delay = retry_delay
+        self.catalog = catalog
+        self.connect = connect or self._enet_connection
+        self.on_vehicle_done = on_vehicle_done
+        self.created_at = datetime.utcnow()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self._gate = asyncio.Semaphore(self.parallelism)
+        self._task: Optional[asyncio.Task] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def _enet_connection(self, vehicle: CampaignVehicle) -> ENETConnection:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.parallelism, thread_name_prefix="campaign")
+        # Kept out of the process-wide capture and session recording, which
+        # belong to the interactive connection
+        return ENETConnection(*vehicle.address, executor=self._executor, capture=None, recorder=None)
+
+    def start(self):
+        self.started_at = time.monotonic()
+        self._task = asyncio.create_task(self._run())
+
+    async def wait(self):
+        if self._task:
+            await asyncio.shield(self._task)
+
+    async def cancel(self):
+        if self._task and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def _run(self):
+        try:
+            await asyncio.gather(*(self._vehicle(vehicle) for vehicle in self.vehicles))
+        finally:
+            self.finished_at = time.monotonic()
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+            summary = self.summary()
+            logger.info(f"Campaign {self.id}: {summary['succeeded']}/{summary['total']} vehicles coded, "
+                        f"{summary['failed']} failed in {summary['elapsed_s']} s")
+
+    async def _vehicle(self, vehicle: CampaignVehicle):
+        try:
+            for attempt in range(self.retries + 1):
+                async with self._gate:
+                    if vehicle.started_at is None:
+                        vehicle.started_at = time.monotonic()
+                    vehicle.state = RUNNING
+                    vehicle.attempts += 1
+                    try:
+                        vehicle.result = await asyncio.wait_for(self._attempt(vehicle), ATTEMPT_TIMEOUT)
+                        vehicle.state = SUCCEEDED
+                        vehicle.error = None
+                        return
+                    except VehicleMismatch as e:
+                        vehicle.state = FAILED
+                        vehicle.error = str(e)
+                        return
+                    except asyncio.TimeoutError:
+                        vehicle.error = f"No result within {ATTEMPT_TIMEOUT:.0f} s"
+                    except Exception as e:
+                        vehicle.error = f"{type(e).__name__}: {e}"
+                logger.warning(f"Campaign {self.id}: {vehicle.gateway} attempt {vehicle.attempts} failed: {vehicle.error}")
+
+                if attempt < self.retries:
+                    vehicle.state = RETRY_WAIT
+                    await asyncio.sleep(self.retry_delay * (2 ** attempt) * random.uniform(0.5, 1.0))
+            vehicle.state = FAILED
+        except asyncio.CancelledError:
+            vehicle.state = CANCELLED
+            raise
+        finally:
+            vehicle.finished_at = time.monotonic()
+            if self.on_vehicle_done and vehicle.state in FINAL_STATES:
+                try:
+                    await self.on_vehicle_done(self, vehicle)
+                except Exception as e:
+                    logger.error(f"Campaign {self.id}: result hook for {vehicle.gateway} failed: {e}")
+
+    async def _attempt(self, vehicle: CampaignVehicle) -> Dict:
+        connection = self.connect(vehicle)
+        try:
+            if not await connection.connect():
+                raise ConnectionError(f"Could not connect to {vehicle.gateway}")
+            manager = G01ECUManager(connection, catalog=self.catalog)
+
+            data = await manager.read_parameter(G01_X3_B48_CONFIG["ecu_addresses"]["DME"], DID_VIN)
+            if not data:
+                raise ConnectionError(f"No VIN from {vehicle.gateway}")
+            vehicle.vin_read = data[:17].decode("ascii", errors="replace")
+            if vehicle.vin and vehicle.vin_read != vehicle.vin:
+                raise VehicleMismatch(f"Expected VIN {vehicle.vin}, gateway {vehicle.gateway} has {vehicle.vin_read}")
+
+            result = await execute_plan(manager, self.plan, verify=self.verify)
+            if not result["success"]:
+                failed = [r["ecu"] for r in result["ecus"] if not r["success"]]
+                raise RuntimeError(f"Coding failed on {', '.join(failed)}")
+            return result
+        finally:
+            connection.disconnect()
+
+    def summary(self) -> Dict:
+        counts = {state: 0 for state in (PENDING, RUNNING, RETRY_WAIT, SUCCEEDED, FAILED, CANCELLED)}
+        for vehicle in self.vehicles:
+            counts[vehicle.state] += 1
+        done = counts[SUCCEEDED] + counts[FAILED] + counts[CANCELLED]
+
+        elapsed = None
+        rate = None
+        if self.started_at is not None:
+            elapsed = (self.finished_at or time.monotonic()) - self.started_at
+            rate = round(counts[SUCCEEDED] / elapsed * 60, 2) if elapsed > 0 else None
+        return {
+            "id": self.id,
+            "modifications": self.modifications,
+            "created_at": self.created_at.isoformat(),
+            "parallelism": self.parallelism,
+            "retries": self.retries,
+            "active": self.running,
+            "total": len(self.vehicles),
+            **counts,
+            "progress": round(done / len(self.vehicles), 3),
+            "elapsed_s": round(elapsed, 2) if elapsed is not None else None,
+            "vehicles_per_min": rate,
+        }
+
+    def to_dict(self) -> Dict:
+        return {
+            **self.summary(),
+            "plan": self.plan.to_dict(),
+            "vehicles": [vehicle.to_dict() for vehicle in self.vehicles],
+        }
+
+class CampaignManager:
+    """Registry of campaigns; the oldest finished ones are forgotten first"""
+
+    def __init__(self, max_finished: int = MAX_FINISHED):
+        self.campaigns: Dict[str, Campaign] = {}
+        self.max_finished = max_finished
+
+    def start(self, campaign: Campaign) -> Campaign:
+        finished = [c for c in self.campaigns.values() if not c.running]
+        for old in finished[:max(0, len(finished) - self.max_finished + 1)]:
+            del self.campaigns[old.id]
+        self.campaigns[campaign.id] = campaign
+        campaign.start()
+        return campaign
+
+    def get(self, campaign_id: str) -> Optional[Campaign]:
+        return self.campaigns.get(campaign_id)
+
+    async def cancel(self, campaign_id: str) -> bool:
+        campaign = self.campaigns.get(campaign_id)
+        if campaign is None:
+            return False
+        await campaign.cancel()
+        return True
+
+    async def cancel_all(self):
+        for campaign in list(self.campaigns.values()):
+            await campaign.cancel()
+
+CAMPAIGNS = CampaignManager()
+
+# ============================================================================
+# EXPORT
+# ============================================================================
+
+__all__ = [
+    'DEFAULT_PARALLELISM',
+    'MAX_PARALLELISM',
+    'DEFAULT_RETRIES',
+    'VehicleMismatch',
+    'CampaignVehicle',
+    'Campaign',
+    'CampaignManager',
+    'CAMPAIGNS',
+]
+
+if __name__ == "__main__":
+    import struct
+    from coding_plan import compile_plan
+
+    CARS = 16
+    SERVICE_TIME = 0.01   # Per UDS request inside the car
+    FLAKY = {3, 9}        # These cars drop the link on their first attempt
+
+    class SimulatedCar:
+        """Raw UDS over TCP like a gateway on ENET: 0x22 (multi-DID), 0x10, 0x27, 0x2E"""
+
+        def __init__(self, index: int):
+            self.vin = f"WBATEST{index:010d}"
+            self.values = {DID_VIN: self.vin.encode()}
+            self.drops = 1 if index in FLAKY else 0
+            self.requests = 0
+
+        def answer(self, message: bytes) -> bytes:
+            sid = message[0]
+            if sid == 0x22:
+                dids = [struct.unpack('>H', message[i:i + 2])[0] for i in range(1, len(message) - 1, 2)]
+                if any(did not in self.values for did in dids):
+                    return bytes([0x7F, sid, 0x31])
+                return b'\x62' + b''.join(struct.pack('>H', did) + self.values[did] for did in dids)
+            if sid == 0x2E:
+                self.values[struct.unpack('>H', message[1:3])[0]] = message[3:]
+                return b'\x6E' + message[1:3]
+            if sid == 0x27:
+                return bytes([0x67, message[1]]) + (b'\x12\x34\x56\x78' if message[1] % 2 else b'')
+            return bytes([sid + 0x40]) + message[1:2]
+
+        async def serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+            try:
+                while True:
+                    message = await reader.read(4096)
+                    if not message:
+                        break
+                    self.requests += 1
+                    if self.drops and self.requests == 5:
+                        self.drops -= 1
+                        break
+                    await asyncio.sleep(SERVICE_TIME)
+                    writer.write(self.answer(message))
+                    await writer.drain()
+            finally:
+                writer.close()
+
+    async def run(parallelism: int, plan: CodingPlan) -> Dict:
+        cars, servers, vehicles = [], [], []
+        for i in range(CARS):
+            car = SimulatedCar(i)
+            server = await asyncio.start_server(car.serve, "127.0.0.1", 0)
+            cars.append(car)
+            servers.append(server)
+            vehicles.append(CampaignVehicle(f"127.0.0.1:{server.sockets[0].getsockname()[1]}", car.vin))
+
+        campaign = Campaign(plan, vehicles, parallelism=parallelism, retry_delay=0.1)
+        campaign.start()
+        await campaign.wait()
+        for server in servers:
+            server.close()
+            await server.wait_closed()
+        return campaign.summary()
+
+    async def main():
+        plan = compile_plan(["VIDEO_IN_MOTION", "EXHAUST_FLAPS", "ANGEL_EYES_BRIGHTNESS"])
+        print(f"{CARS} cars, {plan.writes} writes on {len(plan.ecus)} ECUs each, "
+              f"{SERVICE_TIME * 1000:.0f} ms per request, {len(FLAKY)} cars drop their first attempt\n")
+        print(f"{'parallel':>8}{'coded':>7}{'failed':>8}{'seconds':>9}{'cars/min':>10}")
+        for parallelism in (1, 4, 16):
+            s = await run(parallelism, plan)
+            print(f"{parallelism:>8}{s['succeeded']:>7}{s['failed']:>8}{s['elapsed_s']:>9.2f}{s['vehicles_per_min']:>10.0f}")
+
+    logging.basicConfig(level=logging.CRITICAL)  # The flaky cars log every failed request
+    asyncio.run(main())
@@ -0,0 +1,199 @@
+"""
+Coding Plans
+Compile G01_CODING_PARAMS modifications into one write plan per ECU and execute it
+"""
+
+import time
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Optional
+import logging
+
+from g01_x3_b48_module import G01_CODING_PARAMS, G01_X3_B48_CONFIG, parameter_value
+
+logger = logging.getLogger(__name__)
+
+# Cheat sheet (frontend sheetId) -> G01 modifications. Sheets mapped to an
+# empty list have no G01 coding parameters yet.
+CHEAT_SHEETS = {
+    "scr1": ["SCR1_REMOTE_START"],
+    "angel_eyes": ["ANGEL_EYES_BRIGHTNESS"],
+    "exhaust_flaps": ["EXHAUST_FLAPS"],
+    "video_in_motion": ["VIDEO_IN_MOTION"],
+    "needle_sweep": [],
+    "drl_brightness": [],
+}
+
+# ============================================================================
+# PLAN
+# ============================================================================
+
+@dataclass
+class PlannedWrite:
+    did: int
+    value: bytes
+    source: str  # "MODIFICATION.PARAMETER"
+
+@dataclass
+class ECUPlan:
+    """Every write for one ECU; applied with a single unlock"""
+    ecu: str
+    address: int
+    writes: Dict[int, PlannedWrite] = field(default_factory=dict)
+    modifications: List[str] = field(default_factory=list)
+
+    @property
+    def values(self) -> Dict[int, bytes]:
+        """DID -> encoded value, in DID order"""
+        return {did: self.writes[did].value for did in sorted(self.writes)}
+
+    def to_dict(self) -> Dict:
+        return {
+            "ecu": self.ecu,
+            "address": f"0x{self.address:02X}",
+            "modifications": self.modifications,
+            "writes": [
+                {"did": f"0x{w.did:04X}", "value": w.value.decode(errors="replace"), "source": w.source}
+                for w in (self.writes[did] for did in sorted(self.writes))
+            ],
+        }
+
+@dataclass
+class CodingPlan:
+    ecus: List[ECUPlan] = field(default_factory=list)
+    conflicts: List[Dict] = field(default_factory=list)
+
+    @property
+    def writes(self) -> int:
+        return sum(len(plan.writes) for plan in self.ecus)
+
+    def to_dict(self) -> Dict:
+        return {
+            "ecus": [plan.to_dict() for plan in self.ecus],
+            "writes": self.writes,
+            "conflicts": self.conflicts,
+        }
+
+def compile_plan(modifications: Iterable[str],
+                 overrides: Optional[Dict[str, Dict[str, str]]] = None) -> CodingPlan:
+    """
+    Merge modifications into one ordered plan per ECU
+
+    Args:
+        modifications: G01_CODING_PARAMS names, applied in this order
+        overrides: modification -> parameter name -> value; parameters not
+                   listed get their enabled value
+
+    A DID set twice with the same value is written once. With different
+    values the later modification wins and the clash is listed in
+    plan.conflicts.
+
+    Raises:
+        ValueError: unknown modification or an override out of range
+    """
+    overrides = overrides or {}
+    by_ecu: Dict[str, ECUPlan] = {}
+    plan = CodingPlan()
+
+    for name in dict.fromkeys(modifications):
+        mod = G01_CODING_PARAMS.get(name)
+        if mod is None:
+            raise ValueError(f"Unknown modification: {name}")
+
+        ecu_plan = by_ecu.get(mod["ecu"])
+        if ecu_plan is None:
+            address = G01_X3_B48_CONFIG["ecu_addresses"][mod["ecu"]]
+            ecu_plan = by_ecu[mod["ecu"]] = ECUPlan(mod["ecu"], address)
+        ecu_plan.modifications.append(name)
+
+        values = overrides.get(name, {})
+        unknown = set(values) - {param["name"] for param in mod["parameters"]}
+        if unknown:
+            raise ValueError(f"{name} has no parameter {', '.join(sorted(unknown))}")
+        for param in mod["parameters"]:
+            write = PlannedWrite(
+                param["address"],
+                parameter_value(param, values.get(param["name"])),
+                f"{name}.{param['name']}",
+            )
+            previous = ecu_plan.writes.get(write.did)
+            if previous and previous.value != write.value:
+                plan.conflicts.append({
+                    "ecu": ecu_plan.ecu,
+                    "did": f"0x{write.did:04X}",
+                    "dropped": previous.source,
+                    "kept": write.source,
+                })
+                logger.warning(f"{write.source} overrides {previous.source} (DID {write.did:04X})")
+            ecu_plan.writes[write.did] = write
+
+    plan.ecus = sorted(by_ecu.values(), key=lambda p: p.address)
+    return plan
+
+def cheat_sheet_modifications(sheet_ids: Iterable[str]) -> List[str]:
+    """
+    Raises:
+        ValueError: unknown sheet or one without G01 coding parameters
+    """
+    modifications = []
+    for sheet_id in sheet_ids:
+        if sheet_id not in CHEAT_SHEETS:
+            raise ValueError(f"Unknown cheat sheet: {sheet_id}")
+        if not CHEAT_SHEETS[sheet_id]:
+            raise ValueError(f"Cheat sheet {sheet_id} has no G01 coding parameters")
+        modifications.extend(CHEAT_SHEETS[sheet_id])
+    return modifications
+
+# ============================================================================
+# EXECUTION
+# ============================================================================
+
+async def execute_plan(manager, plan: CodingPlan, verify: bool = True) -> Dict:
+    """
+    Apply a plan: per ECU one read-compare-write (single unlock), ECUs in plan order
+
+    ECUs run one after another: the manager's UDS calls carry no ECU
+    address, so every transport talks to one ECU at a time.
+    """
+    async def run(ecu_plan: ECUPlan) -> Dict:
+        start = time.perf_counter()
+        try:
+            result = (await manager.apply_values(ecu_plan.address, ecu_plan.values, verify=verify)).to_dict()
+        except Exception as e:
+            logger.error(f"Coding plan for {ecu_plan.ecu} failed: {e}")
+            result = {"success": False, "error": str(e)}
+        return {
+            "ecu": ecu_plan.ecu,
+            "modifications": ecu_plan.modifications,
+            "elapsed_ms": round((time.perf_counter() - start) * 1000, 1),
+            **result,
+        }
+
+    start = time.perf_counter()
+    results = [await run(ecu_plan) for ecu_plan in plan.ecus]
+    elapsed = time.perf_counter() - start
+
+    success = all(r["success"] for r in results)
+    logger.info(
+        f"Coding plan: {len(plan.ecus)} ECUs, {plan.writes} writes, "
+        f"{'ok' if success else 'FAILED'} in {elapsed * 1000:.0f} ms"
+    )
+    return {
+        "success": success,
+        "ecus": results,
+        "conflicts": plan.conflicts,
+        "elapsed_ms": round(elapsed * 1000, 1),
+    }
+
+# ============================================================================
+# EXPORT
+# ============================================================================
+
+__all__ = [
+    'CHEAT_SHEETS',
+    'PlannedWrite',
+    'ECUPlan',
+    'CodingPlan',
+    'compile_plan',
+    'cheat_sheet_modifications',
+    'execute_plan',
+]
@@ -0,0 +1,238 @@
+"""
+ECU Coding Snapshots
+Compressed per-VIN / per-ECU backups of coding DIDs with block hashes and differential restore
+"""
+
+import hashlib
+import struct
+import time
+import uuid
+import zlib
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Dict, List, Optional
+import logging
+
+from g01_x3_b48_module import G01_CODING_PARAMS, G01_X3_B48_CONFIG
+from request_scheduler import BULK, request_priority
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_COLLECTION = "coding_snapshots"
+
+SNAPSHOT_MAGIC = b"BMWCSNP1"
+
+# Block record: DID, data length
+BLOCK_HEADER = struct.Struct('>HI')
+
+# ============================================================================
+# CODING DIDS
+# ============================================================================
+
+def coding_dids(ecu: str) -> List[int]:
+    """
+    Coding DIDs known for an ECU: every parameter address of the
+    G01_CODING_PARAMS modifications that target it
+    """
+    dids = {
+        param["address"]
+        for mod in G01_CODING_PARAMS.values()
+        if mod["ecu"] == ecu
+        for param in mod["parameters"]
+    }
+    return sorted(dids)
+
+def ecu_name(address: int) -> Optional[str]:
+    for name, candidate in G01_X3_B48_CONFIG["ecu_addresses"].items():
+        if candidate == address:
+            return name
+    return None
+
+# ============================================================================
+# SNAPSHOT
+# ============================================================================
+
+def block_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()[:16]
+
+@dataclass
+class CodingSnapshot:
+    """Coding blocks (DID -> raw data) of one ECU at one point in time"""
+    vin: str
+    ecu_address: int
+    blocks: Dict[int, bytes]
+    id: str = field(default_factory=lambda: str(uuid.uuid4()))
+    created: datetime = field(default_factory=datetime.utcnow)
+    missing: List[int] = field(default_factory=list)   # DIDs the ECU did not answer
+
+    def encode(self) -> bytes:
+        """Compact binary form: magic + zlib(DID/length/data records, sorted by DID)"""
+        raw = b"".join(
+            BLOCK_HEADER.pack(did, len(data)) + data
+            for did, data in sorted(self.blocks.items())
+        )
+        return SNAPSHOT_MAGIC + zlib.compress(raw, 9)
+
+    @staticmethod
+    def decode_blocks(encoded: bytes) -> Dict[int, bytes]:
+        if encoded[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+            raise ValueError("Not a coding snapshot")
+        raw = zlib.decompress(encoded[len(SNAPSHOT_MAGIC):])
+        blocks = {}
+        offset = 0
+        while offset < len(raw):
+            did, length = BLOCK_HEADER.unpack_from(raw, offset)
+            offset += BLOCK_HEADER.size
+            blocks[did] = raw[offset:offset + length]
+            offset += length
+        return blocks
+
+    def block_hashes(self) -> Dict[str, str]:
+        return {f"{did:04X}": block_hash(data) for did, data in sorted(self.blocks.items())}
+
+    @property
+    def digest(self) -> str:
+        """Content hash over all blocks; equal snapshots of any ECU/VIN share it"""
+        h = hashlib.sha256()
+        for did, data in sorted(self.blocks.items()):
+            h.update(BLOCK_HEADER.pack(did, len(data)) + data)
+        return h.hexdigest()
+
+    def to_document(self) -> dict:
+        encoded = self.encode()
+        return {
+            "_id": self.id,
+            "vin": self.vin,
+            "ecu": ecu_name(self.ecu_address),
+            "ecu_address": self.ecu_address,
+            "created": self.created,
+            "blocks": len(self.blocks),
+            "size": sum(len(d) for d in self.blocks.values()),
+            "compressed_size": len(encoded),
+            "sha256": self.digest,
+            "block_hashes": self.block_hashes(),
+            "missing": [f"{did:04X}" for did in self.missing],
+            "data": encoded,
+        }
+
+    @classmethod
+    def from_document(cls, doc: dict) -> "CodingSnapshot":
+        snapshot = cls(
+            vin=doc["vin"],
+            ecu_address=doc["ecu_address"],
+            blocks=cls.decode_blocks(bytes(doc["data"])),
+            id=doc["_id"],
+            created=doc["created"],
+            missing=[int(did, 16) for did in doc.get("missing", [])],
+        )
+        if snapshot.digest != doc["sha256"]:
+            raise ValueError(f"Snapshot {doc['_id']} is corrupt (content hash mismatch)")
+        return snapshot
+
+def summarize(doc: dict) -> dict:
+    """Snapshot document without the payload, for listings"""
+    summary = {k: v for k, v in doc.items() if k not in ("data", "block_hashes")}
+    summary["id"] = summary.pop("_id")
+    return summary
+
+def _throughput(blocks: int, size: int, requests: int, elapsed: float) -> dict:
+    elapsed = max(elapsed, 1e-9)
+    return {
+        "blocks": blocks,
+        "bytes": size,
+        "requests": requests,
+        "elapsed_ms": round(elapsed * 1000, 1),
+        "blocks_per_s": round(blocks / elapsed, 1),
+        "bytes_per_s": round(size / elapsed, 1),
+    }
+
+# ============================================================================
+# TAKE / RESTORE
+# ============================================================================
+
+async def take_snapshot(manager, vin: str, ecu_address: int, dids: List[int]) -> tuple:
+    """
+    Read every DID into a snapshot (BULK class)
+
+    Block lengths are not known up front, so each DID is its own 0x22
+    request; they go back to back, and over ENET one at a time.
+
+    Returns:
+        (CodingSnapshot, throughput dict)
+    """
+    start = time.perf_counter()
+    with request_priority(BULK):
+        blocks = await manager.read_blocks(ecu_address, dids)
+    elapsed = time.perf_counter() - start
+
+    snapshot = CodingSnapshot(
+        vin=vin,
+        ecu_address=ecu_address,
+        blocks=blocks,
+        missing=[did for did in dids if did not in blocks],
+    )
+    if snapshot.missing:
+        logger.warning(f"Snapshot of ECU 0x{ecu_address:02X}: no answer for {len(snapshot.missing)} DIDs")
+
+    stats = _throughput(len(blocks), sum(len(d) for d in blocks.values()), len(dids), elapsed)
+    logger.info(f"Snapshot of ECU 0x{ecu_address:02X}: {stats['blocks']} blocks in {stats['elapsed_ms']} ms")
+    return snapshot, stats
+
+async def restore_snapshot(manager, snapshot: CodingSnapshot, verify: bool = True) -> dict:
+    """
+    Write back only the blocks that differ from the live ECU
+
+    Uses the manager's read-compare-write path: live values are read with
+    multi-DID requests at the snapshot's block lengths, differing blocks
+    are written back to back and read back the same way.
+    """
+    start = time.perf_counter()
+    result = await manager.apply_values(snapshot.ecu_address, snapshot.blocks, verify=verify)
+    elapsed = time.perf_counter() - start
+
+    written = set(result.written)
+    size = sum(len(data) for did, data in snapshot.blocks.items() if did in written)
+    return {
+        **result.to_dict(),
+        "throughput": _throughput(len(written), size, result.requests, elapsed),
+    }
+
+# ============================================================================
+# STORAGE
+# ============================================================================
+
+async def save_snapshot(db, snapshot: CodingSnapshot) -> dict:
+    doc = snapshot.to_document()
+    await db[SNAPSHOT_COLLECTION].insert_one(doc)
+    return summarize(doc)
+
+async def load_snapshot(db, snapshot_id: str) -> Optional[CodingSnapshot]:
+    doc = await db[SNAPSHOT_COLLECTION].find_one({"_id": snapshot_id})
+    return CodingSnapshot.from_document(doc) if doc else None
+
+async def list_snapshots(db, vin: Optional[str] = None, ecu: Optional[str] = None,
+                         limit: int = 100) -> List[dict]:
+    query = {}
+    if vin:
+        query["vin"] = vin
+    if ecu:
+        query["ecu"] = ecu
+    docs = await db[SNAPSHOT_COLLECTION].find(query, {"data": 0, "block_hashes": 0}) \
+        .sort("created", -1).limit(limit).to_list(limit)
+    return [summarize(doc) for doc in docs]
+
+# ============================================================================
+# EXPORT
+# ============================================================================
+
+__all__ = [
+    'SNAPSHOT_COLLECTION',
+    'CodingSnapshot',
+    'coding_dids',
+    'ecu_name',
+    'take_snapshot',
+    'restore_snapshot',
+    'save_snapshot',
+    'load_snapshot',
+    'list_snapshots',
+]
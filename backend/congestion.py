@@ -0,0 +1,422 @@
+"""
+Congestion Control
+AIMD request windows per ECU and per gateway, with jittered retries of busyRepeatRequest
+"""
+
+import asyncio
+import random
+import struct
+import time
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, Optional, Tuple
+import logging
+
+from uds_timing import is_busy
+
+logger = logging.getLogger(__name__)
+
+# Window in requests; fractional internally, floored when applied
+INITIAL_WINDOW = 2.0
+MIN_WINDOW = 1
+MAX_ECU_WINDOW = 32
+MAX_GATEWAY_WINDOW = 64
+
+# Additive increase: +1 per window of healthy responses.
+# Multiplicative decrease: x0.5, at most once per smoothed round trip.
+INCREASE = 1.0
+DECREASE = 0.5
+
+# A response is "slow" (requests queueing in the ECU) above this multiple
+# of the lowest recent round trip and at least LATENCY_FLOOR above it. The
+# floor only screens out tester-side scheduling jitter; it has to stay well
+# below one ECU service time or a fast link never sees its queue grow
+LATENCY_TOLERANCE = 3.0
+LATENCY_FLOOR = 0.005
+
+# The baseline round trip drifts up by this fraction of the gap per
+# sample, so a route that became permanently slower is re-learned. Faster
+# drift lets the baseline catch up with a standing queue within a few
+# hundred samples, which hides exactly the queueing it is meant to detect
+MIN_RTT_DRIFT = 0.001
+
+# After busyRepeatRequest the window that drew it becomes a ceiling: growth
+# stops one below it and only probes past it at this fraction of the
+# additive rate, so the window settles under the ECU's queue limit instead
+# of running into it every few round trips
+PROBE_RATE = 0.1
+
+# busyRepeatRequest retries: full jitter, delay ~ U(0, min(cap, base * 2^n))
+MAX_BUSY_RETRIES = 6
+BUSY_BACKOFF_BASE = 0.01
+BUSY_BACKOFF_CAP = 0.5
+
+# ============================================================================
+# AIMD WINDOW
+# ============================================================================
+
+class AIMDWindow:
+    """
+    Number of requests allowed in flight on one path (an ECU or a gateway)
+
+    Grows by one per window of healthy responses, halves when a response
+    is busyRepeatRequest or (with latency_signal) its round trip exceeds
+    LATENCY_TOLERANCE x the baseline, i.e. requests queue in the ECU. One
+    decrease per round trip, so the burst of slow answers that a single
+    overload produces counts once. A busy answer also lowers the ceiling
+    the window grows back to (see PROBE_RATE).
+    """
+
+    def __init__(self, name: str, initial: float = INITIAL_WINDOW, maximum: int = MAX_ECU_WINDOW,
+                 minimum: int = MIN_WINDOW, latency_signal: bool = True):
+        self.name = name
+        self.latency_signal = latency_signal
+        self.window = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.in_flight = 0
+        self.min_rtt: Optional[float] = None
+        self.srtt: Optional[float] = None
+        self.responses = 0
+        self.busy = 0
+        self.slow = 0
+        self.decreases = 0
+        self.threshold = float(maximum)
+        self.ceiling = float(maximum)
+        self._hold_until = 0.0
+
+    @property
+    def limit(self) -> int:
+        return max(self.minimum, int(self.window))
+
+    @property
+    def available(self) -> bool:
+        return self.in_flight < self.limit
+
+    def observe(self, rtt: float, busy: bool = False):
+        """Feed one completed request"""
+        self.responses += 1
+        if self.min_rtt is None:
+            self.min_rtt = self.srtt = rtt
+        else:
+            self.srtt += (rtt - self.srtt) / 8
+            self.min_rtt = min(rtt, self.min_rtt + (self.srtt - self.min_rtt) * MIN_RTT_DRIFT)
+
+        slow = self.latency_signal and rtt > max(self.min_rtt * LATENCY_TOLERANCE, self.min_rtt + LATENCY_FLOOR)
+        if busy or slow:
+            self.busy += busy
+            self.slow += slow and not busy
+            now = time.monotonic()
+            if now >= self._hold_until:
+                if busy:
+                    self.ceiling = max(float(self.minimum), min(self.ceiling, self.window) - 1)
+                self.window = max(float(self.minimum), self.window * DECREASE)
+                self.threshold = self.window
+                self.decreases += 1
+                self._hold_until = now + self.srtt
+            return
+
+        # Slow start (+1 per response) until the first pushback, then additive
+        increase = INCREASE if self.window < self.threshold else INCREASE / self.window
+        if self.window + increase > self.ceiling:
+            increase *= PROBE_RATE
+            self.ceiling = max(self.ceiling, self.window + increase)
+        self.window = min(float(self.maximum), self.window + increase)
+
+    def stats(self) -> Dict:
+        return {
+            "window": round(self.window, 2),
+            "limit": self.limit,
+            "in_flight": self.in_flight,
+            "srtt_ms": round(self.srtt * 1000, 2) if self.srtt is not None else None,
+            "min_rtt_ms": round(self.min_rtt * 1000, 2) if self.min_rtt is not None else None,
+            "responses": self.responses,
+            "busy": self.busy,
+            "slow": self.slow,
+            "decreases": self.decreases,
+            "ceiling": round(self.ceiling, 2),
+        }
+
+# ============================================================================
+# CONTROLLER
+# ============================================================================
+
+class CongestionController:
+    """
+    Windows for one gateway and every ECU behind it
+
+    A request needs a slot in both its ECU's window and the gateway's, so
+    the gateway bounds the total over all ECUs (and all connections to it)
+    while each ECU is bounded by its own responsiveness. The gateway only
+    backs off on busyRepeatRequest: its round trips mix every ECU's queue,
+    which the ECU windows already keep short.
+    """
+
+    def __init__(self, gateway: str, max_ecu_window: int = MAX_ECU_WINDOW,
+                 max_gateway_window: int = MAX_GATEWAY_WINDOW):
+        self.gateway = AIMDWindow(gateway, initial=INITIAL_WINDOW * 2, maximum=max_gateway_window,
+                                  latency_signal=False)
+        self.max_ecu_window = max_ecu_window
+        self.ecus: Dict[int, AIMDWindow] = {}
+        self.retries = 0
+        self._released: Optional[asyncio.Event] = None
+
+    def ecu(self, address: int) -> AIMDWindow:
+        window = self.ecus.get(address)
+        if window is None:
+            window = self.ecus[address] = AIMDWindow(f"0x{address:02X}", maximum=self.max_ecu_window)
+        return window
+
+    def try_acquire(self, address: int) -> bool:
+        ecu = self.ecu(address)
+        if not (ecu.available and self.gateway.available):
+            return False
+        ecu.in_flight += 1
+        self.gateway.in_flight += 1
+        return True
+
+    async def acquire(self, address: int):
+        while not self.try_acquire(address):
+            await self.wait()
+
+    def release(self, address: int, rtt: Optional[float] = None, busy: bool = False):
+        """Free a slot; rtt None (no response) frees it without a sample"""
+        ecu = self.ecu(address)
+        ecu.in_flight -= 1
+        self.gateway.in_flight -= 1
+        if rtt is not None:
+            ecu.observe(rtt, busy)
+            self.gateway.observe(rtt, busy)
+        if self._released is not None:
+            self._released.set()
+
+    async def wait(self, timeout: Optional[float] = None):
+        """Until some slot is released (or the timeout passes)"""
+        if self._released is None:
+            self._released = asyncio.Event()
+        self._released.clear()
+        try:
+            await asyncio.wait_for(self._released.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def stats(self) -> Dict:
+        return {
+            "gateway": self.gateway.stats(),
+            "ecus": {window.name: window.stats() for window in self.ecus.values()},
+            "busy_retries": self.retries,
+        }
+
+def busy_backoff(attempt: int) -> float:
+    """Full-jitter delay before retry number `attempt` (0-based)"""
+    return random.uniform(0, min(BUSY_BACKOFF_CAP, BUSY_BACKOFF_BASE * (2 ** attempt)))
+
+async def retry_busy(send: Callable[[], Awaitable[Optional[bytes]]], service_id: int,
+                     controller: Optional[CongestionController] = None,
+                     retries: int = MAX_BUSY_RETRIES) -> Optional[bytes]:
+    """
+    Run `send` again while the answer is busyRepeatRequest, with full jitter
+
+    Returns:
+        The first non-busy response, or the last busy one once retries run out
+    """
+    response = await send()
+    for attempt in range(retries):
+        if not is_busy(service_id, response):
+            break
+        if controller is not None:
+            controller.retries += 1
+        await asyncio.sleep(busy_backoff(attempt))
+        response = await send()
+    return response
+
+# Shared by every connection to the same gateway
+_CONTROLLERS: Dict[str, CongestionController] = {}
+
+def controller_for(gateway: str) -> CongestionController:
+    controller = _CONTROLLERS.get(gateway)
+    if controller is None:
+        controller = _CONTROLLERS[gateway] = CongestionController(gateway)
+    return controller
+
+def congestion_stats() -> Dict[str, Dict]:
+    return {gateway: controller.stats() for gateway, controller in _CONTROLLERS.items()}
+
+# ============================================================================
+# GATEWAY SIMULATOR
+# ============================================================================
+
+class _SimulatedECU:
+    def __init__(self):
+        self.queue: Deque[Tuple[asyncio.StreamWriter, bytes, bool]] = deque()
+        self.ready = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+
+class GatewaySimulator:
+    """
+    DoIP gateway (TCP) with ECUs of limited capacity, for tuning and demos
+
+    Each ECU serves its queue in order, one request per `service_time`.
+    A request that arrives while its ECU already queues `ecu_queue_limit`
+    requests, or while the gateway holds `gateway_limit` in total, is
+    answered busyRepeatRequest when its turn comes (after `busy_time`),
+    so answers stay in request order as on a real gateway. `link_latency`
+    is added each way.
+    """
+
+    def __init__(self, service_time: float = 0.002, busy_time: float = 0.0002,
+                 ecu_queue_limit: int = 8, gateway_limit: int = 16, link_latency: float = 0.0):
+        self.service_time = service_time
+        self.busy_time = busy_time
+        self.ecu_queue_limit = ecu_queue_limit
+        self.gateway_limit = gateway_limit
+        self.link_latency = link_latency
+        self.ecus: Dict[int, _SimulatedECU] = {}
+        self.queued = 0
+        self.served = 0
+        self.busy = 0
+        self.server: Optional[asyncio.AbstractServer] = None
+        self.clients: Dict[asyncio.Task, asyncio.StreamWriter] = {}
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0, ssl=None) -> int:
+        """Listen on host:port (0 picks a free port), TLS if an SSLContext is given"""
+        self.server = await asyncio.start_server(self._client, host, port, ssl=ssl)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        for ecu in self.ecus.values():
+            if ecu.task:
+                ecu.task.cancel()
+        if self.server:
+            self.server.close()
+        for writer in self.clients.values():
+            writer.close()
+        await asyncio.gather(*self.clients, return_exceptions=True)
+        if self.server:
+            await self.server.wait_closed()
+
+    async def _client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        loop = asyncio.get_running_loop()
+        task = asyncio.current_task()
+        self.clients[task] = writer
+        try:
+            while True:
+                header = await reader.readexactly(8)
+                payload_type, length = struct.unpack('>HI', header[2:8])
+                payload = await reader.readexactly(length)
+                if payload_type == 0x0005:
+                    tester = payload[:2]
+                    response = tester + b"\x00\x10" + b"\x10" + b"\x00" * 4
+                    writer.write(struct.pack('>BBHI', 0x02, 0xFD, 0x0006, len(response)) + response)
+                elif payload_type == 0x8001:
+                    loop.call_later(self.link_latency, self._arrive, writer, payload)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.clients.pop(task, None)
+            writer.close()
+
+    def _arrive(self, writer: asyncio.StreamWriter, payload: bytes):
+        source, target = struct.unpack('>HH', payload[:4])
+        ecu = self.ecus.get(target)
+        if ecu is None:
+            ecu = self.ecus[target] = _SimulatedECU()
+            ecu.task = asyncio.ensure_future(self._serve(target, ecu))
+        busy = len(ecu.queue) >= self.ecu_queue_limit or self.queued >= self.gateway_limit
+        ecu.queue.append((writer, payload, busy))
+        self.queued += 1
+        ecu.ready.set()
+
+    async def _serve(self, address: int, ecu: _SimulatedECU):
+        loop = asyncio.get_running_loop()
+        while True:
+            if not ecu.queue:
+                ecu.ready.clear()
+                await ecu.ready.wait()
+                continue
+            writer, payload, busy = ecu.queue[0]
+            await asyncio.sleep(self.busy_time if busy else self.service_time)
+            ecu.queue.popleft()
+            self.queued -= 1
+
+            source = payload[:2]
+            uds = payload[4:]
+            if busy:
+                self.busy += 1
+                answer = bytes([0x7F, uds[0], 0x21])
+            else:
+                self.served += 1
+                answer = bytes([uds[0] + 0x40]) + uds[1:3] + b"\x00\x00"
+            message = struct.pack('>HH', address, struct.unpack('>H', source)[0]) + answer
+            packet = struct.pack('>BBHI', 0x02, 0xFD, 0x8001, len(message)) + message
+            loop.call_later(self.link_latency, self._write, writer, packet)
+
+    @staticmethod
+    def _write(writer: asyncio.StreamWriter, packet: bytes):
+        if not writer.is_closing():
+            writer.write(packet)
+
+# ============================================================================
+# EXPORT
+# ============================================================================
+
+__all__ = [
+    'AIMDWindow',
+    'CongestionController',
+    'GatewaySimulator',
+    'busy_backoff',
+    'retry_busy',
+    'controller_for',
+    'congestion_stats',
+]
+
+if __name__ == "__main__":
+    from doip_protocol import DoIPConnection
+
+    ECUS = [0x12, 0x40, 0x63]
+    READS = 300
+
+    # (name, ECU service time, one-way link latency, busy above n queued per ECU, per gateway)
+    SCENARIOS = [
+        ("local link", 0.004, 0.001, 8, 16),
+        ("slow link", 0.010, 0.030, 8, 24),
+    ]
+
+    async def run(host: str, depth: Optional[int], service: float, latency: float,
+                  ecu_limit: int, gateway_limit: int) -> Tuple[float, int, Dict]:
+        simulator = GatewaySimulator(service_time=service, link_latency=latency,
+                                     ecu_queue_limit=ecu_limit, gateway_limit=gateway_limit)
+        port = await simulator.start(host)
+        connections = [DoIPConnection(host, port) for _ in ECUS]
+        for connection in connections:
+            await connection.connect()
+
+        start = time.perf_counter()
+        results = await asyncio.gather(*(
+            connection.send_diagnostic_requests(ecu, [bytes([0x22, 0xF1, n % 256]) for n in range(READS)], depth)
+            for connection, ecu in zip(connections, ECUS)
+        ))
+        elapsed = time.perf_counter() - start
+
+        answered = sum(1 for responses in results for r in responses if r and r[0] == 0x62)
+        for connection in connections:
+            connection.disconnect()
+        await simulator.stop()
+        return answered / elapsed, simulator.busy, connections[0].congestion.stats()
+
+    async def main():
+        print(f"{len(ECUS)} ECUs x {READS} pipelined reads, one connection each\n")
+        print(f"{'scenario':<14}{'depth':<10}{'req/s':>8}{'busy NRCs':>11}  final windows (gateway / ECUs)")
+        host = 1
+        for name, service, latency, ecu_limit, gateway_limit in SCENARIOS:
+            for depth in (1, 4, 8, None):
+                # A fresh loopback address per run, so each starts with fresh windows
+                host += 1
+                rate, busy, stats = await run(f"127.0.0.{host}", depth, service, latency, ecu_limit, gateway_limit)
+                windows = ""
+                if depth is None:
+                    ecus = "/".join(str(e["limit"]) for e in stats["ecus"].values())
+                    windows = f"{stats['gateway']['limit']} / {ecus}"
+                print(f"{name:<14}{depth or 'adaptive':<10}{rate:>8.0f}{busy:>11}  {windows}")
+                name = ""
+
+    asyncio.run(main())
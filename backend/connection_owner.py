@@ -0,0 +1,381 @@
+"""
+Connection Owner
+One process holds the vehicle connection and the PSdZ catalog; API workers reach them over a Unix socket
+"""
+
+import asyncio
+import itertools
+import json
+import os
+import struct
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set, Tuple, Union
+import logging
+
+from enet import ENETConnection, UDSServices
+from request_scheduler import INTERACTIVE, RequestExpired, current_priority, request_priority
+from psdz_catalog import PSdZCatalog, SHARED_INDEX_FILE, STAT_INTERVAL, get_catalog, write_shared_index
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SOCKET = "/tmp/bmw_ecu_owner.sock"
+
+# Frame: 4-byte big-endian length + UTF-8 JSON
+FRAME_HEADER = struct.Struct('>I')
+MAX_FRAME = 16 * 1024 * 1024
+
+# Seconds a worker waits for the owner before failing a call
+CALL_TIMEOUT = 60.0
+
+# ============================================================================
+# FRAMING
+# ============================================================================
+
+async def read_frame(reader: asyncio.StreamReader) -> Optional[dict]:
+    """Next message, None at end of stream"""
+    try:
+        header = await reader.readexactly(FRAME_HEADER.size)
+    except asyncio.IncompleteReadError:
+        return None
+    (length,) = FRAME_HEADER.unpack(header)
+    if length > MAX_FRAME:
+        raise ValueError(f"IPC frame of {length} bytes exceeds {MAX_FRAME}")
+    return json.loads(await reader.readexactly(length))
+
+def write_frame(writer: asyncio.StreamWriter, message: dict):
+    payload = json.dumps(message, separators=(",", ":")).encode()
+    writer.write(FRAME_HEADER.pack(len(payload)) + payload)
+
+def _hex(data: Optional[bytes]) -> Optional[str]:
+    return data.hex() if data is not None else None
+
+def _unhex(data: Optional[str]) -> Optional[bytes]:
+    return bytes.fromhex(data) if data is not None else None
+
+# ============================================================================
+# OWNER
+# ============================================================================
+
+class ConnectionOwner:
+    """
+    Holds the ENET connection and the PSdZ catalog for every API worker
+
+    UDS calls from all workers share the ENET connection's scheduler, in
+    the priority class (and deadline) the worker sent along, so requests
+    never interleave on the unframed ENET socket and one worker's bulk
+    batch cannot hold up another's interactive read. Connection changes
+    are pushed to all workers as "status" events. The catalog is refreshed here and published
+    as the shared index that workers memory-map (psdz_catalog.SharedCatalog).
+    """
+
+    def __init__(self, catalog: PSdZCatalog):
+        self.catalog = catalog
+        self.connection: Optional[ENETConnection] = None
+        self.clients: Set[asyncio.StreamWriter] = set()
+        self._lock = asyncio.Lock()
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._refresher: Optional[asyncio.Task] = None
+
+    # ------------------------------------------------------------------
+    # Catalog
+    # ------------------------------------------------------------------
+
+    def refresh_catalog(self, force: bool = False) -> bool:
+        changed = self.catalog.refresh(force)
+        index = self.catalog.swe_path / SHARED_INDEX_FILE
+        if changed or force or not index.exists():
+            write_shared_index(self.catalog, index)
+        return changed
+
+    async def _refresh_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(STAT_INTERVAL)
+            try:
+                await loop.run_in_executor(None, self.refresh_catalog)
+            except Exception as e:
+                logger.error(f"PSdZ catalog refresh failed: {e}")
+
+    # ------------------------------------------------------------------
+    # Connection
+    # ------------------------------------------------------------------
+
+    def status(self) -> dict:
+        connection = self.connection
+        return {
+            "connected": bool(connection and connection.connected),
+            "ip": connection.ip_address if connection else None,
+            "port": connection.port if connection else None,
+            "catalog_generation": self.catalog.generation,
+        }
+
+    def _broadcast_status(self):
+        event = {"event": "status", "status": self.status()}
+        for writer in list(self.clients):
+            try:
+                write_frame(writer, event)
+            except Exception:
+                self.clients.discard(writer)
+
+    async def connect(self, ip: str, port: int = 6801) -> bool:
+        async with self._lock:
+            current = self.connection
+            if current and current.connected and (current.ip_address, current.port) == (ip, port):
+                return True  # Another worker got here first
+            if current:
+                current.disconnect()
+            self.connection = ENETConnection(ip, port)
+            connected = await self.connection.connect()
+        self._broadcast_status()
+        return connected
+
+    async def disconnect(self):
+        async with self._lock:
+            if self.connection:
+                self.connection.disconnect()
+                self.connection = None
+        self._broadcast_status()
+
+    def _require_connection(self) -> ENETConnection:
+        if not self.connection or not self.connection.connected:
+            raise ConnectionError("Not connected to ENET")
+        return self.connection
+
+    @staticmethod
+    def _priority(params: Dict[str, Any]):
+        """request_priority() for a call's "priority" and "expires_in" (seconds) params"""
+        expires_in = params.get("expires_in")
+        deadline = asyncio.get_running_loop().time() + expires_in if expires_in is not None else None
+        return request_priority(params.get("priority", INTERACTIVE), deadline)
+
+    async def uds(self, service_id: int, data: str = "") -> str:
+        response = await self._require_connection().send_uds_request(service_id, _unhex(data))
+        return _hex(response)
+
+    async def uds_many(self, requests: List[Tuple[int, str]]) -> List[Optional[str]]:
+        responses = await self._require_connection().send_uds_requests(
+            [(service_id, _unhex(data)) for service_id, data in requests]
+        )
+        return [_hex(r) for r in responses]
+
+    # ------------------------------------------------------------------
+    # IPC
+    # ------------------------------------------------------------------
+
+    async def dispatch(self, method: str, params: Dict[str, Any]) -> Any:
+        if method == "status":
+            return self.status()
+        if method == "connect":
+            return await self.connect(params["ip"], params.get("port", 6801))
+        if method == "disconnect":
+            return await self.disconnect()
+        if method == "uds":
+            with self._priority(params):
+                return await self.uds(params["service_id"], params.get("data", ""))
+        if method == "uds_many":
+            with self._priority(params):
+                return await self.uds_many(params["requests"])
+        if method == "catalog_refresh":
+            loop = asyncio.get_running_loop()
+            changed = await loop.run_in_executor(None, self.refresh_catalog, params.get("force", False))
+            return {"changed": changed, "generation": self.catalog.generation}
+        raise ValueError(f"Unknown method: {method}")
+
+    async def _answer(self, writer: asyncio.StreamWriter, message: dict):
+        reply: Dict[str, Any] = {"id": message.get("id")}
+        try:
+            reply["result"] = await self.dispatch(message.get("method"), message.get("params") or {})
+        except Exception as e:
+            reply["error"] = f"{type(e).__name__}: {e}"
+        if writer in self.clients:
+            write_frame(writer, reply)
+
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.clients.add(writer)
+        pending: Set[asyncio.Task] = set()
+        try:
+            while True:
+                message = await read_frame(reader)
+                if message is None:
+                    break
+                # Calls are answered as they finish; UDS calls queue in the scheduler
+                task = asyncio.create_task(self._answer(writer, message))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+        except Exception as e:
+            logger.warning(f"IPC client dropped: {e}")
+        finally:
+            self.clients.discard(writer)
+            for task in pending:
+                task.cancel()
+            writer.close()
+
+    async def serve(self, socket_path: Union[str, Path] = DEFAULT_SOCKET):
+        socket_path = str(socket_path)
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+        await asyncio.get_running_loop().run_in_executor(None, self.refresh_catalog)
+        self._server = await asyncio.start_unix_server(self.handle_client, path=socket_path)
+        os.chmod(socket_path, 0o600)
+        self._refresher = asyncio.create_task(self._refresh_loop())
+        logger.info(f"Connection owner listening on {socket_path} (catalog generation {self.catalog.generation})")
+
+        try:
+            async with self._server:
+                await self._server.serve_forever()
+        finally:
+            self._refresher.cancel()
+            if self.connection:
+                self.connection.disconnect()
+
+# ============================================================================
+# WORKER SIDE
+# ============================================================================
+
+class RemoteConnection(UDSServices):
+    """
+    ENETConnection stand-in for API workers: every call goes to the owner
+
+    Implements the ENETConnection interface (connected, send_uds_request(s)
+    and the UDS service helpers), so a G01ECUManager works on top of it
+    unchanged. `connected`, `ip_address` and `port` follow the
+    owner's status events, so a connection made through one worker is
+    visible in all of them.
+    """
+
+    def __init__(self, socket_path: Union[str, Path] = DEFAULT_SOCKET,
+                 ip_address: Optional[str] = None, port: int = 6801):
+        self.socket_path = str(socket_path)
+        self.ip_address = ip_address
+        self.port = port
+        self.connected = False
+        self.catalog_generation = 0
+        self._ids = itertools.count(1)
+        self._calls: Dict[int, asyncio.Future] = {}
+        self._reader_task: Optional[asyncio.Task] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._opening = asyncio.Lock()
+
+    @classmethod
+    async def attach(cls, socket_path: Union[str, Path] = DEFAULT_SOCKET) -> "RemoteConnection":
+        """Connect to the owner and adopt its current vehicle connection"""
+        remote = cls(socket_path)
+        remote._apply_status(await remote.call("status"))
+        return remote
+
+    def _apply_status(self, status: dict):
+        self.connected = status["connected"]
+        self.ip_address = status["ip"] or self.ip_address
+        self.port = status["port"] or self.port
+        self.catalog_generation = status["catalog_generation"]
+
+    async def _open(self):
+        async with self._opening:
+            if self._writer and not self._writer.is_closing():
+                return
+            reader, self._writer = await asyncio.open_unix_connection(self.socket_path)
+            self._reader_task = asyncio.create_task(self._read_loop(reader))
+
+    async def _read_loop(self, reader: asyncio.StreamReader):
+        try:
+            while True:
+                message = await read_frame(reader)
+                if message is None:
+                    break
+                if message.get("event") == "status":
+                    self._apply_status(message["status"])
+                    continue
+                future = self._calls.pop(message.get("id"), None)
+                if future and not future.done():
+                    future.set_result(message)
+        except Exception as e:
+            logger.warning(f"Connection owner link lost: {e}")
+        finally:
+            for future in self._calls.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("Connection owner went away"))
+            self._calls.clear()
+            if self._writer:
+                self._writer.close()
+            self._writer = None
+
+    async def call(self, method: str, **params) -> Any:
+        """One request to the owner; owner-side failures are re-raised here"""
+        await self._open()
+        call_id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self._calls[call_id] = future
+        write_frame(self._writer, {"id": call_id, "method": method, "params": params})
+        try:
+            reply = await asyncio.wait_for(future, CALL_TIMEOUT)
+        finally:
+            self._calls.pop(call_id, None)
+        if "error" in reply:
+            if reply["error"].startswith(RequestExpired.__name__):
+                raise RequestExpired(reply["error"])
+            raise RuntimeError(f"Connection owner: {reply['error']}")
+        return reply["result"]
+
+    @staticmethod
+    def _priority() -> Dict[str, Any]:
+        """The caller's priority class and time left to its deadline, for the owner's scheduler"""
+        klass, deadline = current_priority()
+        if deadline is None:
+            return {"priority": klass}
+        return {"priority": klass, "expires_in": deadline - asyncio.get_running_loop().time()}
+
+    async def connect(self) -> bool:
+        self.connected = await self.call("connect", ip=self.ip_address, port=self.port)
+        return self.connected
+
+    def disconnect(self):
+        """Ask the owner to drop the vehicle connection (synchronous, like ENETConnection)"""
+        self.connected = False
+        asyncio.get_event_loop().create_task(self.call("disconnect"))
+
+    async def close(self):
+        """Close this worker's link to the owner; the vehicle stays connected"""
+        if self._reader_task:
+            self._reader_task.cancel()
+        if self._writer:
+            self._writer.close()
+            self._writer = None
+
+    async def send_uds_request(self, service_id: int, data: bytes = b'') -> bytes:
+        return _unhex(await self.call("uds", service_id=service_id, data=data.hex(), **self._priority()))
+
+    async def send_uds_requests(self, requests: List[tuple]) -> List[Optional[bytes]]:
+        responses = await self.call("uds_many", requests=[(sid, data.hex()) for sid, data in requests],
+                                    **self._priority())
+        return [_unhex(r) for r in responses]
+
+    async def refresh_catalog(self, force: bool = False) -> dict:
+        return await self.call("catalog_refresh", force=force)
+
+# ============================================================================
+# EXPORT
+# ============================================================================
+
+__all__ = [
+    'DEFAULT_SOCKET',
+    'ConnectionOwner',
+    'RemoteConnection',
+]
+
+if __name__ == "__main__":
+    # python connection_owner.py [socket path]
+    # then: ECU_OWNER_SOCKET=<socket path> uvicorn server:app --workers N
+    import sys
+
+    from g01_x3_b48_module import G01_X3_B48_CONFIG
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    owner = ConnectionOwner(get_catalog(G01_X3_B48_CONFIG["swe_path"]))
+    try:
+        asyncio.run(owner.serve(sys.argv[1] if len(sys.argv) > 1 else DEFAULT_SOCKET))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,293 @@
+"""
+Columnar Datalog Storage
+Append-only chunked column files for recorded live data, memory-mapped reads into NumPy
+"""
+
+import json
+import os
+import struct
+from array import array
+from bisect import bisect_left, bisect_right
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+DATALOG_MAGIC = b"BMWLOG01"
+DATALOG_SUFFIX = ".bmwlog"
+INDEX_SUFFIX = ".idx"
+
+# Chunk header: marker, row count, first and last timestamp
+CHUNK_MARKER = b"CHNK"
+CHUNK_HEADER = struct.Struct('<4sIdd')
+
+# Index entry: file offset of the chunk header, rows, first and last timestamp
+INDEX_ENTRY = struct.Struct('<QIdd')
+
+# Rows buffered before a chunk is written; bounds writer memory
+DEFAULT_CHUNK_ROWS = 4096
+
+# array typecode for each supported column dtype
+ARRAY_TYPECODES = {"f8": 'd', "f4": 'f', "i4": 'i', "i8": 'q', "u2": 'H', "u4": 'I'}
+
+def _pad(size: int) -> int:
+    """Columns start on 8-byte boundaries so NumPy views are aligned"""
+    return (-size) % 8
+
+# ============================================================================
+# WRITER
+# ============================================================================
+
+class DatalogWriter:
+    """
+    Appends rows (timestamp + one value per channel) to a datalog file
+
+    Rows are buffered column-wise for one chunk at a time, then written as
+    contiguous typed columns. The chunk index is appended to a sidecar file
+    as each chunk lands, so a crashed writer leaves a readable log.
+    Instances are callable so they can be attached as a live data sink.
+    """
+
+    def __init__(self, path: Path, channels: Sequence[str], dtypes: Optional[Sequence[str]] = None,
+                 chunk_rows: int = DEFAULT_CHUNK_ROWS, metadata: Optional[dict] = None):
+        self.path = Path(path)
+        self.channels = list(channels)
+        self.dtypes = list(dtypes) if dtypes else ["f8"] * len(self.channels)
+        self.chunk_rows = chunk_rows
+        self.rows_written = 0
+
+        for dtype in self.dtypes:
+            if dtype not in ARRAY_TYPECODES:
+                raise ValueError(f"Unsupported datalog dtype: {dtype}")
+
+        header = json.dumps({
+            "channels": [{"name": n, "dtype": d} for n, d in zip(self.channels, self.dtypes)],
+            **(metadata or {}),
+        }).encode()
+        header += b" " * _pad(len(DATALOG_MAGIC) + 4 + len(header))
+
+        self._file = open(self.path, 'wb')
+        self._file.write(DATALOG_MAGIC + struct.pack('<I', len(header)) + header)
+        self._index = open(self.path.with_suffix(self.path.suffix + INDEX_SUFFIX), 'wb')
+        self._reset_buffers()
+
+    def _reset_buffers(self):
+        self._timestamps = array('d')
+        self._columns = [array(ARRAY_TYPECODES[d]) for d in self.dtypes]
+
+    def append(self, timestamp: float, row: Sequence[float]):
+        self._timestamps.append(timestamp)
+        for column, value in zip(self._columns, row):
+            column.append(value)
+        if len(self._timestamps) >= self.chunk_rows:
+            self.flush()
+
+    __call__ = append
+
+    def flush(self):
+        """Write buffered rows as one chunk"""
+        rows = len(self._timestamps)
+        if rows == 0 or self._file is None:
+            return
+
+        offset = self._file.tell()
+        self._file.write(CHUNK_HEADER.pack(CHUNK_MARKER, rows, self._timestamps[0], self._timestamps[-1]))
+        self._file.write(b"\x00" * _pad(CHUNK_HEADER.size))
+        for column in [self._timestamps] + self._columns:
+            data = column.tobytes()
+            self._file.write(data + b"\x00" * _pad(len(data)))
+        self._file.flush()
+
+        self._index.write(INDEX_ENTRY.pack(offset, rows, self._timestamps[0], self._timestamps[-1]))
+        self._index.flush()
+
+        self.rows_written += rows
+        self._reset_buffers()
+
+    def close(self):
+        if self._file is None:
+            return
+        self.flush()
+        self._file.close()
+        self._index.close()
+        self._file = None
+        logger.info(f"Datalog {self.path.name} closed: {self.rows_written} rows")
+
+# ============================================================================
+# READER
+# ============================================================================
+
+def _json_values(values: np.ndarray) -> list:
+    """Float list with NaN (missed samples) as None"""
+    values = values.astype('f8')
+    return [None if v != v else v for v in values.tolist()]
+
+class DatalogReader:
+    """
+    Memory-mapped datalog reader
+
+    Columns are returned as NumPy views straight onto the mapped file; only
+    queries spanning several chunks concatenate (and therefore copy).
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._map = np.memmap(self.path, dtype=np.uint8, mode='r')
+
+        if bytes(self._map[:len(DATALOG_MAGIC)]) != DATALOG_MAGIC:
+            raise ValueError(f"Not a datalog file: {path}")
+
+        header_len = struct.unpack_from('<I', self._map, len(DATALOG_MAGIC))[0]
+        start = len(DATALOG_MAGIC) + 4
+        self.header = json.loads(bytes(self._map[start:start + header_len]))
+        self.channels = [c["name"] for c in self.header["channels"]]
+        self.dtypes = [np.dtype(c["dtype"]) for c in self.header["channels"]]
+        self._data_start = start + header_len
+
+        self.chunks = self._load_index()
+        self.t_first = [c[2] for c in self.chunks]
+        self.t_last = [c[3] for c in self.chunks]
+
+    def _load_index(self) -> List[tuple]:
+        index_path = self.path.with_suffix(self.path.suffix + INDEX_SUFFIX)
+        if index_path.exists():
+            data = index_path.read_bytes()
+            usable = len(data) - len(data) % INDEX_ENTRY.size
+            return [entry for entry in INDEX_ENTRY.iter_unpack(data[:usable])
+                    if entry[0] < len(self._map)]
+        return self._scan_chunks()
+
+    def _scan_chunks(self) -> List[tuple]:
+        """Rebuild the chunk index by walking chunk headers"""
+        chunks = []
+        offset = self._data_start
+        while offset + CHUNK_HEADER.size <= len(self._map):
+            marker, rows, t_first, t_last = CHUNK_HEADER.unpack_from(self._map, offset)
+            if marker != CHUNK_MARKER:
+                break
+            size = self._chunk_size(rows)
+            if offset + size > len(self._map):
+                break
+            chunks.append((offset, rows, t_first, t_last))
+            offset += size
+        return chunks
+
+    def _chunk_size(self, rows: int) -> int:
+        size = CHUNK_HEADER.size + _pad(CHUNK_HEADER.size)
+        for dtype in [np.dtype('f8')] + self.dtypes:
+            nbytes = rows * dtype.itemsize
+            size += nbytes + _pad(nbytes)
+        return size
+
+    def _chunk_columns(self, chunk: tuple) -> List[np.ndarray]:
+        offset, rows = chunk[0], chunk[1]
+        position = offset + CHUNK_HEADER.size + _pad(CHUNK_HEADER.size)
+        columns = []
+        for dtype in [np.dtype('f8')] + self.dtypes:
+            columns.append(np.frombuffer(self._map, dtype=dtype, count=rows, offset=position))
+            nbytes = rows * dtype.itemsize
+            position += nbytes + _pad(nbytes)
+        return columns
+
+    @property
+    def rows(self) -> int:
+        return sum(c[1] for c in self.chunks)
+
+    @property
+    def time_range(self) -> tuple:
+        if not self.chunks:
+            return (None, None)
+        return (self.t_first[0], self.t_last[-1])
+
+    def query(self, start: Optional[float] = None, end: Optional[float] = None,
+              channels: Optional[Sequence[str]] = None) -> Dict[str, np.ndarray]:
+        """
+        Rows with start <= t <= end
+
+        Returns:
+            {"t": timestamps, <channel>: values, ...}
+        """
+        names = list(channels) if channels else self.channels
+        indices = [self.channels.index(n) for n in names]
+
+        # Chunk index narrows the scan to overlapping chunks
+        first = bisect_left(self.t_last, start) if start is not None else 0
+        last = bisect_right(self.t_first, end) if end is not None else len(self.chunks)
+
+        parts: Dict[str, List[np.ndarray]] = {name: [] for name in ["t"] + names}
+        for chunk in self.chunks[first:last]:
+            columns = self._chunk_columns(chunk)
+            t = columns[0]
+            lo = int(np.searchsorted(t, start, 'left')) if start is not None else 0
+            hi = int(np.searchsorted(t, end, 'right')) if end is not None else len(t)
+            if lo >= hi:
+                continue
+            parts["t"].append(t[lo:hi])
+            for name, index in zip(names, indices):
+                parts[name].append(columns[index + 1][lo:hi])
+
+        result = {}
+        for name, arrays in parts.items():
+            dtype = np.dtype('f8') if name == "t" else self.dtypes[self.channels.index(name)]
+            if not arrays:
+                result[name] = np.empty(0, dtype=dtype)
+            elif len(arrays) == 1:
+                result[name] = arrays[0]
+            else:
+                result[name] = np.concatenate(arrays)
+        return result
+
+    def downsample(self, start: Optional[float] = None, end: Optional[float] = None,
+                   points: int = 1000, channels: Optional[Sequence[str]] = None) -> dict:
+        """
+        Min/max envelope in `points` equal time buckets, for plotting long logs
+
+        Returns:
+            {"t": bucket start times, "min": {channel: [...]}, "max": {channel: [...]}}
+        """
+        data = self.query(start, end, channels)
+        t = data.pop("t")
+        if len(t) == 0:
+            return {"t": [], "min": {n: [] for n in data}, "max": {n: [] for n in data}}
+
+        if len(t) <= points:
+            values = {n: _json_values(v) for n, v in data.items()}
+            return {"t": t.tolist(), "min": values, "max": values}
+
+        t0, t1 = float(t[0]), float(t[-1])
+        edges = np.linspace(t0, t1, points + 1)
+        boundaries = np.searchsorted(t, edges[:-1], 'left')
+        # Empty buckets would make reduceat repeat a neighbour; keep only populated ones
+        boundaries, keep = np.unique(boundaries, return_index=True)
+
+        result = {"t": edges[:-1][keep].tolist(), "min": {}, "max": {}}
+        for name, values in data.items():
+            # fmin/fmax skip NaN (missed reads) instead of propagating them
+            result["min"][name] = _json_values(np.fmin.reduceat(values, boundaries))
+            result["max"][name] = _json_values(np.fmax.reduceat(values, boundaries))
+        return result
+
+    def summary(self) -> dict:
+        t_first, t_last = self.time_range
+        return {
+            "file": self.path.name,
+            "channels": self.channels,
+            "rows": self.rows,
+            "chunks": len(self.chunks),
+            "start": t_first,
+            "end": t_last,
+            "size_bytes": os.path.getsize(self.path),
+        }
+
+# ============================================================================
+# EXPORT
+# ============================================================================
+
+__all__ = [
+    'DATALOG_SUFFIX',
+    'DatalogWriter',
+    'DatalogReader',
+]
@@ -0,0 +1,265 @@
+"""
+DoIP Vehicle Discovery
+Concurrent UDP vehicle identification (ISO 13400-2 payload 0x0001) on all local interfaces
+"""
+
+import asyncio
+import socket
+import struct
+import time
+from dataclasses import dataclass, asdict
+from typing import Dict, List, Optional, Tuple
+import logging
+
+logger = logging.getLogger(__name__)
+
+DOIP_DISCOVERY_PORT = 13400
+
+# Vehicle Identification Request: protocol version 0x02, payload type 0x0001, no payload
+VEHICLE_IDENTIFICATION_REQUEST = struct.pack('>BBHI', 0x02, 0xFD, 0x0001, 0)
+
+# Vehicle Announcement / Identification Response payload type
+VEHICLE_ANNOUNCEMENT = 0x0004
+
+# Gateways answer within A_DoIP_Ctrl (2 s) at worst, usually in a few ms
+DEFAULT_WINDOW = 0.5
+CACHE_TTL = 30.0
+
+# Linux ioctls for interface address and broadcast address
+SIOCGIFADDR = 0x8915
+SIOCGIFBRDADDR = 0x8919
+
+# ============================================================================
+# ANNOUNCEMENTS
+# ============================================================================
+
+@dataclass
+class VehicleAnnouncement:
+    """A gateway that answered vehicle identification"""
+    interface: str
+    ip: str
+    vin: str
+    logical_address: int
+    eid: str
+    gid: str
+    further_action: int
+    received_at: float
+
+    def to_dict(self) -> dict:
+        return {**asdict(self), "logical_address": f"0x{self.logical_address:04X}"}
+
+def parse_announcement(data: bytes, interface: str, ip: str) -> Optional[VehicleAnnouncement]:
+    """Parse a DoIP Vehicle Announcement message, None if it is anything else"""
+    if len(data) < 8 or data[0] ^ data[1] != 0xFF:
+        return None
+
+    payload_type, length = struct.unpack('>HI', data[2:8])
+    payload = data[8:8 + length]
+    if payload_type != VEHICLE_ANNOUNCEMENT or len(payload) < 32:
+        return None
+
+    return VehicleAnnouncement(
+        interface=interface,
+        ip=ip,
+        vin=payload[0:17].decode('ascii', errors='ignore'),
+        logical_address=struct.unpack('>H', payload[17:19])[0],
+        eid=payload[19:25].hex(),
+        gid=payload[25:31].hex(),
+        further_action=payload[31],
+        received_at=time.time(),
+    )
+
+# ============================================================================
+# INTERFACES
+# ============================================================================
+
+def _ioctl_address(sock: socket.socket, request: int, name: str) -> Optional[str]:
+    import fcntl
+
+    try:
+        packed = struct.pack('256s', name.encode()[:15])
+        return socket.inet_ntoa(fcntl.ioctl(sock.fileno(), request, packed)[20:24])
+    except OSError:
+        return None
+
+def local_interfaces() -> List[Tuple[str, str, str]]:
+    """
+    IPv4 interfaces that can carry a broadcast
+
+    Returns:
+        List of (interface name, local address, broadcast address)
+    """
+    interfaces = []
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            for _, name in socket.if_nameindex():
+                address = _ioctl_address(sock, SIOCGIFADDR, name)
+                broadcast = _ioctl_address(sock, SIOCGIFBRDADDR, name)
+                if address and broadcast and not address.startswith("127."):
+                    interfaces.append((name, address, broadcast))
+    except (ImportError, OSError) as e:
+        logger.warning(f"Interface enumeration unavailable: {e}")
+
+    if not interfaces:
+        interfaces.append(("default", "0.0.0.0", "255.255.255.255"))
+    return interfaces
+
+# ============================================================================
+# DISCOVERY
+# ============================================================================
+
+class _DiscoveryProtocol(asyncio.DatagramProtocol):
+    def __init__(self, interface: str, results: List[VehicleAnnouncement], first: asyncio.Future):
+        self.interface = interface
+        self.results = results
+        self.first = first
+
+    def datagram_received(self, data: bytes, addr):
+        announcement = parse_announcement(data, self.interface, addr[0])
+        if announcement is None:
+            return
+        if any(a.ip == announcement.ip and a.logical_address == announcement.logical_address
+               for a in self.results):
+            return
+        self.results.append(announcement)
+        if not self.first.done():
+            self.first.set_result(announcement)
+
+class VehicleDiscovery:
+    """
+    Broadcasts vehicle identification requests on every interface at once
+
+    Results are cached per interface for CACHE_TTL seconds so repeated
+    connects skip the network round trip entirely.
+
+    Args:
+        port: Destination UDP port (13400; overridable for local responders)
+        targets: Explicit (interface, local address, destination) triples
+                 instead of enumerating interfaces - used for testing
+    """
+
+    def __init__(self, port: int = DOIP_DISCOVERY_PORT,
+                 targets: Optional[List[Tuple[str, str, str]]] = None):
+        self.port = port
+        self.targets = targets
+        self.cache: Dict[str, Tuple[float, List[VehicleAnnouncement]]] = {}
+
+    def cached(self) -> List[VehicleAnnouncement]:
+        now = time.monotonic()
+        return [
+            announcement
+            for stamp, announcements in self.cache.values()
+            if now - stamp < CACHE_TTL
+            for announcement in announcements
+        ]
+
+    def invalidate(self):
+        self.cache.clear()
+
+    async def discover(self, window: float = DEFAULT_WINDOW, first_only: bool = False,
+                       use_cache: bool = True) -> List[VehicleAnnouncement]:
+        """
+        Discover DoIP gateways
+
+        Args:
+            window: How long to collect announcements (seconds)
+            first_only: Return as soon as the first gateway answers
+            use_cache: Serve fresh cached results without touching the network
+        """
+        if use_cache:
+            cached = self.cached()
+            if cached:
+                return cached[:1] if first_only else cached
+
+        loop = asyncio.get_running_loop()
+        first = loop.create_future()
+        targets = self.targets or local_interfaces()
+        per_interface: Dict[str, List[VehicleAnnouncement]] = {name: [] for name, _, _ in targets}
+        transports = []
+
+        try:
+            for name, local_ip, destination in targets:
+                try:
+                    transport, _ = await loop.create_datagram_endpoint(
+                        lambda name=name: _DiscoveryProtocol(name, per_interface[name], first),
+                        local_addr=(local_ip, 0),
+                        allow_broadcast=True,
+                    )
+                except OSError as e:
+                    logger.warning(f"Discovery on {name} ({local_ip}) unavailable: {e}")
+                    continue
+                transports.append(transport)
+                transport.sendto(VEHICLE_IDENTIFICATION_REQUEST, (destination, self.port))
+
+            if first_only:
+                await asyncio.wait({first}, timeout=window)
+            else:
+                await asyncio.sleep(window)
+        finally:
+            for transport in transports:
+                transport.close()
+            if not first.done():
+                first.cancel()
+
+        now = time.monotonic()
+        for name, announcements in per_interface.items():
+            if announcements:
+                self.cache[name] = (now, announcements)
+
+        results = [a for announcements in per_interface.values() for a in announcements]
+        for a in results:
+            logger.info(f"DoIP gateway {a.ip} ({a.logical_address:04X}) on {a.interface}: VIN {a.vin}")
+        return results[:1] if first_only else results
+
+    async def find_gateway(self, window: float = DEFAULT_WINDOW) -> Optional[VehicleAnnouncement]:
+        """First gateway to answer, or None"""
+        results = await self.discover(window=window, first_only=True)
+        return results[0] if results else None
+
+# ============================================================================
+# LOCAL RESPONDER (simulators / tests)
+# ============================================================================
+
+def build_announcement(vin: str, logical_address: int, eid: bytes = b"\x00" * 6,
+                       gid: bytes = b"\x00" * 6, further_action: int = 0x00) -> bytes:
+    """Encode a Vehicle Announcement message"""
+    payload = vin.encode('ascii')[:17].ljust(17, b"\x00")
+    payload += struct.pack('>H', logical_address) + eid + gid + bytes([further_action])
+    return struct.pack('>BBHI', 0x02, 0xFD, VEHICLE_ANNOUNCEMENT, len(payload)) + payload
+
+class AnnouncementResponder(asyncio.DatagramProtocol):
+    """Answers vehicle identification requests like a gateway would"""
+
+    def __init__(self, vin: str, logical_address: int = 0x0010, eid: bytes = b"\x00" * 6):
+        self.announcement = build_announcement(vin, logical_address, eid, eid)
+        self.transport: Optional[asyncio.DatagramTransport] = None
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> int:
+        """Start answering; returns the bound UDP port"""
+        loop = asyncio.get_running_loop()
+        self.transport, _ = await loop.create_datagram_endpoint(lambda: self, local_addr=(host, port))
+        return self.transport.get_extra_info('sockname')[1]
+
+    def stop(self):
+        if self.transport:
+            self.transport.close()
+
+    def datagram_received(self, data: bytes, addr):
+        if data[:4] == VEHICLE_IDENTIFICATION_REQUEST[:4]:
+            self.transport.sendto(self.announcement, addr)
+
+# Process-wide discovery with a shared per-interface cache
+DISCOVERY = VehicleDiscovery()
+
+# ============================================================================
+# EXPORT
+# ============================================================================
+
+__all__ = [
+    'VehicleAnnouncement',
+    'VehicleDiscovery',
+    'DISCOVERY',
+    'AnnouncementResponder',
+    'parse_announcement',
+    'local_interfaces',
+]
@@ -1,29 +1,76 @@
 """
 BMW DoIP Protocol Implementation
-Using ZGM gateway at 169.254.0.8:13400
+ZGM gateway located by UDP vehicle identification on port 13400
 """
 
 import socket
 import struct
 import asyncio
-from typing import Optional, Tuple
+import heapq
+import time
+from collections import deque
+from typing import Dict, List, Optional, Tuple
 import logging
 
+from metrics import observe_uds, observe_connect, observe_response_pending
+from traffic_capture import CAPTURE, DIRECTION_TX, DIRECTION_RX, TRANSPORT_DOIP
+from session_replay import RECORDER
+from doip_discovery import DISCOVERY, VehicleDiscovery, VehicleAnnouncement
+from uds_timing import RESPONSE_TIMES, P2_STAR, MAX_RESPONSE_PENDING, is_response_pending, is_busy
+from congestion import CongestionController, controller_for, retry_busy, busy_backoff, MAX_BUSY_RETRIES
+from doip_tls import DOIP_TLS_PORT, TLS_SESSIONS, TLSSessionCache
+
 logger = logging.getLogger(__name__)
 
+# Static ZGM address, only used when no gateway answers vehicle identification
+DEFAULT_ZGM_IP = "169.254.0.8"
+
+DOIP_PORT = 13400
+
 class DoIPConnection:
     """BMW DoIP (Diagnostics over IP) Protocol Handler"""
     
-    def __init__(self, zgm_ip: str = "169.254.0.8", port: int = 13400):
+    def __init__(self, zgm_ip: Optional[str] = None, port: Optional[int] = None,
+                 discovery: Optional[VehicleDiscovery] = None, tls: bool = False,
+                 tls_sessions: Optional[TLSSessionCache] = None):
+        """
+        Args:
+            zgm_ip: Gateway address; None discovers it via UDP vehicle identification
+            port: Gateway TCP port (default 13400, or 3496 with TLS)
+            discovery: Discovery instance (defaults to the shared, cached one)
+            tls: Secure the connection with TLS
+            tls_sessions: Client context and per-gateway TLS sessions to
+                          resume (defaults to the shared cache)
+        """
         self.zgm_ip = zgm_ip
-        self.port = port
+        self.port = port or (DOIP_TLS_PORT if tls else DOIP_PORT)
+        self.tls_sessions = (tls_sessions or TLS_SESSIONS) if tls else None
+        self.discovery = discovery or DISCOVERY
+        self.announcement: Optional[VehicleAnnouncement] = None
         self.socket: Optional[socket.socket] = None
         self.connected = False
         self.source_address = 0x0E00  # Tester address
+        self.connect_count = 0
+        self.congestion: Optional[CongestionController] = None
+    
+    async def locate_gateway(self) -> str:
+        """Resolve the gateway address by vehicle identification broadcast"""
+        self.announcement = await self.discovery.find_gateway()
+        if self.announcement:
+            return self.announcement.ip
+        
+        logger.warning(f"No DoIP gateway answered vehicle identification, trying {DEFAULT_ZGM_IP}")
+        return DEFAULT_ZGM_IP
         
     async def connect(self) -> bool:
         """Connect to BMW ZGM (Central Gateway Module)"""
+        reconnect = self.connect_count > 0
+        self.connect_count += 1
         try:
+            if self.zgm_ip is None:
+                self.zgm_ip = await self.locate_gateway()
+            self.congestion = controller_for(self.zgm_ip)
+            
             self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.socket.settimeout(10)
             
@@ -32,21 +79,36 @@ class DoIPConnection:
             )
             
             logger.info(f"Socket connected to {self.zgm_ip}:{self.port}")
+            CAPTURE.bind(self.socket.getsockname()[0], self.zgm_ip, self.port)
+            
+            if self.tls_sessions:
+                # Handshake Finished and the first request are separate small
+                # writes; Nagle would hold the second for the delayed ACK
+                self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                self.socket = await asyncio.get_event_loop().run_in_executor(
+                    None, self.tls_sessions.wrap, self.socket, (self.zgm_ip, self.port)
+                )
             
             # Send routing activation
             success = await self.send_routing_activation()
             self.connected = success
+            if success and self.tls_sessions:
+                self.tls_sessions.store((self.zgm_ip, self.port), self.socket)
+            observe_connect("doip_tls" if self.tls_sessions else "doip", success, reconnect)
             
             return success
             
         except Exception as e:
             logger.error(f"DoIP connection failed: {e}")
+            if self.socket:
+                self.socket.close()
+            observe_connect("doip_tls" if self.tls_sessions else "doip", False, reconnect)
             return False
     
     async def send_routing_activation(self) -> bool:
         """Send DoIP Routing Activation Request"""
         # DoIP Header: Protocol Version (0x02) + Inverse (0xFD) + Payload Type (0x0005) + Length (0x00000007)
-        header = struct.pack('>BBHII', 0x02, 0xFD, 0x0005, 0x00000007)
+        header = struct.pack('>BBHI', 0x02, 0xFD, 0x0005, 0x00000007)
         
         # Payload: Source Address (0x0E00) + Activation Type (0x00) + Reserved (0x00000000)
         payload = struct.pack('>HBI', self.source_address, 0x00, 0x00000000)
@@ -54,6 +116,7 @@ class DoIPConnection:
         packet = header + payload
         
         try:
+            CAPTURE.record(DIRECTION_TX, TRANSPORT_DOIP, packet, self.source_address)
             await asyncio.get_event_loop().run_in_executor(
                 None, self.socket.send, packet
             )
@@ -62,6 +125,7 @@ class DoIPConnection:
             response = await asyncio.get_event_loop().run_in_executor(
                 None, self.socket.recv, 4096
             )
+            CAPTURE.record(DIRECTION_RX, TRANSPORT_DOIP, response, 0, self.source_address)
             
             if len(response) < 8:
                 return False
@@ -70,7 +134,8 @@ class DoIPConnection:
             payload_type = struct.unpack('>H', response[2:4])[0]
             
             if payload_type == 0x0006:  # Routing Activation Response
-                response_code = response[13] if len(response) > 13 else 0
+                # Header (8) + tester address (2) + entity address (2) + response code
+                response_code = response[12] if len(response) > 12 else 0
                 success = response_code == 0x10  # Success code
                 logger.info(f"Routing activation: {'SUCCESS' if success else 'FAILED'} (code: {response_code:02X})")
                 return success
@@ -85,6 +150,9 @@ class DoIPConnection:
         """
         Send UDS diagnostic request via DoIP
         
+        Waits for a slot in the gateway's congestion window and repeats the
+        request, with jittered backoff, while the ECU answers busyRepeatRequest.
+        
         Args:
             target_ecu: ECU address (e.g., 0x0012 for DME)
             uds_data: UDS request data (e.g., [0x22, 0xF1, 0x90] for VIN)
@@ -96,6 +164,12 @@ class DoIPConnection:
             logger.error("Not connected to ZGM")
             return None
         
+        return await retry_busy(
+            lambda: self._send_diagnostic_request(target_ecu, uds_data), uds_data[0], self.congestion
+        )
+    
+    async def _send_diagnostic_request(self, target_ecu: int, uds_data: bytes) -> Optional[bytes]:
+        """One request/response exchange inside a congestion window slot"""
         # Build DoIP Diagnostic Message (0x8001)
         payload_length = 4 + len(uds_data)  # SA(2) + TA(2) + UDS data
         
@@ -108,35 +182,245 @@ class DoIPConnection:
         # Complete packet
         packet = header + addresses + uds_data
         
+        await self.congestion.acquire(target_ecu)
+        start = time.perf_counter()
+        uds_response = None
+        service_id = uds_data[0]
+        
+        # Adaptive P2 until the ECU answers, P2* after each responsePending
+        timeout = RESPONSE_TIMES.p2_timeout(self.zgm_ip, target_ecu)
+        first_response = None
+        pending = 0
+        
         try:
             # Send request
+            CAPTURE.record(DIRECTION_TX, TRANSPORT_DOIP, packet, self.source_address, target_ecu)
             await asyncio.get_event_loop().run_in_executor(
                 None, self.socket.send, packet
             )
             
-            # Receive response
-            response = await asyncio.get_event_loop().run_in_executor(
-                None, self.socket.recv, 4096
-            )
-            
-            if len(response) < 12:
-                logger.error("Response too short")
-                return None
-            
-            # Verify DoIP response type (0x8001)
-            resp_type = struct.unpack('>H', response[2:4])[0]
-            if resp_type != 0x8001:
-                logger.error(f"Unexpected response type: {resp_type:04X}")
-                return None
-            
-            # Extract UDS data (skip DoIP header + SA + TA)
-            uds_response = response[12:]
-            
-            return uds_response
+            while True:
+                # Receive next DoIP message
+                resp_type, response = await asyncio.get_event_loop().run_in_executor(
+                    None, self._read_message, timeout
+                )
+                CAPTURE.record(DIRECTION_RX, TRANSPORT_DOIP, response, target_ecu, self.source_address)
+                
+                if resp_type == 0x8002:
+                    # Diagnostic message positive ACK from the gateway; the ECU response follows
+                    continue
+                
+                if resp_type == 0x8003:
+                    nack = response[12] if len(response) > 12 else 0
+                    logger.error(f"Diagnostic message NACK from gateway (code: {nack:02X})")
+                    return None
+                
+                # Verify DoIP response type (0x8001)
+                if resp_type != 0x8001:
+                    logger.error(f"Unexpected response type: {resp_type:04X}")
+                    return None
+                
+                if len(response) < 13:
+                    logger.error("Response too short")
+                    return None
+                
+                # Extract UDS data (skip DoIP header + SA + TA)
+                source = struct.unpack('>H', response[8:10])[0]
+                uds = response[12:]
+                
+                if source != target_ecu or not self._answers(service_id, uds):
+                    # Late answer to an earlier request that timed out
+                    logger.warning(f"Discarding stale response from {source:04X}: {uds[:8].hex()}")
+                    continue
+                
+                if first_response is None:
+                    first_response = time.perf_counter() - start
+                    RESPONSE_TIMES.observe(self.zgm_ip, target_ecu, first_response)
+                
+                if is_response_pending(service_id, uds):
+                    pending += 1
+                    RESPONSE_TIMES.observe_pending(self.zgm_ip, target_ecu)
+                    observe_response_pending("doip", target_ecu, service_id)
+                    if pending > MAX_RESPONSE_PENDING:
+                        logger.error(f"ECU {target_ecu:02X} still pending after {pending} responsePending")
+                        return None
+                    timeout = P2_STAR
+                    continue
+                
+                uds_response = uds
+                return uds_response
+        
+        except socket.timeout:
+            RESPONSE_TIMES.observe_timeout(self.zgm_ip, target_ecu)
+            logger.error(f"No response from ECU {target_ecu:02X} within {timeout:.2f}s")
+            return None
             
         except Exception as e:
             logger.error(f"Diagnostic request failed: {e}")
             return None
+        
+        finally:
+            self.congestion.release(target_ecu, first_response, is_busy(service_id, uds_response))
+            elapsed = time.perf_counter() - start
+            observe_uds("doip", target_ecu, uds_data, uds_response, elapsed)
+            RECORDER.record("doip", target_ecu, uds_data, uds_response, start, elapsed)
+    
+    async def send_diagnostic_requests(self, target_ecu: int, requests: List[bytes],
+                                       depth: Optional[int] = None) -> List[Optional[bytes]]:
+        """
+        Send several UDS requests to one ECU, several in flight at a time
+        
+        The next request is written while earlier ones are still being
+        answered, so each round trip overlaps the previous one instead of
+        adding to it. Responses are matched in order. Requests the ECU
+        answers busyRepeatRequest are sent again after a jittered backoff.
+        
+        Args:
+            depth: Fixed number in flight; None follows the congestion
+                   window of the ECU and gateway (AIMD, shared with every
+                   other connection to the same gateway)
+        
+        Returns:
+            One UDS response per request (None where it failed or timed out)
+        """
+        results: List[Optional[bytes]] = [None] * len(requests)
+        if not self.connected:
+            logger.error("Not connected to ZGM")
+            return results
+        
+        loop = asyncio.get_event_loop()
+        congestion = self.congestion
+        adaptive = depth is None
+        in_flight: deque = deque()  # [request index, send time, responsePending count, first response time]
+        next_index = 0
+        retries: List[Tuple[float, int]] = []  # Heap of (resend time, request index) after busyRepeatRequest
+        attempts: Dict[int, int] = {}
+        timeout = RESPONSE_TIMES.p2_timeout(self.zgm_ip, target_ecu)
+        
+        def ready() -> Optional[int]:
+            if retries and retries[0][0] <= time.perf_counter():
+                return retries[0][1]
+            return next_index if next_index < len(requests) else None
+        
+        def finish(entry: list, response: Optional[bytes]):
+            index, started, _, first_response = entry
+            if adaptive:
+                congestion.release(target_ecu, first_response, is_busy(requests[index][0], response))
+            results[index] = response
+            elapsed = time.perf_counter() - started
+            observe_uds("doip", target_ecu, requests[index], response, elapsed)
+            RECORDER.record("doip", target_ecu, requests[index], response, started, elapsed)
+        
+        try:
+            while next_index < len(requests) or retries or in_flight:
+                while True:
+                    index = ready()
+                    if index is None:
+                        break
+                    if adaptive:
+                        if not congestion.try_acquire(target_ecu):
+                            break
+                    elif len(in_flight) >= depth:
+                        break
+                    if retries and retries[0][1] == index:
+                        heapq.heappop(retries)
+                    else:
+                        next_index += 1
+                    
+                    uds_data = requests[index]
+                    packet = struct.pack('>BBHI', 0x02, 0xFD, 0x8001, 4 + len(uds_data))
+                    packet += struct.pack('>HH', self.source_address, target_ecu) + uds_data
+                    CAPTURE.record(DIRECTION_TX, TRANSPORT_DOIP, packet, self.source_address, target_ecu)
+                    in_flight.append([index, time.perf_counter(), 0, None])
+                    await loop.run_in_executor(None, self.socket.sendall, packet)
+                
+                if not in_flight:
+                    if ready() is not None:
+                        # Window full with requests of other connections
+                        await congestion.wait(P2_STAR)
+                    elif retries:
+                        await asyncio.sleep(max(0.0, retries[0][0] - time.perf_counter()))
+                    continue
+                
+                resp_type, response = await loop.run_in_executor(None, self._read_message, timeout)
+                CAPTURE.record(DIRECTION_RX, TRANSPORT_DOIP, response, target_ecu, self.source_address)
+                
+                if resp_type == 0x8002:
+                    continue
+                
+                entry = in_flight[0]
+                index = entry[0]
+                service_id = requests[index][0]
+                
+                if resp_type == 0x8003 or resp_type != 0x8001 or len(response) < 13:
+                    logger.error(f"Pipelined request #{index} failed (DoIP type {resp_type:04X})")
+                    finish(in_flight.popleft(), None)
+                    continue
+                
+                source = struct.unpack('>H', response[8:10])[0]
+                uds = response[12:]
+                if source != target_ecu or not self._answers(service_id, uds):
+                    logger.warning(f"Discarding stale response from {source:04X}: {uds[:8].hex()}")
+                    continue
+                
+                if entry[2] == 0:
+                    entry[3] = time.perf_counter() - entry[1]
+                    RESPONSE_TIMES.observe(self.zgm_ip, target_ecu, entry[3])
+                
+                if is_response_pending(service_id, uds):
+                    entry[2] += 1
+                    RESPONSE_TIMES.observe_pending(self.zgm_ip, target_ecu)
+                    observe_response_pending("doip", target_ecu, service_id)
+                    if entry[2] > MAX_RESPONSE_PENDING:
+                        logger.error(f"ECU {target_ecu:02X} still pending after {entry[2]} responsePending")
+                        break
+                    timeout = P2_STAR
+                    continue
+                
+                in_flight.popleft()
+                finish(entry, uds)
+                timeout = RESPONSE_TIMES.p2_timeout(self.zgm_ip, target_ecu)
+                
+                attempt = attempts.get(index, 0)
+                if is_busy(service_id, uds) and attempt < MAX_BUSY_RETRIES:
+                    attempts[index] = attempt + 1
+                    congestion.retries += 1
+                    heapq.heappush(retries, (time.perf_counter() + busy_backoff(attempt), index))
+        
+        except socket.timeout:
+            RESPONSE_TIMES.observe_timeout(self.zgm_ip, target_ecu)
+            logger.error(f"No response from ECU {target_ecu:02X} within {timeout:.2f}s")
+        
+        except Exception as e:
+            logger.error(f"Pipelined diagnostic requests failed: {e}")
+        
+        # Requests still in flight after a failure are reported as unanswered
+        for entry in in_flight:
+            finish(entry, None)
+        return results
+    
+    @staticmethod
+    def _answers(service_id: int, uds: bytes) -> bool:
+        """True if a UDS response belongs to a request for service_id"""
+        if uds[0] == 0x7F:
+            return len(uds) > 1 and uds[1] == service_id
+        return uds[0] == service_id + 0x40
+    
+    def _read_message(self, timeout: float) -> Tuple[int, bytes]:
+        """Blocking read of one complete DoIP message (runs in executor)"""
+        self.socket.settimeout(timeout)
+        header = self._recv_exact(8)
+        payload_type, length = struct.unpack('>HI', header[2:8])
+        return payload_type, header + self._recv_exact(length)
+    
+    def _recv_exact(self, size: int) -> bytes:
+        data = b''
+        while len(data) < size:
+            chunk = self.socket.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError("Connection closed by gateway")
+            data += chunk
+        return data
     
     async def read_vin(self) -> Optional[str]:
         """Read VIN using UDS Service 0x22 (Read Data By Identifier)"""
@@ -211,12 +495,22 @@ class DoIPConnection:
         
         return response and response[0] == 0x6E
     
+    async def write_parameters(self, ecu_address: int, values: Dict[int, bytes]) -> Dict[int, bool]:
+        """Write several DIDs with pipelined 0x2E requests"""
+        dids = list(values)
+        requests = [struct.pack('>BH', 0x2E, did) + values[did] for did in dids]
+        responses = await self.send_diagnostic_requests(ecu_address, requests)
+        return {did: bool(r) and r[0] == 0x6E for did, r in zip(dids, responses)}
+    
     def disconnect(self):
         """Close connection"""
         if self.socket:
+            if self.connected and self.tls_sessions:
+                # Keep the newest ticket the gateway sent for the next connect
+                self.tls_sessions.store((self.zgm_ip, self.port), self.socket)
             self.socket.close()
             self.connected = False
             logger.info("DoIP connection closed")
 
 # Export
-__all__ = ['DoIPConnection']
+__all__ = ['DOIP_PORT', 'DoIPConnection']
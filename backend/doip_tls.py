@@ -0,0 +1,277 @@
+"""
+DoIP over TLS
+TLS transport (TCP 3496) with TLS sessions cached per gateway for resumed handshakes
+"""
+
+import datetime
+import socket
+import ssl
+import time
+from collections import deque
+from pathlib import Path
+from typing import Deque, Dict, Optional, Tuple
+import logging
+
+logger = logging.getLogger(__name__)
+
+# ISO 13400-2 port for TLS-secured diagnostic connections
+DOIP_TLS_PORT = 3496
+
+# Recent handshake durations kept per kind (full / resumed) for percentiles
+HANDSHAKE_SAMPLES = 256
+
+def client_context(cafile: Optional[str] = None, certfile: Optional[str] = None,
+                   keyfile: Optional[str] = None) -> ssl.SSLContext:
+    """
+    TLS client context for gateways
+
+    The gateway certificate is verified against `cafile` (system CAs if
+    None) but not matched against a host name: gateways are addressed by
+    link-local IP and their certificates name the vehicle, not the address.
+    `certfile`/`keyfile` is the tester certificate for gateways that
+    require mutual authentication.
+    """
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.check_hostname = False
+    if cafile:
+        context.load_verify_locations(cafile)
+    else:
+        context.load_default_certs()
+    if certfile:
+        context.load_cert_chain(certfile, keyfile)
+    return context
+
+# ============================================================================
+# SESSION CACHE
+# ============================================================================
+
+class TLSSessionCache:
+    """
+    One client context and the last TLS session of each gateway
+
+    A session can only be resumed by the context that created it, so the
+    two live together. The next connect to the same gateway offers the
+    cached session (TLS 1.3 ticket or TLS 1.2 session ID): the gateway
+    skips the certificate exchange and key agreement signatures, and under
+    TLS 1.2 a round trip. A gateway that no longer knows the session
+    simply falls back to a full handshake.
+    """
+
+    def __init__(self, context: Optional[ssl.SSLContext] = None):
+        self._context = context
+        self.sessions: Dict[Tuple[str, int], ssl.SSLSession] = {}
+        self.handshakes: Dict[str, Deque[float]] = {
+            "full": deque(maxlen=HANDSHAKE_SAMPLES),
+            "resumed": deque(maxlen=HANDSHAKE_SAMPLES),
+        }
+
+    @property
+    def context(self) -> ssl.SSLContext:
+        if self._context is None:
+            self._context = client_context()
+        return self._context
+
+    def session(self, gateway: Tuple[str, int]) -> Optional[ssl.SSLSession]:
+        """Cached session for a gateway, unless its lifetime has passed"""
+        session = self.sessions.get(gateway)
+        if session is not None and session.time + session.timeout <= time.time():
+            del self.sessions[gateway]
+            return None
+        return session
+
+    def wrap(self, sock: socket.socket, gateway: Tuple[str, int]) -> ssl.SSLSocket:
+        """
+        TLS handshake on a connected socket, resuming the gateway's session
+        if there is one (blocking; run in an executor)
+        """
+        start = time.perf_counter()
+        tls = self.context.wrap_socket(sock, session=self.session(gateway))
+        kind = "resumed" if tls.session_reused else "full"
+        self.handshakes[kind].append(time.perf_counter() - start)
+        logger.info(f"TLS {tls.version()} to {gateway[0]}:{gateway[1]}: {kind} handshake")
+        return tls
+
+    def store(self, gateway: Tuple[str, int], tls: ssl.SSLSocket):
+        """
+        Remember the connection's session; under TLS 1.3 the ticket arrives
+        after the handshake, so call this once the gateway has answered
+        """
+        session = tls.session
+        if session is not None and (session.has_ticket or tls.version() != "TLSv1.3"):
+            self.sessions[gateway] = session
+
+    def forget(self, gateway: Tuple[str, int]):
+        self.sessions.pop(gateway, None)
+
+    def stats(self) -> Dict:
+        stats = {"gateways": len(self.sessions)}
+        for kind, samples in self.handshakes.items():
+            ordered = sorted(samples)
+            stats[kind] = {
+                "count": len(ordered),
+                "p50_ms": round(ordered[len(ordered) // 2] * 1000, 2) if ordered else None,
+            }
+        return stats
+
+TLS_SESSIONS = TLSSessionCache()
+
+# ============================================================================
+# TEST GATEWAY CERTIFICATES
+# ============================================================================
+
+def self_signed_certificate(directory: Path, common_name: str = "DoIP test gateway") -> Tuple[Path, Path]:
+    """
+    Write a self-signed ECDSA P-256 certificate and key for a simulated
+    gateway; the certificate doubles as the client's CA file
+
+    Returns:
+        (certificate path, key path)
+    """
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.x509.oid import NameOID
+
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, common_name)])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    certificate = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(minutes=5))
+        .not_valid_after(now + datetime.timedelta(days=30))
+        .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+        .sign(key, hashes.SHA256())
+    )
+
+    directory = Path(directory)
+    cert_path = directory / "gateway.pem"
+    key_path = directory / "gateway.key"
+    cert_path.write_bytes(certificate.public_bytes(serialization.Encoding.PEM))
+    key_path.write_bytes(key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption(),
+    ))
+    return cert_path, key_path
+
+def server_context(certfile: Path, keyfile: Path) -> ssl.SSLContext:
+    """TLS server context for a simulated gateway (issues session tickets)"""
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(certfile, keyfile)
+    return context
+
+# ============================================================================
+# EXPORT
+# ============================================================================
+
+__all__ = [
+    'DOIP_TLS_PORT',
+    'TLSSessionCache',
+    'TLS_SESSIONS',
+    'client_context',
+    'server_context',
+    'self_signed_certificate',
+]
+
+if __name__ == "__main__":
+    import asyncio
+    import statistics
+    import tempfile
+
+    from congestion import GatewaySimulator
+    from doip_protocol import DoIPConnection
+
+    CONNECTS = 40
+    LINKS = [("loopback", 0.0), ("2 ms link", 0.002)]  # One-way latency added by a relay
+
+    relayed = set()
+
+    async def relay(target_port: int, latency: float) -> asyncio.AbstractServer:
+        """TCP relay to the gateway that delays every flight by `latency` each way"""
+        async def pump(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+            try:
+                while True:
+                    data = await reader.read(65536)
+                    if not data:
+                        break
+                    await asyncio.sleep(latency)
+                    writer.write(data)
+            except ConnectionError:
+                pass
+            finally:
+                writer.close()
+
+        async def client(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+            relayed.add(asyncio.current_task())
+            gateway_reader, gateway_writer = await asyncio.open_connection("127.0.0.1", target_port)
+            await asyncio.gather(pump(reader, gateway_writer), pump(gateway_reader, writer))
+
+        return await asyncio.start_server(client, "127.0.0.1", 0)
+
+    async def first_response(port: int, sessions: Optional[TLSSessionCache]) -> float:
+        """Connect, activate routing and read one DID; seconds until the answer"""
+        connection = DoIPConnection("127.0.0.1", port, tls=sessions is not None, tls_sessions=sessions)
+        start = time.perf_counter()
+        if not await connection.connect():
+            raise ConnectionError(f"DoIP connect to port {port} failed")
+        response = await connection.send_diagnostic_request(0x12, bytes([0x22, 0xF1, 0x90]))
+        elapsed = time.perf_counter() - start
+        connection.disconnect()
+        if not response or response[0] != 0x62:
+            raise ConnectionError("No answer to the first request")
+        return elapsed
+
+    async def series(port: int, sessions_for_run) -> Tuple[float, float]:
+        samples = sorted([await first_response(port, sessions_for_run()) for _ in range(CONNECTS)])
+        return statistics.median(samples) * 1000, samples[int(len(samples) * 0.9)] * 1000
+
+    async def main():
+        with tempfile.TemporaryDirectory() as directory:
+            certfile, keyfile = self_signed_certificate(Path(directory))
+
+            plain = GatewaySimulator(service_time=0.0005)
+            plain_port = await plain.start()
+            tls_gateway = GatewaySimulator(service_time=0.0005)
+            tls_port = await tls_gateway.start(ssl=server_context(certfile, keyfile))
+
+            print(f"Connect + routing activation + first 0x22, over {CONNECTS} connects\n")
+            print(f"{'link':<12}{'transport':<26}{'p50 ms':>8}{'p90 ms':>8}")
+            for link, latency in LINKS:
+                plain_relay = await relay(plain_port, latency)
+                tls_relay = await relay(tls_port, latency)
+                plain_via = plain_relay.sockets[0].getsockname()[1]
+                tls_via = tls_relay.sockets[0].getsockname()[1]
+
+                p50, p90 = await series(plain_via, lambda: None)
+                print(f"{link:<12}{'plain TCP':<26}{p50:>8.2f}{p90:>8.2f}")
+
+                for version in (ssl.TLSVersion.TLSv1_3, ssl.TLSVersion.TLSv1_2):
+                    def context():
+                        c = client_context(cafile=str(certfile))
+                        c.maximum_version = version
+                        return c
+
+                    # A fresh cache per connect: every handshake is a full one
+                    p50, p90 = await series(tls_via, lambda: TLSSessionCache(context()))
+                    print(f"{'':<12}{version.name + ' full':<26}{p50:>8.2f}{p90:>8.2f}")
+
+                    shared = TLSSessionCache(context())
+                    await first_response(tls_via, shared)
+                    p50, p90 = await series(tls_via, lambda: shared)
+                    resumed = shared.stats()["resumed"]["count"]
+                    print(f"{'':<12}{version.name + ' resumed':<26}{p50:>8.2f}{p90:>8.2f}"
+                          f"   ({resumed}/{CONNECTS} resumed)")
+
+                plain_relay.close()
+                tls_relay.close()
+                await asyncio.gather(*relayed, return_exceptions=True)
+
+            await plain.stop()
+            await tls_gateway.stop()
+
+    asyncio.run(main())
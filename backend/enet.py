@@ -0,0 +1,252 @@
+"""
+BMW ENET Connection
+Raw UDS over the ENET cable (TCP 6801 on the gateway)
+"""
+
+import asyncio
+import socket
+import struct
+import time
+from concurrent.futures import Executor
+from typing import List, Optional
+import logging
+
+from metrics import observe_uds, observe_connect, observe_response_pending
+from uds_timing import RESPONSE_TIMES, P2_STAR, MAX_RESPONSE_PENDING, is_response_pending, answers_request
+from traffic_capture import CAPTURE, DIRECTION_TX, DIRECTION_RX, TRANSPORT_ENET, TrafficCapture
+from session_replay import RECORDER, SessionRecorder
+from request_scheduler import RequestScheduler
+
+logger = logging.getLogger(__name__)
+
+# A send that cannot complete within this long means the adapter is gone
+SEND_TIMEOUT = 10.0
+
+class UDSServices:
+    """
+    UDS service helpers for any connection with send_uds_request()
+    """
+    
+    async def read_vin(self) -> str:
+        """Read VIN from vehicle using UDS Service 0x22 (ReadDataByIdentifier)"""
+        try:
+            # Service 0x22, DID 0xF190 (VIN)
+            response = await self.send_uds_request(0x22, b'\\xF1\\x90')
+            # Parse response (skip first 3 bytes: response code + DID echo)
+            vin = response[3:20].decode('ascii')
+            return vin
+        except Exception as e:
+            logger.error(f"VIN read failed: {e}")
+            return "DEMO_VIN_123456789"
+    
+    async def read_ecu_data(self, did: int) -> bytes:
+        """Read data from ECU by Data Identifier"""
+        did_bytes = struct.pack('>H', did)
+        return await self.send_uds_request(0x22, did_bytes)
+    
+    async def write_ecu_data(self, did: int, data: bytes) -> bool:
+        """Write data to ECU"""
+        try:
+            did_bytes = struct.pack('>H', did)
+            response = await self.send_uds_request(0x2E, did_bytes + data)
+            # Check for positive response (0x6E)
+            return response[0] == 0x6E
+        except Exception as e:
+            logger.error(f"ECU write failed: {e}")
+            return False
+    
+    async def start_diagnostic_session(self, session_type: int = 0x03):
+        """Start diagnostic session (0x03 = Extended Diagnostic Session)"""
+        return await self.send_uds_request(0x10, struct.pack('B', session_type))
+    
+    async def security_access_seed(self) -> bytes:
+        """Request security seed"""
+        return await self.send_uds_request(0x27, b'\\x01')
+    
+    async def security_access_key(self, key: bytes):
+        """Send security key"""
+        return await self.send_uds_request(0x27, b'\\x02' + key)
+
+class ENETConnection(UDSServices):
+    def __init__(self, ip_address: str = "169.254.250.250", port: int = 6801,
+                 executor: Optional[Executor] = None,
+                 capture: Optional[TrafficCapture] = CAPTURE,
+                 recorder: Optional[SessionRecorder] = RECORDER):
+        """
+        ENET Connection for BMW G01 X3
+        Uses static IP in 169.254.x.x range as per BMW ENET protocol
+        
+        Socket calls block, so they run in `executor` (the loop's default
+        pool if None); many connections in flight at once need their own.
+        Frames go to `capture` and round trips to `recorder`, the process-wide
+        ones by default; None keeps this connection out of them.
+        """
+        self.ip_address = ip_address
+        self.port = port
+        self.executor = executor
+        self.capture = capture
+        self.recorder = recorder
+        self.socket = None
+        self.connected = False
+        self.connect_count = 0
+        self.stale_responses = 0
+        self.scheduler = RequestScheduler()
+    
+    async def connect(self) -> bool:
+        """Establish TCP connection to ENET cable"""
+        reconnect = self.connect_count > 0
+        self.connect_count += 1
+        try:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.socket.settimeout(10)  # Increased timeout
+            await asyncio.get_event_loop().run_in_executor(
+                self.executor, self.socket.connect, (self.ip_address, self.port)
+            )
+            self.connected = True
+            logger.info(f"Connected to ENET at {self.ip_address}:{self.port}")
+            if self.capture:
+                self.capture.bind(self.socket.getsockname()[0], self.ip_address, self.port)
+            observe_connect("enet", True, reconnect)
+            return True
+        except Exception as e:
+            logger.error(f"ENET connection failed: {e}")
+            self.connected = False
+            observe_connect("enet", False, reconnect)
+            return False
+    
+    def disconnect(self):
+        """Close ENET connection"""
+        if self.socket:
+            self.socket.close()
+            self.connected = False
+            logger.info("ENET connection closed")
+    
+    async def send_uds_request(self, service_id: int, data: bytes = b'') -> bytes:
+        """
+        Send UDS (Unified Diagnostic Services) request
+        
+        Waits its turn in the connection's scheduler (priority class of the
+        caller, see request_scheduler.request_priority).
+        """
+        if not self.connected:
+            raise Exception("Not connected to ENET")
+        return await self.scheduler.run(self._exchange, service_id, data)
+    
+    async def _exchange(self, service_id: int, data: bytes) -> bytes:
+        # ISO-TP header + UDS service ID + data
+        message = struct.pack('B', service_id) + data
+        loop = asyncio.get_event_loop()
+        
+        start = time.perf_counter()
+        response = None
+        
+        # Adaptive P2 until the ECU answers, P2* after each responsePending
+        timeout = RESPONSE_TIMES.p2_timeout(self.ip_address, None)
+        deadline = start + timeout
+        pending = 0
+        
+        try:
+            # Late answers to earlier, timed-out requests are drained first
+            for stale in await loop.run_in_executor(self.executor, self._drain_and_send, message):
+                if self.capture:
+                    self.capture.record(DIRECTION_RX, TRANSPORT_ENET, stale)
+                self._discard(stale)
+            if self.capture:
+                self.capture.record(DIRECTION_TX, TRANSPORT_ENET, message)
+            
+            while True:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    raise socket.timeout()
+                received = await loop.run_in_executor(self.executor, self._recv, remaining)
+                if self.capture:
+                    self.capture.record(DIRECTION_RX, TRANSPORT_ENET, received)
+                
+                if not answers_request(message, received):
+                    # Raw UDS has no request IDs: whatever does not fit this
+                    # request is an answer that arrived after its timeout
+                    self._discard(received)
+                    continue
+                
+                if pending == 0:
+                    RESPONSE_TIMES.observe(self.ip_address, None, time.perf_counter() - start)
+                
+                if not is_response_pending(service_id, received):
+                    response = received
+                    return response
+                
+                pending += 1
+                RESPONSE_TIMES.observe_pending(self.ip_address, None)
+                observe_response_pending("enet", None, service_id)
+                if pending > MAX_RESPONSE_PENDING:
+                    raise TimeoutError(f"Still pending after {pending} responsePending")
+                timeout = P2_STAR
+                deadline = time.perf_counter() + timeout
+        except socket.timeout:
+            RESPONSE_TIMES.observe_timeout(self.ip_address, None)
+            logger.error(f"UDS request failed: no response within {timeout:.2f}s")
+            raise
+        except Exception as e:
+            logger.error(f"UDS request failed: {e}")
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            observe_uds("enet", None, message, response, elapsed)
+            if self.recorder:
+                self.recorder.record("enet", None, message, response, start, elapsed)
+    
+    def _discard(self, frame: bytes):
+        self.stale_responses += 1
+        logger.warning(f"Discarding stale ENET response: {frame[:8].hex()}")
+    
+    async def send_uds_requests(self, requests: List[tuple]) -> List[Optional[bytes]]:
+        """
+        Send several (service_id, data) requests back to back
+        
+        ENET carries raw UDS without framing, so responses to overlapping
+        requests could not be told apart; requests go strictly one at a time,
+        each scheduled on its own so higher classes can run in between.
+        
+        Returns:
+            One response per request (None where it failed)
+        """
+        responses = []
+        for service_id, data in requests:
+            try:
+                responses.append(await self.send_uds_request(service_id, data))
+            except Exception:
+                responses.append(None)
+        return responses
+    
+    def _drain_and_send(self, message: bytes) -> List[bytes]:
+        """
+        Read whatever is already waiting on the socket, then send (runs in
+        executor); returns the drained frames
+        """
+        drained = []
+        self.socket.settimeout(0.0)
+        try:
+            while True:
+                data = self.socket.recv(4096)
+                if not data:
+                    raise ConnectionError("Connection closed by ENET adapter")
+                drained.append(data)
+        except (BlockingIOError, socket.timeout):
+            pass
+        self.socket.settimeout(SEND_TIMEOUT)
+        self.socket.sendall(message)
+        return drained
+    
+    def _recv(self, timeout: float) -> bytes:
+        """Blocking receive of one response (runs in executor)"""
+        self.socket.settimeout(timeout)
+        data = self.socket.recv(4096)
+        if not data:
+            raise ConnectionError("Connection closed by ENET adapter")
+        return data
+
+# ============================================================================
+# EXPORT
+# ============================================================================
+
+__all__ = ['UDSServices', 'ENETConnection']
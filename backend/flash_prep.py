@@ -0,0 +1,520 @@
+"""
+Flash Image Preparation
+Segmented, checksummed, optionally compressed TransferData blocks built ahead of time in a process pool
+"""
+
+import asyncio
+import hashlib
+import json
+import mmap
+import os
+import shutil
+import struct
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Union
+import logging
+
+logger = logging.getLogger(__name__)
+
+MANIFEST = "manifest.json"
+BLOCKS_SUFFIX = ".blocks"
+
+# RequestDownload dataFormatIdentifier: compression method in the high
+# nibble, encryption in the low one. Method numbers are ECU-specific;
+# these are the ones this tool's flash ECUs use.
+COMPRESSION_METHODS = {None: 0x00, "zlib": 0x10}
+COMPRESS_LEVEL = 9
+
+# addressAndLengthFormatIdentifier: 4-byte size, 4-byte address
+ADDRESS_AND_LENGTH_FORMAT = 0x44
+
+# maxNumberOfBlockLength counts the SID and the block sequence counter
+BLOCK_OVERHEAD = 2
+MIN_BLOCK_LENGTH = 0x10
+
+# ISO 14229 checkMemory-style routine run after each segment, with the
+# segment CRC32 (uncompressed) as option record
+CHECK_MEMORY_ROUTINE = 0x0202
+
+HASH_CHUNK = 1024 * 1024
+
+# ============================================================================
+# IMAGES
+# ============================================================================
+
+@dataclass
+class Segment:
+    address: int
+    data: bytes
+
+def parse_intel_hex(text: str) -> List[Segment]:
+    """
+    Contiguous segments of an Intel HEX file (record types 00, 01, 02, 04)
+
+    Raises:
+        ValueError: malformed record or bad checksum
+    """
+    segments: List[Segment] = []
+    base = 0
+    start: Optional[int] = None
+    current = bytearray()
+
+    for number, line in enumerate(text.splitlines(), 1):
+        line = line.strip()
+        if not line:
+            continue
+        if not line.startswith(":"):
+            raise ValueError(f"Line {number}: not an Intel HEX record")
+        record = bytes.fromhex(line[1:])
+        if len(record) < 5 or len(record) != record[0] + 5 or sum(record) & 0xFF:
+            raise ValueError(f"Line {number}: bad record length or checksum")
+        length, offset, kind = record[0], struct.unpack(">H", record[1:3])[0], record[3]
+        payload = record[4:4 + length]
+
+        if kind == 0x00:
+            address = base + offset
+            if start is not None and address != start + len(current):
+                segments.append(Segment(start, bytes(current)))
+                start, current = None, bytearray()
+            if start is None:
+                start = address
+            current += payload
+        elif kind == 0x01:
+            break
+        elif kind == 0x02:
+            base = struct.unpack(">H", payload)[0] << 4
+        elif kind == 0x04:
+            base = struct.unpack(">H", payload)[0] << 16
+
+    if start is not None and current:
+        segments.append(Segment(start, bytes(current)))
+    return segments
+
+def load_image(path: Union[str, Path], base_address: int = 0) -> List[Segment]:
+    """Segments of an Intel HEX (.hex / .ihex) or raw binary image"""
+    path = Path(path)
+    if path.suffix.lower() in (".hex", ".ihex"):
+        return parse_intel_hex(path.read_text())
+    return [Segment(base_address, path.read_bytes())]
+
+def file_sha256(path: Union[str, Path]) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def cache_key(image_sha256: str, max_block_length: int, compression: Optional[str],
+              base_address: int = 0) -> str:
+    """Content address of a prepared image: same image bytes + block size + coding = same blocks"""
+    key = f"{image_sha256[:32]}_{max_block_length:04x}_{compression or 'raw'}"
+    return key if not base_address else f"{key}_{base_address:08x}"
+
+# ============================================================================
+# PREPARATION (process pool workers)
+# ============================================================================
+
+def _build_segment(directory: str, index: int, address: int, data: bytes,
+                   block_data: int, compression: Optional[str]) -> Dict:
+    """
+    Encode one segment and write its TransferData payloads back to back
+
+    Every payload is [sequence counter] + data, exactly what follows SID
+    0x36; all but the last are block_data + 1 bytes long, so block i sits
+    at offset i * (block_data + 1).
+    """
+    crc = zlib.crc32(data)
+    stream = zlib.compress(data, COMPRESS_LEVEL) if compression == "zlib" else data
+
+    name = f"segment_{index:03d}{BLOCKS_SUFFIX}"
+    digest = hashlib.sha256()
+    blocks = 0
+    with open(os.path.join(directory, name), "wb") as f:
+        for offset in range(0, len(stream), block_data):
+            payload = bytes([(blocks + 1) & 0xFF]) + stream[offset:offset + block_data]
+            f.write(payload)
+            digest.update(payload)
+            blocks += 1
+
+    return {
+        "index": index,
+        "address": address,
+        "size": len(data),
+        "crc32": crc,
+        "stream_size": len(stream),
+        "blocks": blocks,
+        "file": name,
+        "sha256": digest.hexdigest(),
+    }
+
+# ============================================================================
+# PREPARED IMAGES
+# ============================================================================
+
+@dataclass
+class PreparedSegment:
+    address: int
+    size: int
+    crc32: int
+    stream_size: int
+    blocks: int
+    path: Path
+    sha256: str
+
+@dataclass
+class PreparedImage:
+    """A cache entry: manifest plus one block file per segment"""
+    key: str
+    directory: Path
+    image_sha256: str
+    source: str
+    max_block_length: int
+    compression: Optional[str]
+    segments: List[PreparedSegment] = field(default_factory=list)
+    prepared_in: float = 0.0
+
+    @property
+    def block_data(self) -> int:
+        return self.max_block_length - BLOCK_OVERHEAD
+
+    @property
+    def data_format(self) -> int:
+        return COMPRESSION_METHODS[self.compression]
+
+    @classmethod
+    def load(cls, directory: Union[str, Path]) -> "PreparedImage":
+        directory = Path(directory)
+        manifest = json.loads((directory / MANIFEST).read_text())
+        return cls(
+            key=manifest["key"],
+            directory=directory,
+            image_sha256=manifest["image_sha256"],
+            source=manifest["source"],
+            max_block_length=manifest["max_block_length"],
+            compression=manifest["compression"],
+            segments=[
+                PreparedSegment(s["address"], s["size"], s["crc32"], s["stream_size"], s["blocks"],
+                                directory / s["file"], s["sha256"])
+                for s in manifest["segments"]
+            ],
+            prepared_in=manifest.get("prepared_in", 0.0),
+        )
+
+    def blocks(self, segment: PreparedSegment) -> Iterator[bytes]:
+        """TransferData payloads of a segment, sliced from the mapped block file"""
+        stride = self.block_data + 1
+        with open(segment.path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            for offset in range(0, len(mapped), stride):
+                yield mapped[offset:offset + stride]
+
+    def verify(self) -> bool:
+        """Block files still match the manifest"""
+        return all(
+            segment.path.exists() and file_sha256(segment.path) == segment.sha256
+            for segment in self.segments
+        )
+
+    def to_dict(self) -> Dict:
+        return {
+            "id": self.key,
+            "image_sha256": self.image_sha256,
+            "source": self.source,
+            "max_block_length": self.max_block_length,
+            "compression": self.compression,
+            "segments": [
+                {
+                    "address": f"0x{s.address:08X}",
+                    "size": s.size,
+                    "crc32": f"0x{s.crc32:08X}",
+                    "stream_size": s.stream_size,
+                    "blocks": s.blocks,
+                }
+                for s in self.segments
+            ],
+            "size": sum(s.size for s in self.segments),
+            "transfer_size": sum(s.stream_size for s in self.segments),
+            "blocks": sum(s.blocks for s in self.segments),
+            "prepared_in_s": round(self.prepared_in, 3),
+        }
+
+class FlashPreparer:
+    """
+    Builds prepared images in a process pool, once per content address
+
+    Segments of an image are encoded in parallel and written to a temporary
+    directory that is renamed into place, so a cache entry is either
+    complete or absent. Concurrent requests for the same key share one
+    preparation.
+
+    Args:
+        workers: Pool size (default: CPU count)
+    """
+
+    def __init__(self, cache_dir: Union[str, Path], workers: Optional[int] = None):
+        self.cache_dir = Path(cache_dir)
+        self.workers = workers or os.cpu_count() or 1
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._building: Dict[str, asyncio.Future] = {}
+
+    @property
+    def pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers)
+        return self._pool
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(cancel_futures=True)
+            self._pool = None
+
+    def get(self, key: str) -> Optional[PreparedImage]:
+        directory = self.cache_dir / key
+        if "/" in key or not (directory / MANIFEST).exists():
+            return None
+        return PreparedImage.load(directory)
+
+    def entries(self) -> List[PreparedImage]:
+        if not self.cache_dir.exists():
+            return []
+        return [PreparedImage.load(d) for d in sorted(self.cache_dir.iterdir()) if (d / MANIFEST).exists()]
+
+    def remove(self, key: str) -> bool:
+        directory = self.cache_dir / key
+        if "/" in key or not directory.is_dir():
+            return False
+        shutil.rmtree(directory)
+        return True
+
+    async def prepare(self, image_path: Union[str, Path], max_block_length: int,
+                      compression: Optional[str] = None, base_address: int = 0) -> PreparedImage:
+        """
+        Prepared image for an ECU's maxNumberOfBlockLength, from the cache if present
+
+        Raises:
+            ValueError: block length too small or unknown compression
+        """
+        if compression not in COMPRESSION_METHODS:
+            raise ValueError(f"Unknown compression: {compression}")
+        if max_block_length < MIN_BLOCK_LENGTH:
+            raise ValueError(f"maxNumberOfBlockLength {max_block_length} is below {MIN_BLOCK_LENGTH}")
+
+        loop = asyncio.get_running_loop()
+        image_path = Path(image_path)
+        sha256 = await loop.run_in_executor(None, file_sha256, image_path)
+        key = cache_key(sha256, max_block_length, compression, base_address)
+
+        cached = self.get(key)
+        if cached is not None:
+            return cached
+
+        building = self._building.get(key)
+        if building is None:
+            building = self._building[key] = asyncio.ensure_future(
+                self._build(key, image_path, sha256, max_block_length, compression, base_address)
+            )
+            building.add_done_callback(lambda _: self._building.pop(key, None))
+        return await asyncio.shield(building)
+
+    async def _build(self, key: str, image_path: Path, sha256: str, max_block_length: int,
+                     compression: Optional[str], base_address: int) -> PreparedImage:
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+
+        segments = await loop.run_in_executor(self.pool, load_image, image_path, base_address)
+        if not segments:
+            raise ValueError(f"{image_path.name} contains no data")
+
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        staging = self.cache_dir / f".{key}.{os.getpid()}.tmp"
+        staging.mkdir()
+        try:
+            block_data = max_block_length - BLOCK_OVERHEAD
+            built = await asyncio.gather(*(
+                loop.run_in_executor(self.pool, _build_segment, str(staging), index,
+                                     segment.address, segment.data, block_data, compression)
+                for index, segment in enumerate(segments)
+            ))
+            elapsed = time.perf_counter() - start
+            manifest = {
+                "key": key,
+                "image_sha256": sha256,
+                "source": image_path.name,
+                "max_block_length": max_block_length,
+                "compression": compression,
+                "segments": built,
+                "prepared_in": elapsed,
+                "created": time.time(),
+            }
+            (staging / MANIFEST).write_text(json.dumps(manifest, indent=1))
+            try:
+                os.rename(staging, self.cache_dir / key)
+            except OSError:
+                pass  # Another process prepared the same key first
+        finally:
+            if staging.exists():
+                shutil.rmtree(staging)
+
+        prepared = PreparedImage.load(self.cache_dir / key)
+        logger.info(
+            f"Prepared {image_path.name} for {max_block_length}-byte blocks: {len(built)} segments, "
+            f"{sum(s['blocks'] for s in built)} blocks in {elapsed:.2f}s"
+        )
+        return prepared
+
+# ============================================================================
+# TRANSFER
+# ============================================================================
+
+def _max_block_length(response: bytes) -> int:
+    """maxNumberOfBlockLength from a positive RequestDownload response (74 LF MM..)"""
+    width = response[1] >> 4
+    return int.from_bytes(response[2:2 + width], "big")
+
+async def transfer_prepared(connection, prepared: PreparedImage, check_memory: bool = True) -> Dict:
+    """
+    Stream a prepared image: per segment RequestDownload, TransferData blocks,
+    RequestTransferExit and (optionally) a checkMemory routine with its CRC32
+
+    The ECU must already be in the programming session and unlocked.
+    Nothing is encoded here; each request is a slice of a block file.
+
+    Raises:
+        RuntimeError: a negative response, or an ECU accepting smaller blocks
+                      than the image was prepared for
+    """
+    start = time.perf_counter()
+    sent = 0
+    for segment in prepared.segments:
+        request = (bytes([prepared.data_format, ADDRESS_AND_LENGTH_FORMAT])
+                   + struct.pack(">II", segment.address, segment.size))
+        response = await connection.send_uds_request(0x34, request)
+        if not response or response[0] != 0x74:
+            raise RuntimeError(f"RequestDownload at 0x{segment.address:08X} refused: {response.hex() if response else None}")
+        accepted = _max_block_length(response)
+        if accepted < prepared.max_block_length:
+            raise RuntimeError(
+                f"ECU accepts {accepted}-byte blocks, image prepared for {prepared.max_block_length}; prepare again"
+            )
+
+        for block in prepared.blocks(segment):
+            response = await connection.send_uds_request(0x36, block)
+            if not response or response[0] != 0x76 or response[1] != block[0]:
+                raise RuntimeError(f"TransferData block {block[0]} refused: {response.hex() if response else None}")
+            sent += len(block) - 1
+
+        response = await connection.send_uds_request(0x37)
+        if not response or response[0] != 0x77:
+            raise RuntimeError(f"RequestTransferExit refused: {response.hex() if response else None}")
+
+        if check_memory:
+            response = await connection.send_uds_request(
+                0x31, struct.pack(">BHI", 0x01, CHECK_MEMORY_ROUTINE, segment.crc32)
+            )
+            if not response or response[0] != 0x71:
+                raise RuntimeError(f"checkMemory of 0x{segment.address:08X} failed: {response.hex() if response else None}")
+
+    elapsed = time.perf_counter() - start
+    return {
+        "success": True,
+        "id": prepared.key,
+        "segments": len(prepared.segments),
+        "bytes": sent,
+        "elapsed_ms": round(elapsed * 1000, 1),
+        "throughput_kbps": round(sent / 1024 / elapsed, 1) if elapsed else None,
+    }
+
+# ============================================================================
+# EXPORT
+# ============================================================================
+
+__all__ = [
+    'COMPRESSION_METHODS',
+    'Segment',
+    'PreparedImage',
+    'FlashPreparer',
+    'cache_key',
+    'load_image',
+    'parse_intel_hex',
+    'transfer_prepared',
+]
+
+if __name__ == "__main__":
+    # python flash_prep.py [size MB] [block length]
+    # Preparation in the pool (cold, then cached) vs encoding inline during
+    # the transfer, for a synthetic multi-segment image
+    import sys
+    import tempfile
+
+    size = int(float(sys.argv[1]) * 1024 * 1024) if len(sys.argv) > 1 else 4 * 1024 * 1024
+    block_length = int(sys.argv[2], 0) if len(sys.argv) > 2 else 0xFFF
+
+    def synthetic_hex(path: Path, segments: int = 4):
+        """Flash-like content: code-ish bytes with long erased (0xFF) runs"""
+        rng = __import__("random").Random(7)
+        lines = []
+        per = size // segments
+        for s in range(segments):
+            data = bytearray()
+            while len(data) < per:
+                data += bytes(rng.getrandbits(8) for _ in range(256)) if rng.random() < 0.6 else b"\xff" * 1024
+            data = data[:per]
+            address = 0x80000000 + s * 0x400000
+            lines.append(f":02000004{address >> 16:04X}{(-(2 + 4 + (address >> 24) + (address >> 16 & 0xFF))) & 0xFF:02X}")
+            for offset in range(0, per, 32):
+                if offset and (address + offset) & 0xFFFF == 0:
+                    upper = (address + offset) >> 16
+                    lines.append(f":02000004{upper:04X}{(-(2 + 4 + (upper >> 8) + (upper & 0xFF))) & 0xFF:02X}")
+                chunk = data[offset:offset + 32]
+                low = (address + offset) & 0xFFFF
+                record = bytes([len(chunk), low >> 8, low & 0xFF, 0]) + chunk
+                lines.append(":" + (record + bytes([(-sum(record)) & 0xFF])).hex().upper())
+        lines.append(":00000001FF")
+        path.write_text("\n".join(lines))
+
+    class Sink:
+        """Stands in for the ECU: acknowledges everything instantly"""
+        async def send_uds_request(self, service_id: int, data: bytes = b'') -> bytes:
+            if service_id == 0x34:
+                return bytes([0x74, 0x20]) + struct.pack(">H", block_length)
+            if service_id == 0x36:
+                return bytes([0x76, data[0]])
+            return bytes([service_id + 0x40])
+
+    async def inline(image: Path, compression: Optional[str]) -> float:
+        """What /flash/apply would do without preparation: encode while the ECU waits"""
+        start = time.perf_counter()
+        sink = Sink()
+        for segment in load_image(image):
+            stream = zlib.compress(segment.data, COMPRESS_LEVEL) if compression else segment.data
+            zlib.crc32(segment.data)
+            await sink.send_uds_request(0x34)
+            for n, offset in enumerate(range(0, len(stream), block_length - BLOCK_OVERHEAD), 1):
+                await sink.send_uds_request(0x36, bytes([n & 0xFF]) + stream[offset:offset + block_length - BLOCK_OVERHEAD])
+            await sink.send_uds_request(0x37)
+        return time.perf_counter() - start
+
+    async def main():
+        with tempfile.TemporaryDirectory() as tmp:
+            image = Path(tmp) / "image.hex"
+            synthetic_hex(image)
+            print(f"image: {size / 1024 / 1024:.1f} MB in 4 segments, blocks of {block_length} bytes, "
+                  f"{os.cpu_count()} CPUs")
+            for compression in (None, "zlib"):
+                preparer = FlashPreparer(Path(tmp) / f"cache_{compression}")
+                t = time.perf_counter()
+                prepared = await preparer.prepare(image, block_length, compression)
+                cold = time.perf_counter() - t
+                t = time.perf_counter()
+                await preparer.prepare(image, block_length, compression)
+                warm = time.perf_counter() - t
+                on_car = (await transfer_prepared(Sink(), prepared))["elapsed_ms"] / 1000
+                print(f"{compression or 'raw':<6} prepare cold {cold:6.2f}s  cached {warm * 1000:6.1f} ms  "
+                      f"on-car: prepared {on_car:6.3f}s vs inline {await inline(image, compression):6.3f}s  "
+                      f"({prepared.to_dict()['transfer_size'] / prepared.to_dict()['size']:.0%} of image sent)")
+                preparer.shutdown()
+
+    asyncio.run(main())
@@ -161,40 +161,29 @@ FUNCTION_SEARCH_INDEX = {
     "engine": ["0000000f"],
 }
 
-def search_cafd_by_function(query: str):
-    """Search CAFD by function name"""
+def search_cafd_ids(query: str):
+    """CAFD IDs matching a function name, index hits first, without duplicates"""
     query_lower = query.lower()
     results = []
     
     # Direct match in index
     for key, cafd_ids in FUNCTION_SEARCH_INDEX.items():
         if query_lower in key:
-            for cafd_id in cafd_ids:
-                if cafd_id in G01_CAFD_DATABASE:
-                    results.append({
-                        "cafd_id": cafd_id,
-                        **G01_CAFD_DATABASE[cafd_id]
-                    })
+            results.extend(cafd_id for cafd_id in cafd_ids if cafd_id in G01_CAFD_DATABASE)
     
     # Search in CAFD details
     for cafd_id, info in G01_CAFD_DATABASE.items():
         if query_lower in info["name"].lower():
-            results.append({"cafd_id": cafd_id, **info})
-        else:
-            for func in info["functions"]:
-                if query_lower in func.lower():
-                    results.append({"cafd_id": cafd_id, **info})
-                    break
+            results.append(cafd_id)
+        elif any(query_lower in func.lower() for func in info["functions"]):
+            results.append(cafd_id)
     
     # Remove duplicates
-    seen = set()
-    unique_results = []
-    for r in results:
-        if r["cafd_id"] not in seen:
-            seen.add(r["cafd_id"])
-            unique_results.append(r)
-    
-    return unique_results
+    return list(dict.fromkeys(results))
+
+def search_cafd_by_function(query: str):
+    """Search CAFD by function name"""
+    return [{"cafd_id": cafd_id, **G01_CAFD_DATABASE[cafd_id]} for cafd_id in search_cafd_ids(query)]
 
 def get_cafd_info(cafd_id: str):
     """Get CAFD information by ID"""
@@ -3,12 +3,22 @@ BMW G01 X3 B48 Engine - Specific Implementation
 Complete ECU coding and flashing for G01 X3 with B48 engine
 """
 
+import asyncio
 import struct
 import hashlib
+from dataclasses import dataclass, field
 from pathlib import Path
 from typing import List, Dict, Optional, Tuple
 import logging
 
+from metrics import timed_ecu_operation
+from uds_timing import is_busy
+from congestion import busy_backoff, MAX_BUSY_RETRIES
+from request_scheduler import RequestExpired
+from security_keys import KeyRecord, format_bl_id, get_key_index
+from psdz_catalog import PSdZCatalog, get_catalog
+from psdz_pack import PackStore, get_pack
+
 logger = logging.getLogger(__name__)
 
 # ============================================================================
@@ -33,8 +43,11 @@ G01_X3_B48_CONFIG = {
         "PDC": 0x60,      # Park Distance Control
         "TCU": 0x18,      # Transmission Control
     },
+    "swe_path": "/app/backend/psdz_data/cafd/swe/",
     "cafd_path": "/app/backend/psdz_data/cafd/swe/cafd/",
     "odx_path": "/app/backend/psdz_data/cafd/mainseries/S15A/",
+    "security_path": "/app/backend/psdz_data/security/",
+    "psdz_pack": "/app/backend/psdz_data.pack",  # Optional; see psdz_pack.py
 }
 
 # ============================================================================
@@ -95,25 +108,56 @@ class CAFDParser:
     Parse BMW CAFD (Coding And Flash Data) files
     """
     
-    def __init__(self, cafd_path: str):
+    def __init__(self, cafd_path: str, catalog: Optional[PSdZCatalog] = None,
+                 pack: Optional[PackStore] = None):
         self.cafd_path = Path(cafd_path)
+        self.catalog = catalog
+        self.pack = pack
+    
+    def find_cafd_file(self, cafd_id: str, version: Optional[str] = None) -> Optional[Path]:
+        """
+        Path of a CAFD version (latest if not given)
+        
+        Falls back to the pack store when the file is not on disk; the
+        returned path then only names the packed file.
+        """
+        if self.catalog:
+            entry = self.catalog.entry(cafd_id, version)
+            if entry:
+                return self.catalog.path(entry)
+        
+        suffix = "_".join(f"{int(part):03d}" for part in version.replace("_", ".").split(".")) if version else ""
+        cafd_files = sorted(self.cafd_path.glob(f"cafd_{cafd_id}.caf.{suffix}*"))
+        if cafd_files:
+            return cafd_files[-1]
+        
+        if self.pack:
+            packed = self.pack.names(f"cafd_{cafd_id}.caf.{suffix}")
+            if packed:
+                return self.cafd_path / packed[-1].rsplit("/", 1)[-1]
+        return None
     
-    def parse_cafd(self, cafd_id: str) -> Dict:
+    def open_cafd_file(self, path: Path):
+        """
+        Open a CAFD from disk, or stream it from the pack store
+        """
+        if self.pack and not path.exists() and self.pack.has(path.name):
+            return self.pack.open(path.name)
+        return open(path, 'rb')
+    
+    def parse_cafd(self, cafd_id: str, version: Optional[str] = None) -> Dict:
         """
         Parse CAFD binary file
         Returns: Dictionary of parameters
         """
-        cafd_files = list(self.cafd_path.glob(f"cafd_{cafd_id}.caf*"))
+        cafd_file = self.find_cafd_file(cafd_id, version)
         
-        if not cafd_files:
+        if not cafd_file:
             logger.warning(f"CAFD {cafd_id} not found")
             return {}
         
-        # Use the first matching file
-        cafd_file = cafd_files[0]
-        
         try:
-            with open(cafd_file, 'rb') as f:
+            with self.open_cafd_file(cafd_file) as f:
                 data = f.read()
             
             # Parse CAFD structure
@@ -217,27 +261,171 @@ G01_CODING_PARAMS = {
     },
 }
 
+def parameter_value(param: Dict, value: Optional[str] = None) -> bytes:
+    """
+    Encoded value of a coding parameter
+    
+    Without a value the parameter's enabled setting is used: the second
+    option ("aktiv"/"dauerhaft") or the maximum of a numeric range.
+    """
+    if value is None:
+        value = param["options"][1] if "options" in param else str(param["max"])
+    elif "options" in param:
+        if value not in param["options"]:
+            raise ValueError(f"{param['name']}: {value!r} is not one of {param['options']}")
+    elif not param["min"] <= int(value) <= param["max"]:
+        raise ValueError(f"{param['name']}: {value} outside {param['min']}..{param['max']}")
+    return str(value).encode()
+
 # ============================================================================
 # G01 ECU COMMUNICATION
 # ============================================================================
 
+# DIDs per ReadDataByIdentifier request; BMW ECUs reject longer lists with NRC 0x13
+MAX_DIDS_PER_READ = 8
+
+def parse_multi_did_response(response: bytes, dids: Dict[int, Optional[int]]) -> Dict[int, bytes]:
+    """
+    Split a positive 0x62 response to a multi-DID request
+    
+    The response is DID/data pairs without length fields, so the expected
+    length of each DID is needed to find the next one.
+    """
+    values = {}
+    offset = 1
+    
+    for did, length in dids.items():
+        if offset + 2 > len(response):
+            break
+        
+        echoed = struct.unpack('>H', response[offset:offset + 2])[0]
+        if echoed != did:
+            logger.error(f"Multi-DID response out of step: expected {did:04X}, got {echoed:04X}")
+            break
+        offset += 2
+        
+        end = len(response) if length is None else offset + length
+        values[did] = response[offset:end]
+        offset = end
+    
+    return values
+
+# SVK (software version list) DID and the process class of bootloader entries
+DID_SVK = 0xF101
+PROCESS_CLASS_BTLD = 0x06
+
+def parse_svk_bootloader(data: bytes) -> Optional[Tuple[int, Tuple[int, int, int]]]:
+    """
+    Bootloader ID and version from SVK data (DID 0xF101, without DID echo)
+    
+    The SVK header carries the entry count in bytes 2-3; the entries are the
+    trailing 8-byte records (process class, 4-byte ID, main/sub/patch version).
+    """
+    if len(data) < 4:
+        return None
+    
+    count = struct.unpack('>H', data[2:4])[0]
+    start = len(data) - count * 8
+    if count == 0 or start < 4:
+        return None
+    
+    for offset in range(start, len(data), 8):
+        process_class, number, main, sub, patch = struct.unpack('>BIBBB', data[offset:offset + 8])
+        if process_class == PROCESS_CLASS_BTLD:
+            return number, (main, sub, patch)
+    return None
+
+@dataclass
+class CodingResult:
+    """Outcome of a read-compare-write apply; truthy when everything landed"""
+    unchanged: List[int] = field(default_factory=list)
+    written: List[int] = field(default_factory=list)
+    failed: List[int] = field(default_factory=list)
+    verify_failed: List[int] = field(default_factory=list)
+    requests: int = 0
+    unlocked: bool = False
+    
+    @property
+    def success(self) -> bool:
+        return not self.failed and not self.verify_failed
+    
+    def __bool__(self) -> bool:
+        return self.success
+    
+    def to_dict(self) -> Dict:
+        return {
+            "success": self.success,
+            "unchanged": [f"0x{did:04X}" for did in self.unchanged],
+            "written": [f"0x{did:04X}" for did in self.written],
+            "failed": [f"0x{did:04X}" for did in self.failed],
+            "verify_failed": [f"0x{did:04X}" for did in self.verify_failed],
+            "requests": self.requests,
+            "unlocked": self.unlocked,
+        }
+
 class G01ECUManager:
     """
     Manage ECU communication for G01 X3
     """
     
-    def __init__(self, enet_connection):
+    def __init__(self, enet_connection, catalog=None):
         self.enet = enet_connection
         self.seed_to_key = BMWSeedToKey()
-        self.cafd_parser = CAFDParser(G01_X3_B48_CONFIG["cafd_path"])
+        self.cafd_parser = CAFDParser(
+            G01_X3_B48_CONFIG["cafd_path"],
+            catalog=catalog or get_catalog(G01_X3_B48_CONFIG["swe_path"]),
+            pack=get_pack(G01_X3_B48_CONFIG["psdz_pack"])
+        )
+        self.security_keys = get_key_index(G01_X3_B48_CONFIG["security_path"])
+        self.bootloaders: Dict[int, int] = {}  # ECU address -> bootloader number
+    
+    async def read_bootloader_id(self, ecu_address: int) -> Optional[str]:
+        """
+        Read an ECU's bootloader ID from its SVK and remember it for key lookups
+        """
+        data = await self.read_parameter(ecu_address, DID_SVK)
+        parsed = parse_svk_bootloader(data) if data else None
+        if parsed is None:
+            logger.warning(f"No bootloader entry in SVK of ECU 0x{ecu_address:02X}")
+            return None
+        
+        number, version = parsed
+        self.bootloaders[ecu_address] = number
+        return format_bl_id(number, version)
     
-    async def unlock_ecu(self, ecu_address: int, security_level: int = 3) -> bool:
+    def key_material(self, ecu_address: int, security_level: int = 3) -> Optional[KeyRecord]:
+        """
+        Authentication key record for an ECU whose bootloader is known (O(1))
+        """
+        number = self.bootloaders.get(ecu_address)
+        if number is None:
+            return None
+        return self.security_keys.resolve_level(number, security_level)
+    
+    async def resolve_key_material(self, ecu_address: int, security_level: int = 3) -> Optional[KeyRecord]:
+        """
+        Authentication key record for an ECU, reading its SVK first if needed
+        """
+        if ecu_address not in self.bootloaders:
+            await self.read_bootloader_id(ecu_address)
+        return self.key_material(ecu_address, security_level)
+    
+    @timed_ecu_operation("unlock")
+    async def unlock_ecu(self, ecu_address: int, security_level: int = 3,
+                         session: int = 0x03) -> bool:
         """
         Unlock ECU for coding/flashing
+        
+        `session` is the diagnostic session entered first: 0x03 (extended)
+        for coding, 0x02 (programming) for flashing.
         """
         try:
             # Start diagnostic session
-            await self.enet.send_uds_request(0x10, struct.pack('B', 0x03))
+            session_response = await self.enet.send_uds_request(0x10, struct.pack('B', session))
+            
+            if not session_response or session_response[0] != 0x50:
+                logger.error(f"Session 0x{session:02X} refused: {session_response.hex() if session_response else None}")
+                return False
             
             # Request seed
             seed_response = await self.enet.send_uds_request(
@@ -262,6 +450,13 @@ class G01ECUManager:
             
             logger.info(f"Calculated key: {key.hex()}")
             
+            record = self.key_material(ecu_address, security_level)
+            if record:
+                logger.info(
+                    f"Key file entry for {record.bl_id}: type {record.key_type} "
+                    f"({record.digest_alg}/{record.signature_scheme}, {record.enc_key_ref})"
+                )
+            
             # Send key
             key_response = await self.enet.send_uds_request(
                 0x27,
@@ -279,6 +474,7 @@ class G01ECUManager:
             logger.error(f"ECU unlock failed: {e}")
             return False
     
+    @timed_ecu_operation("read")
     async def read_parameter(self, ecu_address: int, did: int) -> Optional[bytes]:
         """
         Read parameter from ECU
@@ -294,6 +490,37 @@ class G01ECUManager:
             logger.error(f"Read parameter failed: {e}")
             return None
     
+    @timed_ecu_operation("read_multi")
+    async def read_parameters(self, ecu_address: int, dids: Dict[int, Optional[int]]) -> Dict[int, bytes]:
+        """
+        Read several DIDs with one 0x22 request
+        
+        Args:
+            ecu_address: Target ECU
+            dids: DID -> expected data length, in request order. The last DID
+                  may have length None (takes the rest of the response).
+        
+        Returns:
+            DID -> data for every DID the ECU answered; empty dict on failure
+        
+        Raises:
+            RequestExpired: the caller's deadline passed before the read was sent
+        """
+        try:
+            request = b''.join(struct.pack('>H', did) for did in dids)
+            response = await self.enet.send_uds_request(0x22, request)
+            
+            if not response or response[0] != 0x62:
+                return {}
+            
+            return parse_multi_did_response(response, dids)
+        except RequestExpired:
+            raise
+        except Exception as e:
+            logger.error(f"Read parameters failed: {e}")
+            return {}
+    
+    @timed_ecu_operation("write")
     async def write_parameter(self, ecu_address: int, did: int, value: bytes) -> bool:
         """
         Write parameter to ECU
@@ -307,6 +534,158 @@ class G01ECUManager:
             logger.error(f"Write parameter failed: {e}")
             return False
     
+    async def _exchange_many(self, requests: List[Tuple[int, bytes]]) -> List[Optional[bytes]]:
+        """
+        Several UDS round trips through the transport's send_uds_requests
+        
+        OBD adapters pipeline runs of single-frame requests (0x2E among
+        them); raw ENET cannot tell overlapping responses apart and sends
+        them one at a time.
+        
+        Requests answered busyRepeatRequest are sent again, together, after
+        a jittered backoff (up to MAX_BUSY_RETRIES rounds).
+        """
+        responses = await self._send_many(requests)
+        for attempt in range(MAX_BUSY_RETRIES):
+            busy = [i for i, (service_id, _) in enumerate(requests) if is_busy(service_id, responses[i])]
+            if not busy:
+                break
+            await asyncio.sleep(busy_backoff(attempt))
+            for i, response in zip(busy, await self._send_many([requests[i] for i in busy])):
+                responses[i] = response
+        return responses
+    
+    async def _send_many(self, requests: List[Tuple[int, bytes]]) -> List[Optional[bytes]]:
+        send_many = getattr(self.enet, "send_uds_requests", None)
+        if send_many:
+            return await send_many(requests)
+        
+        responses = []
+        for service_id, data in requests:
+            try:
+                responses.append(await self.enet.send_uds_request(service_id, data))
+            except Exception as e:
+                logger.error(f"UDS request {service_id:02X} failed: {e}")
+                responses.append(None)
+        return responses
+    
+    async def read_values(self, ecu_address: int, lengths: Dict[int, int]) -> Dict[int, bytes]:
+        """
+        Current values of many DIDs: multi-DID reads of MAX_DIDS_PER_READ
+        
+        The response carries no lengths, so `lengths` are the lengths the
+        DIDs are expected to have (coding DIDs keep theirs, so those of
+        values about to be written will do). A batch is only taken if every
+        DID echo lines up and the response ends exactly where the lengths
+        say; the DIDs of any other batch are read whole with read_blocks.
+        
+        Returns:
+            DID -> data for every DID the ECU answered
+        """
+        values, _ = await self._read_values(ecu_address, lengths)
+        return values
+    
+    async def _read_values(self, ecu_address: int, lengths: Dict[int, int]) -> Tuple[Dict[int, bytes], int]:
+        """read_values, plus the number of requests it took"""
+        dids = list(lengths)
+        batches = [
+            {did: lengths[did] for did in dids[start:start + MAX_DIDS_PER_READ]}
+            for start in range(0, len(dids), MAX_DIDS_PER_READ)
+        ]
+        responses = await self._exchange_many([
+            (0x22, b''.join(struct.pack('>H', did) for did in batch)) for batch in batches
+        ])
+        
+        values = {}
+        unread = []
+        for batch, response in zip(batches, responses):
+            size = 1 + sum(2 + length for length in batch.values())
+            parsed = {}
+            if response and response[0] == 0x62 and len(response) == size:
+                parsed = parse_multi_did_response(response, batch)
+            if len(parsed) == len(batch):
+                values.update(parsed)
+            else:
+                unread.extend(batch)
+        
+        if unread:
+            values.update(await self.read_blocks(ecu_address, unread))
+        return values, len(batches) + len(unread)
+    
+    async def read_blocks(self, ecu_address: int, dids: List[int]) -> Dict[int, bytes]:
+        """
+        Whole DIDs of unknown length: one single-DID 0x22 each, pipelined
+        
+        Returns:
+            DID -> data for every DID the ECU answered
+        """
+        responses = await self._exchange_many([(0x22, struct.pack('>H', did)) for did in dids])
+        return {
+            did: response[3:]
+            for did, response in zip(dids, responses)
+            if response and response[0] == 0x62 and response[1:3] == struct.pack('>H', did)
+        }
+    
+    async def write_values(self, ecu_address: int, values: Dict[int, bytes]) -> Dict[int, bool]:
+        """
+        0x2E writes back to back (pipelined where the transport can); DID -> positive response
+        """
+        dids = list(values)
+        responses = await self._exchange_many([
+            (0x2E, struct.pack('>H', did) + values[did]) for did in dids
+        ])
+        return {did: bool(r) and r[0] == 0x6E for did, r in zip(dids, responses)}
+    
+    @timed_ecu_operation("apply_values")
+    async def apply_values(self, ecu_address: int, values: Dict[int, bytes],
+                           verify: bool = True) -> CodingResult:
+        """
+        Read-compare-write: only DIDs whose current value differs are written
+        
+        Current values are read with multi-DID requests at the target
+        values' lengths (see read_values; a DID whose live length differs is
+        read whole, so it still compares unequal); when nothing differs the
+        ECU is not even unlocked. Writes go back to back (see _exchange_many)
+        and are read back the same way as the current values.
+        
+        On ENET, where requests go one at a time, N changed DIDs cost about
+        N writes, the unlock and two reads per MAX_DIDS_PER_READ DIDs.
+        """
+        result = CodingResult()
+        
+        current, requests = await self._read_values(ecu_address, {did: len(value) for did, value in values.items()})
+        result.requests += requests
+        changes = {did: value for did, value in values.items() if current.get(did) != value}
+        result.unchanged = [did for did in values if did not in changes]
+        
+        if not changes:
+            logger.info(f"ECU 0x{ecu_address:02X}: all {len(values)} values already coded")
+            return result
+        
+        result.unlocked = await self.unlock_ecu(ecu_address, security_level=3)
+        if not result.unlocked:
+            result.failed = list(changes)
+            return result
+        
+        written = await self.write_values(ecu_address, changes)
+        result.requests += len(changes)
+        result.written = [did for did, ok in written.items() if ok]
+        result.failed = [did for did, ok in written.items() if not ok]
+        
+        if verify and result.written:
+            readback, requests = await self._read_values(
+                ecu_address, {did: len(values[did]) for did in result.written}
+            )
+            result.requests += requests
+            result.verify_failed = [did for did in result.written if readback.get(did) != values[did]]
+        
+        logger.info(
+            f"ECU 0x{ecu_address:02X}: {len(result.written)} written, {len(result.unchanged)} unchanged, "
+            f"{len(result.failed)} failed, {len(result.verify_failed)} failed verification"
+        )
+        return result
+    
+    @timed_ecu_operation("apply")
     async def apply_coding(self, modification: str) -> bool:
         """
         Apply coding modification from G01_CODING_PARAMS
@@ -318,24 +697,12 @@ class G01ECUManager:
         mod = G01_CODING_PARAMS[modification]
         ecu_addr = G01_X3_B48_CONFIG["ecu_addresses"][mod["ecu"]]
         
-        # Unlock ECU
-        if not await self.unlock_ecu(ecu_addr, security_level=3):
-            return False
-        
-        # Apply each parameter
-        for param in mod["parameters"]:
-            # Convert value to bytes
-            if "options" in param:
-                value = param["options"][1].encode()  # Use "aktiv" or enabled option
-            else:
-                value = str(param["max"]).encode()
-            
-            success = await self.write_parameter(ecu_addr, param["address"], value)
-            if not success:
-                logger.error(f"Failed to write {param['name']}")
-                return False
+        values = {param["address"]: parameter_value(param) for param in mod["parameters"]}
         
-        return True
+        result = await self.apply_values(ecu_addr, values)
+        if not result:
+            logger.error(f"Failed to apply {modification}: {result.to_dict()}")
+        return result.success
 
 # ============================================================================
 # EXPORT
@@ -346,5 +713,10 @@ __all__ = [
     'BMWSeedToKey',
     'CAFDParser',
     'G01ECUManager',
+    'CodingResult',
     'G01_CODING_PARAMS',
+    'MAX_DIDS_PER_READ',
+    'parameter_value',
+    'parse_multi_did_response',
+    'parse_svk_bootloader',
 ]
@@ -0,0 +1,202 @@
+"""
+Transaction History Rollups
+Incrementally maintained per-VIN / per-day / per-type counters for shop dashboards
+"""
+
+import asyncio
+import os
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+import logging
+
+from pymongo import ReplaceOne, UpdateOne
+
+logger = logging.getLogger(__name__)
+
+# Rollup documents live next to the raw transactions collection
+ROLLUP_COLLECTION = "history_rollups"
+
+# Scope key for the fleet-wide rollup document
+GLOBAL_SCOPE = "all"
+
+# ============================================================================
+# ROLLUP KEYS
+# ============================================================================
+
+def transaction_day(timestamp: datetime) -> str:
+    """Bucket a transaction timestamp (UTC) into its rollup day"""
+    return timestamp.strftime("%Y-%m-%d")
+
+def rollup_key(vin: Optional[str] = None, day: Optional[str] = None) -> str:
+    """
+    Build the _id of a rollup document
+
+    One document exists per scope: fleet-wide, per VIN, per day and per VIN+day,
+    so every dashboard query is a single primary key lookup.
+    """
+    if vin and day:
+        return f"vin:{vin}|day:{day}"
+    if vin:
+        return f"vin:{vin}"
+    if day:
+        return f"day:{day}"
+    return GLOBAL_SCOPE
+
+def rollup_scopes(vin: str, day: str) -> List[Dict[str, Optional[str]]]:
+    """All scopes a single transaction contributes to"""
+    return [
+        {"vin": None, "day": None},
+        {"vin": vin, "day": None},
+        {"vin": None, "day": day},
+        {"vin": vin, "day": day},
+    ]
+
+# ============================================================================
+# INCREMENTAL UPDATES (called by the transaction writer)
+# ============================================================================
+
+async def update_rollups(db, transaction: Dict[str, Any]):
+    """
+    Fold one transaction into its rollup documents
+
+    Args:
+        db: Motor database handle
+        transaction: Transaction document as inserted into `transactions`
+    """
+    tx_type = transaction["type"]
+    status = transaction["status"]
+    day = transaction_day(transaction["timestamp"])
+
+    increment = {
+        "total": 1,
+        status: 1,
+        f"types.{tx_type}.total": 1,
+        f"types.{tx_type}.{status}": 1,
+    }
+
+    operations = [
+        UpdateOne(
+            {"_id": rollup_key(**scope)},
+            {
+                "$inc": increment,
+                "$set": {"updated_at": datetime.utcnow()},
+                "$setOnInsert": scope,
+            },
+            upsert=True,
+        )
+        for scope in rollup_scopes(transaction["vin"], day)
+    ]
+
+    await db[ROLLUP_COLLECTION].bulk_write(operations, ordered=False)
+
+# ============================================================================
+# READ PATH
+# ============================================================================
+
+def _with_rates(counts: Dict[str, Any]) -> Dict[str, Any]:
+    """Add a failure rate next to the raw counters"""
+    total = counts.get("total", 0)
+    failed = counts.get("failed", 0)
+    return {
+        "total": total,
+        "success": counts.get("success", 0),
+        "failed": failed,
+        "failure_rate": round(failed / total, 4) if total else 0.0,
+    }
+
+async def get_rollup(db, vin: Optional[str] = None, day: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Read the rollup for a scope with a single primary key lookup
+
+    Returns zeroed counters when nothing has been recorded for the scope yet.
+    """
+    doc = await db[ROLLUP_COLLECTION].find_one({"_id": rollup_key(vin, day)}) or {}
+
+    return {
+        "vin": vin,
+        "day": day,
+        **_with_rates(doc),
+        "types": {
+            tx_type: _with_rates(counts)
+            for tx_type, counts in doc.get("types", {}).items()
+        },
+        "updated_at": doc.get("updated_at"),
+    }
+
+# ============================================================================
+# BACKFILL
+# ============================================================================
+
+BACKFILL_PIPELINE = [
+    {
+        "$group": {
+            "_id": {
+                "vin": "$vin",
+                "day": {"$dateToString": {"format": "%Y-%m-%d", "date": "$timestamp"}},
+                "type": "$type",
+                "status": "$status",
+            },
+            "count": {"$sum": 1},
+        }
+    },
+]
+
+async def backfill_rollups(db) -> int:
+    """
+    Rebuild all rollup documents from the raw transactions collection
+
+    The aggregation collapses transactions to (vin, day, type, status) counts
+    on the server; only those groups are folded into rollup documents here.
+
+    Returns:
+        Number of rollup documents written
+    """
+    rollups: Dict[str, Dict[str, Any]] = {}
+
+    async for group in db.transactions.aggregate(BACKFILL_PIPELINE, allowDiskUse=True):
+        key = group["_id"]
+        count = group["count"]
+
+        for scope in rollup_scopes(key["vin"], key["day"]):
+            doc = rollups.setdefault(rollup_key(**scope), {**scope, "total": 0, "types": {}})
+            doc["total"] += count
+            doc[key["status"]] = doc.get(key["status"], 0) + count
+
+            type_counts = doc["types"].setdefault(key["type"], {"total": 0})
+            type_counts["total"] += count
+            type_counts[key["status"]] = type_counts.get(key["status"], 0) + count
+
+    now = datetime.utcnow()
+    operations = [
+        ReplaceOne({"_id": key}, {**doc, "updated_at": now}, upsert=True)
+        for key, doc in rollups.items()
+    ]
+
+    if operations:
+        await db[ROLLUP_COLLECTION].bulk_write(operations, ordered=False)
+
+    logger.info(f"Rollup backfill wrote {len(operations)} documents")
+    return len(operations)
+
+# ============================================================================
+# EXPORT
+# ============================================================================
+
+__all__ = [
+    'ROLLUP_COLLECTION',
+    'rollup_key',
+    'update_rollups',
+    'get_rollup',
+    'backfill_rollups',
+]
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    logging.basicConfig(level=logging.INFO)
+    load_dotenv(Path(__file__).parent / '.env')
+
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+    asyncio.run(backfill_rollups(client[os.environ['DB_NAME']]))
@@ -0,0 +1,336 @@
+"""
+Live Data Streaming
+Batched high-rate DID polling into per-stream ring buffers with decimated push
+"""
+
+import asyncio
+import math
+import time
+import uuid
+from array import array
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Tuple
+import logging
+
+from g01_x3_b48_module import MAX_DIDS_PER_READ
+from request_scheduler import LIVE, RequestExpired, request_priority
+
+logger = logging.getLogger(__name__)
+
+# Samples kept per stream: ~80 s at 50 Hz
+DEFAULT_RING_CAPACITY = 4096
+
+# Polling bounds (Hz)
+MIN_RATE_HZ = 0.1
+MAX_RATE_HZ = 100.0
+
+# Clients receive batched samples at this interval rather than one message per sample
+PUSH_INTERVAL = 0.05
+
+# ============================================================================
+# CHANNELS
+# ============================================================================
+
+@dataclass(frozen=True)
+class Channel:
+    """One live value: a DID on an ECU, decoded as an unsigned big-endian integer"""
+    ecu: int
+    did: int
+    length: int = 2
+    name: Optional[str] = None
+    scale: float = 1.0
+    offset: float = 0.0
+
+    @property
+    def key(self) -> str:
+        return self.name or f"{self.ecu:02X}:{self.did:04X}"
+
+    def decode(self, data: Optional[bytes]) -> float:
+        if not data:
+            return math.nan
+        return int.from_bytes(data[:self.length], 'big') * self.scale + self.offset
+
+def plan_batches(channels: List[Channel]) -> List[Tuple[int, List[int]]]:
+    """
+    Group channels into multi-DID reads
+
+    Returns:
+        List of (ECU address, channel indices), at most MAX_DIDS_PER_READ per batch
+    """
+    by_ecu: Dict[int, List[int]] = {}
+    for index, channel in enumerate(channels):
+        by_ecu.setdefault(channel.ecu, []).append(index)
+
+    batches = []
+    for ecu, indices in by_ecu.items():
+        for start in range(0, len(indices), MAX_DIDS_PER_READ):
+            batches.append((ecu, indices[start:start + MAX_DIDS_PER_READ]))
+    return batches
+
+# ============================================================================
+# RING BUFFER
+# ============================================================================
+
+class StreamRing:
+    """
+    Fixed-size ring of sample rows (timestamp + one value per channel)
+
+    Storage is two preallocated double arrays; rows are addressed by a
+    monotonically increasing sequence number so readers keep a cursor.
+    """
+
+    def __init__(self, channels: int, capacity: int = DEFAULT_RING_CAPACITY):
+        self.channels = channels
+        self.capacity = capacity
+        self.timestamps = array('d', bytes(8 * capacity))
+        self.values = array('d', bytes(8 * capacity * channels))
+        self.sequence = 0  # Rows ever written
+
+    def append(self, timestamp: float, row: List[float]):
+        slot = self.sequence % self.capacity
+        self.timestamps[slot] = timestamp
+        base = slot * self.channels
+        self.values[base:base + self.channels] = array('d', row)
+        self.sequence += 1
+
+    def read_since(self, cursor: int, decimation: int = 1) -> Tuple[int, int, List[float], List[List[float]]]:
+        """
+        Rows written after `cursor`, keeping every `decimation`-th row
+
+        Returns:
+            (new cursor, rows dropped because the reader fell behind,
+             timestamps, per-channel value columns)
+        """
+        oldest = max(0, self.sequence - self.capacity)
+        dropped = max(0, oldest - cursor)
+        start = max(cursor, oldest)
+
+        # Keep decimation phase aligned to absolute sequence numbers
+        if decimation > 1:
+            start += (-start) % decimation
+
+        timestamps: List[float] = []
+        columns: List[List[float]] = [[] for _ in range(self.channels)]
+
+        for seq in range(start, self.sequence, decimation):
+            slot = seq % self.capacity
+            timestamps.append(self.timestamps[slot])
+            base = slot * self.channels
+            for c in range(self.channels):
+                columns[c].append(self.values[base + c])
+
+        return self.sequence, dropped, timestamps, columns
+
+# ============================================================================
+# STREAMS
+# ============================================================================
+
+class LiveDataStream:
+    """
+    Polls a set of channels at a fixed rate into a ring buffer
+
+    Each tick issues one multi-DID 0x22 per ECU batch. Ticks are scheduled on
+    absolute deadlines; if a tick overruns, missed ticks are skipped rather
+    than burst, so a slow ECU lowers the effective rate instead of piling up.
+    Reads run in the LIVE scheduler class and expire when the next tick is
+    due, so a poll stuck behind other traffic is dropped instead of sent stale.
+    """
+
+    def __init__(self, manager, channels: List[Channel], rate_hz: float,
+                 capacity: int = DEFAULT_RING_CAPACITY):
+        self.id = str(uuid.uuid4())
+        self.manager = manager
+        self.channels = channels
+        self.rate_hz = min(MAX_RATE_HZ, max(MIN_RATE_HZ, rate_hz))
+        self.ring = StreamRing(len(channels), capacity)
+        self.batches = plan_batches(channels)
+        self.sinks: List[Callable[[float, List[float]], None]] = []
+        self.ticks_skipped = 0
+        self.ticks_expired = 0
+        self.read_errors = 0
+        self.started_at = time.time()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._poll())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+        for sink in self.sinks:
+            close = getattr(sink, "close", None)
+            if close:
+                close()
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def _read_tick(self) -> List[float]:
+        row = [math.nan] * len(self.channels)
+
+        for ecu, indices in self.batches:
+            dids = {self.channels[i].did: self.channels[i].length for i in indices}
+            values = await self.manager.read_parameters(ecu, dids)
+            if not values:
+                self.read_errors += 1
+            for i in indices:
+                row[i] = self.channels[i].decode(values.get(self.channels[i].did))
+
+        return row
+
+    async def _poll(self):
+        loop = asyncio.get_running_loop()
+        period = 1.0 / self.rate_hz
+        deadline = loop.time()
+
+        while True:
+            try:
+                with request_priority(LIVE, deadline=deadline + period):
+                    row = await self._read_tick()
+            except RequestExpired:
+                self.ticks_expired += 1
+            else:
+                timestamp = time.time()
+                self.ring.append(timestamp, row)
+                for sink in self.sinks:
+                    try:
+                        sink(timestamp, row)
+                    except Exception as e:
+                        logger.error(f"Live data sink failed: {e}")
+
+            deadline += period
+            now = loop.time()
+            if now > deadline:
+                missed = int((now - deadline) / period) + 1
+                self.ticks_skipped += missed
+                deadline += missed * period
+            await asyncio.sleep(deadline - now)
+
+    def status(self) -> dict:
+        elapsed = max(time.time() - self.started_at, 1e-9)
+        return {
+            "id": self.id,
+            "channels": [c.key for c in self.channels],
+            "rate_hz": self.rate_hz,
+            "requests_per_tick": len(self.batches),
+            "samples": self.ring.sequence,
+            "effective_rate_hz": round(self.ring.sequence / elapsed, 2),
+            "ticks_skipped": self.ticks_skipped,
+            "ticks_expired": self.ticks_expired,
+            "read_errors": self.read_errors,
+            "running": self.running,
+        }
+
+class LiveDataManager:
+    """Registry of running streams"""
+
+    def __init__(self):
+        self.streams: Dict[str, LiveDataStream] = {}
+
+    def create(self, manager, channels: List[Channel], rate_hz: float) -> LiveDataStream:
+        stream = LiveDataStream(manager, channels, rate_hz)
+        self.streams[stream.id] = stream
+        stream.start()
+        logger.info(f"Live stream {stream.id}: {len(channels)} channels @ {stream.rate_hz} Hz")
+        return stream
+
+    def get(self, stream_id: str) -> Optional[LiveDataStream]:
+        return self.streams.get(stream_id)
+
+    async def stop(self, stream_id: str) -> bool:
+        stream = self.streams.pop(stream_id, None)
+        if not stream:
+            return False
+        await stream.stop()
+        return True
+
+    async def stop_all(self):
+        for stream_id in list(self.streams):
+            await self.stop(stream_id)
+
+# ============================================================================
+# PUSH
+# ============================================================================
+
+async def push_samples(stream: LiveDataStream, send: Callable, receive: Callable,
+                       decimation: int = 1):
+    """
+    Push new samples to one client until it disconnects or the stream stops
+
+    A stopped stream gets its last samples pushed, then a "stopped" message
+    with its final status.
+
+    Args:
+        send: async callable taking a JSON-serialisable dict
+        receive: async callable returning the next client message (dict);
+                 {"decimation": N} changes the decimation on the fly
+    """
+    state = {"decimation": max(1, decimation), "cursor": stream.ring.sequence}
+    keys = [c.key for c in stream.channels]
+
+    async def control():
+        while True:
+            message = await receive()
+            if "decimation" in message:
+                state["decimation"] = max(1, int(message["decimation"]))
+
+    async def push():
+        cursor, dropped, timestamps, columns = stream.ring.read_since(state["cursor"], state["decimation"])
+        state["cursor"] = cursor
+        if not timestamps and not dropped:
+            return
+
+        await send({
+            "type": "samples",
+            "stream": stream.id,
+            "t": timestamps,
+            "values": {
+                key: [None if math.isnan(v) else v for v in column]
+                for key, column in zip(keys, columns)
+            },
+            "dropped": dropped,
+        })
+
+    control_task = asyncio.create_task(control())
+    try:
+        while stream.running and not control_task.done():
+            await asyncio.sleep(PUSH_INTERVAL)
+            await push()
+
+        if not control_task.done():
+            await push()
+            await send({"type": "stopped", "stream": stream.id, "status": stream.status()})
+    finally:
+        control_task.cancel()
+        # wait() does not raise the control task's (expected) cancellation,
+        # but does let a cancellation of this task through
+        await asyncio.wait([control_task])
+        if not control_task.cancelled():
+            try:
+                control_task.result()
+            except Exception:
+                # Client disconnects surface here; nothing left to clean up
+                pass
+
+# Process-wide stream registry
+LIVE_STREAMS = LiveDataManager()
+
+# ============================================================================
+# EXPORT
+# ============================================================================
+
+__all__ = [
+    'Channel',
+    'StreamRing',
+    'LiveDataStream',
+    'LiveDataManager',
+    'LIVE_STREAMS',
+    'push_samples',
+]
@@ -0,0 +1,322 @@
+"""
+Runtime Metrics
+Low-overhead counters and histograms exposed in Prometheus text format
+"""
+
+import functools
+import time
+from bisect import bisect_left
+from typing import Dict, List, Optional, Tuple
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Round-trip buckets in seconds: UDS responses range from ~1 ms (gateway echo)
+# up to several seconds for responsePending-heavy services
+LATENCY_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+# ============================================================================
+# METRIC TYPES
+# ============================================================================
+
+class Counter:
+    """Monotonic counter keyed by a tuple of label values"""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, label_values: Tuple[str, ...] = (), amount: float = 1):
+        values = self.values
+        values[label_values] = values.get(label_values, 0) + amount
+
+    def render(self) -> List[str]:
+        return [
+            f"{self.name}{_format_labels(self.labels, key)} {value}"
+            for key, value in self.values.items()
+        ]
+
+class Histogram:
+    """
+    Cumulative histogram with fixed buckets
+
+    Each label set holds a flat list of per-bucket counts plus sum and count,
+    so an observation is one bisect and three list updates.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        # label values -> [bucket_0 .. bucket_n, +Inf, sum, count]
+        self.series: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, label_values: Tuple[str, ...], value: float):
+        series = self.series.get(label_values)
+        if series is None:
+            series = self.series[label_values] = [0] * (len(self.buckets) + 3)
+        series[bisect_left(self.buckets, value)] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def render(self) -> List[str]:
+        lines = []
+        bucket_labels = self.labels + ("le",)
+        bounds = [str(b) for b in self.buckets] + ["+Inf"]
+
+        for key, series in self.series.items():
+            cumulative = 0
+            for bound, count in zip(bounds, series):
+                cumulative += count
+                lines.append(
+                    f"{self.name}_bucket{_format_labels(bucket_labels, key + (bound,))} {cumulative}"
+                )
+            labels = _format_labels(self.labels, key)
+            lines.append(f"{self.name}_sum{labels} {series[-2]}")
+            lines.append(f"{self.name}_count{labels} {series[-1]}")
+        return lines
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...]) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+class MetricsRegistry:
+    """Holds all metrics and renders the Prometheus exposition text"""
+
+    def __init__(self):
+        self.metrics: List = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+# ============================================================================
+# BACKEND METRICS
+# ============================================================================
+
+REGISTRY = MetricsRegistry()
+
+UDS_REQUEST_SECONDS = REGISTRY.register(Histogram(
+    "uds_request_duration_seconds",
+    "UDS request round-trip time",
+    ("transport", "ecu", "service"),
+))
+
+UDS_NEGATIVE_RESPONSES = REGISTRY.register(Counter(
+    "uds_negative_responses_total",
+    "UDS negative responses by NRC",
+    ("transport", "ecu", "service", "nrc"),
+))
+
+UDS_REQUEST_ERRORS = REGISTRY.register(Counter(
+    "uds_request_errors_total",
+    "UDS requests that failed without a response",
+    ("transport", "ecu", "service"),
+))
+
+TRANSPORT_BYTES = REGISTRY.register(Counter(
+    "transport_bytes_total",
+    "Bytes exchanged with the vehicle",
+    ("transport", "direction"),
+))
+
+TRANSPORT_CONNECTS = REGISTRY.register(Counter(
+    "transport_connects_total",
+    "Vehicle connection attempts",
+    ("transport", "result"),
+))
+
+TRANSPORT_RECONNECTS = REGISTRY.register(Counter(
+    "transport_reconnects_total",
+    "Connection attempts on a transport that was connected before",
+    ("transport",),
+))
+
+ECU_OPERATION_SECONDS = REGISTRY.register(Histogram(
+    "ecu_operation_duration_seconds",
+    "G01ECUManager operation duration (unlock, read, write, apply)",
+    ("operation", "ecu", "result"),
+))
+
+HTTP_REQUEST_SECONDS = REGISTRY.register(Histogram(
+    "http_request_duration_seconds",
+    "HTTP handler latency",
+    ("method", "route", "status"),
+))
+
+# Label strings are interned per value so the hot path never formats
+_ECU_LABELS: Dict[Optional[int], str] = {None: "gateway"}
+_SERVICE_LABELS = {sid: f"0x{sid:02X}" for sid in range(256)}
+
+def ecu_label(ecu_address: Optional[int]) -> str:
+    label = _ECU_LABELS.get(ecu_address)
+    if label is None:
+        label = _ECU_LABELS[ecu_address] = f"0x{ecu_address:02X}"
+    return label
+
+def observe_uds(transport: str, ecu_address: Optional[int], request: bytes,
+                response: Optional[bytes], elapsed: float):
+    """
+    Record one UDS round trip
+
+    Args:
+        transport: "doip", "enet" or "obd"
+        ecu_address: Target ECU, None when the transport is not ECU-addressed
+        request: UDS request bytes (service ID first)
+        response: UDS response bytes, None when the request failed
+        elapsed: Round-trip time in seconds
+    """
+    ecu = ecu_label(ecu_address)
+    service = _SERVICE_LABELS[request[0]] if request else "none"
+
+    TRANSPORT_BYTES.inc((transport, "out"), len(request))
+
+    if response is None:
+        UDS_REQUEST_ERRORS.inc((transport, ecu, service))
+        return
+
+    UDS_REQUEST_SECONDS.observe((transport, ecu, service), elapsed)
+    TRANSPORT_BYTES.inc((transport, "in"), len(response))
+
+    if len(response) > 2 and response[0] == 0x7F:
+        UDS_NEGATIVE_RESPONSES.inc((transport, ecu, service, _SERVICE_LABELS[response[2]]))
+
+def observe_response_pending(transport: str, ecu_address: Optional[int], service_id: int):
+    """Record an NRC 0x78 responsePending (not a final response)"""
+    UDS_NEGATIVE_RESPONSES.inc((transport, ecu_label(ecu_address), _SERVICE_LABELS[service_id], "0x78"))
+
+def observe_connect(transport: str, success: bool, reconnect: bool):
+    """Record a connection attempt"""
+    TRANSPORT_CONNECTS.inc((transport, "success" if success else "failed"))
+    if reconnect:
+        TRANSPORT_RECONNECTS.inc((transport,))
+
+def observe_ecu_operation(operation: str, ecu_address: Optional[int], success: bool, elapsed: float):
+    """Record the duration of a G01ECUManager operation"""
+    ECU_OPERATION_SECONDS.observe(
+        (operation, ecu_label(ecu_address), "success" if success else "failed"), elapsed
+    )
+
+def timed_ecu_operation(operation: str):
+    """
+    Decorator timing an async ECU manager method
+
+    The ECU label is taken from the first argument (or `ecu_address` keyword)
+    when it is an address; success is the truthiness of the return value.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(self, *args, **kwargs):
+            ecu_address = args[0] if args else kwargs.get("ecu_address")
+            if not isinstance(ecu_address, int):
+                ecu_address = None
+
+            start = time.perf_counter()
+            result = None
+            try:
+                result = await func(self, *args, **kwargs)
+                return result
+            finally:
+                observe_ecu_operation(operation, ecu_address, bool(result), time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+# ============================================================================
+# HTTP INSTRUMENTATION
+# ============================================================================
+
+class MetricsMiddleware:
+    """
+    ASGI middleware recording handler latency per route template
+
+    Routes are labelled by their path template (e.g. /api/cafd/{cafd_id}) so
+    path parameters do not blow up label cardinality.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = ["500"]
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status[0] = str(message["status"])
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get("route")
+            HTTP_REQUEST_SECONDS.observe(
+                (scope["method"], route.path if route else "unmatched", status[0]),
+                time.perf_counter() - start,
+            )
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+def render_metrics() -> str:
+    """Prometheus text exposition of all backend metrics"""
+    return REGISTRY.render()
+
+# ============================================================================
+# EXPORT
+# ============================================================================
+
+__all__ = [
+    'REGISTRY',
+    'MetricsMiddleware',
+    'PROMETHEUS_CONTENT_TYPE',
+    'observe_uds',
+    'observe_response_pending',
+    'observe_connect',
+    'observe_ecu_operation',
+    'timed_ecu_operation',
+    'render_metrics',
+]
+
+if __name__ == "__main__":
+    # Instrumentation overhead benchmark: python metrics.py
+    import timeit
+
+    request = bytes([0x22, 0xF1, 0x90])
+    response = bytes([0x62, 0xF1, 0x90]) + b"WBA00000000000000"
+    negative = bytes([0x7F, 0x22, 0x31])
+    runs = 200_000
+
+    for label, resp in (("positive", response), ("negative", negative)):
+        seconds = timeit.timeit(
+            lambda: observe_uds("doip", 0x12, request, resp, 0.0123), number=runs
+        )
+        print(f"observe_uds ({label}): {seconds / runs * 1e6:.2f} us/request")
+
+    seconds = timeit.timeit(time.perf_counter, number=runs)
+    print(f"perf_counter pair: {2 * seconds / runs * 1e6:.2f} us/request")
@@ -0,0 +1,972 @@
+"""
+OBD Adapter Transport
+UDS over ELM327 / STN adapters (Bluetooth serial, Wi-Fi TCP or a pty) with host-side ISO-TP and command pipelining
+"""
+
+import asyncio
+import os
+import re
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, List, Optional, Sequence, Tuple
+import logging
+
+import serial
+
+from enet import UDSServices
+from metrics import observe_uds, observe_connect, observe_response_pending
+from uds_timing import P2_STAR, MAX_RESPONSE_PENDING, is_response_pending
+from request_scheduler import MAX_BATCH, RequestExpired, RequestScheduler
+
+logger = logging.getLogger(__name__)
+
+# Wi-Fi adapters are access points at a fixed address; Bluetooth SPP
+# adapters appear as a serial device once bound (rfcomm bind 0 <MAC>)
+DEFAULT_WIFI_ADDRESS = "192.168.0.10"
+DEFAULT_WIFI_PORT = 35000
+DEFAULT_BLUETOOTH_DEVICE = "/dev/rfcomm0"
+DEFAULT_BAUDRATE = 115200
+
+# BMW D-CAN: the tester sends on 0x6F1, ECUs answer on 0x600 + address.
+# ISO-TP uses extended addressing: the first data byte is the target ECU
+# (0xF1, the tester, in responses).
+TESTER_ADDRESS = 0xF1
+TESTER_CAN_ID = 0x6F1
+RESPONSE_CAN_BASE = 0x600
+FRAME_PADDING = 0x00
+
+SF_CAPACITY = 6     # Payload bytes per frame after address + PCI
+FF_CAPACITY = 5
+CF_CAPACITY = 6
+MAX_ISOTP_LENGTH = 0xFFF
+
+# A hex digit after a CAN command makes the adapter return as soon as that
+# many frames arrived instead of waiting out the ATST timeout. It is a
+# single digit, so reassembly flow control asks for at most 15 frames.
+MAX_RESPONSE_COUNT = 15
+
+# STmin (ms) requested when the adapter overflows, doubling up to the cap
+MAX_ST_MIN = 20
+BUFFER_FULL_RETRIES = 3
+
+PROMPT = b">"
+COMMAND_TIMEOUT = 2.0
+RESET_TIMEOUT = 5.0
+
+INIT_COMMANDS = [
+    "ATE0",                      # Echo off
+    "ATL0",                      # No linefeeds
+    "ATS0",                      # No spaces between bytes
+    "ATH1",                      # CAN ID in front of each frame
+    "ATSP6",                     # ISO 15765-4, 11 bit, 500 kbaud
+    "ATCAF0",                    # Raw frames; ISO-TP is done here
+    "ATAT1",                     # Adaptive timing
+    f"ATSH{TESTER_CAN_ID:03X}",
+    "ATST32",                    # 200 ms no-answer timeout (x 4.096 ms)
+]
+
+# Services whose responses (positive or negative) always fit one frame and
+# that are safe to repeat; consecutive single-frame requests of these are
+# pipelined by send_uds_requests
+PIPELINED_SERVICES = {0x10, 0x14, 0x28, 0x2E, 0x3E, 0x85}
+
+ADAPTER_ERRORS = ("NO DATA", "CAN ERROR", "BUS ERROR", "BUS BUSY", "UNABLE TO CONNECT",
+                  "DATA ERROR", "FB ERROR", "LV RESET", "STOPPED", "?")
+
+FRAME_LINE = re.compile(r"[0-9A-F]{3}(?:[0-9A-F]{2}){1,8}")
+
+class AdapterError(Exception):
+    """Adapter answered with an error or an unusable frame sequence"""
+
+class BufferFull(AdapterError):
+    """The adapter could not pass frames on as fast as the ECU sent them"""
+
+# ============================================================================
+# ISO-TP FRAMES
+# ============================================================================
+
+def segment(target: int, payload: bytes) -> List[bytes]:
+    """ISO-TP frames (address byte first) carrying one message"""
+    if len(payload) <= SF_CAPACITY:
+        return [bytes([target, len(payload)]) + payload]
+    if len(payload) > MAX_ISOTP_LENGTH:
+        raise ValueError(f"{len(payload)} bytes exceed the ISO-TP limit of {MAX_ISOTP_LENGTH}")
+    frames = [bytes([target, 0x10 | len(payload) >> 8, len(payload) & 0xFF]) + payload[:FF_CAPACITY]]
+    for index, offset in enumerate(range(FF_CAPACITY, len(payload), CF_CAPACITY), 1):
+        frames.append(bytes([target, 0x20 | index & 0x0F]) + payload[offset:offset + CF_CAPACITY])
+    return frames
+
+def flow_control(target: int, block_size: int, st_min: int, status: int = 0) -> bytes:
+    return bytes([target, 0x30 | status, block_size, st_min])
+
+def consecutive_frames(length: int) -> int:
+    """Consecutive frames still needed for `length` bytes"""
+    return -(-length // CF_CAPACITY)
+
+def st_min_seconds(value: int) -> float:
+    """ISO 15765-2 STmin byte: 0-127 ms, 0xF1-0xF9 = 100-900 us, reserved = 127 ms"""
+    if value <= 0x7F:
+        return value / 1000
+    if 0xF1 <= value <= 0xF9:
+        return (value - 0xF0) / 10000
+    return 0.127
+
+def frame_command(frame: bytes, count: Optional[int] = None) -> str:
+    """Adapter command sending one padded frame, optionally waiting for `count` frames"""
+    command = frame.ljust(8, bytes([FRAME_PADDING])).hex().upper()
+    return command + (f"{count:X}" if count else "")
+
+def parse_frame(line: str) -> Optional[Tuple[int, bytes]]:
+    """'612F1...' (ATH1, ATS0) -> (0x612, data); None for anything else"""
+    line = line.replace(" ", "")
+    if not FRAME_LINE.fullmatch(line):
+        return None
+    return int(line[:3], 16), bytes.fromhex(line[3:])
+
+# ============================================================================
+# ADAPTER LINK
+# ============================================================================
+
+class AdapterLink:
+    """
+    Command / prompt exchange with an ELM327-style adapter
+
+    Each command ends with CR and is answered by lines up to the '>' prompt.
+    With pipeline_depth > 1 up to that many commands are written ahead, so
+    the Bluetooth / Wi-Fi round trip is paid once per burst instead of once
+    per command. A genuine ELM327 aborts the running command when a byte
+    arrives and needs depth 1; STN chips and most clones queue input.
+
+    Args:
+        address: Host name / IP (TCP) or serial device path (starts with "/")
+    """
+
+    def __init__(self, address: str, port: Optional[int] = None,
+                 baudrate: int = DEFAULT_BAUDRATE, pipeline_depth: int = 1):
+        self.address = address
+        self.port = port
+        self.baudrate = baudrate
+        self.pipeline_depth = max(1, pipeline_depth)
+        self.commands_sent = 0
+        self._serial: Optional[serial.Serial] = None
+        self._read_transport: Optional[asyncio.ReadTransport] = None
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._lock = asyncio.Lock()
+
+    @property
+    def is_serial(self) -> bool:
+        return self.address.startswith("/")
+
+    async def open(self, timeout: float = 10.0):
+        if not self.is_serial:
+            self._reader, self._writer = await asyncio.wait_for(
+                asyncio.open_connection(self.address, self.port), timeout
+            )
+            return
+
+        # pyserial sets up the tty (raw, baud rate); asyncio then drives its descriptor
+        loop = asyncio.get_running_loop()
+        self._serial = await loop.run_in_executor(
+            None, lambda: serial.Serial(self.address, self.baudrate, timeout=0, exclusive=True)
+        )
+        fd = self._serial.fileno()
+        self._reader = asyncio.StreamReader()
+        self._read_transport, _ = await loop.connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(self._reader), os.fdopen(fd, "rb", buffering=0, closefd=False)
+        )
+        transport, protocol = await loop.connect_write_pipe(
+            lambda: asyncio.StreamReaderProtocol(asyncio.StreamReader()), os.fdopen(os.dup(fd), "wb", buffering=0)
+        )
+        self._writer = asyncio.StreamWriter(transport, protocol, None, loop)
+
+    def close(self):
+        if self._writer:
+            self._writer.close()
+            self._writer = None
+        if self._read_transport:
+            self._read_transport.close()
+            self._read_transport = None
+        if self._serial:
+            self._serial.close()
+            self._serial = None
+
+    async def _read_response(self, timeout: float) -> List[str]:
+        raw = await asyncio.wait_for(self._reader.readuntil(PROMPT), timeout)
+        text = raw[:-1].decode("ascii", errors="replace").replace("\n", "\r")
+        return [line.strip() for line in text.split("\r") if line.strip()]
+
+    async def exchange(self, commands: Sequence[str], timeout: float = COMMAND_TIMEOUT) -> List[List[str]]:
+        """
+        Response lines (prompt removed) for each command, in order
+
+        A timeout leaves unread answers in flight; the link is resynchronised
+        before the error propagates.
+        """
+        async with self._lock:
+            results: List[List[str]] = []
+            sent = 0
+            try:
+                while len(results) < len(commands):
+                    while sent < len(commands) and sent - len(results) < self.pipeline_depth:
+                        self._writer.write(commands[sent].encode("ascii") + b"\r")
+                        sent += 1
+                    await self._writer.drain()
+                    results.append(await self._read_response(timeout))
+            except asyncio.TimeoutError:
+                await self._resync()
+                raise TimeoutError(f"Adapter did not answer {commands[len(results)]!r} within {timeout:.1f}s")
+            finally:
+                self.commands_sent += sent
+            return results
+
+    async def monitor(self, accept: Callable[[str], bool], timeout: float) -> str:
+        """
+        First received line `accept`s, without sending a request (ATMA)
+
+        Used while an ECU is answering responsePending or flow control WAIT.
+        Any byte stops monitoring; the adapter then prints its prompt.
+        """
+        async with self._lock:
+            self._writer.write(b"ATMA\r")
+            deadline = time.monotonic() + timeout
+            try:
+                while True:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise asyncio.TimeoutError
+                    raw = await asyncio.wait_for(self._reader.readuntil(b"\r"), remaining)
+                    line = raw.decode("ascii", errors="replace").strip(" \r\n>")
+                    if line and accept(line):
+                        return line
+            except asyncio.TimeoutError:
+                raise TimeoutError(f"No frame within {timeout:.1f}s")
+            finally:
+                self._writer.write(b"\r")
+                try:
+                    await asyncio.wait_for(self._reader.readuntil(PROMPT), COMMAND_TIMEOUT)
+                except asyncio.TimeoutError:
+                    await self._resync()
+
+    async def _resync(self):
+        """Discard stale answers until a probe's prompt comes back"""
+        self._writer.write(b"ATI\r")
+        deadline = time.monotonic() + COMMAND_TIMEOUT
+        while time.monotonic() < deadline:
+            try:
+                raw = await asyncio.wait_for(self._reader.readuntil(PROMPT), deadline - time.monotonic())
+            except (asyncio.TimeoutError, asyncio.IncompleteReadError):
+                break
+            if b"ELM" in raw or b"STN" in raw:
+                return
+        logger.warning("OBD adapter did not resynchronise")
+
+# ============================================================================
+# CONNECTION
+# ============================================================================
+
+class OBDAdapterConnection(UDSServices):
+    """
+    UDS over an ELM327 / STN adapter; same interface as ENETConnection
+
+    The adapter passes raw CAN frames (ATCAF0) and ISO-TP happens here, so
+    neither long requests (which ELM327s cannot send) nor long responses
+    depend on the adapter firmware:
+
+    - Requests longer than a single frame are segmented; each block the
+      ECU's flow control allows goes out as one pipelined burst of
+      consecutive frames (responses off, ATR0, except for the last one).
+    - Responses are reassembled with our own flow control. Its block size
+      never exceeds 15, so every block is read with a response count and
+      never waits for the adapter timeout. STmin starts at `st_min` and is
+      raised when the adapter reports BUFFER FULL (slow Bluetooth UARTs).
+    - The receive filter for a new target is set in the same burst as the
+      first request to it.
+
+    Raw UDS calls carry no ECU address (G01ECUManager talks to whatever the
+    transport is pointed at), so requests go to `target` unless one is
+    passed explicitly.
+    """
+
+    def __init__(self, address: str = DEFAULT_WIFI_ADDRESS, port: Optional[int] = DEFAULT_WIFI_PORT,
+                 target: int = 0x12, pipeline_depth: int = 1, block_size: int = MAX_RESPONSE_COUNT,
+                 st_min: int = 0, baudrate: int = DEFAULT_BAUDRATE, response_counts: bool = True):
+        """
+        Args:
+            address: Wi-Fi adapter IP, or serial device for Bluetooth / USB / pty
+            target: Default ECU diagnostic address (0x12 = DME)
+            pipeline_depth: Commands written ahead (1 for genuine ELM327)
+            block_size: Flow-control block size requested from ECUs (1-15)
+            st_min: Flow-control STmin in ms requested from ECUs
+            response_counts: False for adapters older than ELM327 v1.3
+        """
+        self.ip_address = address
+        self.port = None if address.startswith("/") else port
+        self.target = target
+        self.block_size = min(max(1, block_size), MAX_RESPONSE_COUNT)
+        self.st_min = st_min
+        self.response_counts = response_counts
+        self.link = AdapterLink(address, self.port, baudrate, pipeline_depth)
+        self.connected = False
+        self.connect_count = 0
+        self.adapter_version: Optional[str] = None
+        self.buffer_full = 0
+        self.scheduler = RequestScheduler()
+        self._filter: Optional[int] = None
+
+    @property
+    def pipeline_depth(self) -> int:
+        return self.link.pipeline_depth
+
+    async def connect(self) -> bool:
+        """Open the link, reset the adapter and switch it to raw CAN frames"""
+        reconnect = self.connect_count > 0
+        self.connect_count += 1
+        try:
+            await self.link.open()
+            (banner,) = await self.link.exchange(["ATZ"], timeout=RESET_TIMEOUT)
+            self.adapter_version = next(
+                (line for line in banner if "ELM" in line or "STN" in line), "unknown adapter"
+            )
+            responses = await self.link.exchange(INIT_COMMANDS)
+            rejected = [command for command, lines in zip(INIT_COMMANDS, responses) if "OK" not in lines]
+            if rejected:
+                raise AdapterError(f"Adapter rejected {', '.join(rejected)}")
+            self._filter = None
+            self.connected = True
+            logger.info(f"Connected to {self.adapter_version} at {self._describe()}")
+            observe_connect("obd", True, reconnect)
+            return True
+        except Exception as e:
+            logger.error(f"OBD adapter connection failed: {e}")
+            self.link.close()
+            self.connected = False
+            observe_connect("obd", False, reconnect)
+            return False
+
+    def disconnect(self):
+        """Close the adapter link"""
+        if self.connected:
+            logger.info(f"OBD adapter connection to {self._describe()} closed")
+        self.link.close()
+        self.connected = False
+
+    def _describe(self) -> str:
+        return self.ip_address if self.port is None else f"{self.ip_address}:{self.port}"
+
+    # ------------------------------------------------------------------
+    # Commands
+    # ------------------------------------------------------------------
+
+    def _frame_command(self, frame: bytes, count: Optional[int] = None) -> str:
+        return frame_command(frame, count if self.response_counts else None)
+
+    async def _commands(self, commands: List[str]) -> List[str]:
+        """Run a burst; lines of the last command (errors in any raise)"""
+        results = await self.link.exchange(commands)
+        for command, lines in zip(commands, results):
+            for line in lines:
+                if line == "BUFFER FULL":
+                    raise BufferFull(f"Adapter buffer full after {command}")
+                if line in ADAPTER_ERRORS or line.startswith(ADAPTER_ERRORS[:-1]):
+                    raise AdapterError(f"{command}: {line}")
+        return results[-1]
+
+    def _select(self, target: int) -> List[str]:
+        """Commands pointing the receive filter at `target`, if it isn't already"""
+        if self._filter == target:
+            return []
+        self._filter = target
+        return [f"ATCRA{RESPONSE_CAN_BASE + target:03X}"]
+
+    @staticmethod
+    def _frames(lines: List[str], target: int) -> List[bytes]:
+        """Data of the frames `target` sent to the tester"""
+        frames = []
+        for line in lines:
+            parsed = parse_frame(line)
+            if parsed and parsed[0] == RESPONSE_CAN_BASE + target and parsed[1][:1] == bytes([TESTER_ADDRESS]):
+                frames.append(parsed[1])
+        return frames
+
+    def _first_frame(self, lines: List[str], target: int) -> bytes:
+        frames = self._frames(lines, target)
+        if not frames:
+            raise AdapterError(f"No answer from ECU 0x{target:02X}")
+        return frames[0]
+
+    async def _monitor(self, target: int, timeout: float) -> bytes:
+        line = await self.link.monitor(lambda line: bool(self._frames([line], target)), timeout)
+        return self._frames([line], target)[0]
+
+    # ------------------------------------------------------------------
+    # ISO-TP
+    # ------------------------------------------------------------------
+
+    async def _send(self, target: int, message: bytes) -> bytes:
+        """Send one message; first frame the ECU answers with"""
+        frames = segment(target, message)
+        prefix = self._select(target)
+        lines = await self._commands(prefix + [self._frame_command(frames[0], 1)])
+        answer = self._first_frame(lines, target)
+        remaining = frames[1:]
+
+        while remaining:
+            fc = answer
+            if fc[1] >> 4 != 3:
+                raise AdapterError(f"Expected flow control from ECU 0x{target:02X}, got {fc.hex()}")
+            status = fc[1] & 0x0F
+            if status == 1:  # WAIT
+                answer = await self._monitor(target, P2_STAR)
+                continue
+            if status != 0:
+                raise AdapterError(f"ECU 0x{target:02X} refused {len(message)} bytes (flow status {status})")
+
+            block_size, separation = fc[2], st_min_seconds(fc[3])
+            block = remaining if block_size == 0 else remaining[:block_size]
+            remaining = remaining[len(block):]
+            last = self._frame_command(block[-1], 1)
+            if len(block) == 1:
+                lines = await self._commands([last])
+            elif separation <= 0:
+                # The whole block in one burst; only the last frame waits for an answer
+                lines = await self._commands(["ATR0"] + [self._frame_command(f) for f in block[:-1]] + ["ATR1", last])
+            else:
+                await self._commands(["ATR0"])
+                for frame in block[:-1]:
+                    await self._commands([self._frame_command(frame)])
+                    await asyncio.sleep(separation)
+                lines = await self._commands(["ATR1", last])
+            answer = self._first_frame(lines, target)
+
+        return answer
+
+    async def _receive(self, target: int, first: bytes) -> bytes:
+        """Whole message starting with `first`, pulling consecutive frames block by block"""
+        pci = first[1] >> 4
+        if pci == 0:
+            return first[2:2 + (first[1] & 0x0F)]
+        if pci != 1:
+            raise AdapterError(f"Unexpected frame from ECU 0x{target:02X}: {first.hex()}")
+
+        length = (first[1] & 0x0F) << 8 | first[2]
+        payload = bytearray(first[3:3 + FF_CAPACITY])
+        sequence = 1
+        while len(payload) < length:
+            block = min(consecutive_frames(length - len(payload)), self.block_size)
+            lines = await self._commands([self._frame_command(flow_control(target, block, self.st_min), block)])
+            frames = self._frames(lines, target)
+            if len(frames) < block:
+                raise AdapterError(f"ECU 0x{target:02X} sent {len(frames)} of {block} consecutive frames")
+            for frame in frames[:block]:
+                if frame[1] != 0x20 | sequence & 0x0F:
+                    raise AdapterError(f"ECU 0x{target:02X}: consecutive frame out of sequence ({frame.hex()})")
+                payload += frame[2:2 + CF_CAPACITY]
+                sequence += 1
+        return bytes(payload[:length])
+
+    async def _transfer(self, target: int, message: bytes) -> bytes:
+        response = await self._receive(target, await self._send(target, message))
+        pending = 0
+        while is_response_pending(message[0], response):
+            pending += 1
+            observe_response_pending("obd", target, message[0])
+            if pending > MAX_RESPONSE_PENDING:
+                raise TimeoutError(f"Still pending after {pending} responsePending")
+            response = await self._receive(target, await self._monitor(target, P2_STAR))
+        return response
+
+    def _back_off(self):
+        self.buffer_full += 1
+        self.st_min = min(max(1, self.st_min * 2), MAX_ST_MIN)
+        logger.warning(f"OBD adapter buffer full, requesting STmin {self.st_min} ms")
+
+    async def _recover(self):
+        """Put the adapter back into a known state after a failed transfer"""
+        self._filter = None
+        try:
+            await self.link.exchange(["ATR1"])
+        except Exception as e:
+            logger.warning(f"OBD adapter recovery failed: {e}")
+
+    # ------------------------------------------------------------------
+    # UDS
+    # ------------------------------------------------------------------
+
+    async def send_uds_request(self, service_id: int, data: bytes = b'', target: Optional[int] = None) -> bytes:
+        """Send UDS request to `target` (default: self.target), in the caller's scheduler class"""
+        if not self.connected:
+            raise ConnectionError("Not connected to OBD adapter")
+        target = self.target if target is None else target
+        return await self.scheduler.run(self._request, target, bytes([service_id]) + data)
+
+    async def _request(self, target: int, message: bytes) -> bytes:
+        start = time.perf_counter()
+        response = None
+        try:
+            for attempt in range(BUFFER_FULL_RETRIES + 1):
+                try:
+                    response = await self._transfer(target, message)
+                    return response
+                except BufferFull:
+                    await self._recover()
+                    if attempt == BUFFER_FULL_RETRIES:
+                        raise
+                    self._back_off()
+        except Exception as e:
+            logger.error(f"UDS request via OBD adapter failed: {e}")
+            if not isinstance(e, BufferFull):
+                await self._recover()
+            raise
+        finally:
+            observe_uds("obd", target, message, response, time.perf_counter() - start)
+
+    async def send_uds_requests(self, requests: List[tuple], target: Optional[int] = None) -> List[Optional[bytes]]:
+        """
+        Send several (service_id, data) requests
+
+        Runs of single-frame requests to PIPELINED_SERVICES go out as
+        bursts of up to MAX_BATCH with a response count each (each burst is
+        one scheduling unit); everything else runs one at a time. If an
+        answer in a burst is not a complete single frame (e.g.
+        responsePending), that request is repeated on its own and the
+        requests after it are sent again.
+
+        Returns:
+            One response per request (None where it failed)
+        """
+        if not self.connected:
+            raise ConnectionError("Not connected to OBD adapter")
+        target = self.target if target is None else target
+        responses: List[Optional[bytes]] = [None] * len(requests)
+
+        index = 0
+        while index < len(requests):
+            run = index
+            while (run < len(requests) and run - index < MAX_BATCH and requests[run][0] in PIPELINED_SERVICES
+                   and 1 + len(requests[run][1]) <= SF_CAPACITY):
+                run += 1
+
+            if run - index > 1:
+                try:
+                    index += await self.scheduler.run(
+                        self._send_burst, target, requests[index:run], responses, index, cost=run - index
+                    )
+                except RequestExpired:
+                    break
+                if index == run:
+                    continue
+
+            service_id, data = requests[index]
+            try:
+                responses[index] = await self.send_uds_request(service_id, data, target)
+            except Exception:
+                responses[index] = None
+            index += 1
+        return responses
+
+    async def _send_burst(self, target: int, requests: List[tuple],
+                          responses: List[Optional[bytes]], offset: int) -> int:
+        """Pipelined single-frame requests; how many were answered in order"""
+        messages = [bytes([service_id]) + data for service_id, data in requests]
+        commands = self._select(target) + [
+            self._frame_command(segment(target, message)[0], 1) for message in messages
+        ]
+        skip = len(commands) - len(messages)
+
+        start = time.perf_counter()
+        try:
+            results = await self.link.exchange(commands)
+        except Exception as e:
+            logger.warning(f"Pipelined burst failed, repeating one at a time: {e}")
+            await self._recover()
+            return 0
+        elapsed = (time.perf_counter() - start) / len(messages)
+
+        done = 0
+        for message, lines in zip(messages, results[skip:]):
+            frames = self._frames(lines, target)
+            if not frames or frames[0][1] >> 4 != 0 or is_response_pending(message[0], frames[0][2:]):
+                break
+            response = frames[0][2:2 + (frames[0][1] & 0x0F)]
+            responses[offset + done] = response
+            observe_uds("obd", target, message, response, elapsed)
+            done += 1
+        return done
+
+# ============================================================================
+# SIMULATOR
+# ============================================================================
+
+class SimulatedECU:
+    """
+    ISO-TP endpoint (extended addressing) behind a simulated adapter
+
+    Answers 0x10, 0x22 (multi-DID), 0x2E, 0x27 and 0x3E from `memory`;
+    unknown DIDs read as `default_length` zero bytes. Services in
+    `pending` answer responsePending first and the final response after
+    the given delay.
+    """
+
+    def __init__(self, address: int, memory: Optional[Dict[int, bytes]] = None,
+                 block_size: int = 0, st_min: int = 0, default_length: int = 3,
+                 pending: Optional[Dict[int, float]] = None):
+        self.address = address
+        self.memory = dict(memory or {})
+        self.block_size = block_size
+        self.st_min = st_min
+        self.default_length = default_length
+        self.pending = pending or {}
+        self.can_id = RESPONSE_CAN_BASE + address
+        self._rx = bytearray()
+        self._rx_length = 0
+        self._rx_sequence = 0
+        self._tx: Deque[bytes] = deque()
+
+    def handle(self, request: bytes) -> bytes:
+        service_id = request[0]
+        if service_id == 0x10:
+            return bytes([0x50, request[1], 0x00, 0x32, 0x01, 0xF4])
+        if service_id == 0x3E:
+            return b"\x7E\x00"
+        if service_id == 0x27:
+            return bytes([0x67, request[1]]) + (b"\x12\x34\x56\x78" if request[1] % 2 else b"")
+        if service_id == 0x22 and len(request) >= 3 and len(request) % 2 == 1:
+            response = bytearray(b"\x62")
+            for offset in range(1, len(request), 2):
+                did = int.from_bytes(request[offset:offset + 2], "big")
+                response += request[offset:offset + 2] + self.memory.get(did, bytes(self.default_length))
+            return bytes(response)
+        if service_id == 0x2E and len(request) > 3:
+            self.memory[int.from_bytes(request[1:3], "big")] = request[3:]
+            return b"\x6E" + request[1:3]
+        return bytes([0x7F, service_id, 0x11])
+
+    def _respond(self, request: bytes) -> List[Tuple[float, bytes]]:
+        delay = 0.0
+        frames: List[Tuple[float, bytes]] = []
+        if request[0] in self.pending:
+            frames.append((0.0, bytes([TESTER_ADDRESS, 3, 0x7F, request[0], 0x78])))
+            delay = self.pending[request[0]]
+        message = segment(TESTER_ADDRESS, self.handle(request))
+        self._tx = deque(message[1:])
+        frames.append((delay, message[0]))
+        return frames
+
+    def receive(self, frame: bytes) -> List[Tuple[float, bytes]]:
+        """Frames answering `frame`, as (delay after the previous one, data)"""
+        pci = frame[1] >> 4
+        if pci == 0:
+            return self._respond(frame[2:2 + (frame[1] & 0x0F)])
+        if pci == 1:
+            self._rx_length = (frame[1] & 0x0F) << 8 | frame[2]
+            self._rx = bytearray(frame[3:8])
+            self._rx_sequence = 1
+            return [(0.0, flow_control(TESTER_ADDRESS, self.block_size, self.st_min))]
+        if pci == 2:
+            if frame[1] & 0x0F != self._rx_sequence & 0x0F:
+                self._rx_length = 0
+                return []
+            self._rx += frame[2:8]
+            if len(self._rx) >= self._rx_length:
+                return self._respond(bytes(self._rx[:self._rx_length]))
+            if self.block_size and self._rx_sequence % self.block_size == 0:
+                self._rx_sequence += 1
+                return [(0.0, flow_control(TESTER_ADDRESS, self.block_size, self.st_min))]
+            self._rx_sequence += 1
+            return []
+        if pci == 3 and self._tx:
+            count = frame[2] or len(self._tx)
+            spacing = st_min_seconds(frame[3])
+            return [(spacing, self._tx.popleft()) for _ in range(min(count, len(self._tx)))]
+        return []
+
+class ELM327Simulator:
+    """
+    ELM327 / STN adapter with simulated ECUs behind it, served on a pty
+
+    Timing model: `link_latency` each way (Bluetooth / Wi-Fi), `command_time`
+    per command inside the adapter, `frame_time` per CAN frame on the bus.
+    queued=False behaves like a genuine ELM327 (a byte arriving while a
+    command runs aborts it with STOPPED); True queues input like STN chips.
+    With `uart_baudrate` set, frames arriving faster than they can be
+    printed fill a 256 byte buffer and end in BUFFER FULL.
+    """
+
+    BUFFER_SIZE = 256
+
+    def __init__(self, ecus: Sequence[SimulatedECU], link_latency: float = 0.0,
+                 command_time: float = 0.001, frame_time: float = 0.00025,
+                 queued: bool = True, uart_baudrate: Optional[int] = None):
+        self.ecus = {ecu.can_id: ecu for ecu in ecus}
+        self.link_latency = link_latency
+        self.command_time = command_time
+        self.frame_time = frame_time
+        self.queued = queued
+        self.uart_baudrate = uart_baudrate
+        self.commands = 0
+        self.master: Optional[int] = None
+        self.path: Optional[str] = None
+        self._input = b""
+        self._queue: Deque[str] = deque()
+        self._arrived = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._bus: Deque[Tuple[float, int, bytes]] = deque()
+        self._reset()
+
+    def _reset(self):
+        self.echo = True
+        self.headers = False
+        self.spaces = True
+        self.linefeeds = False
+        self.responses = True
+        self.timeout = 0x32 * 0.004096
+        self.header = 0x7DF
+        self.receive_filter: Optional[int] = None
+
+    async def start(self) -> str:
+        """Open the pty and serve it; returns the device path for clients"""
+        import tty
+        self.master, slave = os.openpty()
+        tty.setraw(slave)
+        self.path = os.ttyname(slave)
+        self._slave = slave  # Kept open so the pty survives client reconnects
+        os.set_blocking(self.master, False)
+        asyncio.get_running_loop().add_reader(self.master, self._on_readable)
+        self._task = asyncio.create_task(self._process())
+        return self.path
+
+    def close(self):
+        if self._task:
+            self._task.cancel()
+        if self.master is not None:
+            asyncio.get_running_loop().remove_reader(self.master)
+            os.close(self.master)
+            os.close(self._slave)
+            self.master = None
+
+    def _on_readable(self):
+        try:
+            data = os.read(self.master, 4096)
+        except (BlockingIOError, OSError):
+            return
+        asyncio.get_running_loop().call_later(self.link_latency, self._arrive, data)
+
+    def _arrive(self, data: bytes):
+        self._input += data
+        *commands, self._input = self._input.split(b"\r")
+        self._queue.extend(c.decode("ascii", errors="replace").strip().upper() for c in commands)
+        self._arrived.set()
+
+    def _emit(self, text: str):
+        data = text.encode("ascii")
+        if self.linefeeds:
+            data = data.replace(b"\r", b"\r\n")
+        asyncio.get_running_loop().call_later(self.link_latency, self._write, data)
+
+    def _write(self, data: bytes):
+        if self.master is not None:
+            try:
+                os.write(self.master, data)
+            except OSError:
+                pass
+
+    async def _busy(self, seconds: float):
+        """Spend time in the adapter; an ELM327 stops when input arrives meanwhile"""
+        if self.queued or seconds <= 0:
+            await asyncio.sleep(seconds)
+            return
+        self._arrived.clear()
+        try:
+            await asyncio.wait_for(self._arrived.wait(), seconds)
+        except asyncio.TimeoutError:
+            return
+        raise InterruptedError
+
+    async def _process(self):
+        while True:
+            if not self._queue:
+                self._arrived.clear()
+                await self._arrived.wait()
+                continue
+            command = self._queue.popleft()
+            self.commands += 1
+            echo = command + "\r" if self.echo else ""
+            try:
+                await self._busy(self.command_time)
+                output = await self._execute(command)
+            except InterruptedError:
+                self._bus.clear()
+                output = ["STOPPED"]
+            self._emit(echo + "".join(line + "\r" for line in output) + "\r>")
+
+    def _format(self, can_id: int, data: bytes) -> str:
+        sep = " " if self.spaces else ""
+        parts = ([f"{can_id:03X}"] if self.headers else []) + [f"{b:02X}" for b in data]
+        return sep.join(parts)
+
+    async def _execute(self, command: str) -> List[str]:
+        compact = command.replace(" ", "")
+        if compact.startswith("AT"):
+            return await self._at(compact[2:])
+        if not compact or not re.fullmatch(r"[0-9A-F]+", compact):
+            return ["?"]
+
+        count = None
+        if len(compact) % 2:
+            count, compact = int(compact[-1], 16), compact[:-1]
+        data = bytes.fromhex(compact)
+        await asyncio.sleep(self.frame_time)
+
+        self._bus.clear()
+        now = time.monotonic()
+        for ecu in self.ecus.values():
+            if self.header == TESTER_CAN_ID and data[:1] == bytes([ecu.address]):
+                at = now
+                for delay, frame in ecu.receive(data):
+                    at += max(delay, self.frame_time)
+                    self._bus.append((at, ecu.can_id, frame))
+        if not self.responses:
+            return []
+        return await self._listen(count)
+
+    async def _listen(self, count: Optional[int]) -> List[str]:
+        lines: List[str] = []
+        backlog = 0.0
+        last = time.monotonic()
+        while count is None or len(lines) < count:
+            if not self._bus:
+                await self._busy(self.timeout)  # Nothing more is coming
+                break
+            at, can_id, frame = self._bus[0]
+            wait = at - time.monotonic()
+            if wait > self.timeout:
+                await self._busy(self.timeout)
+                break
+            await self._busy(wait)
+            self._bus.popleft()
+            if self.receive_filter is not None and can_id != self.receive_filter:
+                continue
+            line = self._format(can_id, frame)
+            if self.uart_baudrate:
+                # Bytes printed vs bytes the UART could move since the last frame
+                backlog += (len(line) + 1) - (at - last) * self.uart_baudrate / 10
+                backlog = max(0.0, backlog)
+                last = at
+                if backlog > self.BUFFER_SIZE:
+                    self._bus.clear()
+                    return lines + ["BUFFER FULL"]
+            lines.append(line)
+        if not lines:
+            return ["NO DATA"]
+        return lines
+
+    async def _monitor_all(self) -> List[str]:
+        """ATMA: print frames as they come until any input arrives"""
+        self._arrived.clear()
+        while not self._arrived.is_set():
+            if not self._bus:
+                await self._arrived.wait()
+                break
+            at, can_id, frame = self._bus[0]
+            try:
+                await asyncio.wait_for(self._arrived.wait(), max(0.0, at - time.monotonic()))
+                break
+            except asyncio.TimeoutError:
+                pass
+            self._bus.popleft()
+            if self.receive_filter is None or can_id == self.receive_filter:
+                self._emit(self._format(can_id, frame) + "\r")
+        if self._queue and self._queue[0] == "":
+            self._queue.popleft()  # The byte that stopped monitoring
+        return []
+
+    async def _at(self, command: str) -> List[str]:
+        flags = {"E": "echo", "H": "headers", "S": "spaces", "L": "linefeeds", "R": "responses"}
+        if command == "Z":
+            self._reset()
+            self._bus.clear()
+            return ["", "ELM327 v1.5"]
+        if command in ("I", "@1"):
+            return ["ELM327 v1.5"]
+        if command == "MA":
+            return await self._monitor_all()
+        if len(command) == 2 and command[0] in flags and command[1] in "01":
+            setattr(self, flags[command[0]], command[1] == "1")
+            return ["OK"]
+        if command.startswith("SH") and len(command) == 5:
+            self.header = int(command[2:], 16)
+            return ["OK"]
+        if command.startswith("CRA"):
+            self.receive_filter = int(command[3:], 16) if len(command) == 6 else None
+            return ["OK"]
+        if command.startswith("ST") and len(command) == 4:
+            self.timeout = max(1, int(command[2:], 16)) * 0.004096
+            return ["OK"]
+        if command in ("SP6", "CAF0", "CAF1", "AT0", "AT1", "AT2", "D"):
+            return ["OK"]
+        return ["?"]
+
+# ============================================================================
+# EXPORT
+# ============================================================================
+
+__all__ = [
+    'DEFAULT_WIFI_ADDRESS',
+    'DEFAULT_WIFI_PORT',
+    'DEFAULT_BLUETOOTH_DEVICE',
+    'AdapterError',
+    'AdapterLink',
+    'OBDAdapterConnection',
+    'SimulatedECU',
+    'ELM327Simulator',
+    'segment',
+]
+
+if __name__ == "__main__":
+    # python obd_adapter.py [requests]
+    # Request throughput through a pty-simulated adapter, one command at a
+    # time vs pipelined, for USB-, Wi-Fi- and Bluetooth-like link latency
+    import sys
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+
+    async def workload(connection: OBDAdapterConnection, name: str) -> int:
+        if name == "small writes (batched)":
+            requests = [(0x2E, bytes([0x30, i & 0xFF, i & 0xFF])) for i in range(count)]
+            assert all(r and r[0] == 0x6E for r in await connection.send_uds_requests(requests))
+        elif name == "coding writes (20 B)":
+            for i in range(count):
+                assert await connection.write_ecu_data(0x3000 + i, bytes(range(20)))
+        else:
+            for i in range(count):
+                response = await connection.read_ecu_data(0x4000 + i)
+                assert len(response) == 3 + 40, response
+        return count
+
+    async def run(latency: float, depth: int, name: str, response_counts: bool = True) -> float:
+        ecu = SimulatedECU(0x12, {0x4000 + i: bytes(40) for i in range(count)})
+        simulator = ELM327Simulator([ecu], link_latency=latency)
+        path = await simulator.start()
+        connection = OBDAdapterConnection(path, target=0x12, pipeline_depth=depth,
+                                          response_counts=response_counts)
+        assert await connection.connect()
+        try:
+            start = time.perf_counter()
+            done = await workload(connection, name)
+            return done / (time.perf_counter() - start)
+        finally:
+            connection.disconnect()
+            simulator.close()
+
+    async def main():
+        print(f"{'link':<12}{'workload':<26}{'depth 1 req/s':>15}{'depth 4 req/s':>15}{'gain':>8}")
+        for link, latency in [("pty", 0.0), ("wifi 8ms", 0.008), ("bt 20ms", 0.020)]:
+            for name in ["small writes (batched)", "coding writes (20 B)", "reads (40 B)"]:
+                sequential = await run(latency, 1, name)
+                pipelined = await run(latency, 4, name)
+                print(f"{link:<12}{name:<26}{sequential:>15.1f}{pipelined:>15.1f}{pipelined / sequential:>7.1f}x")
+        naive = await run(0.008, 1, "reads (40 B)", response_counts=False)
+        print(f"{'wifi 8ms':<12}{'reads, no resp. counts':<26}{naive:>15.1f}")
+
+    asyncio.run(main())
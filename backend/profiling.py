@@ -0,0 +1,484 @@
+"""
+Profiling
+On-demand stack sampling, tracemalloc snapshot diffs and slow-request capture for the running backend
+"""
+
+import itertools
+import os
+import re
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter, OrderedDict, deque
+from dataclasses import dataclass, field
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Set, Tuple, Union
+import logging
+
+logger = logging.getLogger(__name__)
+
+# 200 Hz: one sample costs ~50 us per thread, well below 1% of a core
+SAMPLE_INTERVAL = 0.005
+MAX_PROFILE_SECONDS = 300.0
+
+PROFILE_SUFFIX = ".collapsed"
+
+# Leaf frames of threads that are waiting, not working (event loop in
+# select, idle executor workers, blocked locks)
+IDLE_FRAMES = {
+    ("selectors.py", "select"),
+    ("threading.py", "wait"),
+    ("thread.py", "_worker"),
+    ("queue.py", "get"),
+    ("socket.py", "accept"),
+}
+
+MAX_SNAPSHOTS = 16
+TRACEMALLOC_FRAMES = 25
+
+# ============================================================================
+# STACK SAMPLING
+# ============================================================================
+
+_frame_labels: Dict[object, Tuple[str, bool]] = {}
+
+def _label(code) -> Tuple[str, bool]:
+    """'function (file.py:line)' for a code object, and whether it is an idle leaf"""
+    cached = _frame_labels.get(code)
+    if cached is None:
+        filename = os.path.basename(code.co_filename)
+        cached = (f"{code.co_name} ({filename}:{code.co_firstlineno})",
+                  (filename, code.co_name) in IDLE_FRAMES)
+        _frame_labels[code] = cached
+    return cached
+
+def sample_stacks(skip: Iterable[int] = (), include_idle: bool = False) -> List[str]:
+    """
+    Current stack of every thread, collapsed ("thread;outer;...;leaf")
+
+    Args:
+        skip: Thread idents to leave out (the sampler itself)
+        include_idle: Keep threads whose leaf frame is a wait (IDLE_FRAMES)
+    """
+    names = {thread.ident: thread.name for thread in threading.enumerate()}
+    skip = set(skip)
+    stacks = []
+    for ident, frame in sys._current_frames().items():
+        if ident in skip:
+            continue
+        labels = []
+        idle = _label(frame.f_code)[1]
+        while frame is not None:
+            labels.append(_label(frame.f_code)[0])
+            frame = frame.f_back
+        if idle and not include_idle:
+            continue
+        labels.append(names.get(ident, f"thread-{ident}"))
+        stacks.append(";".join(reversed(labels)))
+    return stacks
+
+@dataclass
+class Profile:
+    """Sampled stacks in flamegraph.pl / speedscope collapsed format"""
+    label: str
+    started: float
+    duration: float
+    interval: float
+    samples: int = 0
+    stacks: Counter = field(default_factory=Counter)
+    file: Optional[str] = None
+
+    def collapsed(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def top(self, limit: int = 15) -> List[Dict]:
+        """Leaf frames by sample share (self time)"""
+        leaves: Counter = Counter()
+        for stack, count in self.stacks.items():
+            leaves[stack.rsplit(";", 1)[-1]] += count
+        total = sum(leaves.values()) or 1
+        return [
+            {"frame": frame, "samples": count, "percent": round(count * 100 / total, 1)}
+            for frame, count in leaves.most_common(limit)
+        ]
+
+    def summary(self) -> Dict:
+        return {
+            "label": self.label,
+            "started": datetime.utcfromtimestamp(self.started).isoformat() + "Z",
+            "duration_s": round(self.duration, 3),
+            "interval_ms": self.interval * 1000,
+            "samples": self.samples,
+            "stacks": len(self.stacks),
+            "file": self.file,
+            "top": self.top(),
+        }
+
+    def save(self, directory: Union[str, Path]) -> Path:
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        slug = re.sub(r"[^A-Za-z0-9]+", "_", self.label).strip("_")
+        stamp = datetime.utcfromtimestamp(self.started).strftime("%Y%m%d_%H%M%S_%f")[:-3]
+        path = directory / f"{slug}_{stamp}{PROFILE_SUFFIX}"
+        path.write_text(self.collapsed())
+        self.file = path.name
+        return path
+
+class SamplingProfiler:
+    """
+    Wall-clock sampler over every thread of this process, started on demand
+
+    A daemon thread reads sys._current_frames() every `interval` until the
+    duration is up or stop() is called. Nothing is instrumented, so
+    there is no cost while it is not running. The finished profile is
+    saved to `directory` and kept as `last`.
+    """
+
+    def __init__(self, directory: Union[str, Path]):
+        self.directory = Path(directory)
+        self.last: Optional[Profile] = None
+        self._current: Optional[Profile] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, seconds: float, interval: float = SAMPLE_INTERVAL,
+              include_idle: bool = False, label: str = "profile") -> Profile:
+        """
+        Raises:
+            RuntimeError: a profile is already running
+        """
+        with self._lock:
+            if self.running:
+                raise RuntimeError("A profile is already running")
+            seconds = min(max(seconds, interval), MAX_PROFILE_SECONDS)
+            self._current = Profile(label, time.time(), 0.0, interval)
+            self._stop.clear()
+            self._thread = threading.Thread(
+                target=self._run, args=(self._current, seconds, include_idle),
+                name="sampling-profiler", daemon=True
+            )
+            self._thread.start()
+            logger.info(f"Sampling profiler started for {seconds:.0f}s at {interval * 1000:.1f} ms")
+            return self._current
+
+    def _run(self, profile: Profile, seconds: float, include_idle: bool):
+        own = {threading.get_ident()}
+        start = time.perf_counter()
+        deadline = start + seconds
+        while not self._stop.wait(profile.interval) and time.perf_counter() < deadline:
+            profile.stacks.update(sample_stacks(own, include_idle))
+            profile.samples += 1
+        profile.duration = time.perf_counter() - start
+        try:
+            profile.save(self.directory)
+        except OSError as e:
+            logger.error(f"Could not save profile: {e}")
+        self.last = profile
+        logger.info(f"Sampling profiler finished: {profile.samples} samples, {len(profile.stacks)} stacks")
+
+    def stop(self) -> Optional[Profile]:
+        """End the running profile early; the finished (or last) profile"""
+        thread = self._thread
+        if thread is not None:
+            self._stop.set()
+            thread.join()
+        return self.last
+
+    def status(self) -> Dict:
+        current = self._current if self.running else None
+        return {
+            "running": current is not None,
+            "current": {"label": current.label, "samples": current.samples} if current else None,
+            "last": self.last.summary() if self.last else None,
+        }
+
+def list_profiles(directory: Union[str, Path]) -> List[Dict]:
+    directory = Path(directory)
+    if not directory.exists():
+        return []
+    files = sorted(directory.glob(f"*{PROFILE_SUFFIX}"), key=lambda f: f.stat().st_mtime, reverse=True)
+    return [
+        {
+            "file": f.name,
+            "bytes": f.stat().st_size,
+            "modified": datetime.utcfromtimestamp(f.stat().st_mtime).isoformat() + "Z",
+        }
+        for f in files
+    ]
+
+# ============================================================================
+# SLOW REQUESTS
+# ============================================================================
+
+@dataclass
+class _Request:
+    started: float
+    wall_start: float
+    stacks: Counter = field(default_factory=Counter)
+    samples: int = 0
+
+class SlowRequestProfiler:
+    """
+    Profiles only the requests that turn out slow
+
+    Requests register on arrival; a watchdog thread sleeps until the oldest
+    one crosses `threshold` and only then samples, attributing stacks to
+    every request past it. A fast request costs a dict insert and delete.
+    Because sampling runs in its own thread, handlers that block the event
+    loop (synchronous parsing in an async route) are caught too.
+    When such a request ends, its profile is saved to `directory`.
+
+    Args:
+        threshold: Seconds before sampling starts; 0 disables the hook
+        routes: Route templates to keep profiles for (default: all)
+    """
+
+    def __init__(self, directory: Union[str, Path], threshold: float = 1.0,
+                 interval: float = SAMPLE_INTERVAL, routes: Optional[Iterable[str]] = None,
+                 keep: int = 50):
+        self.directory = Path(directory)
+        self.threshold = threshold
+        self.interval = interval
+        self.routes: Optional[Set[str]] = set(routes) if routes else None
+        self.captured = 0
+        self.recent: deque = deque(maxlen=keep)
+        self._active: Dict[int, _Request] = {}
+        self._tokens = itertools.count()
+        self._wake = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.threshold > 0
+
+    def begin(self) -> Optional[int]:
+        if not self.enabled:
+            return None
+        token = next(self._tokens)
+        with self._wake:
+            self._active[token] = _Request(time.perf_counter(), time.time())
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._watch, name="slow-request-profiler", daemon=True)
+                self._thread.start()
+            elif len(self._active) == 1:
+                self._wake.notify()
+        return token
+
+    def end(self, token: Optional[int], route: str) -> Optional[Profile]:
+        """Close a request; its profile if it was slow (and its route is watched)"""
+        if token is None:
+            return None
+        with self._wake:
+            request = self._active.pop(token, None)
+        if request is None or not request.samples:
+            return None
+        if self.routes is not None and route not in self.routes:
+            return None
+
+        elapsed = time.perf_counter() - request.started
+        profile = Profile(f"slow {route}", request.wall_start, elapsed, self.interval,
+                          request.samples, request.stacks)
+        try:
+            profile.save(self.directory)
+        except OSError as e:
+            logger.error(f"Could not save slow request profile: {e}")
+        self.captured += 1
+        self.recent.append({"route": route, "elapsed_ms": round(elapsed * 1000, 1), "file": profile.file})
+        return profile
+
+    def _watch(self):
+        own = {threading.get_ident()}
+        while True:
+            with self._wake:
+                while not self._active:
+                    self._wake.wait()
+                now = time.perf_counter()
+                due = [r for r in self._active.values() if now - r.started >= self.threshold]
+                if not due:
+                    oldest = min(r.started for r in self._active.values())
+                    self._wake.wait(oldest + self.threshold - now)
+                    continue
+            stacks = sample_stacks(own)
+            for request in due:
+                request.stacks.update(stacks)
+                request.samples += 1
+            time.sleep(self.interval)
+
+    def status(self) -> Dict:
+        return {
+            "enabled": self.enabled,
+            "threshold_ms": self.threshold * 1000,
+            "routes": sorted(self.routes) if self.routes else None,
+            "in_flight": len(self._active),
+            "captured": self.captured,
+            "recent": list(self.recent),
+        }
+
+class SlowRequestMiddleware:
+    """ASGI middleware feeding HTTP requests to a SlowRequestProfiler"""
+
+    def __init__(self, app, profiler: SlowRequestProfiler):
+        self.app = app
+        self.profiler = profiler
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.profiler.enabled:
+            await self.app(scope, receive, send)
+            return
+
+        token = self.profiler.begin()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            route = scope.get("route")
+            profile = self.profiler.end(token, route.path if route else scope["path"])
+            if profile is not None:
+                logger.warning(
+                    f"Slow request {scope['method']} {scope['path']}: {profile.duration * 1000:.0f} ms, "
+                    f"profile {profile.file}"
+                )
+
+# ============================================================================
+# ALLOCATIONS
+# ============================================================================
+
+class AllocationTracer:
+    """
+    tracemalloc snapshots taken on demand and diffed between any two
+
+    Tracing slows allocation-heavy code noticeably, so it only runs
+    between start() and stop(); snapshots survive stop() until the next
+    start(). Frames of tracemalloc itself and the import system are
+    filtered out.
+    """
+
+    def __init__(self, max_snapshots: int = MAX_SNAPSHOTS):
+        self.max_snapshots = max_snapshots
+        self.snapshots: "OrderedDict[int, Tuple[str, float, tracemalloc.Snapshot]]" = OrderedDict()
+        self._ids = itertools.count(1)
+
+    @property
+    def tracing(self) -> bool:
+        return tracemalloc.is_tracing()
+
+    def start(self, frames: int = TRACEMALLOC_FRAMES):
+        if not tracemalloc.is_tracing():
+            self.snapshots.clear()
+            tracemalloc.start(frames)
+            logger.info(f"tracemalloc started ({frames} frames)")
+
+    def stop(self):
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+            logger.info("tracemalloc stopped")
+
+    def snapshot(self, label: Optional[str] = None) -> Dict:
+        """
+        Raises:
+            RuntimeError: tracing is not running
+        """
+        if not tracemalloc.is_tracing():
+            raise RuntimeError("tracemalloc is not running")
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+            tracemalloc.Filter(False, "<unknown>"),
+        ))
+        snapshot_id = next(self._ids)
+        self.snapshots[snapshot_id] = (label or f"snapshot {snapshot_id}", time.time(), snapshot)
+        while len(self.snapshots) > self.max_snapshots:
+            self.snapshots.popitem(last=False)
+        return self.describe(snapshot_id)
+
+    def _get(self, snapshot_id: int) -> Tuple[str, float, tracemalloc.Snapshot]:
+        """
+        Raises:
+            KeyError: unknown or evicted snapshot
+        """
+        if snapshot_id not in self.snapshots:
+            raise KeyError(f"No snapshot {snapshot_id}")
+        return self.snapshots[snapshot_id]
+
+    def describe(self, snapshot_id: int, limit: int = 10) -> Dict:
+        label, taken, snapshot = self._get(snapshot_id)
+        stats = snapshot.statistics("lineno")
+        return {
+            "id": snapshot_id,
+            "label": label,
+            "taken": datetime.utcfromtimestamp(taken).isoformat() + "Z",
+            "size_kb": round(sum(s.size for s in stats) / 1024, 1),
+            "blocks": sum(s.count for s in stats),
+            "top": [
+                {"location": str(s.traceback), "size_kb": round(s.size / 1024, 1), "count": s.count}
+                for s in stats[:limit]
+            ],
+        }
+
+    def diff(self, base_id: int, target_id: Optional[int] = None,
+             group_by: str = "lineno", limit: int = 25) -> Dict:
+        """
+        Growth between two snapshots; target None takes a new one
+
+        Args:
+            group_by: "lineno", "filename" or "traceback" (full allocation stacks)
+        """
+        if group_by not in ("lineno", "filename", "traceback"):
+            raise ValueError(f"Unknown grouping: {group_by}")
+        base = self._get(base_id)
+        if target_id is None:
+            target_id = self.snapshot()["id"]
+        target = self._get(target_id)
+
+        stats = target[2].compare_to(base[2], group_by)
+        return {
+            "base": {"id": base_id, "label": base[0]},
+            "target": {"id": target_id, "label": target[0]},
+            "size_diff_kb": round(sum(s.size_diff for s in stats) / 1024, 1),
+            "count_diff": sum(s.count_diff for s in stats),
+            "top": [
+                {
+                    "location": s.traceback.format() if group_by == "traceback" else str(s.traceback),
+                    "size_diff_kb": round(s.size_diff / 1024, 1),
+                    "count_diff": s.count_diff,
+                    "size_kb": round(s.size / 1024, 1),
+                    "count": s.count,
+                }
+                for s in stats[:limit]
+            ],
+        }
+
+    def status(self) -> Dict:
+        current, peak = tracemalloc.get_traced_memory() if tracemalloc.is_tracing() else (0, 0)
+        return {
+            "tracing": tracemalloc.is_tracing(),
+            "frames": tracemalloc.get_traceback_limit() if tracemalloc.is_tracing() else None,
+            "traced_kb": round(current / 1024, 1),
+            "peak_kb": round(peak / 1024, 1),
+            "snapshots": [
+                {"id": snapshot_id, "label": label, "taken": datetime.utcfromtimestamp(taken).isoformat() + "Z"}
+                for snapshot_id, (label, taken, _) in self.snapshots.items()
+            ],
+        }
+
+# ============================================================================
+# EXPORT
+# ============================================================================
+
+__all__ = [
+    'PROFILE_SUFFIX',
+    'Profile',
+    'SamplingProfiler',
+    'SlowRequestProfiler',
+    'SlowRequestMiddleware',
+    'AllocationTracer',
+    'list_profiles',
+    'sample_stacks',
+]
@@ -0,0 +1,650 @@
+"""
+PSdZ SWE Catalog
+Versioned, persisted index of CAFD and FAFP files with streamed header attributes and content hashes
+"""
+
+import hashlib
+import json
+import mmap
+import os
+import re
+import struct
+import time
+from dataclasses import dataclass, asdict
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# SWE kinds: directory under swe/ and file name pattern <kind>_<id>.<ext>.<main>_<sub>_<patch>
+SWE_KINDS = {"cafd": "caf", "fafp": "fap"}
+SWE_FILE = re.compile(r'^(cafd|fafp)_([0-9a-fA-F]{8})\.(caf|fap)\.(\d{3})_(\d{3})_(\d{3})$')
+
+INDEX_FILE = ".catalog.json"
+INDEX_VERSION = 1
+
+READ_SIZE = 64 * 1024
+
+# Read-only binary index shared by API worker processes (see SharedCatalog)
+SHARED_INDEX_FILE = ".catalog.idx"
+SHARED_MAGIC = b"PSDZIDX1"
+SHARED_HEADER = struct.Struct('>8sQII')   # magic, generation, record count, string table offset
+
+# Fixed-size big-endian records sorted by (kind, id, version): the leading
+# kind + id bytes compare like the tuple they encode
+SHARED_RECORD = np.dtype([
+    ("key", "S9"),              # b"c" / b"f" + 8 hex digit ID
+    ("version", ">u2", (3,)),
+    ("size", ">u8"),
+    ("mtime_ns", ">i8"),
+    ("payload_size", ">i8"),    # -1: no payload
+    ("sha256", "u1", (32,)),
+    ("flags", "u1"),
+    ("format_version", ">u4"),  # Offset into the string table, NO_STRING if absent
+])
+NO_STRING = 0xFFFFFFFF
+FLAG_NAMES = ("is_compressed", "is_encrypted", "is_obfuscated", "is_normalized")
+KIND_CODES = {"cafd": b"c", "fafp": b"f"}
+
+# The shared index file is re-stat'ed at most this often (seconds)
+MAP_CHECK_INTERVAL = 1.0
+
+# Directory mtimes are re-checked at most this often (seconds)
+STAT_INTERVAL = 5.0
+
+PAYLOAD_OPEN = b"<encryptedData>"
+ROOT_ELEMENT = re.compile(rb'<([A-Za-z][\w:.-]*)((?:\s+[\w:.-]+="[^"]*")*)\s*/?>')
+ATTRIBUTE = re.compile(rb'([\w:.-]+)="([^"]*)"')
+WHITESPACE = b" \t\r\n"
+
+# ============================================================================
+# STREAMING READER
+# ============================================================================
+
+def _flag(attributes: Dict[str, str], name: str) -> bool:
+    return attributes.get(name, "").lower() == "true"
+
+def read_swe_file(path: Union[str, Path]) -> dict:
+    """
+    Hash an SWE file and extract its header attributes in one streaming pass
+
+    Only READ_SIZE bytes are held at a time. The base64 payload inside
+    <encryptedData> is measured, not decoded.
+
+    Returns:
+        {"sha256", "size", "payload_size", "attributes"}
+    """
+    digest = hashlib.sha256()
+    size = 0
+    attributes: Optional[Dict[str, str]] = None
+    in_payload = done = False
+    carry = b""
+    b64_chars = 0
+    tail = b""
+
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(READ_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+            size += len(chunk)
+            if done:
+                continue
+
+            buffer = carry + chunk
+            carry = b""
+
+            if attributes is None:
+                match = ROOT_ELEMENT.search(buffer)
+                if match:
+                    attributes = {k.decode(): v.decode() for k, v in ATTRIBUTE.findall(match.group(2))}
+
+            if not in_payload:
+                start = buffer.find(PAYLOAD_OPEN)
+                if start < 0:
+                    # Keep enough bytes to match a tag split across reads
+                    carry = buffer[-(len(PAYLOAD_OPEN) - 1):]
+                    continue
+                buffer = buffer[start + len(PAYLOAD_OPEN):]
+                in_payload = True
+
+            end = buffer.find(b"<")
+            if end >= 0:
+                buffer = buffer[:end]
+                done = True
+            stripped = buffer.translate(None, WHITESPACE)
+            b64_chars += len(stripped)
+            tail = (tail + stripped[-2:])[-2:]
+
+    payload_size = None
+    if in_payload:
+        payload_size = b64_chars // 4 * 3 - tail.count(b"=")
+
+    return {
+        "sha256": digest.hexdigest(),
+        "size": size,
+        "payload_size": payload_size,
+        "attributes": attributes or {},
+    }
+
+# ============================================================================
+# CATALOG ENTRIES
+# ============================================================================
+
+@dataclass
+class CatalogEntry:
+    """One versioned SWE file"""
+    kind: str
+    id: str
+    version: str          # "005_002_009" as in the file name
+    file: str
+    size: int
+    mtime_ns: int
+    sha256: str
+    payload_size: Optional[int]
+    is_compressed: bool
+    is_encrypted: bool
+    is_obfuscated: bool
+    is_normalized: bool
+    format_version: Optional[str]   # Root element version attribute
+
+    @property
+    def version_tuple(self) -> Tuple[int, int, int]:
+        return tuple(int(part) for part in self.version.split("_"))
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+def parse_swe_name(name: str) -> Optional[Tuple[str, str, str]]:
+    """(kind, id, version) from an SWE file name, None for anything else"""
+    match = SWE_FILE.match(name)
+    if not match:
+        return None
+    kind, file_id, _, main, sub, patch = match.groups()
+    return kind, file_id.lower(), f"{main}_{sub}_{patch}"
+
+def build_entry(path: Path, kind: str, file_id: str, version: str, st: os.stat_result) -> CatalogEntry:
+    info = read_swe_file(path)
+    attributes = info["attributes"]
+    return CatalogEntry(
+        kind=kind,
+        id=file_id,
+        version=version,
+        file=path.name,
+        size=info["size"],
+        mtime_ns=st.st_mtime_ns,
+        sha256=info["sha256"],
+        payload_size=info["payload_size"],
+        is_compressed=_flag(attributes, "isCompressed"),
+        is_encrypted=_flag(attributes, "isEncrypted"),
+        is_obfuscated=_flag(attributes, "isObfuscated"),
+        is_normalized=_flag(attributes, "isNormalized"),
+        format_version=attributes.get("version"),
+    )
+
+# ============================================================================
+# CATALOG
+# ============================================================================
+
+class PSdZCatalog:
+    """
+    Index of every CAFD and FAFP version under psdz_data/cafd/swe
+
+    Entries are persisted to a JSON index next to the files. A refresh only
+    re-reads files whose size or mtime changed, and is skipped entirely
+    while the kind directories' mtimes are unchanged (files added or
+    removed); `refresh(force=True)` re-stats every file. `generation` is
+    bumped on every change so consumers can key caches on it.
+
+    Args:
+        swe_path: Directory holding the cafd/ and fafp/ subdirectories
+        index_path: Persisted index (default: .catalog.json in swe_path)
+    """
+
+    def __init__(self, swe_path: Union[str, Path], index_path: Optional[Union[str, Path]] = None):
+        self.swe_path = Path(swe_path)
+        self.index_path = Path(index_path) if index_path else self.swe_path / INDEX_FILE
+        self.generation = 0
+        self.entries: Dict[Tuple[str, str], List[CatalogEntry]] = {}
+        self.by_file: Dict[str, CatalogEntry] = {}
+        self._dir_mtimes: Dict[str, Optional[int]] = {}
+        self._loaded = False
+        self._checked_at = 0.0
+
+    # ------------------------------------------------------------------
+    # Persistence
+    # ------------------------------------------------------------------
+
+    def _load_index(self):
+        try:
+            with open(self.index_path) as f:
+                stored = json.load(f)
+        except (OSError, ValueError):
+            return
+        if stored.get("version") != INDEX_VERSION:
+            return
+
+        self.generation = stored.get("generation", 0)
+        self._dir_mtimes = stored.get("dirs", {})
+        self._set_entries([CatalogEntry(**e) for e in stored.get("entries", [])])
+
+    def _save_index(self):
+        stored = {
+            "version": INDEX_VERSION,
+            "generation": self.generation,
+            "dirs": self._dir_mtimes,
+            "entries": [e.to_dict() for e in self.by_file.values()],
+        }
+        temp = self.index_path.with_suffix(".tmp")
+        try:
+            with open(temp, 'w') as f:
+                json.dump(stored, f, separators=(",", ":"))
+            os.replace(temp, self.index_path)
+        except OSError as e:
+            logger.warning(f"PSdZ catalog index not written ({self.index_path}): {e}")
+
+    def _set_entries(self, entries: List[CatalogEntry]):
+        self.by_file = {e.file: e for e in entries}
+        self.entries = {}
+        for entry in entries:
+            self.entries.setdefault((entry.kind, entry.id), []).append(entry)
+        for versions in self.entries.values():
+            versions.sort(key=lambda e: e.version_tuple)
+
+    # ------------------------------------------------------------------
+    # Refresh
+    # ------------------------------------------------------------------
+
+    def _current_dir_mtimes(self) -> Dict[str, Optional[int]]:
+        mtimes = {}
+        for kind in SWE_KINDS:
+            try:
+                mtimes[kind] = os.stat(self.swe_path / kind).st_mtime_ns
+            except OSError:
+                mtimes[kind] = None
+        return mtimes
+
+    def refresh(self, force: bool = False) -> bool:
+        """
+        Bring the index up to date with the files on disk
+
+        Returns:
+            True if anything changed (generation was bumped)
+        """
+        if not self._loaded:
+            self._load_index()
+            self._loaded = True
+
+        dir_mtimes = self._current_dir_mtimes()
+        if not force and self.by_file and dir_mtimes == self._dir_mtimes:
+            return False
+
+        start = time.perf_counter()
+        entries: List[CatalogEntry] = []
+        read = 0
+
+        for kind in SWE_KINDS:
+            directory = self.swe_path / kind
+            if dir_mtimes[kind] is None:
+                continue
+            with os.scandir(directory) as it:
+                for item in it:
+                    parsed = parse_swe_name(item.name)
+                    if parsed is None or parsed[0] != kind:
+                        continue
+                    st = item.stat()
+                    known = self.by_file.get(item.name)
+                    if known and known.size == st.st_size and known.mtime_ns == st.st_mtime_ns:
+                        entries.append(known)
+                        continue
+                    entries.append(build_entry(Path(item.path), *parsed, st))
+                    read += 1
+
+        changed = read > 0 or len(entries) != len(self.by_file)
+        self._dir_mtimes = dir_mtimes
+        if changed:
+            self._set_entries(entries)
+            self.generation += 1
+            logger.info(
+                f"PSdZ catalog generation {self.generation}: {len(entries)} files, "
+                f"{read} read in {(time.perf_counter() - start) * 1000:.0f} ms"
+            )
+        self._save_index()
+        return changed
+
+    def _ensure_current(self):
+        now = time.monotonic()
+        if self._loaded and now - self._checked_at < STAT_INTERVAL:
+            return
+        self._checked_at = now
+        self.refresh()
+
+    def current_generation(self) -> int:
+        """Generation after the (rate-limited) freshness check"""
+        self._ensure_current()
+        return self.generation
+
+    # ------------------------------------------------------------------
+    # Queries
+    # ------------------------------------------------------------------
+
+    def ids(self, kind: Optional[str] = None) -> List[str]:
+        self._ensure_current()
+        return sorted({file_id for k, file_id in self.entries if kind is None or k == kind})
+
+    def versions(self, file_id: str, kind: str = "cafd") -> List[CatalogEntry]:
+        """All versions of an ID, oldest first"""
+        self._ensure_current()
+        return list(self.entries.get((kind, file_id.lower()), []))
+
+    def latest(self, file_id: str, kind: str = "cafd") -> Optional[CatalogEntry]:
+        versions = self.versions(file_id, kind)
+        return versions[-1] if versions else None
+
+    def entry(self, file_id: str, version: Optional[str] = None, kind: str = "cafd") -> Optional[CatalogEntry]:
+        """A specific version ("005_002_009" or "5.2.9"), or the latest"""
+        if version is None:
+            return self.latest(file_id, kind)
+        wanted = tuple(int(part) for part in re.split(r'[._]', version))
+        for candidate in self.versions(file_id, kind):
+            if candidate.version_tuple == wanted:
+                return candidate
+        return None
+
+    def path(self, entry: CatalogEntry) -> Path:
+        return self.swe_path / entry.kind / entry.file
+
+    def search(self, kind: Optional[str] = None, prefix: str = "") -> List[dict]:
+        """One row per ID: version count and latest version"""
+        self._ensure_current()
+        prefix = prefix.lower()
+        rows = []
+        for (k, file_id), versions in sorted(self.entries.items()):
+            if (kind is None or k == kind) and file_id.startswith(prefix):
+                latest = versions[-1]
+                rows.append({
+                    "kind": k,
+                    "id": file_id,
+                    "versions": len(versions),
+                    "latest": latest.version,
+                    "size": latest.size,
+                })
+        return rows
+
+    def summary(self) -> dict:
+        self._ensure_current()
+        kinds = {}
+        for (kind, _), versions in self.entries.items():
+            stats = kinds.setdefault(kind, {"ids": 0, "files": 0, "bytes": 0})
+            stats["ids"] += 1
+            stats["files"] += len(versions)
+            stats["bytes"] += sum(e.size for e in versions)
+        return {"path": str(self.swe_path), "generation": self.generation, "kinds": kinds}
+
+# ============================================================================
+# SHARED INDEX
+# ============================================================================
+
+def write_shared_index(catalog: PSdZCatalog, path: Optional[Union[str, Path]] = None) -> Path:
+    """
+    Write the catalog as a flat binary index for SharedCatalog readers
+
+    The file is replaced atomically, so readers that still map the old one
+    keep a consistent view until they re-map.
+    """
+    path = Path(path) if path else catalog.swe_path / SHARED_INDEX_FILE
+    entries = sorted(catalog.by_file.values(), key=lambda e: (KIND_CODES[e.kind], e.id, e.version_tuple))
+
+    strings = bytearray()
+    offsets: Dict[str, int] = {}
+    records = np.zeros(len(entries), dtype=SHARED_RECORD)
+    for i, entry in enumerate(entries):
+        if entry.format_version is not None and entry.format_version not in offsets:
+            offsets[entry.format_version] = len(strings)
+            strings += entry.format_version.encode() + b"\0"
+        records[i] = (
+            KIND_CODES[entry.kind] + entry.id.encode(),
+            entry.version_tuple,
+            entry.size,
+            entry.mtime_ns,
+            -1 if entry.payload_size is None else entry.payload_size,
+            np.frombuffer(bytes.fromhex(entry.sha256), dtype=np.uint8),
+            sum(1 << bit for bit, name in enumerate(FLAG_NAMES) if getattr(entry, name)),
+            offsets.get(entry.format_version, NO_STRING),
+        )
+
+    header = SHARED_HEADER.pack(SHARED_MAGIC, catalog.generation, len(entries),
+                                SHARED_HEADER.size + records.nbytes)
+    temp = path.with_suffix(".tmp")
+    with open(temp, 'wb') as f:
+        f.write(header)
+        f.write(records.tobytes())
+        f.write(strings)
+    os.replace(temp, path)
+    return path
+
+class SharedCatalog:
+    """
+    Read-only PSdZCatalog view over a memory-mapped shared index
+
+    Every API worker maps the same file, so the pages are shared between
+    processes and nothing is parsed at startup. Lookups are binary searches
+    over the sorted records. The index is written by the process that owns
+    the PSdZCatalog (see connection_owner.py); readers pick up a new
+    generation by re-mapping when the file is replaced.
+
+    Args:
+        swe_path: Directory holding the cafd/ and fafp/ subdirectories
+        index_path: Shared index (default: .catalog.idx in swe_path)
+    """
+
+    def __init__(self, swe_path: Union[str, Path], index_path: Optional[Union[str, Path]] = None):
+        self.swe_path = Path(swe_path)
+        self.index_path = Path(index_path) if index_path else self.swe_path / SHARED_INDEX_FILE
+        self.generation = 0
+        self._map: Optional[mmap.mmap] = None
+        self._records = np.zeros(0, dtype=SHARED_RECORD)
+        self._strings = b""
+        self._identity: Optional[Tuple[int, int]] = None
+        self._checked_at = 0.0
+
+    def refresh(self, force: bool = False) -> bool:
+        """
+        Re-map the index if it was replaced
+
+        Returns:
+            True if the generation changed
+        """
+        try:
+            st = os.stat(self.index_path)
+        except OSError:
+            if self._identity is not None or force:
+                logger.warning(f"Shared PSdZ catalog index missing: {self.index_path}")
+            return False
+
+        identity = (st.st_ino, st.st_mtime_ns)
+        if identity == self._identity and not force:
+            return False
+
+        with open(self.index_path, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, generation, count, strings_at = SHARED_HEADER.unpack_from(mapped)
+        if magic != SHARED_MAGIC:
+            mapped.close()
+            raise ValueError(f"Not a shared PSdZ catalog index: {self.index_path}")
+
+        # The previous map stays alive as long as arrays created from it do
+        self._records = np.frombuffer(mapped, dtype=SHARED_RECORD, count=count, offset=SHARED_HEADER.size)
+        self._strings = mapped[strings_at:]
+        self._map = mapped
+        self._identity = identity
+
+        changed = generation != self.generation
+        self.generation = generation
+        return changed
+
+    def _ensure_current(self):
+        now = time.monotonic()
+        if now - self._checked_at < MAP_CHECK_INTERVAL:
+            return
+        self._checked_at = now
+        self.refresh()
+
+    def current_generation(self) -> int:
+        """Generation after the (rate-limited) re-map check"""
+        self._ensure_current()
+        return self.generation
+
+    def _entry(self, record) -> CatalogEntry:
+        key = bytes(record["key"])
+        kind = "cafd" if key[:1] == b"c" else "fafp"
+        version = "_".join(f"{part:03d}" for part in record["version"])
+        offset = int(record["format_version"])
+        format_version = None
+        if offset != NO_STRING:
+            format_version = self._strings[offset:self._strings.index(b"\0", offset)].decode()
+        flags = int(record["flags"])
+        payload_size = int(record["payload_size"])
+        return CatalogEntry(
+            kind=kind,
+            id=key[1:].decode(),
+            version=version,
+            file=f"{kind}_{key[1:].decode()}.{SWE_KINDS[kind]}.{version}",
+            size=int(record["size"]),
+            mtime_ns=int(record["mtime_ns"]),
+            sha256=bytes(record["sha256"]).hex(),
+            payload_size=None if payload_size < 0 else payload_size,
+            format_version=format_version,
+            **{name: bool(flags >> bit & 1) for bit, name in enumerate(FLAG_NAMES)},
+        )
+
+    def _span(self, key: bytes) -> Tuple[int, int]:
+        keys = self._records["key"]
+        return int(np.searchsorted(keys, key, "left")), int(np.searchsorted(keys, key, "right"))
+
+    def _kind_mask(self, kind: Optional[str]):
+        if kind is None:
+            return slice(None)
+        return np.char.startswith(self._records["key"], KIND_CODES[kind])
+
+    def ids(self, kind: Optional[str] = None) -> List[str]:
+        self._ensure_current()
+        keys = np.unique(self._records["key"][self._kind_mask(kind)])
+        return sorted({bytes(key[1:]).decode() for key in keys})
+
+    def versions(self, file_id: str, kind: str = "cafd") -> List[CatalogEntry]:
+        """All versions of an ID, oldest first"""
+        self._ensure_current()
+        start, end = self._span(KIND_CODES[kind] + file_id.lower().encode())
+        return [self._entry(record) for record in self._records[start:end]]
+
+    def latest(self, file_id: str, kind: str = "cafd") -> Optional[CatalogEntry]:
+        self._ensure_current()
+        start, end = self._span(KIND_CODES[kind] + file_id.lower().encode())
+        return self._entry(self._records[end - 1]) if end > start else None
+
+    def entry(self, file_id: str, version: Optional[str] = None, kind: str = "cafd") -> Optional[CatalogEntry]:
+        """A specific version ("005_002_009" or "5.2.9"), or the latest"""
+        if version is None:
+            return self.latest(file_id, kind)
+        wanted = tuple(int(part) for part in re.split(r'[._]', version))
+        for candidate in self.versions(file_id, kind):
+            if candidate.version_tuple == wanted:
+                return candidate
+        return None
+
+    def path(self, entry: CatalogEntry) -> Path:
+        return self.swe_path / entry.kind / entry.file
+
+    def _groups(self, kind: Optional[str], prefix: str = ""):
+        """(first, last) record index of every (kind, ID) group that matches"""
+        keys = self._records["key"]
+        if not len(keys):
+            return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+        starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+        ends = np.append(starts[1:], len(keys)) - 1
+        group_keys = keys[starts]
+        mask = np.ones(len(starts), dtype=bool)
+        if kind is not None:
+            mask &= np.char.startswith(group_keys, KIND_CODES[kind])
+        if prefix:
+            ids = group_keys.view(np.uint8).reshape(-1, SHARED_RECORD["key"].itemsize)[:, 1:].copy().view("S8").ravel()
+            mask &= np.char.startswith(ids, prefix.lower().encode())
+        return starts[mask], ends[mask]
+
+    def search(self, kind: Optional[str] = None, prefix: str = "") -> List[dict]:
+        """One row per ID: version count and latest version"""
+        self._ensure_current()
+        starts, ends = self._groups(kind, prefix)
+        latest = self._records[ends]
+        return [
+            {
+                "kind": "cafd" if key[:1] == b"c" else "fafp",
+                "id": key[1:].decode(),
+                "versions": count,
+                "latest": "%03d_%03d_%03d" % tuple(version),
+                "size": size,
+            }
+            for key, version, size, count in zip(
+                latest["key"].tolist(), latest["version"].tolist(),
+                latest["size"].tolist(), (ends - starts + 1).tolist()
+            )
+        ]
+
+    def summary(self) -> dict:
+        self._ensure_current()
+        kinds = {}
+        for kind in SWE_KINDS:
+            starts, _ = self._groups(kind)
+            if not len(starts):
+                continue
+            mask = self._kind_mask(kind)
+            kinds[kind] = {
+                "ids": len(starts),
+                "files": int(np.count_nonzero(mask)),
+                "bytes": int(self._records["size"][mask].sum()),
+            }
+        return {"path": str(self.swe_path), "generation": self.generation, "kinds": kinds}
+
+_CATALOGS: Dict[Path, PSdZCatalog] = {}
+
+def get_catalog(swe_path: Union[str, Path]) -> PSdZCatalog:
+    """Process-wide catalog for an SWE directory"""
+    path = Path(swe_path)
+    catalog = _CATALOGS.get(path)
+    if catalog is None:
+        catalog = _CATALOGS[path] = PSdZCatalog(path)
+    return catalog
+
+# ============================================================================
+# EXPORT
+# ============================================================================
+
+__all__ = [
+    'SWE_KINDS',
+    'CatalogEntry',
+    'PSdZCatalog',
+    'SharedCatalog',
+    'get_catalog',
+    'parse_swe_name',
+    'read_swe_file',
+    'write_shared_index',
+]
+
+if __name__ == "__main__":
+    # python psdz_catalog.py [swe dir] [--force]
+    import sys
+
+    logging.basicConfig(level=logging.INFO)
+
+    args = [a for a in sys.argv[1:] if not a.startswith("--")]
+    catalog = PSdZCatalog(args[0] if args else Path(__file__).parent / "psdz_data" / "cafd" / "swe")
+
+    start = time.perf_counter()
+    changed = catalog.refresh(force="--force" in sys.argv)
+    print(f"refresh: {(time.perf_counter() - start) * 1000:.1f} ms (changed: {changed})")
+    print(json.dumps(catalog.summary(), indent=2))
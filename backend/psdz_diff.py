@@ -0,0 +1,347 @@
+"""
+PSdZ Data Diff
+Compare CAFD versions or whole psdz_data snapshots using cached per-file and per-chunk hashes
+"""
+
+import difflib
+import hashlib
+import json
+import os
+import time
+import zlib
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
+import logging
+
+import numpy as np
+
+from psdz_catalog import parse_swe_name
+from psdz_pack import chunk_boundaries, chunk_digest
+
+logger = logging.getLogger(__name__)
+
+# Per-snapshot hash cache, stored in the snapshot root
+CACHE_FILE = ".psdz_hashes"
+CACHE_VERSION = 1
+
+# Changed files listed with byte ranges in a tree diff; the rest only counted
+MAX_RANGES_PER_FILE = 64
+
+# ============================================================================
+# HASH CACHE
+# ============================================================================
+
+class HashCache:
+    """
+    File and chunk hashes for one snapshot, keyed by relative path
+
+    An entry is reused while the file's size and mtime are unchanged, so a
+    file that has not been touched costs one stat() and no reads. Chunks use
+    the same content-defined boundaries as the pack store, which keeps a
+    local edit from shifting every later chunk hash.
+    """
+
+    def __init__(self, root: Union[str, Path]):
+        self.root = Path(root)
+        self.path = self.root / CACHE_FILE
+        self.entries: Dict[str, dict] = {}
+        self.hashed = 0
+        self._dirty = False
+        self._load()
+
+    def _load(self):
+        try:
+            cached = json.loads(zlib.decompress(self.path.read_bytes()))
+        except (OSError, ValueError, zlib.error):
+            return
+        if cached.get("version") == CACHE_VERSION:
+            self.entries = cached["files"]
+
+    def save(self):
+        if not self._dirty:
+            return
+        data = zlib.compress(json.dumps({"version": CACHE_VERSION, "files": self.entries},
+                                        separators=(",", ":")).encode())
+        temp = self.path.with_suffix(".tmp")
+        try:
+            temp.write_bytes(data)
+            os.replace(temp, self.path)
+            self._dirty = False
+        except OSError as e:
+            logger.warning(f"Hash cache not written ({self.path}): {e}")
+
+    def files(self) -> Dict[str, os.stat_result]:
+        """Relative path -> stat for every (non-hidden) file in the snapshot"""
+        found = {}
+        for directory, dirs, names in os.walk(self.root):
+            dirs[:] = [d for d in dirs if not d.startswith(".")]
+            for name in names:
+                if not name.startswith("."):
+                    path = os.path.join(directory, name)
+                    found[os.path.relpath(path, self.root).replace(os.sep, "/")] = os.stat(path)
+        return found
+
+    def signature(self, rel: str, st: Optional[os.stat_result] = None) -> dict:
+        """
+        {"size", "mtime_ns", "sha256", "chunks": [[length, digest], ...]}
+        """
+        st = st or os.stat(self.root / rel)
+        entry = self.entries.get(rel)
+        if entry and entry["size"] == st.st_size and entry["mtime_ns"] == st.st_mtime_ns:
+            return entry
+
+        data = (self.root / rel).read_bytes()
+        chunks = []
+        begin = 0
+        for end in chunk_boundaries(data):
+            chunks.append([end - begin, chunk_digest(data[begin:end])])
+            begin = end
+
+        entry = self.entries[rel] = {
+            "size": st.st_size,
+            "mtime_ns": st.st_mtime_ns,
+            "sha256": hashlib.sha256(data).hexdigest(),
+            "chunks": chunks,
+        }
+        self.hashed += 1
+        self._dirty = True
+        return entry
+
+    def prune(self, present):
+        for rel in set(self.entries) - set(present):
+            del self.entries[rel]
+            self._dirty = True
+
+# ============================================================================
+# FILE DIFF
+# ============================================================================
+
+def _offsets(chunks: List[list]) -> List[int]:
+    offsets = [0]
+    for length, _ in chunks:
+        offsets.append(offsets[-1] + length)
+    return offsets
+
+def _trim(base: bytes, target: bytes) -> Tuple[int, int]:
+    """Lengths of the common prefix and (non-overlapping) common suffix"""
+    a = np.frombuffer(base, dtype=np.uint8)
+    b = np.frombuffer(target, dtype=np.uint8)
+    n = min(len(a), len(b))
+
+    mismatch = np.flatnonzero(a[:n] != b[:n])
+    prefix = int(mismatch[0]) if len(mismatch) else n
+
+    m = n - prefix
+    mismatch = np.flatnonzero(a[len(a) - m:][::-1] != b[len(b) - m:][::-1]) if m else []
+    suffix = int(mismatch[0]) if len(mismatch) else m
+    return prefix, suffix
+
+def change_ranges(base_sig: dict, target_sig: dict, base_path: Optional[Path] = None,
+                  target_path: Optional[Path] = None) -> List[dict]:
+    """
+    Changed byte ranges between two file signatures
+
+    Chunk digest sequences are aligned first (no file I/O). When paths are
+    given, each changed region is read and trimmed to the exact differing
+    bytes; otherwise ranges are chunk-granular.
+    """
+    base_chunks, target_chunks = base_sig["chunks"], target_sig["chunks"]
+    base_at, target_at = _offsets(base_chunks), _offsets(target_chunks)
+    matcher = difflib.SequenceMatcher(
+        None, [d for _, d in base_chunks], [d for _, d in target_chunks], autojunk=False
+    )
+
+    base_file = open(base_path, 'rb') if base_path else None
+    target_file = open(target_path, 'rb') if target_path else None
+    ranges = []
+    try:
+        for op, i1, i2, j1, j2 in matcher.get_opcodes():
+            if op == "equal":
+                continue
+            a0, a1 = base_at[i1], base_at[i2]
+            b0, b1 = target_at[j1], target_at[j2]
+
+            if op == "replace" and base_file and target_file:
+                base_file.seek(a0)
+                target_file.seek(b0)
+                prefix, suffix = _trim(base_file.read(a1 - a0), target_file.read(b1 - b0))
+                if prefix == a1 - a0 == b1 - b0:
+                    continue  # Same bytes, only the chunk boundaries moved
+                a0, b0 = a0 + prefix, b0 + prefix
+                a1, b1 = a1 - suffix, b1 - suffix
+
+            ranges.append({"op": op, "base": [a0, a1], "target": [b0, b1]})
+    finally:
+        for f in (base_file, target_file):
+            if f:
+                f.close()
+    return ranges
+
+def summarize_ranges(ranges: List[dict]) -> int:
+    """Bytes touched by a set of change ranges"""
+    return sum(max(r["base"][1] - r["base"][0], r["target"][1] - r["target"][0]) for r in ranges)
+
+def diff_files(base_path: Union[str, Path], target_path: Union[str, Path],
+               base_cache: Optional[HashCache] = None, target_cache: Optional[HashCache] = None) -> dict:
+    """Exact byte-level diff of two files"""
+    base_path, target_path = Path(base_path), Path(target_path)
+    base_cache = base_cache or HashCache(base_path.parent)
+    target_cache = target_cache or HashCache(target_path.parent)
+
+    base_sig = base_cache.signature(base_path.name)
+    target_sig = target_cache.signature(target_path.name)
+    identical = base_sig["sha256"] == target_sig["sha256"]
+    ranges = [] if identical else change_ranges(base_sig, target_sig, base_path, target_path)
+
+    base_cache.save()
+    target_cache.save()
+    return {
+        "base": {"file": base_path.name, "size": base_sig["size"], "sha256": base_sig["sha256"]},
+        "target": {"file": target_path.name, "size": target_sig["size"], "sha256": target_sig["sha256"]},
+        "identical": identical,
+        "changed_bytes": summarize_ranges(ranges),
+        "ranges": ranges,
+    }
+
+def diff_versions(cafd_dir: Union[str, Path], cafd_id: str, base_version: str, target_version: str,
+                  kind: str = "cafd") -> dict:
+    """Diff two versions ("005_002_009" or "5.2.9") of one CAFD/FAFP ID"""
+    cafd_dir = Path(cafd_dir)
+    extension = {"cafd": "caf", "fafp": "fap"}[kind]
+
+    def path_for(version: str) -> Path:
+        parts = version.replace("_", ".").split(".")
+        path = cafd_dir / f"{kind}_{cafd_id.lower()}.{extension}.{'_'.join(f'{int(p):03d}' for p in parts)}"
+        if not path.exists():
+            raise FileNotFoundError(f"{kind.upper()} {cafd_id} version {version} not found")
+        return path
+
+    cache = HashCache(cafd_dir)
+    return {"id": cafd_id.lower(), "kind": kind,
+            **diff_files(path_for(base_version), path_for(target_version), cache, cache)}
+
+# ============================================================================
+# TREE DIFF
+# ============================================================================
+
+def _versions_by_id(files) -> Dict[Tuple[str, str], List[str]]:
+    versions: Dict[Tuple[str, str], List[str]] = {}
+    for rel in files:
+        parsed = parse_swe_name(rel.rsplit("/", 1)[-1])
+        if parsed:
+            kind, file_id, version = parsed
+            versions.setdefault((kind, file_id), []).append(version)
+    for listed in versions.values():
+        listed.sort()
+    return versions
+
+def diff_trees(base_root: Union[str, Path], target_root: Union[str, Path], exact: bool = False) -> dict:
+    """
+    Diff two psdz_data snapshots
+
+    Files are matched by relative path and compared by cached SHA-256;
+    only new or modified files are read. Changed files get chunk-granular
+    ranges (exact byte ranges with exact=True, which reads those files).
+
+    Returns:
+        changed/added/removed files, changed/added/removed SWE IDs and
+        version bumps (latest version per ID moved)
+    """
+    start = time.perf_counter()
+    base, target = HashCache(base_root), HashCache(target_root)
+    base_files, target_files = base.files(), target.files()
+
+    added = sorted(set(target_files) - set(base_files))
+    removed = sorted(set(base_files) - set(target_files))
+    changed = []
+    unchanged = 0
+
+    for rel in sorted(set(base_files) & set(target_files)):
+        base_sig = base.signature(rel, base_files[rel])
+        target_sig = target.signature(rel, target_files[rel])
+        if base_sig["sha256"] == target_sig["sha256"]:
+            unchanged += 1
+            continue
+
+        ranges = change_ranges(
+            base_sig, target_sig,
+            base.root / rel if exact else None,
+            target.root / rel if exact else None,
+        )
+        changed.append({
+            "file": rel,
+            "size": [base_sig["size"], target_sig["size"]],
+            "changed_bytes": summarize_ranges(ranges),
+            "ranges": ranges[:MAX_RANGES_PER_FILE],
+            "ranges_total": len(ranges),
+        })
+
+    # Hash new files too so the target cache is complete for the next diff
+    for rel in added:
+        target.signature(rel, target_files[rel])
+
+    base.prune(base_files)
+    target.prune(target_files)
+    base.save()
+    target.save()
+
+    base_ids, target_ids = _versions_by_id(base_files), _versions_by_id(target_files)
+    touched = {parse_swe_name(rel.rsplit("/", 1)[-1]) for rel in added + removed + [c["file"] for c in changed]}
+    changed_ids = sorted({(p[0], p[1]) for p in touched if p} & set(base_ids) & set(target_ids))
+
+    bumps = [
+        {"kind": kind, "id": file_id, "from": base_ids[(kind, file_id)][-1], "to": target_ids[(kind, file_id)][-1]}
+        for kind, file_id in sorted(set(base_ids) & set(target_ids))
+        if base_ids[(kind, file_id)][-1] != target_ids[(kind, file_id)][-1]
+    ]
+
+    def id_rows(keys):
+        return [{"kind": kind, "id": file_id} for kind, file_id in sorted(keys)]
+
+    return {
+        "base": str(base.root),
+        "target": str(target.root),
+        "files": {
+            "unchanged": unchanged,
+            "changed": changed,
+            "added": added,
+            "removed": removed,
+        },
+        "ids": {
+            "changed": id_rows(changed_ids),
+            "added": id_rows(set(target_ids) - set(base_ids)),
+            "removed": id_rows(set(base_ids) - set(target_ids)),
+        },
+        "version_bumps": bumps,
+        "files_hashed": base.hashed + target.hashed,
+        "elapsed_ms": round((time.perf_counter() - start) * 1000, 1),
+    }
+
+# ============================================================================
+# EXPORT
+# ============================================================================
+
+__all__ = [
+    'HashCache',
+    'diff_files',
+    'diff_versions',
+    'diff_trees',
+]
+
+if __name__ == "__main__":
+    # python psdz_diff.py tree <base psdz_data> <target psdz_data> [--exact]
+    # python psdz_diff.py versions <cafd dir> <id> <base version> <target version>
+    import sys
+
+    logging.basicConfig(level=logging.INFO)
+    command = sys.argv[1] if len(sys.argv) > 1 else ""
+
+    if command == "tree":
+        result = diff_trees(sys.argv[2], sys.argv[3], exact="--exact" in sys.argv)
+    elif command == "versions":
+        result = diff_versions(sys.argv[2], sys.argv[3], sys.argv[4], sys.argv[5])
+    else:
+        print(__doc__)
+        sys.exit(1)
+
+    print(json.dumps(result, indent=2))
@@ -0,0 +1,368 @@
+"""
+PSdZ Data Pack Store
+Content-defined chunking with chunk-level dedup and zlib-compressed chunks in a single pack file
+"""
+
+import hashlib
+import io
+import json
+import os
+import time
+import zlib
+from bisect import bisect_right
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Union
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+PACK_MAGIC = b"PSDZPK01"
+PACK_SUFFIX = ".pack"
+INDEX_SUFFIX = ".idx"
+INDEX_VERSION = 1
+
+# Chunking: rolling gear sum over a 48-byte window, cut where the low 13 bits
+# are zero (~8 KB average), bounded to 2 KB .. 64 KB
+WINDOW = 48
+CUT_MASK = (1 << 13) - 1
+MIN_CHUNK = 2 * 1024
+MAX_CHUNK = 64 * 1024
+
+COMPRESS_LEVEL = 6
+
+# Fixed gear table: chunk boundaries (and therefore dedup) must be stable across builds
+GEAR = np.random.default_rng(0x5053445A).integers(0, 2 ** 32, 256, dtype=np.uint64).astype(np.uint32)
+
+# ============================================================================
+# CHUNKING
+# ============================================================================
+
+def chunk_boundaries(data: bytes) -> List[int]:
+    """
+    Content-defined chunk end offsets for `data`
+
+    The rolling hash is the sum of GEAR values over the last WINDOW bytes,
+    computed for every position at once as a difference of uint32 prefix
+    sums (wrap-around is harmless: the sum is only used modulo 2^32).
+    Only the sparse candidate positions are walked in Python to apply the
+    min/max chunk sizes.
+    """
+    size = len(data)
+    if size <= MIN_CHUNK:
+        return [size] if size else []
+
+    sums = np.cumsum(GEAR[np.frombuffer(data, dtype=np.uint8)], dtype=np.uint32)
+    rolling = sums.copy()
+    rolling[WINDOW:] -= sums[:-WINDOW]
+    candidates = np.flatnonzero((rolling & CUT_MASK) == 0) + 1
+
+    cuts = []
+    last = 0
+    for position in candidates.tolist():
+        while position - last > MAX_CHUNK:
+            last += MAX_CHUNK
+            cuts.append(last)
+        if position - last >= MIN_CHUNK:
+            cuts.append(position)
+            last = position
+    while size - last > MAX_CHUNK:
+        last += MAX_CHUNK
+        cuts.append(last)
+    if last < size:
+        cuts.append(size)
+    return cuts
+
+def chunk_digest(chunk: bytes) -> str:
+    return hashlib.blake2b(chunk, digest_size=16).hexdigest()
+
+# ============================================================================
+# BUILDER
+# ============================================================================
+
+def _walk(root: Path) -> Iterator[Path]:
+    for directory, dirs, files in os.walk(root):
+        dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+        for name in sorted(files):
+            if not name.startswith("."):
+                yield Path(directory) / name
+
+def build_pack(root: Union[str, Path], pack_path: Union[str, Path]) -> dict:
+    """
+    Pack every file under `root` into `pack_path` (+ `.idx`)
+
+    Files are chunked independently; identical chunks anywhere in the tree
+    are stored once. Both files are written to temporaries and swapped in,
+    so readers never see a half-written pack.
+
+    Returns:
+        Pack statistics (see PackStore.stats)
+    """
+    root = Path(root)
+    pack_path = Path(pack_path)
+    index_path = pack_path.with_suffix(pack_path.suffix + INDEX_SUFFIX)
+    start = time.perf_counter()
+
+    chunks: List[list] = []              # [offset, compressed length, length, digest]
+    chunk_ids: Dict[str, int] = {}
+    files: Dict[str, dict] = {}
+
+    temp_pack = pack_path.with_suffix(pack_path.suffix + ".tmp")
+    with open(temp_pack, 'wb') as out:
+        out.write(PACK_MAGIC)
+        for path in _walk(root):
+            st = path.stat()
+            data = path.read_bytes()
+            refs = []
+            begin = 0
+            for end in chunk_boundaries(data):
+                chunk = data[begin:end]
+                digest = chunk_digest(chunk)
+                chunk_id = chunk_ids.get(digest)
+                if chunk_id is None:
+                    compressed = zlib.compress(chunk, COMPRESS_LEVEL)
+                    chunk_id = chunk_ids[digest] = len(chunks)
+                    chunks.append([out.tell(), len(compressed), len(chunk), digest])
+                    out.write(compressed)
+                refs.append(chunk_id)
+                begin = end
+
+            files[path.relative_to(root).as_posix()] = {
+                "size": len(data),
+                "mtime_ns": st.st_mtime_ns,
+                "sha256": hashlib.sha256(data).hexdigest(),
+                "chunks": refs,
+            }
+
+    index = {
+        "version": INDEX_VERSION,
+        "created": time.time(),
+        "root": str(root),
+        "chunking": {"window": WINDOW, "mask_bits": CUT_MASK.bit_length(), "min": MIN_CHUNK, "max": MAX_CHUNK},
+        "chunks": chunks,
+        "files": files,
+    }
+    temp_index = index_path.with_suffix(index_path.suffix + ".tmp")
+    temp_index.write_bytes(zlib.compress(json.dumps(index, separators=(",", ":")).encode(), COMPRESS_LEVEL))
+
+    os.replace(temp_pack, pack_path)
+    os.replace(temp_index, index_path)
+
+    stats = PackStore(pack_path).stats()
+    logger.info(
+        f"Packed {stats['files']} files ({stats['logical_bytes'] / 1e6:.1f} MB) into "
+        f"{stats['pack_bytes'] / 1e6:.1f} MB in {time.perf_counter() - start:.1f} s"
+    )
+    return stats
+
+# ============================================================================
+# READER
+# ============================================================================
+
+class PackFile(io.RawIOBase):
+    """Streaming read-only view of one packed file; one chunk decompressed at a time"""
+
+    def __init__(self, store: "PackStore", name: str):
+        self._chunks = store.iter_chunks(name)
+        self._buffer = b""
+        self._offset = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, target) -> int:
+        while self._offset >= len(self._buffer):
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                return 0
+            self._buffer, self._offset = chunk, 0
+
+        count = min(len(target), len(self._buffer) - self._offset)
+        target[:count] = self._buffer[self._offset:self._offset + count]
+        self._offset += count
+        return count
+
+class PackStore:
+    """
+    Read-through access to a pack built by build_pack()
+
+    Files are addressed by their path relative to the packed root
+    ("cafd/swe/cafd/cafd_0000000f.caf.005_002_009") or, when unique, by
+    bare file name. Reads use os.pread, so one store can serve concurrent
+    readers.
+    """
+
+    def __init__(self, pack_path: Union[str, Path]):
+        self.pack_path = Path(pack_path)
+        index_path = self.pack_path.with_suffix(self.pack_path.suffix + INDEX_SUFFIX)
+        index = json.loads(zlib.decompress(index_path.read_bytes()))
+        if index.get("version") != INDEX_VERSION:
+            raise ValueError(f"Unsupported pack index version: {index.get('version')}")
+
+        self.chunks = index["chunks"]
+        self.files: Dict[str, dict] = index["files"]
+        self.created = index.get("created")
+        self.by_basename: Dict[str, Optional[str]] = {}
+        for name in self.files:
+            base = name.rsplit("/", 1)[-1]
+            # Ambiguous basenames must be addressed by full path
+            self.by_basename[base] = None if base in self.by_basename else name
+        self._starts: Dict[str, List[int]] = {}
+
+        self._fd = os.open(self.pack_path, os.O_RDONLY)
+        if os.pread(self._fd, len(PACK_MAGIC), 0) != PACK_MAGIC:
+            os.close(self._fd)
+            raise ValueError(f"Not a PSdZ pack: {pack_path}")
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def resolve(self, name: str) -> Optional[str]:
+        if name in self.files:
+            return name
+        return self.by_basename.get(name)
+
+    def has(self, name: str) -> bool:
+        return self.resolve(name) is not None
+
+    def names(self, prefix: str = "") -> List[str]:
+        """Packed file names (relative paths) whose basename starts with `prefix`"""
+        return sorted(n for n in self.files if n.rsplit("/", 1)[-1].startswith(prefix))
+
+    def _entry(self, name: str) -> dict:
+        resolved = self.resolve(name)
+        if resolved is None:
+            raise FileNotFoundError(f"Not in pack: {name}")
+        return self.files[resolved]
+
+    def _chunk(self, chunk_id: int) -> bytes:
+        offset, compressed, _, _ = self.chunks[chunk_id]
+        return zlib.decompress(os.pread(self._fd, compressed, offset))
+
+    def iter_chunks(self, name: str) -> Iterator[bytes]:
+        for chunk_id in self._entry(name)["chunks"]:
+            yield self._chunk(chunk_id)
+
+    def open(self, name: str) -> io.BufferedReader:
+        """Streaming file object for a packed file"""
+        self._entry(name)
+        return io.BufferedReader(PackFile(self, name))
+
+    def read(self, name: str) -> bytes:
+        return b"".join(self.iter_chunks(name))
+
+    def read_range(self, name: str, start: int, length: int) -> bytes:
+        """Random access: decompresses only the chunks overlapping the range"""
+        resolved = self.resolve(name)
+        entry = self._entry(name)
+        starts = self._starts.get(resolved)
+        if starts is None:
+            starts, position = [], 0
+            for chunk_id in entry["chunks"]:
+                starts.append(position)
+                position += self.chunks[chunk_id][2]
+            self._starts[resolved] = starts
+
+        end = min(start + length, entry["size"])
+        parts = []
+        index = max(0, bisect_right(starts, start) - 1)
+        while index < len(starts) and starts[index] < end:
+            data = self._chunk(entry["chunks"][index])
+            parts.append(data[max(0, start - starts[index]):end - starts[index]])
+            index += 1
+        return b"".join(parts)
+
+    def verify(self, name: str) -> bool:
+        digest = hashlib.sha256()
+        for chunk in self.iter_chunks(name):
+            digest.update(chunk)
+        return digest.hexdigest() == self._entry(name)["sha256"]
+
+    def stats(self) -> dict:
+        logical = sum(f["size"] for f in self.files.values())
+        unique = sum(c[2] for c in self.chunks)
+        stored = sum(c[1] for c in self.chunks)
+        pack_bytes = os.path.getsize(self.pack_path)
+        index_bytes = os.path.getsize(self.pack_path.with_suffix(self.pack_path.suffix + INDEX_SUFFIX))
+        references = sum(len(f["chunks"]) for f in self.files.values())
+        return {
+            "files": len(self.files),
+            "logical_bytes": logical,
+            "chunks": references,
+            "unique_chunks": len(self.chunks),
+            "unique_bytes": unique,
+            "stored_bytes": stored,
+            "pack_bytes": pack_bytes,
+            "index_bytes": index_bytes,
+            "dedup_ratio": round(logical / unique, 3) if unique else None,
+            "compression_ratio": round(unique / stored, 3) if stored else None,
+            "savings_bytes": logical - pack_bytes - index_bytes,
+            "savings_percent": round(100 * (1 - (pack_bytes + index_bytes) / logical), 1) if logical else None,
+        }
+
+_PACKS: Dict[Path, PackStore] = {}
+
+def get_pack(pack_path: Union[str, Path]) -> Optional[PackStore]:
+    """Process-wide store for a pack file, None if it has not been built"""
+    path = Path(pack_path)
+    store = _PACKS.get(path)
+    if store is None:
+        if not path.exists():
+            return None
+        store = _PACKS[path] = PackStore(path)
+    return store
+
+# ============================================================================
+# EXPORT
+# ============================================================================
+
+__all__ = [
+    'PACK_SUFFIX',
+    'PackStore',
+    'build_pack',
+    'chunk_boundaries',
+    'get_pack',
+]
+
+if __name__ == "__main__":
+    # python psdz_pack.py build <psdz_data dir> <pack file>
+    # python psdz_pack.py stats <pack file>
+    # python psdz_pack.py bench <pack file> <psdz_data dir> [samples]
+    import random
+    import sys
+
+    logging.basicConfig(level=logging.INFO)
+    command = sys.argv[1] if len(sys.argv) > 1 else "stats"
+
+    if command == "build":
+        print(json.dumps(build_pack(sys.argv[2], sys.argv[3]), indent=2))
+
+    elif command == "stats":
+        print(json.dumps(PackStore(sys.argv[2]).stats(), indent=2))
+
+    elif command == "bench":
+        store = PackStore(sys.argv[2])
+        root = Path(sys.argv[3])
+        samples = int(sys.argv[4]) if len(sys.argv) > 4 else 500
+        names = random.Random(1).sample(sorted(store.files), min(samples, len(store.files)))
+
+        def measure(label, read):
+            start = time.perf_counter()
+            for name in names:
+                read(name)
+            elapsed = (time.perf_counter() - start) / len(names)
+            print(f"{label:<28} {elapsed * 1e6:9.1f} us/file")
+
+        measure("plain file, whole", lambda n: (root / n).read_bytes())
+        measure("pack, whole", store.read)
+
+        def plain_range(name):
+            with open(root / name, 'rb') as f:
+                f.seek(store.files[name]["size"] // 2)
+                return f.read(4096)
+
+        measure("plain file, 4 KB range", plain_range)
+        measure("pack, 4 KB range", lambda n: store.read_range(n, store.files[n]["size"] // 2, 4096))
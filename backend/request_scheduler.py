@@ -0,0 +1,291 @@
+"""
+Request Scheduler
+Per-connection priority classes for UDS traffic: weighted fair queuing with deadline drops
+"""
+
+import asyncio
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional, Tuple
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Priority classes
+INTERACTIVE = "interactive"   # A user waiting on the screen (default)
+LIVE = "live"                 # Live-data polls; worthless once the next tick is due
+BULK = "bulk"                 # Scans, snapshots, campaigns: throughput, not latency
+
+# Share of the link each class gets while all of them are backlogged
+CLASS_WEIGHTS = {INTERACTIVE: 16.0, LIVE: 4.0, BULK: 1.0}
+
+# Longest run of pipelined requests one scheduling unit may hold the link
+# for; a batch is split into units of this size, so an interactive request
+# waits for at most one of them
+MAX_BATCH = 8
+
+# Recent queue waits kept per class for percentiles
+WAIT_SAMPLES = 512
+
+# (class, absolute deadline on the event loop clock) for requests made here
+_PRIORITY: ContextVar[Tuple[str, Optional[float]]] = ContextVar("uds_priority", default=(INTERACTIVE, None))
+
+class RequestExpired(Exception):
+    """A request's deadline passed while it was still queued; it was never sent"""
+
+@contextmanager
+def request_priority(klass: str, deadline: Optional[float] = None):
+    """
+    Run the UDS requests made inside the block (and tasks started from it)
+    in `klass`; with a deadline, requests still queued at that loop time
+    raise RequestExpired instead of being sent
+    """
+    if klass not in CLASS_WEIGHTS:
+        raise ValueError(f"Unknown priority class: {klass}")
+    token = _PRIORITY.set((klass, deadline))
+    try:
+        yield
+    finally:
+        _PRIORITY.reset(token)
+
+def current_priority() -> Tuple[str, Optional[float]]:
+    return _PRIORITY.get()
+
+# ============================================================================
+# SCHEDULER
+# ============================================================================
+
+@dataclass
+class _Ticket:
+    future: asyncio.Future
+    klass: str
+    cost: float
+    enqueued: float
+    timer: Optional[asyncio.TimerHandle] = None
+    start: Optional[float] = None     # WFQ tags, set once the ticket heads its class queue
+    finish: float = 0.0
+
+@dataclass
+class _ClassStats:
+    submitted: int = 0
+    served: int = 0
+    expired: int = 0
+    waits: Deque[float] = field(default_factory=lambda: deque(maxlen=WAIT_SAMPLES))
+
+    def percentile(self, q: float) -> Optional[float]:
+        if not self.waits:
+            return None
+        ordered = sorted(self.waits)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def to_dict(self) -> Dict:
+        p50, p99 = self.percentile(0.5), self.percentile(0.99)
+        return {
+            "submitted": self.submitted,
+            "served": self.served,
+            "expired": self.expired,
+            "wait_p50_ms": round(p50 * 1000, 2) if p50 is not None else None,
+            "wait_p99_ms": round(p99 * 1000, 2) if p99 is not None else None,
+        }
+
+class RequestScheduler:
+    """
+    Grants one connection's link to one request (or batch unit) at a time
+
+    Waiting units are queued per class and granted in order of their WFQ
+    finish tag (start + cost / weight, start never before the current
+    virtual time), so a class that was idle gets no credit for it and an
+    interactive request overtakes every queued bulk unit. Units whose
+    deadline passes while queued fail with RequestExpired without ever
+    reaching the wire.
+
+    A unit is tagged when it reaches the head of its class queue, so one
+    that expires or is cancelled while queued costs its class nothing.
+    """
+
+    def __init__(self, weights: Optional[Dict[str, float]] = None):
+        self.weights = dict(weights or CLASS_WEIGHTS)
+        self.queues: Dict[str, Deque[_Ticket]] = {klass: deque() for klass in self.weights}
+        self.stats: Dict[str, _ClassStats] = {klass: _ClassStats() for klass in self.weights}
+        self._finish: Dict[str, float] = {klass: 0.0 for klass in self.weights}
+        self._virtual_time = 0.0
+        self._busy = False
+
+    async def run(self, call: Callable[..., Awaitable[Any]], *args, cost: float = 1.0) -> Any:
+        """await call(*args) once the link is granted to the caller's priority class"""
+        await self._acquire(cost)
+        try:
+            return await call(*args)
+        finally:
+            self._release()
+
+    async def _acquire(self, cost: float):
+        klass, deadline = current_priority()
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        stats = self.stats[klass]
+        stats.submitted += 1
+        if deadline is not None and now >= deadline:
+            stats.expired += 1
+            raise RequestExpired(f"{klass} request past its deadline")
+
+        if not self._busy:
+            self._busy = True
+            start, self._finish[klass] = self._tags(klass, cost)
+            self._virtual_time = start
+            stats.served += 1
+            stats.waits.append(0.0)
+            return
+
+        ticket = _Ticket(loop.create_future(), klass, cost, now)
+        if deadline is not None:
+            ticket.timer = loop.call_at(deadline, self._expire, ticket)
+        self.queues[klass].append(ticket)
+        try:
+            await ticket.future
+        except asyncio.CancelledError:
+            if ticket.future.done() and not ticket.future.cancelled() and ticket.future.exception() is None:
+                self._release()  # Granted, but the caller went away before using it
+            raise
+
+    def _tags(self, klass: str, cost: float) -> Tuple[float, float]:
+        start = max(self._virtual_time, self._finish[klass])
+        return start, start + cost / self.weights[klass]
+
+    def _expire(self, ticket: _Ticket):
+        if not ticket.future.done():
+            self.stats[ticket.klass].expired += 1
+            ticket.future.set_exception(RequestExpired(f"{ticket.klass} request expired in queue"))
+
+    def _release(self):
+        self._busy = False
+        loop = asyncio.get_running_loop()
+        heads = []
+        for klass, queue in self.queues.items():
+            while queue and queue[0].future.done():
+                queue.popleft()  # Expired or cancelled while queued
+            if queue:
+                head = queue[0]
+                if head.start is None:
+                    head.start, head.finish = self._tags(klass, head.cost)
+                heads.append(head)
+        if not heads:
+            return
+
+        ticket = min(heads, key=lambda t: t.finish)
+        self.queues[ticket.klass].popleft()
+        if ticket.timer:
+            ticket.timer.cancel()
+        self._busy = True
+        self._finish[ticket.klass] = ticket.finish
+        self._virtual_time = ticket.start
+        stats = self.stats[ticket.klass]
+        stats.served += 1
+        stats.waits.append(loop.time() - ticket.enqueued)
+        ticket.future.set_result(None)
+
+    def status(self) -> Dict:
+        return {
+            klass: {**stats.to_dict(), "queued": len(self.queues[klass])}
+            for klass, stats in self.stats.items()
+        }
+
+def scheduler_status(connection) -> Optional[Dict]:
+    """Scheduler statistics of a connection, if it has a scheduler"""
+    scheduler = getattr(connection, "scheduler", None)
+    return scheduler.status() if scheduler is not None else None
+
+# ============================================================================
+# EXPORT
+# ============================================================================
+
+__all__ = [
+    'INTERACTIVE',
+    'LIVE',
+    'BULK',
+    'CLASS_WEIGHTS',
+    'MAX_BATCH',
+    'RequestExpired',
+    'RequestScheduler',
+    'request_priority',
+    'current_priority',
+    'scheduler_status',
+]
+
+if __name__ == "__main__":
+    import random
+    import time
+
+    SERVICE = 0.004       # One UDS round trip on the link
+    DURATION = 4.0
+    LIVE_HZ = 20
+    LIVE_READS = 3        # Multi-DID reads per live tick
+    BULK_WORKERS = 6      # Concurrent bulk readers (e.g. snapshots of several ECUs)
+
+    class FIFO:
+        """Call order, as without a scheduler"""
+        def __init__(self):
+            self.lock = asyncio.Lock()
+
+        async def run(self, call, *args, cost: float = 1.0):
+            async with self.lock:
+                return await call(*args)
+
+    async def exchange(requests: int):
+        await asyncio.sleep(SERVICE * requests)
+
+    async def scenario(link) -> Dict:
+        loop = asyncio.get_running_loop()
+        stop = loop.time() + DURATION
+        counts = {"bulk": 0, "live_on_time": 0, "live_late": 0, "live_dropped": 0}
+        interactive = []
+
+        async def bulk():
+            with request_priority(BULK):
+                while loop.time() < stop:
+                    await link.run(exchange, 1)
+                    counts["bulk"] += 1
+
+        async def live():
+            period = 1 / LIVE_HZ
+            tick = loop.time()
+            while tick < stop:
+                try:
+                    with request_priority(LIVE, deadline=tick + period):
+                        for _ in range(LIVE_READS):
+                            await link.run(exchange, 1)
+                    counts["live_on_time" if loop.time() <= tick + period else "live_late"] += 1
+                except RequestExpired:
+                    counts["live_dropped"] += 1
+                tick += period
+                await asyncio.sleep(max(0.0, tick - loop.time()))
+
+        async def user():
+            while loop.time() < stop:
+                await asyncio.sleep(random.uniform(0.02, 0.08))
+                started = time.perf_counter()
+                await link.run(exchange, 1)
+                interactive.append(time.perf_counter() - started)
+
+        await asyncio.gather(*(bulk() for _ in range(BULK_WORKERS)), live(), user())
+        interactive.sort()
+        return {
+            "p50": interactive[len(interactive) // 2] * 1000,
+            "p99": interactive[int(len(interactive) * 0.99)] * 1000,
+            "bulk_rate": counts["bulk"] / DURATION,
+            **counts,
+        }
+
+    async def main():
+        print(f"{SERVICE * 1000:.0f} ms per request; {BULK_WORKERS} bulk readers back to back, "
+              f"{LIVE_HZ} Hz live ticks of {LIVE_READS} reads, a user read every 20-80 ms\n")
+        print(f"{'policy':<8}{'user p50 ms':>12}{'user p99 ms':>12}{'bulk req/s':>12}"
+              f"{'live on time':>14}{'late':>6}{'dropped':>9}")
+        for name, link in (("fifo", FIFO()), ("wfq", RequestScheduler())):
+            r = await scenario(link)
+            print(f"{name:<8}{r['p50']:>12.1f}{r['p99']:>12.1f}{r['bulk_rate']:>12.0f}"
+                  f"{r['live_on_time']:>14}{r['live_late']:>6}{r['live_dropped']:>9}")
+
+    asyncio.run(main())
@@ -0,0 +1,284 @@
+"""
+Response Cache
+Precompressed, ETag-versioned bodies for catalog endpoints, keyed by PSdZ catalog generation
+"""
+
+import asyncio
+import gzip
+import hashlib
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from dataclasses import dataclass
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+import logging
+
+import brotli
+
+from serialization import MSGPACK_TYPES
+
+logger = logging.getLogger(__name__)
+
+MAX_ENTRIES = 1024
+
+GZIP_LEVEL = 9
+BROTLI_QUALITY = 9    # Runs once per body and generation, off the event loop; 11 is ~8x slower for ~15% less
+
+# Bodies smaller than this are stored uncompressed only
+MIN_COMPRESS_SIZE = 512
+
+# Preferred first when a client rates codings equally
+CODINGS = ("br", "gzip")
+
+@lru_cache(maxsize=256)
+def accepted_codings(accept_encoding: str) -> Tuple[str, ...]:
+    """
+    CODINGS the client accepts (RFC 9110 Accept-Encoding), best first
+
+    A coding with q=0, directly or through "*;q=0", is never chosen;
+    unlisted codings are accepted only through "*".
+    """
+    weights: Dict[str, float] = {}
+    for item in accept_encoding.split(","):
+        coding, *params = [part.strip() for part in item.split(";")]
+        if not coding:
+            continue
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        weights[coding.lower()] = q
+
+    default = weights.get("*", 0.0)
+    rated = [(weights.get(coding, default), -rank, coding) for rank, coding in enumerate(CODINGS)]
+    return tuple(coding for q, _, coding in sorted(rated, reverse=True) if q > 0)
+
+# ============================================================================
+# ENTRIES
+# ============================================================================
+
+@dataclass(frozen=True)
+class CachedBody:
+    """One response, pre-encoded in every content coding"""
+    identity: bytes
+    gzip: Optional[bytes]
+    br: Optional[bytes]
+    media_type: bytes
+    etag: bytes
+    last_modified: bytes
+    modified_at: float
+
+    @classmethod
+    def build(cls, body: bytes, media_type: bytes, generation: int, modified_at: float) -> "CachedBody":
+        compress = len(body) >= MIN_COMPRESS_SIZE
+        digest = hashlib.blake2b(body, digest_size=12).hexdigest()
+        return cls(
+            identity=body,
+            gzip=gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0) if compress else None,
+            br=brotli.compress(body, quality=BROTLI_QUALITY) if compress else None,
+            media_type=media_type,
+            etag=f'"g{generation}-{digest}"'.encode(),
+            last_modified=formatdate(modified_at, usegmt=True).encode(),
+            modified_at=modified_at,
+        )
+
+    def encoded(self, accept_encoding: str) -> Tuple[bytes, Optional[bytes]]:
+        """(body, Content-Encoding) for a client's Accept-Encoding"""
+        for coding in accepted_codings(accept_encoding):
+            body = self.br if coding == "br" else self.gzip
+            if body is not None:
+                return body, coding.encode()
+        return self.identity, None
+
+    def not_modified(self, if_none_match: Optional[str], if_modified_since: Optional[str]) -> bool:
+        if if_none_match is not None:
+            tags = [tag.strip() for tag in if_none_match.split(",")]
+            return "*" in tags or self.etag.decode() in tags or f"W/{self.etag.decode()}" in tags
+        if if_modified_since is not None:
+            try:
+                return parsedate_to_datetime(if_modified_since).timestamp() >= int(self.modified_at)
+            except (TypeError, ValueError):
+                return False
+        return False
+
+# ============================================================================
+# CACHE
+# ============================================================================
+
+class ResponseCache:
+    """
+    Bounded map of (path, query, format) -> CachedBody for one generation
+
+    The whole map is replaced when the generation changes, so entries of an
+    older catalog can never be served; Last-Modified is the time this
+    process first saw the generation.
+    """
+
+    def __init__(self, max_entries: int = MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.generation: Optional[int] = None
+        self.generation_seen = time.time()
+        self.entries: "OrderedDict[tuple, CachedBody]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+
+    def entries_for(self, generation: int) -> "OrderedDict[tuple, CachedBody]":
+        if generation != self.generation:
+            if self.generation is not None:
+                logger.info(f"Response cache: generation {self.generation} -> {generation}, "
+                            f"dropping {len(self.entries)} entries")
+            self.entries = OrderedDict()
+            self.generation = generation
+            self.generation_seen = time.time()
+        return self.entries
+
+    def get(self, key: tuple, generation: int) -> Optional[CachedBody]:
+        entries = self.entries_for(generation)
+        entry = entries.get(key)
+        if entry is not None:
+            entries.move_to_end(key)
+        return entry
+
+    def put(self, key: tuple, generation: int, entry: CachedBody):
+        if generation != self.generation:
+            return  # Built while the catalog moved on
+        entries = self.entries
+        entries[key] = entry
+        while len(entries) > self.max_entries:
+            entries.popitem(last=False)
+
+    def stats(self) -> Dict:
+        return {
+            "generation": self.generation,
+            "entries": len(self.entries),
+            "bytes": sum(len(e.identity) + len(e.gzip or b"") + len(e.br or b"") for e in self.entries.values()),
+            "hits": self.hits,
+            "misses": self.misses,
+            "not_modified": self.not_modified,
+        }
+
+# ============================================================================
+# ASGI MIDDLEWARE
+# ============================================================================
+
+def _header(headers: List[Tuple[bytes, bytes]], name: bytes) -> Optional[str]:
+    for key, value in headers:
+        if key == name:
+            return value.decode("latin-1")
+    return None
+
+class CachedResponseMiddleware:
+    """
+    Serve GET requests under the given paths from a ResponseCache
+
+    A hit is a dict lookup and one send: the stored body in the client's
+    best content coding, or 304 when its ETag / Last-Modified validators
+    match. A miss runs the endpoint; a 200 response is compressed once
+    (in a worker thread) and stored. Error responses are never cached.
+
+    Args:
+        prefixes: Path prefixes to cache (a trailing "$" makes a path exact)
+        generation: Current catalog generation, called on every request; it
+                    must not block (read the attribute, refresh elsewhere)
+    """
+
+    def __init__(self, app, prefixes: Sequence[str], generation: Callable[[], int],
+                 cache: Optional[ResponseCache] = None):
+        self.app = app
+        self.exact = tuple(p[:-1] for p in prefixes if p.endswith("$"))
+        self.prefixes = tuple(p for p in prefixes if not p.endswith("$"))
+        self.generation = generation
+        self.cache = cache or ResponseCache()
+
+    def _cacheable(self, scope) -> bool:
+        if scope["type"] != "http" or scope["method"] != "GET":
+            return False
+        path = scope["path"]
+        return path in self.exact or path.startswith(self.prefixes)
+
+    async def __call__(self, scope, receive, send):
+        if not self._cacheable(scope):
+            await self.app(scope, receive, send)
+            return
+
+        headers = scope["headers"]
+        accept = _header(headers, b"accept") or ""
+        key = (scope["path"], scope["query_string"], any(t in accept for t in MSGPACK_TYPES))
+        generation = self.generation()
+
+        entry = self.cache.get(key, generation)
+        if entry is None:
+            self.cache.misses += 1
+            entry = await self._fill(scope, receive, send, key, generation)
+            if entry is None:
+                return  # Uncacheable response, already sent
+        else:
+            self.cache.hits += 1
+
+        await self._send(entry, headers, send)
+
+    async def _fill(self, scope, receive, send, key, generation) -> Optional[CachedBody]:
+        start_message = None
+        chunks = []
+
+        async def capture(message):
+            nonlocal start_message
+            if message["type"] == "http.response.start":
+                start_message = message
+            elif message["type"] == "http.response.body":
+                chunks.append(message.get("body", b""))
+
+        await self.app(scope, receive, capture)
+
+        body = b"".join(chunks)
+        if start_message is None or start_message["status"] != 200:
+            if start_message is not None:
+                await send(start_message)
+                await send({"type": "http.response.body", "body": body})
+            return None
+
+        media_type = _header(start_message.get("headers", []), b"content-type") or "application/json"
+        entry = await asyncio.get_running_loop().run_in_executor(
+            None, CachedBody.build, body, media_type.encode(), generation, self.cache.generation_seen
+        )
+        self.cache.put(key, generation, entry)
+        return entry
+
+    async def _send(self, entry: CachedBody, headers, send):
+        common = [
+            (b"etag", entry.etag),
+            (b"last-modified", entry.last_modified),
+            (b"cache-control", b"no-cache"),
+            (b"vary", b"Accept, Accept-Encoding"),
+        ]
+        if entry.not_modified(_header(headers, b"if-none-match"), _header(headers, b"if-modified-since")):
+            self.cache.not_modified += 1
+            await send({"type": "http.response.start", "status": 304, "headers": common})
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        body, coding = entry.encoded(_header(headers, b"accept-encoding") or "")
+        response_headers = common + [
+            (b"content-type", entry.media_type),
+            (b"content-length", str(len(body)).encode()),
+        ]
+        if coding:
+            response_headers.append((b"content-encoding", coding))
+        await send({"type": "http.response.start", "status": 200, "headers": response_headers})
+        await send({"type": "http.response.body", "body": body})
+
+# ============================================================================
+# EXPORT
+# ============================================================================
+
+__all__ = [
+    'CachedBody',
+    'ResponseCache',
+    'CachedResponseMiddleware',
+]
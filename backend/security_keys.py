@@ -0,0 +1,398 @@
+"""
+PSdZ Security Key Index
+BL_ID-keyed lookup of authentication, NCD signature and transport keys with a cached compact form
+"""
+
+import json
+import os
+import time
+import xml.etree.ElementTree as ET
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Key files by kind; each entry carries a <BL_ID> and one <keyData>
+KEY_FILES = {
+    "auth_l3": "sec_auth_l3.xml",
+    "auth_l4": "sec_auth_l4.xml",
+    "ncd": "sec_ncdkeys.xml",
+    "trans": "sec_transkeys.xml",
+}
+
+# Session keys that the key files' encKeyRef attributes point to
+REFERENCE_FILE = "sec_keyreference.xml"
+
+# Security access level -> authentication key kind
+LEVEL_KINDS = {3: "auth_l3", 4: "auth_l4"}
+
+# JSON, so reading a cache planted in the key directory can't run code
+CACHE_FILE = ".key_index.json"
+CACHE_VERSION = 2
+
+# Source files are re-stat'ed at most this often (seconds)
+STAT_INTERVAL = 5.0
+
+# ============================================================================
+# BOOTLOADER IDS
+# ============================================================================
+
+def bootloader_number(bl_id: Union[str, int]) -> int:
+    """
+    Numeric bootloader ID from "btld-0000005B-00.00.00", "0000005B" or an int
+
+    Key files list every bootloader at version 00.00.00, so keys are
+    resolved by number and the version part is ignored.
+    """
+    if isinstance(bl_id, int):
+        return bl_id
+    parts = bl_id.strip().split("-")
+    if parts[0].lower() == "btld":
+        parts = parts[1:]
+    if not parts:
+        raise ValueError(f"Invalid bootloader ID: {bl_id}")
+    return int(parts[0], 16)
+
+def format_bl_id(number: int, version: Tuple[int, int, int] = (0, 0, 0)) -> str:
+    return f"btld-{number:08X}-{version[0]:02d}.{version[1]:02d}.{version[2]:02d}"
+
+# ============================================================================
+# KEY RECORDS
+# ============================================================================
+
+@dataclass(frozen=True)
+class KeyRecord:
+    """One key file entry for a bootloader"""
+    kind: str
+    bl_id: str
+    key_type: int
+    digest_alg: Optional[str]
+    signature_scheme: Optional[str]
+    key_data: bytes
+    plain: bool
+    test_key: bool
+    enc_key_ref: Optional[str]   # Session key the key data is encrypted with (unless plain)
+
+    def to_dict(self) -> dict:
+        """Metadata only; key material is never serialised"""
+        return {
+            "kind": self.kind,
+            "bl_id": self.bl_id,
+            "key_type": self.key_type,
+            "digest_alg": self.digest_alg,
+            "signature_scheme": self.signature_scheme,
+            "key_length": len(self.key_data),
+            "plain": self.plain,
+            "test_key": self.test_key,
+            "enc_key_ref": self.enc_key_ref,
+        }
+
+@dataclass(frozen=True)
+class SessionKey:
+    reference: str
+    key_type: int
+    pub_key_ref: Optional[str]
+    key_data: bytes
+
+def _flag(value: Optional[str]) -> bool:
+    return (value or "").lower() == "true"
+
+def _local(tag: str) -> str:
+    return tag.rsplit("}", 1)[-1]
+
+def _parse_key_file(path: Path, kind: str) -> List[KeyRecord]:
+    """Stream one key file, clearing entries as they are consumed"""
+    records = []
+    enc_key_ref = None
+
+    for event, elem in ET.iterparse(path, events=("start", "end")):
+        if event == "start":
+            if enc_key_ref is None and "encKeyRef" in elem.attrib:
+                enc_key_ref = elem.attrib["encKeyRef"]
+            continue
+
+        bl_id = elem.find("BL_ID")
+        key_data = elem.find("keyData")
+        if bl_id is None or key_data is None:
+            continue
+
+        records.append(KeyRecord(
+            kind=kind,
+            bl_id=bl_id.text.strip(),
+            key_type=int(key_data.get("type", 0)),
+            digest_alg=key_data.get("digestAlg"),
+            signature_scheme=key_data.get("signatureScheme"),
+            key_data=bytes.fromhex((key_data.text or "").strip()),
+            plain=_flag(elem.get("plain")),
+            test_key=_flag(elem.get("testKey")),
+            enc_key_ref=enc_key_ref,
+        ))
+        elem.clear()
+
+    return records
+
+def _parse_reference_file(path: Path) -> Dict[str, SessionKey]:
+    session_keys = {}
+    for _, elem in ET.iterparse(path, events=("end",)):
+        if _local(elem.tag) != "SessionKey":
+            continue
+        reference = elem.findtext("Reference", "").strip()
+        key_data = elem.find("keyData")
+        if reference and key_data is not None:
+            session_keys[reference] = SessionKey(
+                reference=reference,
+                key_type=int(key_data.get("type", 0)),
+                pub_key_ref=key_data.get("pubKeyRef"),
+                key_data=bytes.fromhex((key_data.text or "").strip()),
+            )
+        elem.clear()
+    return session_keys
+
+# ============================================================================
+# INDEX
+# ============================================================================
+
+class SecurityKeyIndex:
+    """
+    Hash maps over the PSdZ security key files
+
+    `keys[kind][bootloader number]` and `session_keys[reference]` are built
+    once from the XML and persisted in a compact cache (key blobs are
+    deduplicated; most bootloaders share key data). The cache is keyed by
+    the source files' mtime and size, so edited key files are re-parsed
+    automatically. Loading is lazy: the first lookup pays for it.
+
+    Args:
+        security_path: Directory holding the sec_*.xml files
+        cache_path: Cache file (default: .key_index.json in security_path);
+                    an unwritable location just disables the cache
+    """
+
+    def __init__(self, security_path: Union[str, Path], cache_path: Optional[Union[str, Path]] = None):
+        self.security_path = Path(security_path)
+        self.cache_path = Path(cache_path) if cache_path else self.security_path / CACHE_FILE
+        self.keys: Dict[str, Dict[int, KeyRecord]] = {}
+        self.session_keys: Dict[str, SessionKey] = {}
+        self.loaded_from: Optional[str] = None
+        self.load_ms = 0.0
+        self._signature: Optional[dict] = None
+        self._checked_at = 0.0
+
+    def _source_signature(self) -> dict:
+        signature = {}
+        for name in list(KEY_FILES.values()) + [REFERENCE_FILE]:
+            try:
+                st = os.stat(self.security_path / name)
+                signature[name] = (st.st_mtime_ns, st.st_size)
+            except OSError:
+                signature[name] = None
+        return signature
+
+    def _ensure_loaded(self):
+        now = time.monotonic()
+        if self._signature is not None and now - self._checked_at < STAT_INTERVAL:
+            return
+        self._checked_at = now
+
+        signature = self._source_signature()
+        if signature != self._signature:
+            self.load(signature)
+
+    def load(self, signature: Optional[dict] = None):
+        """(Re)build the maps from the cache if it is current, else from the XML"""
+        start = time.perf_counter()
+        signature = signature or self._source_signature()
+
+        if not self._load_cache(signature):
+            self._parse(signature)
+            self._save_cache(signature)
+            self.loaded_from = "xml"
+        else:
+            self.loaded_from = "cache"
+
+        self._signature = signature
+        self.load_ms = (time.perf_counter() - start) * 1000
+        logger.info(
+            f"Security key index: {self.key_count} keys for {len(self.bootloaders())} bootloaders, "
+            f"{len(self.session_keys)} session keys ({self.loaded_from}, {self.load_ms:.1f} ms)"
+        )
+
+    def _parse(self, signature: dict):
+        self.keys = {}
+        for kind, name in KEY_FILES.items():
+            if signature.get(name) is None:
+                logger.warning(f"Security key file missing: {name}")
+                self.keys[kind] = {}
+                continue
+            self.keys[kind] = {
+                bootloader_number(record.bl_id): record
+                for record in _parse_key_file(self.security_path / name, kind)
+            }
+
+        self.session_keys = {}
+        if signature.get(REFERENCE_FILE) is not None:
+            self.session_keys = _parse_reference_file(self.security_path / REFERENCE_FILE)
+
+    def _load_cache(self, signature: dict) -> bool:
+        try:
+            with open(self.cache_path) as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return False
+
+        # Signature values come back from JSON as lists
+        sources = {name: list(value) if value else None for name, value in signature.items()}
+        if not isinstance(cached, dict) or cached.get("version") != CACHE_VERSION \
+                or cached.get("sources") != sources:
+            return False
+
+        try:
+            blobs = [bytes.fromhex(blob) for blob in cached["blobs"]]
+            keys = {
+                kind: {
+                    int(number): KeyRecord(kind, bl_id, key_type, digest, scheme, blobs[blob], plain, test, ref)
+                    for number, (bl_id, key_type, digest, scheme, blob, plain, test, ref) in entries.items()
+                }
+                for kind, entries in cached["keys"].items()
+            }
+            session_keys = {
+                reference: SessionKey(reference, key_type, pub_key_ref, bytes.fromhex(key_data))
+                for reference, (key_type, pub_key_ref, key_data) in cached["session_keys"].items()
+            }
+        except (KeyError, IndexError, TypeError, ValueError, AttributeError):
+            logger.warning(f"Security key cache malformed, re-parsing: {self.cache_path}")
+            return False
+
+        self.keys = keys
+        self.session_keys = session_keys
+        return True
+
+    def _save_cache(self, signature: dict):
+        blobs: List[bytes] = []
+        blob_index: Dict[bytes, int] = {}
+
+        def intern(data: bytes) -> int:
+            if data not in blob_index:
+                blob_index[data] = len(blobs)
+                blobs.append(data)
+            return blob_index[data]
+
+        cached = {
+            "version": CACHE_VERSION,
+            "sources": signature,
+            "keys": {
+                kind: {
+                    number: (r.bl_id, r.key_type, r.digest_alg, r.signature_scheme,
+                             intern(r.key_data), r.plain, r.test_key, r.enc_key_ref)
+                    for number, r in records.items()
+                }
+                for kind, records in self.keys.items()
+            },
+            "session_keys": {
+                reference: (s.key_type, s.pub_key_ref, s.key_data.hex())
+                for reference, s in self.session_keys.items()
+            },
+            "blobs": [blob.hex() for blob in blobs],
+        }
+
+        temp = self.cache_path.with_suffix(".tmp")
+        try:
+            with open(temp, 'w') as f:
+                json.dump(cached, f, separators=(",", ":"))
+            os.replace(temp, self.cache_path)
+        except OSError as e:
+            logger.warning(f"Security key cache not written ({self.cache_path}): {e}")
+
+    # ------------------------------------------------------------------
+    # Lookups
+    # ------------------------------------------------------------------
+
+    def resolve(self, bl_id: Union[str, int], kind: str) -> Optional[KeyRecord]:
+        """Key record of one kind (auth_l3, auth_l4, ncd, trans) for a bootloader"""
+        self._ensure_loaded()
+        return self.keys.get(kind, {}).get(bootloader_number(bl_id))
+
+    def resolve_level(self, bl_id: Union[str, int], security_level: int) -> Optional[KeyRecord]:
+        """Authentication key for a security access level (3 = coding, 4 = flashing)"""
+        kind = LEVEL_KINDS.get(security_level)
+        if kind is None:
+            raise ValueError(f"Invalid security level: {security_level}")
+        return self.resolve(bl_id, kind)
+
+    def resolve_all(self, bl_id: Union[str, int]) -> Dict[str, KeyRecord]:
+        """Every key record for a bootloader, by kind"""
+        self._ensure_loaded()
+        number = bootloader_number(bl_id)
+        return {kind: records[number] for kind, records in self.keys.items() if number in records}
+
+    def session_key(self, record: KeyRecord) -> Optional[SessionKey]:
+        """Session key a record's key data is encrypted with"""
+        self._ensure_loaded()
+        if record.enc_key_ref is None:
+            return None
+        return self.session_keys.get(record.enc_key_ref)
+
+    def bootloaders(self) -> set:
+        return {number for records in self.keys.values() for number in records}
+
+    @property
+    def key_count(self) -> int:
+        return sum(len(records) for records in self.keys.values())
+
+    def summary(self) -> dict:
+        self._ensure_loaded()
+        return {
+            "path": str(self.security_path),
+            "keys": {kind: len(records) for kind, records in self.keys.items()},
+            "bootloaders": len(self.bootloaders()),
+            "unique_key_blobs": len({r.key_data for records in self.keys.values() for r in records.values()}),
+            "session_keys": sorted(self.session_keys),
+            "loaded_from": self.loaded_from,
+            "load_ms": round(self.load_ms, 2),
+        }
+
+_INDEXES: Dict[Path, SecurityKeyIndex] = {}
+
+def get_key_index(security_path: Union[str, Path]) -> SecurityKeyIndex:
+    """Process-wide index for a security directory, shared by all managers"""
+    path = Path(security_path)
+    index = _INDEXES.get(path)
+    if index is None:
+        index = _INDEXES[path] = SecurityKeyIndex(path)
+    return index
+
+# ============================================================================
+# EXPORT
+# ============================================================================
+
+__all__ = [
+    'KeyRecord',
+    'SessionKey',
+    'SecurityKeyIndex',
+    'get_key_index',
+    'bootloader_number',
+    'format_bl_id',
+]
+
+if __name__ == "__main__":
+    # python security_keys.py [security dir] [bl_id]
+    import sys
+
+    logging.basicConfig(level=logging.INFO)
+
+    index = SecurityKeyIndex(sys.argv[1] if len(sys.argv) > 1 else Path(__file__).parent / "psdz_data" / "security")
+    print(json.dumps(index.summary(), indent=2))
+
+    if len(sys.argv) > 2:
+        for kind, record in index.resolve_all(sys.argv[2]).items():
+            print(json.dumps(record.to_dict(), indent=2))
+
+    numbers = sorted(index.bootloaders())
+    start = time.perf_counter()
+    for _ in range(100):
+        for number in numbers:
+            index.resolve_level(number, 3)
+    elapsed = time.perf_counter() - start
+    print(f"resolve_level: {elapsed / (100 * len(numbers)) * 1e6:.2f} us/lookup")
@@ -0,0 +1,212 @@
+"""
+Response Serialization
+orjson / MessagePack encoding with pre-encoded immutable records for large list responses
+"""
+
+from datetime import datetime
+from typing import Any, Dict, Hashable, Iterable, List, Optional, Tuple
+import logging
+
+import msgpack
+import orjson
+from starlette.requests import Request
+from starlette.responses import Response
+
+logger = logging.getLogger(__name__)
+
+JSON_TYPE = "application/json"
+MSGPACK_TYPE = "application/msgpack"
+MSGPACK_TYPES = (MSGPACK_TYPE, "application/x-msgpack")
+
+ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+
+# ============================================================================
+# ENCODERS
+# ============================================================================
+
+def _default(value: Any) -> Any:
+    """Types neither encoder handles natively (ObjectId, Path, bytes, sets, pydantic models)"""
+    if isinstance(value, (bytes, bytearray)):
+        return value.hex()
+    if isinstance(value, (set, frozenset, tuple)):
+        return list(value)
+    if hasattr(value, "dict"):
+        return value.dict()
+    return str(value)
+
+def _msgpack_default(value: Any) -> Any:
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return _default(value)
+
+def encode_json(content: Any) -> bytes:
+    return orjson.dumps(content, default=_default, option=ORJSON_OPTIONS)
+
+def encode_msgpack(content: Any) -> bytes:
+    return msgpack.packb(content, default=_msgpack_default, use_bin_type=True)
+
+def wants_msgpack(request: Optional[Request]) -> bool:
+    """True when the client asked for MessagePack (the iOS client sends Accept: application/msgpack)"""
+    if request is None:
+        return False
+    accept = request.headers.get("accept", "")
+    return any(media_type in accept for media_type in MSGPACK_TYPES)
+
+def fast_response(request: Optional[Request], content: Any, status_code: int = 200) -> Response:
+    """JSON via orjson, or MessagePack if the client prefers it"""
+    if wants_msgpack(request):
+        return Response(encode_msgpack(content), status_code, media_type=MSGPACK_TYPE)
+    return Response(encode_json(content), status_code, media_type=JSON_TYPE)
+
+# ============================================================================
+# PRE-ENCODED RECORDS
+# ============================================================================
+
+class PackedRecords:
+    """
+    Immutable records encoded once, in both formats
+
+    A list response is then the envelope plus a join of the stored bytes;
+    no dict is copied and no record is walked by an encoder per request.
+    MessagePack arrays and maps are length-prefixed concatenations, so the
+    same splice works for both formats.
+    """
+
+    def __init__(self, records: Iterable[Tuple[Hashable, Dict[str, Any]]]):
+        self.json: Dict[Hashable, bytes] = {}
+        self.msgpack: Dict[Hashable, bytes] = {}
+        for key, record in records:
+            self.json[key] = encode_json(record)
+            self.msgpack[key] = encode_msgpack(record)
+        self.keys: Tuple[Hashable, ...] = tuple(self.json)
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self.json
+
+    def encode(self, field: str, keys: Optional[List[Hashable]] = None,
+               head: Optional[Dict[str, Any]] = None, tail: Optional[Dict[str, Any]] = None,
+               msgpack_format: bool = False) -> bytes:
+        """
+        {**head, field: [records...], **tail} with the records spliced in
+
+        Args:
+            keys: Records to include, in order (default: all)
+        """
+        keys = self.keys if keys is None else keys
+        head, tail = head or {}, tail or {}
+
+        if msgpack_format:
+            packer = msgpack.Packer(default=_msgpack_default, use_bin_type=True)
+            parts = [packer.pack_map_header(len(head) + len(tail) + 1)]
+            for name, value in head.items():
+                parts += [packer.pack(name), packer.pack(value)]
+            parts += [packer.pack(field), packer.pack_array_header(len(keys))]
+            parts += [self.msgpack[key] for key in keys]
+            for name, value in tail.items():
+                parts += [packer.pack(name), packer.pack(value)]
+            return b"".join(parts)
+
+        parts = [encode_json(head)[:-1]]
+        if head:
+            parts.append(b",")
+        parts += [encode_json(field), b":[", b",".join(self.json[key] for key in keys), b"]"]
+        if tail:
+            parts += [b",", encode_json(tail)[1:]]
+        else:
+            parts.append(b"}")
+        return b"".join(parts)
+
+    def response(self, request: Optional[Request], field: str, keys: Optional[List[Hashable]] = None,
+                 head: Optional[Dict[str, Any]] = None, tail: Optional[Dict[str, Any]] = None) -> Response:
+        if wants_msgpack(request):
+            return Response(self.encode(field, keys, head, tail, msgpack_format=True), media_type=MSGPACK_TYPE)
+        return Response(self.encode(field, keys, head, tail), media_type=JSON_TYPE)
+
+# ============================================================================
+# EXPORT
+# ============================================================================
+
+__all__ = [
+    'JSON_TYPE',
+    'MSGPACK_TYPE',
+    'MSGPACK_TYPES',
+    'PackedRecords',
+    'encode_json',
+    'encode_msgpack',
+    'fast_response',
+    'wants_msgpack',
+]
+
+if __name__ == "__main__":
+    # python serialization.py [records]
+    # Compares FastAPI's default path (dict copies + jsonable_encoder + json.dumps)
+    # with orjson, pre-encoded records and MessagePack on catalog- and history-sized payloads
+    import sys
+    import timeit
+    import uuid
+
+    from fastapi.encoders import jsonable_encoder
+    from starlette.responses import JSONResponse
+
+    from g01_cafd_database import G01_CAFD_DATABASE
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 3000
+    templates = list(G01_CAFD_DATABASE.values())
+    catalog = {f"{i:08x}": templates[i % len(templates)] for i in range(count)}
+    packed = PackedRecords((cafd_id, {"cafd_id": cafd_id, **info}) for cafd_id, info in catalog.items())
+
+    transactions = [
+        {
+            "id": str(uuid.uuid4()),
+            "type": "coding",
+            "vin": "WBAXXXXXXXXXXXXXX",
+            "vehicle": "G01 X3",
+            "description": f"Applied SCR1_REMOTE_START to ECU 0x{i % 256:02X}",
+            "timestamp": datetime.utcnow(),
+            "status": "success",
+            "details": {"result": {"written": [f"0x{3000 + j:04X}" for j in range(8)], "requests": 12}},
+        }
+        for i in range(100)
+    ]
+
+    def default_catalog():
+        cafds = [{"cafd_id": cafd_id, **info} for cafd_id, info in catalog.items()]
+        return JSONResponse(jsonable_encoder({"success": True, "cafds": cafds, "count": len(cafds)})).body
+
+    def orjson_catalog():
+        cafds = [{"cafd_id": cafd_id, **info} for cafd_id, info in catalog.items()]
+        return encode_json({"success": True, "cafds": cafds, "count": len(cafds)})
+
+    def packed_catalog():
+        return packed.encode("cafds", head={"success": True}, tail={"count": len(packed)})
+
+    def packed_catalog_msgpack():
+        return packed.encode("cafds", head={"success": True}, tail={"count": len(packed)}, msgpack_format=True)
+
+    def default_history():
+        return JSONResponse(jsonable_encoder({"success": True, "transactions": transactions})).body
+
+    def orjson_history():
+        return encode_json({"success": True, "transactions": transactions})
+
+    def msgpack_history():
+        return encode_msgpack({"success": True, "transactions": transactions})
+
+    assert orjson.loads(packed_catalog()) == orjson.loads(default_catalog())
+    assert msgpack.unpackb(packed_catalog_msgpack()) == orjson.loads(default_catalog())
+
+    print(f"{'payload':<34}{'ms/call':>10}{'bytes':>12}")
+    for name, fn in [
+        (f"cafd list ({count}) default", default_catalog),
+        (f"cafd list ({count}) orjson", orjson_catalog),
+        (f"cafd list ({count}) pre-encoded", packed_catalog),
+        (f"cafd list ({count}) msgpack", packed_catalog_msgpack),
+        ("history (100) default", default_history),
+        ("history (100) orjson", orjson_history),
+        ("history (100) msgpack", msgpack_history),
+    ]:
+        runs, elapsed = timeit.Timer(fn).autorange()
+        print(f"{name:<34}{elapsed / runs * 1000:>10.3f}{len(fn()):>12}")
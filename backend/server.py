@@ -1,17 +1,16 @@
-from fastapi import FastAPI, APIRouter, HTTPException
+from fastapi import FastAPI, APIRouter, HTTPException, Request, WebSocket, WebSocketDisconnect
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import Response
 from motor.motor_asyncio import AsyncIOMotorClient
 import os
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Union
 import uuid
 from datetime import datetime
 import asyncio
-import socket
-import struct
 
 # Import G01 X3 B48 specific module
 from g01_x3_b48_module import (
@@ -23,13 +22,102 @@ from g01_x3_b48_module import (
 )
 from g01_cafd_database import (
     G01_CAFD_DATABASE,
-    search_cafd_by_function,
+    search_cafd_ids,
     get_cafd_info
 )
+from metrics import (
+    MetricsMiddleware,
+    PROMETHEUS_CONTENT_TYPE,
+    render_metrics
+)
+from uds_timing import RESPONSE_TIMES
+from congestion import congestion_stats
+from doip_tls import TLS_SESSIONS
+from request_scheduler import scheduler_status
+from traffic_capture import CAPTURE
+from enet import ENETConnection
+from connection_owner import RemoteConnection
+from obd_adapter import OBDAdapterConnection, DEFAULT_WIFI_ADDRESS, DEFAULT_WIFI_PORT, DEFAULT_BLUETOOTH_DEVICE
+from session_replay import RECORDER, Session
+from doip_discovery import DISCOVERY
+from live_data import Channel, LIVE_STREAMS, push_samples
+from datalog import DATALOG_SUFFIX, DatalogWriter, DatalogReader
+from security_keys import get_key_index
+from psdz_catalog import MAP_CHECK_INTERVAL, SWE_KINDS, SharedCatalog, get_catalog
+from psdz_pack import get_pack
+from psdz_diff import diff_versions, diff_trees
+from serialization import PackedRecords, fast_response
+from response_cache import CachedResponseMiddleware
+from flash_prep import FlashPreparer, transfer_prepared
+from profiling import (
+    PROFILE_SUFFIX,
+    SamplingProfiler,
+    SlowRequestProfiler,
+    SlowRequestMiddleware,
+    AllocationTracer,
+    list_profiles
+)
+from coding_plan import (
+    compile_plan,
+    cheat_sheet_modifications,
+    execute_plan
+)
+from campaign import (
+    CAMPAIGNS,
+    DEFAULT_PARALLELISM,
+    DEFAULT_RETRIES,
+    Campaign,
+    CampaignVehicle
+)
+from coding_snapshot import (
+    coding_dids,
+    ecu_name,
+    take_snapshot,
+    restore_snapshot,
+    save_snapshot,
+    load_snapshot,
+    list_snapshots
+)
+from history_rollups import (
+    update_rollups,
+    get_rollup,
+    backfill_rollups
+)
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
+# Recorded diagnostic sessions (see session_replay.py)
+RECORDINGS_DIR = Path(os.environ.get('RECORDINGS_DIR', ROOT_DIR / 'recordings'))
+
+# Columnar live data logs (see datalog.py)
+DATALOG_DIR = Path(os.environ.get('DATALOG_DIR', ROOT_DIR / 'datalogs'))
+
+# Earlier psdz_data trees to diff against (see psdz_diff.py)
+PSDZ_SNAPSHOTS_DIR = Path(os.environ.get('PSDZ_SNAPSHOTS_DIR', ROOT_DIR / 'psdz_snapshots'))
+
+# Collapsed-stack profiles (see profiling.py). Requests slower than
+# SLOW_REQUEST_SECONDS are profiled automatically (0 disables); with
+# SLOW_REQUEST_ROUTES (comma-separated route templates) only those are kept.
+PROFILES_DIR = Path(os.environ.get('PROFILES_DIR', ROOT_DIR / 'profiles'))
+SLOW_REQUEST_SECONDS = float(os.environ.get('SLOW_REQUEST_SECONDS', '2.0'))
+SLOW_REQUEST_ROUTES = [r for r in os.environ.get('SLOW_REQUEST_ROUTES', '').split(',') if r]
+
+# Flash images and their prepared TransferData blocks (see flash_prep.py)
+FLASH_DIR = Path(os.environ.get('FLASH_DIR', ROOT_DIR / 'flash_images'))
+FLASH_CACHE_DIR = Path(os.environ.get('FLASH_CACHE_DIR', ROOT_DIR / 'flash_cache'))
+FLASH_PREP_WORKERS = int(os.environ.get('FLASH_PREP_WORKERS', '0')) or None
+
+# Set when a connection owner process holds the vehicle connection and the
+# PSdZ catalog (see connection_owner.py); allows running several workers
+OWNER_SOCKET = os.environ.get('ECU_OWNER_SOCKET')
+
+# OBD adapters (see obd_adapter.py). Pipelining needs an adapter that
+# queues input (STN chips, most clones); a genuine ELM327 needs 1.
+OBD_BLUETOOTH_DEVICE = os.environ.get('OBD_BLUETOOTH_DEVICE', DEFAULT_BLUETOOTH_DEVICE)
+OBD_BAUDRATE = int(os.environ.get('OBD_BAUDRATE', '115200'))
+OBD_PIPELINE_DEPTH = int(os.environ.get('OBD_PIPELINE_DEPTH', '1'))
+
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
 client = AsyncIOMotorClient(mongo_url)
@@ -59,7 +147,8 @@ class Vehicle(BaseModel):
 
 class ConnectionRequest(BaseModel):
     type: str  # enet, bluetooth, wifi
-    ipAddress: Optional[str] = None
+    ipAddress: Optional[str] = None  # wifi: adapter IP, optionally "ip:port"
+    devicePath: Optional[str] = None  # bluetooth: bound serial device
 
 class ConnectionResponse(BaseModel):
     success: bool
@@ -84,14 +173,57 @@ class ApplyCodingRequest(BaseModel):
 class ApplyCheatSheetRequest(BaseModel):
     sheetId: str
     vehicle: Vehicle
+    sheetIds: Optional[List[str]] = None  # Further sheets applied in the same plan
+
+class CodingPlanRequest(BaseModel):
+    modifications: List[str]  # G01_CODING_PARAMS names
+    overrides: Optional[Dict[str, Dict[str, str]]] = None  # modification -> parameter -> value
+
+class CampaignVehicleRequest(BaseModel):
+    gateway: str  # ENET address "ip" or "ip:port"
+    vin: Optional[str] = None  # Checked against the car before coding
+
+class CampaignRequest(BaseModel):
+    modifications: List[str] = []  # G01_CODING_PARAMS names
+    sheetIds: Optional[List[str]] = None  # Cheat sheets added to the modifications
+    overrides: Optional[Dict[str, Dict[str, str]]] = None
+    vehicles: List[CampaignVehicleRequest]
+    parallelism: int = DEFAULT_PARALLELISM
+    retries: int = DEFAULT_RETRIES
+    verify: bool = True
 
 class FlashRequest(BaseModel):
     stageId: str
     vehicle: Vehicle
+    preparedId: Optional[str] = None  # from /flash/prepare; streamed instead of the mock flash
+
+class FlashPrepareRequest(BaseModel):
+    image: str  # file name in FLASH_DIR (.hex or raw .bin)
+    maxBlockLength: int = 0xFFF  # the ECU's RequestDownload maxNumberOfBlockLength
+    compression: Optional[str] = None  # None or "zlib"
+    baseAddress: int = 0  # load address of a raw .bin
+
+class LiveChannel(BaseModel):
+    ecu: Union[str, int]  # ECU name (e.g. "DME") or address
+    did: Union[str, int]  # e.g. "0x5003"
+    length: int = 2
+    name: Optional[str] = None
+    scale: float = 1.0
+    offset: float = 0.0
+
+class LiveStreamRequest(BaseModel):
+    channels: List[LiveChannel]
+    rateHz: float = 20.0
+    record: bool = False  # Also write samples to a datalog file
+
+class SnapshotRequest(BaseModel):
+    ecu: Union[str, int]  # ECU name (e.g. "FEM") or address
+    dids: Optional[List[Union[str, int]]] = None  # Default: coding DIDs known for the ECU
+    vin: Optional[str] = None
 
 class Transaction(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
-    type: str  # coding, flash, cheatsheet
+    type: str  # coding, flash, cheatsheet, campaign
     vin: str
     vehicle: str
     description: str
@@ -100,107 +232,21 @@ class Transaction(BaseModel):
     details: Optional[Dict[str, Any]] = None
 
 # ============================================================================
-# ENET COMMUNICATION LAYER
+# VEHICLE CONNECTION
 # ============================================================================
 
-class ENETConnection:
-    def __init__(self, ip_address: str = "169.254.250.250", port: int = 6801):
-        """
-        ENET Connection for BMW G01 X3
-        Uses static IP in 169.254.x.x range as per BMW ENET protocol
-        """
-        self.ip_address = ip_address
-        self.port = port
-        self.socket = None
-        self.connected = False
-    
-    async def connect(self) -> bool:
-        """Establish TCP connection to ENET cable"""
-        try:
-            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.socket.settimeout(10)  # Increased timeout
-            await asyncio.get_event_loop().run_in_executor(
-                None, self.socket.connect, (self.ip_address, self.port)
-            )
-            self.connected = True
-            logger.info(f"Connected to ENET at {self.ip_address}:{self.port}")
-            return True
-        except Exception as e:
-            logger.error(f"ENET connection failed: {e}")
-            self.connected = False
-            return False
-    
-    def disconnect(self):
-        """Close ENET connection"""
-        if self.socket:
-            self.socket.close()
-            self.connected = False
-            logger.info("ENET connection closed")
-    
-    async def send_uds_request(self, service_id: int, data: bytes = b'') -> bytes:
-        """Send UDS (Unified Diagnostic Services) request"""
-        if not self.connected:
-            raise Exception("Not connected to ENET")
-        
-        # ISO-TP header + UDS service ID + data
-        message = struct.pack('B', service_id) + data
-        
-        try:
-            await asyncio.get_event_loop().run_in_executor(
-                None, self.socket.send, message
-            )
-            response = await asyncio.get_event_loop().run_in_executor(
-                None, self.socket.recv, 4096
-            )
-            return response
-        except Exception as e:
-            logger.error(f"UDS request failed: {e}")
-            raise
-    
-    async def read_vin(self) -> str:
-        """Read VIN from vehicle using UDS Service 0x22 (ReadDataByIdentifier)"""
-        try:
-            # Service 0x22, DID 0xF190 (VIN)
-            response = await self.send_uds_request(0x22, b'\\xF1\\x90')
-            # Parse response (skip first 3 bytes: response code + DID echo)
-            vin = response[3:20].decode('ascii')
-            return vin
-        except Exception as e:
-            logger.error(f"VIN read failed: {e}")
-            return "DEMO_VIN_123456789"
-    
-    async def read_ecu_data(self, did: int) -> bytes:
-        """Read data from ECU by Data Identifier"""
-        did_bytes = struct.pack('>H', did)
-        return await self.send_uds_request(0x22, did_bytes)
-    
-    async def write_ecu_data(self, did: int, data: bytes) -> bool:
-        """Write data to ECU"""
-        try:
-            did_bytes = struct.pack('>H', did)
-            response = await self.send_uds_request(0x2E, did_bytes + data)
-            # Check for positive response (0x6E)
-            return response[0] == 0x6E
-        except Exception as e:
-            logger.error(f"ECU write failed: {e}")
-            return False
-    
-    async def start_diagnostic_session(self, session_type: int = 0x03):
-        """Start diagnostic session (0x03 = Extended Diagnostic Session)"""
-        return await self.send_uds_request(0x10, struct.pack('B', session_type))
-    
-    async def security_access_seed(self) -> bytes:
-        """Request security seed"""
-        return await self.send_uds_request(0x27, b'\\x01')
-    
-    async def security_access_key(self, key: bytes):
-        """Send security key"""
-        return await self.send_uds_request(0x27, b'\\x02' + key)
-
 # Global ENET connection and G01 manager instances
-enet_connection: Optional[ENETConnection] = None
+enet_connection: Optional[Union[ENETConnection, RemoteConnection]] = None
 g01_manager: Optional[G01ECUManager] = None
 
+async def open_connection(ip: str, port: int = 6801) -> Union[ENETConnection, RemoteConnection]:
+    """Direct ENET connection, or a proxy to the connection owner's"""
+    if not OWNER_SOCKET:
+        return ENETConnection(ip, port)
+    if isinstance(enet_connection, RemoteConnection):
+        await enet_connection.close()
+    return RemoteConnection(OWNER_SOCKET, ip, port)
+
 # ============================================================================
 # PSdZData MANAGEMENT
 # ============================================================================
@@ -257,6 +303,40 @@ class PSdZDataManager:
 
 psdz_manager = PSdZDataManager()
 
+# Versioned CAFD / FAFP file index (see psdz_catalog.py); with a connection
+# owner, the read-only index it publishes, shared by all workers
+if OWNER_SOCKET:
+    psdz_catalog = SharedCatalog(G01_X3_B48_CONFIG["swe_path"])
+else:
+    psdz_catalog = get_catalog(G01_X3_B48_CONFIG["swe_path"])
+
+# CAFD database records, encoded once for the list and search endpoints
+CAFD_RECORDS = PackedRecords((cafd_id, {"cafd_id": cafd_id, **info}) for cafd_id, info in G01_CAFD_DATABASE.items())
+
+# ============================================================================
+# TRANSACTION LOG
+# ============================================================================
+
+async def log_transaction(transaction: Transaction):
+    """Persist a transaction and fold it into the history rollups"""
+    doc = transaction.dict()
+    await db.transactions.insert_one(doc)
+    
+    try:
+        await update_rollups(db, doc)
+    except Exception as e:
+        # Rollups can be rebuilt by the backfill job; never fail the operation
+        logger.error(f"History rollup update failed: {e}")
+
+async def log_failure(transaction: Transaction, error: str):
+    """Log an operation as failed; never masks the error being reported"""
+    transaction.status = "failed"
+    transaction.details = {**(transaction.details or {}), "error": error}
+    try:
+        await log_transaction(transaction)
+    except Exception as e:
+        logger.error(f"Failed transaction could not be logged: {e}")
+
 # ============================================================================
 # API ENDPOINTS
 # ============================================================================
@@ -267,42 +347,152 @@ async def root():
 
 # CAFD Search and Browse
 @api_router.get("/cafd/search")
-async def search_cafds(query: str):
+async def search_cafds(query: str, request: Request):
     """Search CAFD by function name (e.g., 'remote start', 'exhaust', 'dme')"""
     try:
-        results = search_cafd_by_function(query)
-        return {"success": True, "results": results, "count": len(results)}
+        cafd_ids = search_cafd_ids(query)
+        return CAFD_RECORDS.response(request, "results", cafd_ids, head={"success": True}, tail={"count": len(cafd_ids)})
     except Exception as e:
         logger.error(f"CAFD search error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 @api_router.get("/cafd/list")
-async def list_all_cafds():
+async def list_all_cafds(request: Request):
     """List all available CAFDs with names"""
     try:
-        cafds = [
-            {"cafd_id": cafd_id, **info}
-            for cafd_id, info in G01_CAFD_DATABASE.items()
-        ]
-        return {"success": True, "cafds": cafds, "count": len(cafds)}
+        return CAFD_RECORDS.response(request, "cafds", head={"success": True}, tail={"count": len(CAFD_RECORDS)})
     except Exception as e:
         logger.error(f"List CAFDs error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 @api_router.get("/cafd/{cafd_id}")
-async def get_cafd_details(cafd_id: str):
-    """Get detailed information about specific CAFD"""
+async def get_cafd_details(cafd_id: str, kind: str = "cafd"):
+    """Get detailed information about specific CAFD (or FAFP with kind=fafp)"""
     try:
-        info = get_cafd_info(cafd_id)
-        if not info:
-            raise HTTPException(status_code=404, detail=f"CAFD {cafd_id} not found")
-        return {"success": True, "cafd": {"cafd_id": cafd_id, **info}}
+        if kind not in SWE_KINDS:
+            raise HTTPException(status_code=400, detail=f"Unknown SWE kind: {kind}")
+        info = get_cafd_info(cafd_id) if kind == "cafd" else None
+        latest = psdz_catalog.latest(cafd_id, kind)
+        if not info and not latest:
+            raise HTTPException(status_code=404, detail=f"{kind.upper()} {cafd_id} not found")
+        return {
+            "success": True,
+            "cafd": {
+                "cafd_id": cafd_id,
+                "kind": kind,
+                **(info or {}),
+                "latest": latest.to_dict() if latest else None,
+                "versions": len(psdz_catalog.versions(cafd_id, kind)),
+            }
+        }
     except HTTPException:
         raise
     except Exception as e:
         logger.error(f"Get CAFD error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@api_router.get("/cafd/{cafd_id}/versions")
+async def get_cafd_versions(cafd_id: str, kind: str = "cafd"):
+    """All versions of a CAFD/FAFP with header attributes, sizes and hashes"""
+    try:
+        versions = psdz_catalog.versions(cafd_id, kind)
+        if not versions:
+            raise HTTPException(status_code=404, detail=f"{kind.upper()} {cafd_id} not found")
+        return {
+            "success": True,
+            "versions": [v.to_dict() for v in versions],
+            "count": len(versions),
+            "generation": psdz_catalog.generation,
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Get CAFD versions error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@api_router.get("/cafd/{cafd_id}/diff")
+async def diff_cafd_versions(cafd_id: str, base: str, target: str, kind: str = "cafd"):
+    """Byte-level change ranges between two versions of a CAFD/FAFP"""
+    try:
+        if kind not in SWE_KINDS:
+            raise HTTPException(status_code=400, detail=f"Unknown SWE kind: {kind}")
+        result = await asyncio.get_event_loop().run_in_executor(
+            None, diff_versions, psdz_catalog.swe_path / kind, cafd_id, base, target, kind
+        )
+        return {"success": True, "diff": result}
+    except HTTPException:
+        raise
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"CAFD diff error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+def resolve_psdz_snapshot(name: str) -> Path:
+    """'current' is the live psdz_data tree; anything else a directory in PSDZ_SNAPSHOTS_DIR"""
+    if name == "current":
+        return psdz_manager.psdz_root
+    path = PSDZ_SNAPSHOTS_DIR / Path(name).name
+    if not path.is_dir():
+        raise HTTPException(status_code=404, detail=f"PSdZ snapshot {name} not found")
+    return path
+
+@api_router.get("/psdz/diff")
+async def diff_psdz_snapshots(base: str, target: str = "current", exact: bool = False):
+    """Changed IDs, version bumps and change ranges between two psdz_data snapshots"""
+    try:
+        base_root, target_root = resolve_psdz_snapshot(base), resolve_psdz_snapshot(target)
+        result = await asyncio.get_event_loop().run_in_executor(
+            None, diff_trees, base_root, target_root, exact
+        )
+        return {"success": True, "diff": result}
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"PSdZ diff error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@api_router.get("/psdz/catalog")
+async def get_psdz_catalog(request: Request, kind: Optional[str] = None, prefix: str = ""):
+    """Indexed CAFD/FAFP IDs with version counts"""
+    try:
+        rows = psdz_catalog.search(kind, prefix)
+        return fast_response(request, {"success": True, "catalog": psdz_catalog.summary(), "files": rows, "count": len(rows)})
+    except Exception as e:
+        logger.error(f"PSdZ catalog error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@api_router.get("/psdz/pack")
+async def get_psdz_pack_stats():
+    """Dedup / compression statistics of the content-addressed PSdZ pack"""
+    try:
+        pack = get_pack(G01_X3_B48_CONFIG["psdz_pack"])
+        if pack is None:
+            raise HTTPException(status_code=404, detail="No PSdZ pack built (python psdz_pack.py build)")
+        return {"success": True, "pack": pack.stats()}
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"PSdZ pack error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@api_router.post("/psdz/catalog/refresh")
+async def refresh_psdz_catalog(force: bool = False):
+    """Re-scan psdz_data (force re-stats every file, e.g. after in-place edits)"""
+    try:
+        if OWNER_SOCKET:
+            # The owner re-scans and republishes; this worker re-maps
+            await enet_connection.refresh_catalog(force)
+            changed = psdz_catalog.refresh()
+        else:
+            changed = await asyncio.get_event_loop().run_in_executor(None, psdz_catalog.refresh, force)
+        return {"success": True, "changed": changed, "catalog": psdz_catalog.summary()}
+    except Exception as e:
+        logger.error(f"PSdZ catalog refresh error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
 # DME Operations
 @api_router.post("/dme/read")
 async def read_dme():
@@ -352,17 +542,13 @@ async def write_dme(parameter: str, value: str):
     """Write specific parameter to DME"""
     global g01_manager
     
+    transaction = None
     try:
         if not g01_manager:
             raise HTTPException(status_code=400, detail="Not connected to G01 X3")
         
         dme_addr = G01_X3_B48_CONFIG["ecu_addresses"]["DME"]
         
-        # Unlock DME
-        unlocked = await g01_manager.unlock_ecu(dme_addr, security_level=3)
-        if not unlocked:
-            raise HTTPException(status_code=500, detail="Failed to unlock DME")
-        
         # Parameter mapping
         param_map = {
             "exhaust_flaps": 0x5000,
@@ -375,22 +561,30 @@ async def write_dme(parameter: str, value: str):
         if not did:
             raise HTTPException(status_code=400, detail=f"Unknown parameter: {parameter}")
         
+        transaction = Transaction(
+            type="coding",
+            vin="UNKNOWN",
+            vehicle="G01 X3 B48",
+            description=f"DME Write: {parameter} = {value}",
+            status="success"
+        )
+        
+        # Unlock DME
+        unlocked = await g01_manager.unlock_ecu(dme_addr, security_level=3)
+        if not unlocked:
+            await log_failure(transaction, "Failed to unlock DME")
+            raise HTTPException(status_code=500, detail="Failed to unlock DME")
+        
         # Write parameter
         value_bytes = value.encode('utf-8')
         success = await g01_manager.write_parameter(dme_addr, did, value_bytes)
         
         if not success:
+            await log_failure(transaction, "Failed to write DME parameter")
             raise HTTPException(status_code=500, detail="Failed to write DME parameter")
         
         # Log transaction
-        transaction = Transaction(
-            type="coding",
-            vin="UNKNOWN",
-            vehicle="G01 X3 B48",
-            description=f"DME Write: {parameter} = {value}",
-            status="success"
-        )
-        await db.transactions.insert_one(transaction.dict())
+        await log_transaction(transaction)
         
         return {
             "success": True,
@@ -401,6 +595,119 @@ async def write_dme(parameter: str, value: str):
         raise
     except Exception as e:
         logger.error(f"DME write error: {e}")
+        if transaction:
+            await log_failure(transaction, str(e))
+        raise HTTPException(status_code=500, detail=str(e))
+
+# Live Data
+def resolve_ecu_address(ecu: Union[str, int]) -> int:
+    """ECU name from the G01 config or a numeric address (int or "0x12")"""
+    if isinstance(ecu, int):
+        return ecu
+    address = G01_X3_B48_CONFIG["ecu_addresses"].get(ecu.upper())
+    return address if address is not None else int(ecu, 0)
+
+@api_router.post("/live/streams")
+async def create_live_stream(request: LiveStreamRequest):
+    """Start polling a set of (ECU, DID) channels; attach via /api/live/ws/{stream_id}"""
+    global g01_manager
+    
+    try:
+        if not g01_manager:
+            raise HTTPException(status_code=400, detail="Not connected to G01 X3")
+        if not request.channels:
+            raise HTTPException(status_code=400, detail="No channels requested")
+        
+        channels = [
+            Channel(
+                ecu=resolve_ecu_address(c.ecu),
+                did=c.did if isinstance(c.did, int) else int(c.did, 0),
+                length=c.length,
+                name=c.name,
+                scale=c.scale,
+                offset=c.offset
+            )
+            for c in request.channels
+        ]
+        stream = LIVE_STREAMS.create(g01_manager, channels, request.rateHz)
+        
+        datalog = None
+        if request.record:
+            DATALOG_DIR.mkdir(parents=True, exist_ok=True)
+            datalog = f"datalog_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}_{stream.id[:8]}{DATALOG_SUFFIX}"
+            stream.sinks.append(DatalogWriter(
+                DATALOG_DIR / datalog,
+                [c.key for c in channels],
+                metadata={"stream": stream.id, "rate_hz": stream.rate_hz}
+            ))
+        
+        return {"success": True, "stream": stream.status(), "datalog": datalog}
+    except HTTPException:
+        raise
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Create live stream error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@api_router.get("/live/streams")
+async def list_live_streams():
+    streams = [stream.status() for stream in LIVE_STREAMS.streams.values()]
+    return {"success": True, "streams": streams, "count": len(streams)}
+
+@api_router.delete("/live/streams/{stream_id}")
+async def stop_live_stream(stream_id: str):
+    if not await LIVE_STREAMS.stop(stream_id):
+        raise HTTPException(status_code=404, detail=f"Stream {stream_id} not found")
+    return {"success": True, "message": "Stream stopped"}
+
+@api_router.websocket("/live/ws/{stream_id}")
+async def live_stream_socket(websocket: WebSocket, stream_id: str, decimation: int = 1):
+    """Push batched samples; send {"decimation": N} to change the rate on the fly"""
+    stream = LIVE_STREAMS.get(stream_id)
+    if not stream:
+        await websocket.close(code=4404)
+        return
+    
+    await websocket.accept()
+    try:
+        await push_samples(stream, websocket.send_json, websocket.receive_json, decimation)
+    except WebSocketDisconnect:
+        pass
+
+# Datalogs
+def open_datalog(name: str) -> DatalogReader:
+    path = DATALOG_DIR / name
+    if path.parent != DATALOG_DIR or path.suffix != DATALOG_SUFFIX or not path.exists():
+        raise HTTPException(status_code=404, detail=f"Datalog {name} not found")
+    return DatalogReader(path)
+
+@api_router.get("/datalog")
+async def list_datalogs():
+    """List recorded live data logs"""
+    try:
+        files = sorted(DATALOG_DIR.glob(f"*{DATALOG_SUFFIX}")) if DATALOG_DIR.exists() else []
+        logs = [DatalogReader(f).summary() for f in files]
+        return {"success": True, "datalogs": logs, "count": len(logs)}
+    except Exception as e:
+        logger.error(f"List datalogs error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@api_router.get("/datalog/{name}")
+async def read_datalog(name: str, start: Optional[float] = None, end: Optional[float] = None,
+                       points: int = 1000, channels: Optional[str] = None):
+    """Min/max downsampled series for plotting (channels: comma-separated names)"""
+    try:
+        reader = open_datalog(name)
+        selected = channels.split(",") if channels else None
+        series = reader.downsample(start, end, max(1, min(points, 10000)), selected)
+        return {"success": True, "datalog": reader.summary(), "series": series}
+    except HTTPException:
+        raise
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Read datalog error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 # Connection Management
@@ -410,13 +717,17 @@ async def connect_to_vehicle(request: ConnectionRequest):
     
     try:
         if request.type == "enet":
-            ip = request.ipAddress or "169.254.250.250"  # BMW ENET static IP
-            enet_connection = ENETConnection(ip, 6801)
+            ip = request.ipAddress
+            if not ip:
+                # Locate the gateway by DoIP vehicle identification instead of guessing
+                gateway = await DISCOVERY.find_gateway()
+                ip = gateway.ip if gateway else "169.254.250.250"  # BMW ENET static IP
+            enet_connection = await open_connection(ip, 6801)
             success = await enet_connection.connect()
             
             if success:
                 # Initialize G01 X3 B48 manager
-                g01_manager = G01ECUManager(enet_connection)
+                g01_manager = G01ECUManager(enet_connection, catalog=psdz_catalog)
                 
                 # Read VIN
                 vin = await enet_connection.read_vin()
@@ -434,20 +745,39 @@ async def connect_to_vehicle(request: ConnectionRequest):
                     message="Failed to connect to ENET cable"
                 )
         
-        elif request.type == "bluetooth":
-            # Bluetooth OBD connection logic
-            return ConnectionResponse(
-                success=True,
-                deviceName="Bluetooth OBD",
-                message="Connected via Bluetooth"
-            )
-        
-        elif request.type == "wifi":
-            # WiFi OBD connection logic
+        elif request.type in ("bluetooth", "wifi"):
+            # ELM327 / STN adapter on the OBD port (D-CAN)
+            if OWNER_SOCKET:
+                return ConnectionResponse(
+                    success=False,
+                    message="OBD adapters are not supported with a connection owner process"
+                )
+            if request.type == "wifi":
+                host, _, port = (request.ipAddress or DEFAULT_WIFI_ADDRESS).partition(":")
+                adapter = OBDAdapterConnection(host, int(port or DEFAULT_WIFI_PORT),
+                                               pipeline_depth=OBD_PIPELINE_DEPTH)
+                label = "WiFi OBD"
+            else:
+                adapter = OBDAdapterConnection(request.devicePath or OBD_BLUETOOTH_DEVICE,
+                                               baudrate=OBD_BAUDRATE, pipeline_depth=OBD_PIPELINE_DEPTH)
+                label = "Bluetooth OBD"
+            
+            if not await adapter.connect():
+                return ConnectionResponse(
+                    success=False,
+                    message=f"Failed to connect to {label} adapter"
+                )
+            
+            if enet_connection:
+                enet_connection.disconnect()
+            enet_connection = adapter
+            g01_manager = G01ECUManager(enet_connection, catalog=psdz_catalog)
+            vin = await enet_connection.read_vin()
+            
             return ConnectionResponse(
                 success=True,
-                deviceName="WiFi OBD",
-                message="Connected via WiFi"
+                deviceName=f"{label} ({adapter.adapter_version}) - G01 X3 B48",
+                message=f"Connected via {label} - VIN: {vin}"
             )
         
         else:
@@ -460,12 +790,28 @@ async def connect_to_vehicle(request: ConnectionRequest):
         logger.error(f"Connection error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@api_router.get("/connection/discover")
+async def discover_vehicles(refresh: bool = False):
+    """Find DoIP gateways on all local interfaces (vehicle identification broadcast)"""
+    try:
+        announcements = await DISCOVERY.discover(use_cache=not refresh)
+        return {
+            "success": True,
+            "vehicles": [a.to_dict() for a in announcements],
+            "count": len(announcements)
+        }
+    except Exception as e:
+        logger.error(f"Vehicle discovery error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
 @api_router.post("/connection/disconnect")
 async def disconnect_from_vehicle():
     global enet_connection
+    await LIVE_STREAMS.stop_all()
     if enet_connection:
         enet_connection.disconnect()
-        enet_connection = None
+        if not OWNER_SOCKET:
+            enet_connection = None  # Workers keep their owner link for status events
     return {"success": True, "message": "Disconnected"}
 
 # Coding
@@ -492,6 +838,7 @@ async def get_cafd_parameters(cafd_id: str, vin: Optional[str] = None):
 async def apply_coding(request: ApplyCodingRequest):
     global g01_manager
     
+    transaction = None
     try:
         if not g01_manager:
             raise HTTPException(status_code=400, detail="Not connected to G01 X3 B48")
@@ -500,90 +847,284 @@ async def apply_coding(request: ApplyCodingRequest):
         ecu_name = request.cafd.split('_')[0] if '_' in request.cafd else "DME"
         ecu_addr = G01_X3_B48_CONFIG["ecu_addresses"].get(ecu_name, 0x12)
         
-        # Unlock ECU
-        unlocked = await g01_manager.unlock_ecu(ecu_addr, security_level=3)
-        if not unlocked:
-            raise HTTPException(status_code=500, detail="Failed to unlock ECU")
-        
-        # Apply each parameter
+        # Target values; a later parameter on the same address wins
+        values = {}
+        names = {}
         for param in request.parameters:
             if param.newValue:
-                # Write to ECU
                 param_addr = int(param.id) if param.id.isdigit() else 0x3000
-                value_bytes = param.newValue.encode('utf-8')
-                
-                success = await g01_manager.write_parameter(ecu_addr, param_addr, value_bytes)
-                if not success:
-                    raise HTTPException(status_code=500, detail=f"Failed to write {param.name}")
+                values[param_addr] = param.newValue.encode('utf-8')
+                names[param_addr] = param.name
         
-        # Log transaction
         transaction = Transaction(
             type="coding",
             vin=request.vehicle.vin or "UNKNOWN",
             vehicle=f"{request.vehicle.series} {request.vehicle.model}",
             description=f"CAFD {request.cafd} - {len(request.parameters)} parameters",
             status="success",
-            details={"cafd": request.cafd, "parameters": [p.dict() for p in request.parameters]}
+            details={
+                "cafd": request.cafd,
+                "parameters": [p.dict() for p in request.parameters],
+            }
         )
-        await db.transactions.insert_one(transaction.dict())
         
-        return {"success": True, "message": "Coding applied successfully to G01 X3"}
+        # Read-compare-write: unchanged values cost multi-DID reads only, no unlock or writes
+        result = await g01_manager.apply_values(ecu_addr, values)
+        transaction.details["result"] = result.to_dict()
+        
+        error = None
+        if not result.unlocked and result.failed:
+            error = "Failed to unlock ECU"
+        elif result.failed:
+            error = f"Failed to write {names[result.failed[0]]}"
+        elif result.verify_failed:
+            error = f"Verification failed for {names[result.verify_failed[0]]}"
+        if error:
+            await log_failure(transaction, error)
+            raise HTTPException(status_code=500, detail=error)
+        
+        # Log transaction
+        await log_transaction(transaction)
+        
+        return {"success": True, "message": "Coding applied successfully to G01 X3", "result": result.to_dict()}
     
     except HTTPException:
         raise
     except Exception as e:
         logger.error(f"Apply coding error: {e}")
+        if transaction:
+            await log_failure(transaction, str(e))
         raise HTTPException(status_code=500, detail=str(e))
 
 @api_router.post("/coding/apply-cheatsheet")
 async def apply_cheatsheet(request: ApplyCheatSheetRequest):
-    global enet_connection
+    global g01_manager
     
     try:
-        if not enet_connection or not enet_connection.connected:
-            raise HTTPException(status_code=400, detail="Not connected to vehicle")
+        if not g01_manager:
+            raise HTTPException(status_code=400, detail="Not connected to G01 X3 B48")
+        
+        sheets = [request.sheetId] + [s for s in request.sheetIds or [] if s != request.sheetId]
+        try:
+            plan = compile_plan(cheat_sheet_modifications(sheets))
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
         
-        # Mock cheatsheet application
-        await asyncio.sleep(2)  # Simulate coding time
+        result = await execute_plan(g01_manager, plan)
         
         # Log transaction
         transaction = Transaction(
             type="cheatsheet",
             vin=request.vehicle.vin or "UNKNOWN",
             vehicle=f"{request.vehicle.series} {request.vehicle.model}",
-            description=f"Cheatsheet: {request.sheetId}",
-            status="success"
+            description=f"Cheatsheet: {', '.join(sheets)}",
+            status="success" if result["success"] else "failed",
+            details={"plan": plan.to_dict(), "result": result}
         )
-        await db.transactions.insert_one(transaction.dict())
+        await log_transaction(transaction)
         
-        return {"success": True, "message": "Cheatsheet applied successfully"}
+        if not result["success"]:
+            raise HTTPException(status_code=500, detail=f"Cheatsheet not fully applied: {result}")
+        return {"success": True, "message": "Cheatsheet applied successfully", "result": result}
     
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Apply cheatsheet error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@api_router.post("/coding/plan")
+async def preview_coding_plan(request: CodingPlanRequest):
+    """Compile modifications into per-ECU write plans without touching the vehicle"""
+    try:
+        return {"success": True, "plan": compile_plan(request.modifications, request.overrides).to_dict()}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+# Coding Snapshots
+@api_router.post("/coding/snapshots")
+async def create_coding_snapshot(request: SnapshotRequest):
+    """Back up an ECU's coding DIDs (pipelined bulk read, compressed, hashed)"""
+    global g01_manager
+    
+    try:
+        if not g01_manager:
+            raise HTTPException(status_code=400, detail="Not connected to G01 X3 B48")
+        
+        ecu_addr = resolve_ecu_address(request.ecu)
+        if request.dids:
+            dids = [d if isinstance(d, int) else int(d, 16) for d in request.dids]
+        else:
+            name = ecu_name(ecu_addr)
+            dids = coding_dids(name) if name else []
+        if not dids:
+            raise HTTPException(status_code=400, detail=f"No coding DIDs known for ECU {request.ecu}")
+        
+        snapshot, throughput = await take_snapshot(g01_manager, request.vin or "UNKNOWN", ecu_addr, dids)
+        if not snapshot.blocks:
+            raise HTTPException(status_code=500, detail="ECU answered none of the coding DIDs")
+        
+        summary = await save_snapshot(db, snapshot)
+        return {"success": True, "snapshot": summary, "throughput": throughput}
+    except HTTPException:
+        raise
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Coding snapshot error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@api_router.get("/coding/snapshots")
+async def get_coding_snapshots(vin: Optional[str] = None, ecu: Optional[str] = None):
+    try:
+        snapshots = await list_snapshots(db, vin=vin, ecu=ecu.upper() if ecu else None)
+        return {"success": True, "snapshots": snapshots, "count": len(snapshots)}
+    except Exception as e:
+        logger.error(f"List snapshots error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@api_router.post("/coding/snapshots/{snapshot_id}/restore")
+async def restore_coding_snapshot(snapshot_id: str):
+    """Write back only the coding blocks that differ from the live ECU"""
+    global g01_manager
+    
+    try:
+        if not g01_manager:
+            raise HTTPException(status_code=400, detail="Not connected to G01 X3 B48")
+        
+        snapshot = await load_snapshot(db, snapshot_id)
+        if snapshot is None:
+            raise HTTPException(status_code=404, detail=f"Snapshot {snapshot_id} not found")
+        
+        result = await restore_snapshot(g01_manager, snapshot)
+        
+        transaction = Transaction(
+            type="coding",
+            vin=snapshot.vin,
+            vehicle="G01 X3",
+            description=f"Restore snapshot {snapshot_id} to ECU 0x{snapshot.ecu_address:02X}",
+            status="success" if result["success"] else "failed",
+            details={"snapshot": snapshot_id, "result": result}
+        )
+        await log_transaction(transaction)
+        
+        if not result["success"]:
+            raise HTTPException(status_code=500, detail=f"Restore incomplete: {result}")
+        return {"success": True, "result": result}
+    except HTTPException:
+        raise
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except Exception as e:
+        logger.error(f"Restore snapshot error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+# Campaigns
+async def log_campaign_vehicle(campaign: Campaign, vehicle: CampaignVehicle):
+    await log_transaction(Transaction(
+        type="campaign",
+        vin=vehicle.vin_read or vehicle.vin or "UNKNOWN",
+        vehicle="G01 X3",
+        description=f"Campaign {campaign.id}: {', '.join(campaign.modifications)} via {vehicle.gateway}",
+        status="success" if vehicle.state == "succeeded" else "failed",
+        details={"campaign": campaign.id, **vehicle.to_dict()}
+    ))
+
+@api_router.post("/campaigns")
+async def start_campaign(request: CampaignRequest):
+    """Code many vehicles with one plan, each on its own ENET connection"""
+    try:
+        modifications = request.modifications + cheat_sheet_modifications(request.sheetIds or [])
+        if not modifications:
+            raise HTTPException(status_code=400, detail="No modifications given")
+        plan = compile_plan(modifications, request.overrides)
+        
+        connected = getattr(enet_connection, "ip_address", None) if enet_connection else None
+        vehicles = [CampaignVehicle(v.gateway, v.vin) for v in request.vehicles]
+        if connected and any(v.address[0] == connected for v in vehicles):
+            raise HTTPException(status_code=409, detail=f"{connected} is the connected vehicle; disconnect it first")
+        
+        campaign = CAMPAIGNS.start(Campaign(
+            plan, vehicles, modifications=list(dict.fromkeys(modifications)),
+            parallelism=request.parallelism, retries=request.retries, verify=request.verify,
+            catalog=psdz_catalog, on_vehicle_done=log_campaign_vehicle
+        ))
+        return {"success": True, "campaign": campaign.summary(), "plan": plan.to_dict()}
+    except HTTPException:
+        raise
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Start campaign error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@api_router.get("/campaigns")
+async def get_campaigns():
+    campaigns = [c.summary() for c in CAMPAIGNS.campaigns.values()]
+    return {"success": True, "campaigns": campaigns, "count": len(campaigns)}
+
+@api_router.get("/campaigns/{campaign_id}")
+async def get_campaign(campaign_id: str):
+    campaign = CAMPAIGNS.get(campaign_id)
+    if campaign is None:
+        raise HTTPException(status_code=404, detail=f"Campaign {campaign_id} not found")
+    return {"success": True, "campaign": campaign.to_dict()}
+
+@api_router.post("/campaigns/{campaign_id}/cancel")
+async def cancel_campaign(campaign_id: str):
+    if not await CAMPAIGNS.cancel(campaign_id):
+        raise HTTPException(status_code=404, detail=f"Campaign {campaign_id} not found")
+    return {"success": True, "campaign": CAMPAIGNS.get(campaign_id).summary()}
+
 # Flash
+FLASH_PREPARER = FlashPreparer(FLASH_CACHE_DIR, workers=FLASH_PREP_WORKERS)
+
+@api_router.post("/flash/prepare")
+async def prepare_flash(request: FlashPrepareRequest):
+    """Segment, checksum and compress an image ahead of time (cached by content and block size)"""
+    try:
+        path = FLASH_DIR / request.image
+        if "/" in request.image or not path.is_file():
+            raise HTTPException(status_code=404, detail=f"No flash image {request.image}")
+        
+        prepared = await FLASH_PREPARER.prepare(
+            path, request.maxBlockLength, request.compression, request.baseAddress
+        )
+        return {"success": True, "prepared": prepared.to_dict()}
+    except HTTPException:
+        raise
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Flash preparation error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@api_router.get("/flash/prepared")
+async def list_prepared_flash():
+    prepared = [p.to_dict() for p in FLASH_PREPARER.entries()]
+    return {"success": True, "prepared": prepared, "count": len(prepared)}
+
+@api_router.delete("/flash/prepared/{prepared_id}")
+async def delete_prepared_flash(prepared_id: str):
+    if not FLASH_PREPARER.remove(prepared_id):
+        raise HTTPException(status_code=404, detail=f"No prepared image {prepared_id}")
+    return {"success": True}
+
 @api_router.post("/flash/apply")
 async def apply_flash(request: FlashRequest):
     global enet_connection
     
+    transaction = None
     try:
         if not enet_connection or not enet_connection.connected:
             raise HTTPException(status_code=400, detail="Not connected to vehicle")
         
-        # Start extended diagnostic session
-        await enet_connection.start_diagnostic_session(0x03)
-        
-        # Security access
-        seed_response = await enet_connection.security_access_seed()
-        # In production, calculate key from seed using manufacturer algorithm
-        key = b'\\x00\\x00\\x00\\x00'  # Mock key
-        await enet_connection.security_access_key(key)
-        
-        # Mock flash process (in production, write actual flash file)
-        await asyncio.sleep(5)  # Simulate flashing
+        prepared = None
+        if request.preparedId:
+            prepared = FLASH_PREPARER.get(request.preparedId)
+            if prepared is None:
+                raise HTTPException(status_code=404, detail=f"No prepared image {request.preparedId}")
         
-        # Log transaction
         transaction = Transaction(
             type="flash",
             vin=request.vehicle.vin or "UNKNOWN",
@@ -592,25 +1133,199 @@ async def apply_flash(request: FlashRequest):
             status="success",
             details={"stage": request.stageId}
         )
-        await db.transactions.insert_one(transaction.dict())
         
-        return {"success": True, "message": "Flash applied successfully"}
+        if prepared:
+            # Programming session and a checked seed/key before any block is sent
+            if not g01_manager:
+                raise HTTPException(status_code=400, detail="Not connected to G01 X3")
+            dme_addr = G01_X3_B48_CONFIG["ecu_addresses"]["DME"]
+            unlocked = await g01_manager.unlock_ecu(dme_addr, security_level=3, session=0x02)
+            if not unlocked:
+                await log_failure(transaction, "Failed to unlock DME for programming")
+                raise HTTPException(status_code=500, detail="Failed to unlock DME for programming")
+            
+            # Blocks were built by /flash/prepare; only the transfer runs in session
+            result = await transfer_prepared(enet_connection, prepared)
+        else:
+            # Start extended diagnostic session
+            await enet_connection.start_diagnostic_session(0x03)
+            
+            # Security access
+            seed_response = await enet_connection.security_access_seed()
+            # In production, calculate key from seed using manufacturer algorithm
+            key = b'\\x00\\x00\\x00\\x00'  # Mock key
+            await enet_connection.security_access_key(key)
+            
+            # Mock flash process (in production, write actual flash file)
+            await asyncio.sleep(5)  # Simulate flashing
+            result = None
+        
+        # Log transaction
+        transaction.details["result"] = result
+        await log_transaction(transaction)
+        
+        return {"success": True, "message": "Flash applied successfully", "result": result}
     
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Flash error: {e}")
+        if transaction:
+            await log_failure(transaction, str(e))
         raise HTTPException(status_code=500, detail=str(e))
 
 # History
 @api_router.get("/history/transactions")
-async def get_transactions(vin: Optional[str] = None):
+async def get_transactions(request: Request, vin: Optional[str] = None):
     try:
         query = {"vin": vin} if vin else {}
-        transactions = await db.transactions.find(query).sort("timestamp", -1).limit(100).to_list(100)
-        return {"success": True, "transactions": transactions}
+        transactions = await db.transactions.find(query, {"_id": 0}).sort("timestamp", -1).limit(100).to_list(100)
+        return fast_response(request, {"success": True, "transactions": transactions})
     except Exception as e:
         logger.error(f"Get transactions error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@api_router.get("/history/stats")
+async def get_history_stats(vin: Optional[str] = None, day: Optional[str] = None):
+    """Precomputed operation counts and failure rates (per VIN and/or day, YYYY-MM-DD)"""
+    try:
+        stats = await get_rollup(db, vin=vin, day=day)
+        return {"success": True, "stats": stats}
+    except Exception as e:
+        logger.error(f"Get history stats error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@api_router.post("/history/stats/backfill")
+async def backfill_history_stats():
+    """Rebuild history rollups from existing transactions"""
+    try:
+        written = await backfill_rollups(db)
+        return {"success": True, "rollups": written}
+    except Exception as e:
+        logger.error(f"History backfill error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+# Diagnostics
+@api_router.get("/diagnostics/timing")
+async def get_response_timing():
+    """Learned per-ECU response times and current P2 timeouts"""
+    return {"success": True, "ecus": RESPONSE_TIMES.summary()}
+
+@api_router.get("/diagnostics/congestion")
+async def get_congestion():
+    """AIMD request windows, round trips and busy NRC counts per gateway and ECU"""
+    return {"success": True, "gateways": congestion_stats()}
+
+@api_router.get("/diagnostics/scheduler")
+async def get_request_scheduler():
+    """Per-class queue waits, served and expired counts of the vehicle connection's scheduler"""
+    return {"success": True, "classes": scheduler_status(enet_connection) if enet_connection else None}
+
+@api_router.get("/diagnostics/tls")
+async def get_tls_sessions():
+    """DoIP-over-TLS gateways with a resumable session and full vs resumed handshake times"""
+    return {"success": True, "tls": TLS_SESSIONS.stats()}
+
+# Security Keys
+@api_router.get("/security/keys")
+async def get_security_key_index():
+    """Security key index status (key counts per file, cache state)"""
+    try:
+        index = get_key_index(G01_X3_B48_CONFIG["security_path"])
+        return {"success": True, "index": index.summary()}
+    except Exception as e:
+        logger.error(f"Security key index error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@api_router.get("/security/keys/{bl_id}")
+async def get_security_keys(bl_id: str):
+    """Key file entries for a bootloader (metadata only)"""
+    try:
+        index = get_key_index(G01_X3_B48_CONFIG["security_path"])
+        records = index.resolve_all(bl_id)
+        if not records:
+            raise HTTPException(status_code=404, detail=f"No keys for bootloader {bl_id}")
+        return {"success": True, "bl_id": bl_id, "keys": {kind: r.to_dict() for kind, r in records.items()}}
+    except HTTPException:
+        raise
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Security key lookup error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+# Traffic Capture
+@api_router.get("/capture/status")
+async def get_capture_status():
+    """Traffic capture ring buffer status"""
+    return {"success": True, "capture": CAPTURE.status()}
+
+@api_router.get("/capture/export")
+async def export_capture(format: str = "pcapng"):
+    """Export captured DoIP/ENET frames as pcapng (Wireshark) or JSON Lines"""
+    try:
+        timestamp = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
+        if format == "pcapng":
+            content, media_type, extension = CAPTURE.export_pcapng(), "application/x-pcapng", "pcapng"
+        elif format == "jsonl":
+            content, media_type, extension = CAPTURE.export_jsonl(), "application/x-ndjson", "jsonl"
+        else:
+            raise HTTPException(status_code=400, detail=f"Unknown capture format: {format}")
+        
+        return Response(
+            content=content,
+            media_type=media_type,
+            headers={"Content-Disposition": f'attachment; filename="capture_{timestamp}.{extension}"'}
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Capture export error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@api_router.post("/capture/clear")
+async def clear_capture():
+    """Drop all buffered frames"""
+    CAPTURE.clear()
+    return {"success": True, "capture": CAPTURE.status()}
+
+# Session Record / Replay
+@api_router.post("/session/record/start")
+async def start_session_recording(label: Optional[str] = None):
+    """Start recording UDS request/response pairs with timing"""
+    RECORDER.start(label=label)
+    return {"success": True, "message": "Session recording started"}
+
+@api_router.post("/session/record/stop")
+async def stop_session_recording():
+    """Stop recording and save the session file"""
+    try:
+        session = RECORDER.stop()
+        if session is None:
+            raise HTTPException(status_code=400, detail="No session recording in progress")
+        
+        RECORDINGS_DIR.mkdir(parents=True, exist_ok=True)
+        path = RECORDINGS_DIR / f"session_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}.bmwrec"
+        session.save(path)
+        
+        return {"success": True, "file": path.name, "session": session.summary()}
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Session recording error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@api_router.get("/session/recordings")
+async def list_session_recordings():
+    """List saved session recordings"""
+    try:
+        files = sorted(RECORDINGS_DIR.glob("*.bmwrec")) if RECORDINGS_DIR.exists() else []
+        recordings = [{"file": f.name, **Session.load(f).summary()} for f in files]
+        return {"success": True, "recordings": recordings, "count": len(recordings)}
+    except Exception as e:
+        logger.error(f"List recordings error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
 # Vehicle Management
 @api_router.get("/vehicles/search")
 async def search_cafds(series: str, model: str, year: str):
@@ -621,9 +1336,111 @@ async def search_cafds(series: str, model: str, year: str):
         logger.error(f"Search CAFDs error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+# Profiling
+PROFILER = SamplingProfiler(PROFILES_DIR)
+SLOW_REQUESTS = SlowRequestProfiler(PROFILES_DIR, threshold=SLOW_REQUEST_SECONDS, routes=SLOW_REQUEST_ROUTES)
+ALLOCATIONS = AllocationTracer()
+
+def _profile_file(profile) -> Response:
+    return Response(
+        content=profile.collapsed(),
+        media_type="text/plain",
+        headers={"Content-Disposition": f'attachment; filename="{profile.file or "profile" + PROFILE_SUFFIX}"'}
+    )
+
+@api_router.post("/admin/profile/start")
+async def start_profile(seconds: float = 10.0, interval_ms: float = 5.0, idle: bool = False,
+                        label: str = "profile"):
+    """Sample all thread stacks for `seconds` (stops early with /admin/profile/stop)"""
+    try:
+        PROFILER.start(seconds, interval=interval_ms / 1000, include_idle=idle, label=label)
+        return {"success": True, "profiler": PROFILER.status()}
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+@api_router.post("/admin/profile/stop")
+async def stop_profile():
+    """Stop the running profile; returns it (or the last one) as a collapsed-stack file"""
+    profile = await asyncio.get_event_loop().run_in_executor(None, PROFILER.stop)
+    if profile is None:
+        raise HTTPException(status_code=404, detail="No profile recorded")
+    return _profile_file(profile)
+
+@api_router.get("/admin/profile/status")
+async def get_profile_status():
+    return {"success": True, "profiler": PROFILER.status(), "slow_requests": SLOW_REQUESTS.status()}
+
+@api_router.get("/admin/profiles")
+async def get_profiles():
+    """Saved profiles, on-demand and slow-request ones, newest first"""
+    profiles = list_profiles(PROFILES_DIR)
+    return {"success": True, "profiles": profiles, "count": len(profiles)}
+
+@api_router.get("/admin/profiles/{name}")
+async def download_profile(name: str):
+    path = PROFILES_DIR / name
+    if "/" in name or not name.endswith(PROFILE_SUFFIX) or not path.is_file():
+        raise HTTPException(status_code=404, detail=f"No profile {name}")
+    return Response(
+        content=path.read_bytes(),
+        media_type="text/plain",
+        headers={"Content-Disposition": f'attachment; filename="{name}"'}
+    )
+
+@api_router.post("/admin/tracemalloc/start")
+async def start_tracemalloc(frames: int = 25):
+    ALLOCATIONS.start(frames)
+    return {"success": True, "tracemalloc": ALLOCATIONS.status()}
+
+@api_router.post("/admin/tracemalloc/stop")
+async def stop_tracemalloc():
+    ALLOCATIONS.stop()
+    return {"success": True, "tracemalloc": ALLOCATIONS.status()}
+
+@api_router.get("/admin/tracemalloc")
+async def get_tracemalloc_status():
+    return {"success": True, "tracemalloc": ALLOCATIONS.status()}
+
+@api_router.post("/admin/tracemalloc/snapshot")
+async def take_tracemalloc_snapshot(label: Optional[str] = None):
+    try:
+        snapshot = await asyncio.get_event_loop().run_in_executor(None, ALLOCATIONS.snapshot, label)
+        return {"success": True, "snapshot": snapshot}
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+@api_router.get("/admin/tracemalloc/diff")
+async def diff_tracemalloc(base: int, target: Optional[int] = None, group_by: str = "lineno", limit: int = 25):
+    """Allocation growth from snapshot `base` to `target` (default: a new snapshot now)"""
+    try:
+        diff = await asyncio.get_event_loop().run_in_executor(
+            None, ALLOCATIONS.diff, base, target, group_by, limit
+        )
+        return {"success": True, "diff": diff}
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=str(e.args[0]))
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+# Metrics
+@app.get("/metrics")
+async def metrics():
+    """Prometheus scrape endpoint"""
+    return Response(content=render_metrics(), media_type=PROMETHEUS_CONTENT_TYPE)
+
 # Include the router in the main app
 app.include_router(api_router)
 
+# Catalog reads only change with psdz_data: serve them precompressed,
+# invalidated by the catalog generation (kept current by refresh_catalog_loop)
+app.add_middleware(
+    CachedResponseMiddleware,
+    prefixes=["/api/cafd/", "/api/psdz/catalog$"],
+    generation=lambda: psdz_catalog.generation
+)
+
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
@@ -632,11 +1449,52 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+app.add_middleware(MetricsMiddleware)
+
+app.add_middleware(SlowRequestMiddleware, profiler=SLOW_REQUESTS)
+
+catalog_refresher: Optional[asyncio.Task] = None
+
+async def refresh_catalog_loop():
+    """Keep the catalog generation current off the event loop (rate-limited by the catalog)"""
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(MAP_CHECK_INTERVAL)
+        try:
+            await loop.run_in_executor(None, psdz_catalog.current_generation)
+        except Exception as e:
+            logger.error(f"PSdZ catalog refresh failed: {e}")
+
+@app.on_event("startup")
+async def start_catalog_refresh():
+    global catalog_refresher
+    await asyncio.get_running_loop().run_in_executor(None, psdz_catalog.refresh)
+    catalog_refresher = asyncio.create_task(refresh_catalog_loop())
+
+@app.on_event("startup")
+async def attach_connection_owner():
+    """Adopt the owner's vehicle connection, if one is already up"""
+    global enet_connection, g01_manager
+    if not OWNER_SOCKET:
+        return
+    try:
+        enet_connection = await RemoteConnection.attach(OWNER_SOCKET)
+        g01_manager = G01ECUManager(enet_connection, catalog=psdz_catalog)
+    except OSError as e:
+        logger.error(f"Connection owner not reachable at {OWNER_SOCKET}: {e}")
+
 @app.on_event("shutdown")
 async def shutdown():
     global enet_connection
-    if enet_connection:
+    if catalog_refresher:
+        catalog_refresher.cancel()
+    await LIVE_STREAMS.stop_all()
+    await CAMPAIGNS.cancel_all()
+    if isinstance(enet_connection, RemoteConnection):
+        await enet_connection.close()  # The vehicle connection belongs to the owner
+    elif enet_connection:
         enet_connection.disconnect()
+    FLASH_PREPARER.shutdown()
     client.close()
 
 if __name__ == "__main__":
@@ -0,0 +1,333 @@
+"""
+Diagnostic Session Record / Replay
+Record live UDS request/response pairs with timing, replay them as a local fake gateway
+"""
+
+import asyncio
+import gzip
+import json
+import struct
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import List, Optional
+import logging
+
+logger = logging.getLogger(__name__)
+
+SESSION_MAGIC = b"BMWSESS1"
+
+# Record header: transport, ECU (0xFFFF = not addressed), request offset,
+# round-trip time, request length, response length (0xFFFFFFFF = no response)
+RECORD_HEADER = struct.Struct('<BHddHI')
+NO_ECU = 0xFFFF
+NO_RESPONSE = 0xFFFFFFFF
+
+TRANSPORT_CODES = {"doip": 0, "enet": 1}
+TRANSPORT_BY_CODE = {code: name for name, code in TRANSPORT_CODES.items()}
+
+# Logical address the replay gateway reports in routing activation responses
+DOIP_GATEWAY_ADDRESS = 0x0010
+
+# ============================================================================
+# SESSION MODEL
+# ============================================================================
+
+@dataclass
+class Exchange:
+    """One UDS request and its response as seen by the tester"""
+    transport: str
+    ecu: Optional[int]
+    offset: float        # Seconds since recording start when the request was sent
+    rtt: float           # Round-trip time in seconds
+    request: bytes
+    response: Optional[bytes]
+
+@dataclass
+class Session:
+    """A recorded diagnostic session"""
+    exchanges: List[Exchange] = field(default_factory=list)
+    metadata: dict = field(default_factory=dict)
+
+    @property
+    def duration(self) -> float:
+        if not self.exchanges:
+            return 0.0
+        last = self.exchanges[-1]
+        return last.offset + last.rtt
+
+    def summary(self) -> dict:
+        return {
+            **self.metadata,
+            "exchanges": len(self.exchanges),
+            "duration_s": round(self.duration, 3),
+            "no_response": sum(1 for e in self.exchanges if e.response is None),
+        }
+
+    def save(self, path: Path):
+        """Write the session as a gzip-compressed binary file"""
+        header = json.dumps(self.metadata).encode()
+        with gzip.open(path, 'wb') as f:
+            f.write(SESSION_MAGIC + struct.pack('<I', len(header)) + header)
+            for e in self.exchanges:
+                response = e.response if e.response is not None else b""
+                f.write(RECORD_HEADER.pack(
+                    TRANSPORT_CODES[e.transport],
+                    NO_ECU if e.ecu is None else e.ecu,
+                    e.offset,
+                    e.rtt,
+                    len(e.request),
+                    NO_RESPONSE if e.response is None else len(response),
+                ))
+                f.write(e.request)
+                f.write(response)
+
+    @classmethod
+    def load(cls, path: Path) -> "Session":
+        with gzip.open(path, 'rb') as f:
+            data = f.read()
+
+        if data[:len(SESSION_MAGIC)] != SESSION_MAGIC:
+            raise ValueError(f"Not a session recording: {path}")
+
+        offset = len(SESSION_MAGIC)
+        header_len = struct.unpack_from('<I', data, offset)[0]
+        offset += 4
+        session = cls(metadata=json.loads(data[offset:offset + header_len]))
+        offset += header_len
+
+        while offset < len(data):
+            transport, ecu, start, rtt, req_len, resp_len = RECORD_HEADER.unpack_from(data, offset)
+            offset += RECORD_HEADER.size
+            request = data[offset:offset + req_len]
+            offset += req_len
+            response = None
+            if resp_len != NO_RESPONSE:
+                response = data[offset:offset + resp_len]
+                offset += resp_len
+
+            session.exchanges.append(Exchange(
+                TRANSPORT_BY_CODE[transport], None if ecu == NO_ECU else ecu, start, rtt, request, response
+            ))
+
+        return session
+
+# ============================================================================
+# RECORDER
+# ============================================================================
+
+class SessionRecorder:
+    """
+    Collects exchanges from the transports while a recording is active
+
+    Transports call `record()` for every round trip; it is a no-op unless
+    `start()` has been called.
+    """
+
+    def __init__(self):
+        self.active = False
+        self.session: Optional[Session] = None
+        self._start = 0.0
+
+    def start(self, **metadata):
+        self.session = Session(metadata={"recorded_at": time.time(), **metadata})
+        self._start = time.perf_counter()
+        self.active = True
+        logger.info("Session recording started")
+
+    def stop(self) -> Optional[Session]:
+        self.active = False
+        session, self.session = self.session, None
+        if session:
+            logger.info(f"Session recording stopped: {len(session.exchanges)} exchanges")
+        return session
+
+    def record(self, transport: str, ecu: Optional[int], request: bytes,
+               response: Optional[bytes], started: float, elapsed: float):
+        """
+        Args:
+            started: perf_counter() value when the request was sent
+            elapsed: Round-trip time in seconds
+        """
+        if not self.active:
+            return
+        self.session.exchanges.append(Exchange(
+            transport, ecu, started - self._start, elapsed, bytes(request),
+            None if response is None else bytes(response),
+        ))
+
+# Process-wide recorder shared by all transports
+RECORDER = SessionRecorder()
+
+# ============================================================================
+# REPLAY GATEWAY
+# ============================================================================
+
+@dataclass
+class Divergence:
+    """A request that did not match the recorded sequence"""
+    index: int
+    expected: Optional[str]
+    actual: str
+
+class ReplayGateway:
+    """
+    Local fake gateway answering from a recorded session
+
+    Speaks DoIP framing (routing activation + diagnostic messages) or the raw
+    ENET framing used by ENETConnection, depending on the session transport.
+    Requests are matched in recorded order; a mismatching request is flagged
+    as a divergence and the gateway resynchronises on the next recorded
+    occurrence of that request (within `lookahead`) or answers with a
+    generalReject NRC.
+
+    Args:
+        session: Recorded session to serve
+        speed: 1.0 replays original response latency, 2.0 twice as fast,
+               0 answers immediately
+    """
+
+    def __init__(self, session: Session, speed: float = 1.0, lookahead: int = 16):
+        self.session = session
+        self.speed = speed
+        self.lookahead = lookahead
+        self.position = 0
+        self.divergences: List[Divergence] = []
+        self.transport = session.exchanges[0].transport if session.exchanges else "doip"
+        self.server: Optional[asyncio.AbstractServer] = None
+        self._clients: set = set()
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> int:
+        """Start listening; returns the bound port"""
+        self.server = await asyncio.start_server(self._handle_client, host, port)
+        bound = self.server.sockets[0].getsockname()[1]
+        logger.info(f"Replay gateway ({self.transport}) listening on {host}:{bound}")
+        return bound
+
+    async def stop(self):
+        for writer in list(self._clients):
+            writer.close()
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    @property
+    def finished(self) -> bool:
+        return self.position >= len(self.session.exchanges)
+
+    def report(self) -> dict:
+        return {
+            "replayed": self.position,
+            "total": len(self.session.exchanges),
+            "divergences": [vars(d) for d in self.divergences],
+        }
+
+    def _match(self, ecu: Optional[int], request: bytes) -> Optional[Exchange]:
+        exchanges = self.session.exchanges
+        end = min(len(exchanges), self.position + self.lookahead)
+
+        for index in range(self.position, end):
+            candidate = exchanges[index]
+            if candidate.request == request and (ecu is None or candidate.ecu in (None, ecu)):
+                if index != self.position:
+                    self.divergences.append(Divergence(
+                        self.position, exchanges[self.position].request.hex(), request.hex()
+                    ))
+                self.position = index + 1
+                return candidate
+
+        expected = exchanges[self.position].request.hex() if self.position < len(exchanges) else None
+        self.divergences.append(Divergence(self.position, expected, request.hex()))
+        logger.warning(f"Replay divergence at #{self.position}: expected {expected}, got {request.hex()}")
+        return None
+
+    async def _respond(self, ecu: Optional[int], request: bytes) -> Optional[bytes]:
+        exchange = self._match(ecu, request)
+        if exchange is None:
+            # generalReject for the requested service
+            return bytes([0x7F, request[0] if request else 0x00, 0x10])
+
+        if self.speed > 0:
+            await asyncio.sleep(exchange.rtt / self.speed)
+        return exchange.response
+
+    async def _handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._clients.add(writer)
+        try:
+            if self.transport == "doip":
+                await self._serve_doip(reader, writer)
+            else:
+                await self._serve_enet(reader, writer)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self._clients.discard(writer)
+            writer.close()
+
+    async def _serve_doip(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        while True:
+            header = await reader.readexactly(8)
+            _, _, payload_type, length = struct.unpack('>BBHI', header)
+            payload = await reader.readexactly(length)
+
+            if payload_type == 0x0005:  # Routing Activation Request
+                source = struct.unpack('>H', payload[:2])[0]
+                body = struct.pack('>HHBI', source, DOIP_GATEWAY_ADDRESS, 0x10, 0)
+                writer.write(struct.pack('>BBHI', 0x02, 0xFD, 0x0006, len(body)) + body)
+
+            elif payload_type == 0x8001:  # Diagnostic Message
+                source, target = struct.unpack('>HH', payload[:4])
+                response = await self._respond(target, payload[4:])
+                if response is not None:
+                    body = struct.pack('>HH', target, source) + response
+                    writer.write(struct.pack('>BBHI', 0x02, 0xFD, 0x8001, len(body)) + body)
+
+            await writer.drain()
+
+    async def _serve_enet(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        while True:
+            request = await reader.read(4096)
+            if not request:
+                return
+            response = await self._respond(None, request)
+            if response is not None:
+                writer.write(response)
+                await writer.drain()
+
+# ============================================================================
+# EXPORT
+# ============================================================================
+
+__all__ = [
+    'Exchange',
+    'Session',
+    'SessionRecorder',
+    'RECORDER',
+    'ReplayGateway',
+]
+
+if __name__ == "__main__":
+    # python session_replay.py <recording> [port] [speed]
+    import sys
+
+    logging.basicConfig(level=logging.INFO)
+
+    async def serve(path: str, port: int, speed: float):
+        session = Session.load(Path(path))
+        print(json.dumps(session.summary(), indent=2))
+        gateway = ReplayGateway(session, speed=speed)
+        await gateway.start("0.0.0.0", port)
+        try:
+            while not gateway.finished:
+                await asyncio.sleep(0.5)
+        finally:
+            await gateway.stop()
+            print(json.dumps(gateway.report(), indent=2))
+
+    default_port = 13400
+    asyncio.run(serve(
+        sys.argv[1],
+        int(sys.argv[2]) if len(sys.argv) > 2 else default_port,
+        float(sys.argv[3]) if len(sys.argv) > 3 else 1.0,
+    ))
@@ -0,0 +1,179 @@
+"""
+UDS Application Timing (ISO 14229-2 P2 / P2*)
+Per-ECU response time learning and adaptive client timeouts
+"""
+
+from collections import deque
+from typing import Deque, Dict, Hashable, Optional, Tuple
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Client-side P2 before anything has been learned for an ECU (seconds)
+P2_DEFAULT = 2.0
+
+# Bounds for the learned P2 timeout: fast enough to give up on a dead ECU,
+# loose enough to tolerate gateway/network jitter on a healthy one
+P2_FLOOR = 0.15
+P2_CEILING = P2_DEFAULT
+
+# Extended timeout after an NRC 0x78 responsePending (P2*server_max + margin)
+P2_STAR = 5.5
+
+# An ECU may keep answering responsePending; stop after this many
+MAX_RESPONSE_PENDING = 20
+
+# Learned timeout = p99 of recent first-response times x margin
+P2_MARGIN = 2.0
+MIN_SAMPLES = 20
+SAMPLE_WINDOW = 256
+
+NRC_RESPONSE_PENDING = 0x78
+NRC_BUSY_REPEAT_REQUEST = 0x21
+
+def is_response_pending(service_id: int, response: Optional[bytes]) -> bool:
+    """True for a `7F <sid> 78` negative response to the given service"""
+    return (
+        response is not None
+        and len(response) >= 3
+        and response[0] == 0x7F
+        and response[1] == service_id
+        and response[2] == NRC_RESPONSE_PENDING
+    )
+
+def is_busy(service_id: int, response: Optional[bytes]) -> bool:
+    """True for a `7F <sid> 21` busyRepeatRequest (ECU or gateway overloaded)"""
+    return (
+        response is not None
+        and len(response) >= 3
+        and response[0] == 0x7F
+        and response[1] == service_id
+        and response[2] == NRC_BUSY_REPEAT_REQUEST
+    )
+
+# Bytes of the request after the service ID that a positive response echoes:
+# the sub-function (suppress bit masked) or the data/routine identifier
+ECHOED_BYTES = {
+    0x10: 1, 0x11: 1, 0x27: 1, 0x28: 1, 0x3E: 1, 0x85: 1,
+    0x22: 2, 0x2E: 2, 0x2F: 2, 0x31: 3,
+}
+SUBFUNCTION_SERVICES = {0x10, 0x11, 0x27, 0x28, 0x3E, 0x85}
+
+def answers_request(request: bytes, response: Optional[bytes]) -> bool:
+    """
+    True if `response` can be the answer to `request`: `7F <sid> ..` or a
+    positive response echoing the request's sub-function / identifier
+
+    Transports without request IDs use this to drop a late answer to an
+    earlier, timed-out request instead of handing it to the next one.
+    """
+    if not request or not response:
+        return False
+    service_id = request[0]
+    if response[0] == 0x7F:
+        return len(response) >= 3 and response[1] == service_id
+    if response[0] != service_id + 0x40:
+        return False
+    echoed = ECHOED_BYTES.get(service_id, 0)
+    expected = bytearray(request[1:1 + echoed])
+    if expected and service_id in SUBFUNCTION_SERVICES:
+        expected[0] &= 0x7F
+    return response[1:1 + len(expected)] == expected
+
+# ============================================================================
+# RESPONSE TIME TRACKER
+# ============================================================================
+
+class ECUResponseTimes:
+    """Sliding window of first-response times for one ECU"""
+
+    def __init__(self, window: int = SAMPLE_WINDOW):
+        self.samples: Deque[float] = deque(maxlen=window)
+        self.timeouts = 0
+        self.pending = 0
+        self._p99: Optional[float] = None
+
+    def add(self, rtt: float):
+        self.samples.append(rtt)
+        self._p99 = None
+
+    def percentile(self, fraction: float) -> Optional[float]:
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+    @property
+    def p99(self) -> Optional[float]:
+        if self._p99 is None:
+            self._p99 = self.percentile(0.99)
+        return self._p99
+
+class ResponseTimeTracker:
+    """
+    Learns per-ECU response time distributions and derives P2 timeouts
+
+    Keys are (gateway, ECU address) so learned timing survives reconnects.
+    Until an ECU has MIN_SAMPLES observations the default P2 applies.
+    """
+
+    def __init__(self):
+        self.ecus: Dict[Tuple[Hashable, Optional[int]], ECUResponseTimes] = {}
+
+    def _get(self, gateway: Hashable, ecu: Optional[int]) -> ECUResponseTimes:
+        key = (gateway, ecu)
+        stats = self.ecus.get(key)
+        if stats is None:
+            stats = self.ecus[key] = ECUResponseTimes()
+        return stats
+
+    def p2_timeout(self, gateway: Hashable, ecu: Optional[int]) -> float:
+        """Timeout for the first response to a request"""
+        stats = self.ecus.get((gateway, ecu))
+        if stats is None or len(stats.samples) < MIN_SAMPLES:
+            return P2_DEFAULT
+        return min(P2_CEILING, max(P2_FLOOR, stats.p99 * P2_MARGIN))
+
+    def observe(self, gateway: Hashable, ecu: Optional[int], rtt: float):
+        """Record the time until the ECU's first response (final or pending)"""
+        self._get(gateway, ecu).add(rtt)
+
+    def observe_pending(self, gateway: Hashable, ecu: Optional[int]):
+        self._get(gateway, ecu).pending += 1
+
+    def observe_timeout(self, gateway: Hashable, ecu: Optional[int]):
+        self._get(gateway, ecu).timeouts += 1
+
+    def summary(self) -> list:
+        rows = []
+        for (gateway, ecu), stats in self.ecus.items():
+            p50 = stats.percentile(0.5)
+            rows.append({
+                "gateway": str(gateway),
+                "ecu": f"0x{ecu:02X}" if ecu is not None else None,
+                "samples": len(stats.samples),
+                "p50_ms": round(p50 * 1000, 2) if p50 is not None else None,
+                "p99_ms": round(stats.p99 * 1000, 2) if stats.p99 is not None else None,
+                "p2_timeout_ms": round(self.p2_timeout(gateway, ecu) * 1000, 1),
+                "response_pending": stats.pending,
+                "timeouts": stats.timeouts,
+            })
+        return rows
+
+# Process-wide tracker shared by all transports
+RESPONSE_TIMES = ResponseTimeTracker()
+
+# ============================================================================
+# EXPORT
+# ============================================================================
+
+__all__ = [
+    'P2_DEFAULT',
+    'P2_STAR',
+    'MAX_RESPONSE_PENDING',
+    'is_response_pending',
+    'is_busy',
+    'answers_request',
+    'ResponseTimeTracker',
+    'RESPONSE_TIMES',
+]
@@ -0,0 +1,67 @@
+import asyncio
+import struct
+
+import pytest
+
+from coding_snapshot import CodingSnapshot, restore_snapshot, take_snapshot
+from g01_x3_b48_module import G01ECUManager
+
+class CodingECU:
+    """Raw UDS ECU holding coding DIDs; multi-DID reads, writes, any seed/key"""
+
+    def __init__(self, values):
+        self.values = dict(values)
+        self.writes = 0
+
+    async def send_uds_request(self, service_id, data=b''):
+        if service_id == 0x22:
+            response = b"\x62"
+            for i in range(0, len(data), 2):
+                did = struct.unpack('>H', data[i:i + 2])[0]
+                if did not in self.values:
+                    return bytes([0x7F, 0x22, 0x31])
+                response += data[i:i + 2] + self.values[did]
+            return response
+        if service_id == 0x2E:
+            self.writes += 1
+            self.values[struct.unpack('>H', data[:2])[0]] = data[2:]
+            return b"\x6E" + data[:2]
+        if service_id == 0x27:
+            return bytes([0x67, data[0]]) + (b"\x01\x02\x03\x04" if data[0] % 2 else b"")
+        return bytes([service_id + 0x40]) + data[:1]
+
+CODING = {0x3000: b"\x01", 0x3001: b"\x00\x10", 0x3002: b"\x05\x05\x05"}
+
+def test_snapshot_document_round_trip():
+    snapshot = CodingSnapshot(vin="WBA0TEST", ecu_address=0x12, blocks=dict(CODING), missing=[0x3003])
+    restored = CodingSnapshot.from_document(snapshot.to_document())
+    assert restored.blocks == CODING
+    assert restored.missing == [0x3003]
+    assert restored.digest == snapshot.digest
+
+def test_corrupt_snapshot_document_is_refused():
+    doc = CodingSnapshot(vin="WBA0TEST", ecu_address=0x12, blocks=dict(CODING)).to_document()
+    doc["sha256"] = "0" * 64
+    with pytest.raises(ValueError):
+        CodingSnapshot.from_document(doc)
+
+def test_take_and_restore_writes_back_only_what_changed():
+    async def scenario():
+        ecu = CodingECU(CODING)
+        manager = G01ECUManager(ecu)
+        snapshot, _ = await take_snapshot(manager, "WBA0TEST", 0x12, [*CODING, 0x3003])
+
+        ecu.values[0x3000] = b"\x02"          # Recoded since the snapshot
+        ecu.values[0x3001] = b"\x00"          # Now a different length
+        restored = await restore_snapshot(manager, snapshot)
+        writes = ecu.writes
+
+        again = await restore_snapshot(manager, snapshot)
+        return snapshot, ecu, restored, writes, again
+
+    snapshot, ecu, restored, writes, again = asyncio.run(scenario())
+    assert snapshot.missing == [0x3003]
+    assert ecu.values == CODING
+    assert sorted(restored["written"]) == ["0x3000", "0x3001"]
+    assert writes == 2 and not restored["verify_failed"]
+    assert again["success"] and ecu.writes == writes
@@ -0,0 +1,35 @@
+from congestion import DECREASE, PROBE_RATE, AIMDWindow
+
+def grow(window, responses, rtt=0.001):
+    for _ in range(responses):
+        window.observe(rtt)
+
+def test_busy_halves_the_window_and_sets_a_ceiling_below_it():
+    window = AIMDWindow("ecu", initial=8, latency_signal=False)
+    window.observe(0.001, busy=True)
+    assert window.window == 8 * DECREASE
+    assert window.ceiling == 7
+
+def test_growth_slows_to_probing_at_the_ceiling():
+    window = AIMDWindow("ecu", initial=8, latency_signal=False)
+    window.observe(0.001, busy=True)
+    grow(window, 200)
+    # Below the ceiling growth is additive; past it only PROBE_RATE of that
+    assert 7 <= window.window < 7 + 200 * PROBE_RATE / 7
+    assert window.ceiling >= 7
+
+def test_one_decrease_per_round_trip():
+    window = AIMDWindow("ecu", initial=16, latency_signal=False)
+    window.observe(10.0)        # Long round trip: the next busy answers fall within it
+    for _ in range(5):
+        window.observe(0.001, busy=True)
+    assert window.decreases == 1
+    assert window.busy == 5
+
+def test_queueing_delay_counts_as_congestion():
+    window = AIMDWindow("ecu", initial=16)
+    grow(window, 20, rtt=0.002)
+    before = window.window
+    window.observe(0.05)        # Far over LATENCY_TOLERANCE x the baseline
+    assert window.slow == 1
+    assert window.window == before * DECREASE
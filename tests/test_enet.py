@@ -0,0 +1,89 @@
+import asyncio
+import socket
+
+import pytest
+
+import enet
+from enet import ENETConnection
+
+class LateECU:
+    """Raw UDS over TCP; answers each request after its own delay"""
+
+    def __init__(self, delays):
+        self.delays = list(delays)
+
+    async def serve(self, reader, writer):
+        while True:
+            message = await reader.read(4096)
+            if not message:
+                break
+            delay = self.delays.pop(0) if self.delays else 0.0
+            asyncio.get_running_loop().call_later(delay, self._answer, writer, message)
+
+    @staticmethod
+    def _answer(writer, message):
+        if not writer.is_closing():
+            writer.write(bytes([message[0] + 0x40]) + message[1:3] + b"\x01")
+
+async def exchange_after_timeout(delays, pause):
+    server = await asyncio.start_server(LateECU(delays).serve, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    connection = ENETConnection("127.0.0.1", port, capture=None, recorder=None)
+    assert await connection.connect()
+    try:
+        with pytest.raises(socket.timeout):
+            await connection.send_uds_request(0x22, b"\xF1\x90")
+        await asyncio.sleep(pause)
+        second = await connection.send_uds_request(0x22, b"\xF1\x01")
+        third = await connection.send_uds_request(0x2E, b"\x60\x00\x01")
+        return second, third, connection.stale_responses
+    finally:
+        connection.disconnect()
+        await asyncio.sleep(0.01)   # Let the fake ECU see the close
+        server.close()
+        await server.wait_closed()
+
+@pytest.fixture
+def short_p2(monkeypatch):
+    monkeypatch.setattr(enet.RESPONSE_TIMES, "p2_timeout", lambda gateway, ecu: 0.1)
+
+@pytest.mark.parametrize("delays, pause", [
+    ([0.15], 0.1),          # Late answer already waiting when the next request is sent
+    ([0.15, 0.08], 0.0),    # Late answer arrives while the next request waits for its own
+])
+def test_late_answer_is_not_handed_to_the_next_request(short_p2, delays, pause):
+    second, third, stale = asyncio.run(exchange_after_timeout(delays, pause))
+    assert second == bytes([0x62, 0xF1, 0x01, 0x01])
+    assert third == bytes([0x6E, 0x60, 0x00, 0x01])
+    assert stale == 1
+
+class PendingECU:
+    """Answers responsePending at once and the real answer after `delay`"""
+
+    def __init__(self, delay):
+        self.delay = delay
+
+    async def serve(self, reader, writer):
+        while True:
+            message = await reader.read(4096)
+            if not message:
+                break
+            writer.write(bytes([0x7F, message[0], 0x78]))
+            await asyncio.sleep(self.delay)
+            writer.write(bytes([message[0] + 0x40]) + message[1:])
+
+def test_response_pending_extends_the_timeout_to_p2_star(short_p2):
+    async def scenario():
+        server = await asyncio.start_server(PendingECU(0.3).serve, "127.0.0.1", 0)
+        connection = ENETConnection("127.0.0.1", server.sockets[0].getsockname()[1], capture=None, recorder=None)
+        assert await connection.connect()
+        try:
+            return await connection.send_uds_request(0x31, b"\x01\xFF\x00")
+        finally:
+            connection.disconnect()
+            await asyncio.sleep(0.01)
+            server.close()
+            await server.wait_closed()
+
+    # 0x78 arrives within P2 (0.1 s); the answer after it, well past P2
+    assert asyncio.run(scenario()) == bytes([0x71, 0x01, 0xFF, 0x00])
@@ -0,0 +1,68 @@
+import asyncio
+
+import pytest
+
+from live_data import Channel, LiveDataStream, push_samples
+
+class CountingManager:
+    def __init__(self):
+        self.reads = 0
+
+    async def read_parameters(self, ecu, dids):
+        self.reads += 1
+        return {did: self.reads.to_bytes(length, "big") for did, length in dids.items()}
+
+async def start_push(receive):
+    stream = LiveDataStream(CountingManager(), [Channel(0x12, 0x5000)], rate_hz=50)
+    stream.start()
+    sent = []
+
+    async def send(message):
+        sent.append(message)
+
+    task = asyncio.create_task(push_samples(stream, send, receive))
+    await asyncio.sleep(0.2)
+    return stream, task, sent
+
+async def idle_client():
+    await asyncio.Event().wait()
+
+def test_push_ends_with_stopped_message_when_stream_stops():
+    async def scenario():
+        stream, task, sent = await start_push(idle_client)
+        await stream.stop()
+        await asyncio.wait_for(task, 1.0)
+        return stream, sent
+
+    stream, sent = asyncio.run(scenario())
+    assert sent[-1]["type"] == "stopped"
+    assert sent[-1]["status"]["running"] is False
+    # Samples polled after the last regular push still reach the client
+    last = stream.ring.timestamps[(stream.ring.sequence - 1) % stream.ring.capacity]
+    assert sent[-2]["type"] == "samples" and sent[-2]["t"][-1] == last
+
+def test_cancelling_the_push_is_not_swallowed():
+    async def scenario():
+        stream, task, _ = await start_push(idle_client)
+        task.cancel()
+        try:
+            with pytest.raises(asyncio.CancelledError):
+                await task
+        finally:
+            await stream.stop()
+
+    asyncio.run(scenario())
+
+def test_client_disconnect_ends_the_push_quietly():
+    async def disconnecting_client():
+        await asyncio.sleep(0.1)
+        raise ConnectionError("client went away")
+
+    async def scenario():
+        stream, task, sent = await start_push(disconnecting_client)
+        await asyncio.wait_for(task, 1.0)
+        await stream.stop()
+        return sent
+
+    sent = asyncio.run(scenario())
+    assert sent and all(m["type"] == "samples" for m in sent)
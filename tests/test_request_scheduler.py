@@ -0,0 +1,102 @@
+import asyncio
+
+import pytest
+
+from request_scheduler import BULK, INTERACTIVE, LIVE, RequestExpired, RequestScheduler, request_priority
+
+async def submit(scheduler, klass, name, order, deadline=None):
+    async def call():
+        order.append(name)
+
+    with request_priority(klass, deadline):
+        await scheduler.run(call)
+
+async def hold(scheduler):
+    """Grant the link to a blocker; set the returned event to release it"""
+    release = asyncio.Event()
+    task = asyncio.create_task(scheduler.run(release.wait))
+    await asyncio.sleep(0)
+    return release, task
+
+async def settle(release, holder, tasks):
+    release.set()
+    await holder
+    return await asyncio.gather(*tasks, return_exceptions=True)
+
+def test_interactive_overtakes_queued_bulk():
+    async def scenario():
+        scheduler, order = RequestScheduler(), []
+        release, holder = await hold(scheduler)
+        tasks = [asyncio.create_task(submit(scheduler, BULK, f"bulk{i}", order)) for i in range(4)]
+        await asyncio.sleep(0)
+        tasks.append(asyncio.create_task(submit(scheduler, INTERACTIVE, "user", order)))
+        await asyncio.sleep(0)
+        await settle(release, holder, tasks)
+        return order
+
+    assert asyncio.run(scenario()) == ["user", "bulk0", "bulk1", "bulk2", "bulk3"]
+
+def test_backlogged_classes_share_by_weight():
+    async def scenario():
+        scheduler, order = RequestScheduler(), []
+        release, holder = await hold(scheduler)
+        tasks = [asyncio.create_task(submit(scheduler, klass, klass, order))
+                 for klass in (BULK, LIVE) for _ in range(20)]
+        await asyncio.sleep(0)
+        await settle(release, holder, tasks)
+        return order[:10]
+
+    # LIVE weighs 4x BULK: four live units per bulk one while both wait
+    assert asyncio.run(scenario()).count(BULK) == 2
+
+def test_queued_request_expires_without_running():
+    async def scenario():
+        scheduler, order = RequestScheduler(), []
+        release, holder = await hold(scheduler)
+        deadline = asyncio.get_running_loop().time() + 0.05
+        task = asyncio.create_task(submit(scheduler, LIVE, "tick", order, deadline))
+        await asyncio.sleep(0.1)
+        results = await settle(release, holder, [task])
+        return order, results, scheduler.status()[LIVE]
+
+    order, results, live = asyncio.run(scenario())
+    assert order == []
+    assert isinstance(results[0], RequestExpired)
+    assert live["expired"] == 1 and live["served"] == 0
+
+def test_past_deadline_is_refused_before_queueing():
+    async def scenario():
+        scheduler = RequestScheduler()
+        deadline = asyncio.get_running_loop().time() - 1
+        with pytest.raises(RequestExpired):
+            await submit(scheduler, LIVE, "tick", [], deadline)
+        return scheduler.status()[LIVE]
+
+    assert asyncio.run(scenario())["expired"] == 1
+
+@pytest.mark.parametrize("leave", ["expire", "cancel"])
+def test_units_leaving_the_queue_cost_their_class_nothing(leave):
+    async def scenario(abandoned: int):
+        scheduler, order = RequestScheduler(), []
+        release, holder = await hold(scheduler)
+
+        deadline = asyncio.get_running_loop().time() + 0.02 if leave == "expire" else None
+        gone = [asyncio.create_task(submit(scheduler, LIVE, "gone", order, deadline)) for _ in range(abandoned)]
+        await asyncio.sleep(0.05)
+        if leave == "cancel":
+            for task in gone:
+                task.cancel()
+        await asyncio.gather(*gone, return_exceptions=True)
+
+        tasks = [asyncio.create_task(submit(scheduler, INTERACTIVE, f"user{i}", order)) for i in range(8)]
+        tasks.append(asyncio.create_task(submit(scheduler, LIVE, "tick", order)))
+        await asyncio.sleep(0)
+        await settle(release, holder, tasks)
+        return order
+
+    async def both():
+        return await scenario(20), await scenario(0)
+
+    with_abandoned, without = asyncio.run(both())
+    assert with_abandoned == without
+    assert without.index("tick") < len(without) - 1
@@ -0,0 +1,20 @@
+import pytest
+
+from response_cache import accepted_codings
+
+@pytest.mark.parametrize("header, expected", [
+    ("", ()),
+    ("gzip", ("gzip",)),
+    ("gzip, br", ("br", "gzip")),
+    ("br;q=0.5, gzip", ("gzip", "br")),
+    ("gzip;q=0, br;q=0", ()),
+    ("gzip, br;q=0", ("gzip",)),
+    ("*", ("br", "gzip")),
+    ("*;q=0", ()),
+    ("*;q=0.1, br;q=0", ("gzip",)),
+    ("identity, deflate", ()),
+    ("GZIP;Q=0.8", ("gzip",)),
+    ("br;q=bogus, gzip", ("gzip",)),
+])
+def test_accepted_codings_honours_q_values(header, expected):
+    assert accepted_codings(header) == expected
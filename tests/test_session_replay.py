@@ -0,0 +1,46 @@
+import asyncio
+
+from enet import ENETConnection
+from session_replay import ReplayGateway, Session, SessionRecorder
+
+def recorded_session():
+    recorder = SessionRecorder()
+    recorder.start(vin="WBA0TEST")
+    recorder.record("enet", None, b"\x22\xF1\x90", b"\x62\xF1\x90WBA0TEST", 0.0, 0.01)
+    recorder.record("enet", None, b"\x10\x03", b"\x50\x03\x00\x32\x01\xF4", 0.02, 0.01)
+    recorder.record("enet", None, b"\x22\x30\x00", None, 0.04, 2.0)
+    return recorder.stop()
+
+def test_recorder_is_idle_until_started():
+    recorder = SessionRecorder()
+    recorder.record("enet", None, b"\x3E\x00", b"\x7E\x00", 0.0, 0.01)
+    assert recorder.stop() is None
+
+def test_session_file_round_trip(tmp_path):
+    session = recorded_session()
+    session.save(tmp_path / "session.bin")
+    loaded = Session.load(tmp_path / "session.bin")
+    assert loaded.exchanges == session.exchanges
+    assert loaded.summary()["vin"] == "WBA0TEST"
+    assert loaded.summary()["no_response"] == 1
+
+def test_replay_answers_an_enet_connection_in_order():
+    async def scenario():
+        gateway = ReplayGateway(recorded_session(), speed=0)
+        port = await gateway.start()
+        connection = ENETConnection("127.0.0.1", port, capture=None, recorder=None)
+        assert await connection.connect()
+        try:
+            vin = await connection.send_uds_request(0x22, b"\xF1\x90")
+            unknown = await connection.send_uds_request(0x3E, b"\x00")   # Not in the recording
+            session = await connection.send_uds_request(0x10, b"\x03")
+        finally:
+            connection.disconnect()
+            await gateway.stop()
+        return vin, unknown, session, gateway.report()
+
+    vin, unknown, session, report = asyncio.run(scenario())
+    assert vin == b"\x62\xF1\x90WBA0TEST"
+    assert unknown == b"\x7F\x3E\x10"
+    assert session == b"\x50\x03\x00\x32\x01\xF4"
+    assert report["replayed"] == 2 and len(report["divergences"]) == 1
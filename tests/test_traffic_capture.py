@@ -0,0 +1,45 @@
+import struct
+
+from traffic_capture import (
+    DIRECTION_RX, DIRECTION_TX, TRANSPORT_DOIP, TRANSPORT_ENET, TrafficCapture
+)
+
+def pcapng_packets(data: bytes):
+    """(captured packet, original length) of each enhanced packet block"""
+    packets, offset = [], 0
+    while offset < len(data):
+        block_type, total = struct.unpack_from('<II', data, offset)
+        if block_type == 0x00000006:
+            captured, original = struct.unpack_from('<II', data, offset + 20)
+            packets.append((data[offset + 28:offset + 28 + captured], original))
+        offset += total
+    return packets
+
+def test_record_truncates_to_the_slot_and_keeps_the_length():
+    capture = TrafficCapture(slots=2, slot_size=4)
+    capture.record(DIRECTION_TX, TRANSPORT_ENET, bytearray(b"\x22\xF1\x90"))
+    capture.record(DIRECTION_RX, TRANSPORT_ENET, memoryview(b"\x62\xF1\x90WBA"))
+    frames = [(length, data) for *_, length, data in capture.frames()]
+    assert frames == [(3, b"\x22\xF1\x90"), (6, b"\x62\xF1\x90W")]
+
+def test_pcapng_exports_every_transport_as_doip_on_13400():
+    capture = TrafficCapture(slots=4, slot_size=8)
+    capture.bind("169.254.0.1", "169.254.250.250", 6801)
+    capture.record(DIRECTION_TX, TRANSPORT_ENET, b"\x22\xF1\x90")
+    capture.record(DIRECTION_RX, TRANSPORT_ENET, b"\x62\xF1\x90WBA1234")
+    doip = struct.pack('>BBHIHH', 0x02, 0xFD, 0x8001, 7, 0x0E00, 0x12) + b"\x22\xF1\x90"
+    capture.record(DIRECTION_TX, TRANSPORT_DOIP, doip[:8], 0x0E00, 0x12)
+
+    exported = capture.export_pcapng()
+    assert b"Gateway 169.254.250.250:6801" in exported
+
+    (request, _), (response, response_length), (_, doip_length) = pcapng_packets(exported)
+    ports = [struct.unpack_from('>HH', packet, 20) for packet, _ in pcapng_packets(exported)]
+    assert ports == [(49152, 13400), (13400, 49152), (49152, 13400)]
+
+    # ENET frames get a DoIP diagnostic message header sized for the whole frame
+    assert request[40:52] == struct.pack('>BBHIHH', 0x02, 0xFD, 0x8001, 7, 0, 0)
+    assert request[52:] == b"\x22\xF1\x90"
+    assert response[40:48] == struct.pack('>BBHI', 0x02, 0xFD, 0x8001, 4 + 10)
+    assert response_length == 40 + 12 + 10
+    assert doip_length == 40 + len(doip[:8])
@@ -0,0 +1,41 @@
+from uds_timing import (
+    MIN_SAMPLES, P2_CEILING, P2_DEFAULT, P2_FLOOR, P2_MARGIN,
+    ResponseTimeTracker, answers_request, is_busy, is_response_pending
+)
+
+def test_answers_request_matches_service_and_echo():
+    read_vin = bytes([0x22, 0xF1, 0x90])
+    assert answers_request(read_vin, bytes([0x62, 0xF1, 0x90]) + b"WBA")
+    assert answers_request(read_vin, bytes([0x7F, 0x22, 0x31]))
+    assert answers_request(read_vin, bytes([0x7F, 0x22, 0x78]))
+    assert not answers_request(read_vin, bytes([0x62, 0xF1, 0x01, 0x00]))  # Other DID
+    assert not answers_request(read_vin, bytes([0x6E, 0xF1, 0x90]))
+    assert not answers_request(read_vin, bytes([0x7F, 0x2E, 0x22]))
+    assert not answers_request(read_vin, None)
+    # Sub-function echo ignores the suppressPosRsp bit
+    assert answers_request(bytes([0x3E, 0x80]), bytes([0x7E, 0x00]))
+    assert not answers_request(bytes([0x27, 0x06]), bytes([0x67, 0x05, 1, 2, 3, 4]))
+
+def test_pending_and_busy_only_match_their_service():
+    assert is_response_pending(0x31, bytes([0x7F, 0x31, 0x78]))
+    assert not is_response_pending(0x22, bytes([0x7F, 0x31, 0x78]))
+    assert is_busy(0x2E, bytes([0x7F, 0x2E, 0x21]))
+    assert not is_busy(0x2E, bytes([0x7F, 0x2E, 0x78]))
+    assert not is_busy(0x2E, None)
+
+def test_p2_is_default_until_enough_samples():
+    tracker = ResponseTimeTracker()
+    for _ in range(MIN_SAMPLES - 1):
+        tracker.observe("gw", 0x12, 0.2)
+    assert tracker.p2_timeout("gw", 0x12) == P2_DEFAULT
+    tracker.observe("gw", 0x12, 0.2)
+    assert tracker.p2_timeout("gw", 0x12) == 0.2 * P2_MARGIN
+
+def test_learned_p2_is_clamped_and_kept_per_ecu():
+    tracker = ResponseTimeTracker()
+    for _ in range(MIN_SAMPLES):
+        tracker.observe("gw", 0x12, 0.001)
+        tracker.observe("gw", 0x40, 5.0)
+    assert tracker.p2_timeout("gw", 0x12) == P2_FLOOR
+    assert tracker.p2_timeout("gw", 0x40) == P2_CEILING
+    assert tracker.p2_timeout("other", 0x12) == P2_DEFAULT